@@ -8,6 +8,7 @@
 #include <stdbool.h>
 #include <stdint.h>
 #include "resources.h"
+#include "config.h"
 
 #define ARRAY_SIZE(array) (sizeof(array) / sizeof(*array))
 
@@ -56,6 +57,144 @@ void print_byte(uint8_t byte)
 	print_nibble(byte & 0xf);
 }
 
+/**
+ * Prints a 32 bit word, in hex, over our UART.
+ */
+void print_word(uint32_t word)
+{
+	for (int shift = 24; shift >= 0; shift -= 8) {
+		print_byte(word >> shift);
+	}
+}
+
+/**
+ * Prints a named telemetry register.
+ */
+void print_register(char *name, uint32_t value)
+{
+	uart_puts(name);
+	uart_puts(": ");
+	print_word(value);
+	uart_puts("\n");
+}
+
+/**
+ * Captures all telemetry registers at once and waits until they are readable.
+ */
+void telemetry_snapshot(void)
+{
+	telemetry_snapshot_write(1);
+	while(telemetry_busy_read());
+}
+
+/**
+ * Prints the health of the audio paths: sync status, feedback values,
+ * FIFO watermarks since the last report and the error counters.
+ */
+void print_telemetry(void)
+{
+	telemetry_snapshot();
+
+	print_register("adat sync", telemetry_adat_sync_read());
+	print_register("usb1 feedback", telemetry_usb1_feedback_read());
+	print_register("usb2 feedback", telemetry_usb2_feedback_read());
+
+	print_register("usb1 output fifo", telemetry_usb1_to_output_fifo_read());
+	print_register("usb1 output fifo min", telemetry_usb1_to_output_fifo_min_read());
+	print_register("usb1 output fifo max", telemetry_usb1_to_output_fifo_max_read());
+	print_register("usb2 to usb1 fifo min", telemetry_usb2_to_usb1_fifo_min_read());
+	print_register("usb2 to usb1 fifo max", telemetry_usb2_to_usb1_fifo_max_read());
+	print_register("input fifo min", telemetry_input_to_usb_fifo_min_read());
+	print_register("input fifo max", telemetry_input_to_usb_fifo_max_read());
+
+	print_register("usb1 output fifo stalls", telemetry_usb1_to_output_fifo_stall_read());
+	print_register("input fifo overflows", telemetry_input_to_usb_fifo_overflow_read());
+	print_register("adat1 underflows", telemetry_adat1_underflow_read());
+	print_register("adat2 underflows", telemetry_adat2_underflow_read());
+	print_register("adat3 underflows", telemetry_adat3_underflow_read());
+	print_register("adat4 underflows", telemetry_adat4_underflow_read());
+	print_register("midi dropped usb1", telemetry_midi_dropped_usb1_read());
+	print_register("midi dropped usb2", telemetry_midi_dropped_usb2_read());
+}
+
+#if USE_CONTROL_MAILBOX
+
+//
+// Control requests, handed over by the gateware through the mailbox.
+//
+
+/**
+ * Vendor requests handled by the firmware, numbered from
+ * VendorRequests.FIRMWARE_REQUESTS in requesthandlers.py on.
+ */
+enum firmware_request {
+	// returns the build date and time of the firmware
+	FIRMWARE_BUILD_TIME = 0x80,
+	// returns the ADAT sync status, both feedback values and the sum of the ADAT underflows
+	READ_HEALTH         = 0x81,
+};
+
+static const char build_time[] = __DATE__ " " __TIME__;
+
+/**
+ * Sends the response to the pending request, cut to the length the host asked for.
+ */
+void respond(const uint8_t *data, uint32_t length, uint32_t max_length)
+{
+	if (length > max_length) {
+		length = max_length;
+	}
+
+	mailbox_address_write(0);
+	for (uint32_t i = 0; i < length; ++i) {
+		mailbox_response_data_write(data[i]);
+	}
+	mailbox_respond_write(length);
+}
+
+/**
+ * Lets the host know the pending request is not supported.
+ */
+void stall(void)
+{
+	mailbox_respond_write(0x80);
+}
+
+/**
+ * Handles the pending control request, if there is one.
+ */
+void handle_control_request(void)
+{
+	if (!mailbox_pending_read()) {
+		return;
+	}
+
+	uint32_t setup_low    = mailbox_setup_low_read();
+	uint32_t setup_high   = mailbox_setup_high_read();
+	uint8_t  request_type = setup_low & 0xff;
+	uint8_t  request      = (setup_low >> 8) & 0xff;
+	uint32_t length       = setup_high >> 16;
+	bool     vendor       = ((request_type >> 5) & 0x3) == 2;
+
+	if (vendor && request == FIRMWARE_BUILD_TIME) {
+		respond((const uint8_t *)build_time, sizeof(build_time) - 1, length);
+	} else if (vendor && request == READ_HEALTH) {
+		telemetry_snapshot();
+		uint32_t health[] = {
+			telemetry_adat_sync_read(),
+			telemetry_usb1_feedback_read(),
+			telemetry_usb2_feedback_read(),
+			telemetry_adat1_underflow_read() + telemetry_adat2_underflow_read() +
+			telemetry_adat3_underflow_read() + telemetry_adat4_underflow_read(),
+		};
+		respond((const uint8_t *)health, sizeof(health), length);
+	} else {
+		stall();
+	}
+}
+
+#endif
+
 //
 // Core application.
 //
@@ -64,8 +203,15 @@ int main(void)
 {
 	uart_puts("SoC started! (built: " __TIME__ ")\n");
 
+	uint32_t loops = 0;
 	while (1) {
-		for(int i=0; i<(1<<23); i++) ;
-		uart_puts("Ping...\r\n");
+#if USE_CONTROL_MAILBOX
+		handle_control_request();
+#endif
+		if (++loops == (1 << 23)) {
+			loops = 0;
+			print_telemetry();
+			uart_puts("\n");
+		}
 	}
 }
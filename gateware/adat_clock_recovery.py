@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+from amaranth import *
+from amaranth.build import Platform
+
+from amlib.test import GatewareTestCase, sync_test_case
+
+class ADATClockRecovery(Elaboratable):
+    """ digital PLL which locks a numerically controlled oscillator to the
+        bit clock strobes of an ADAT receiver (recovered_clock_out)
+
+        The NCO runs in the fast domain. Its MSB is the DAC bit clock (fs * 64) and
+        the bit two places below it is the ADAT clock (fs * 256), so both are coherent.
+        The phase detector counts reference strobes up and NCO ADAT clock edges down.
+        Every update_interval cycles a PI term of that phase error adjusts the NCO
+        frequency word around its nominal value. When the reference goes away,
+        the NCO keeps running at the last frequency.
+        The clock edges snap to the fast clock, so they have up to one fast clock
+        period of jitter, see wire_up_audio_clocks() in car.py.
+    """
+    NCO_BITS         = 32
+    PHASE_ERROR_BITS = 16
+
+    def __init__(self, clk_freq: float, *, adat_clock_freq: float=12.288e6,
+                 update_interval: int=1024, kp_shift: int=8, ki_shift: int=5, max_correction: int=1 << 17,
+                 lock_threshold: int=4, lock_updates: int=256, unlock_threshold: int=64):
+        self._nominal          = round(adat_clock_freq / 4 / clk_freq * 2**self.NCO_BITS)
+        self._update_interval  = update_interval
+        self._kp_shift         = kp_shift
+        self._ki_shift         = ki_shift
+        self._max_correction   = max_correction
+        self._integral_limit   = max_correction << ki_shift
+        self._lock_threshold   = lock_threshold
+        self._lock_updates     = lock_updates
+        self._unlock_threshold = unlock_threshold
+
+        # I/O
+        self.reference_strobe_in = Signal()
+        self.reference_valid_in  = Signal()
+
+        self.adat_clock_out      = Signal()
+        self.dac_clock_out       = Signal()
+        self.locked_out          = Signal()
+
+        # debug signals
+        self.frequency_word_out  = Signal(self.NCO_BITS, reset=self._nominal)
+        self.phase_error_out     = Signal(signed(self.PHASE_ERROR_BITS))
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        phase          = Signal(self.NCO_BITS)
+        frequency_word = self.frequency_word_out
+        m.d.sync += phase.eq(phase + frequency_word)
+
+        adat_clock      = phase[-3]
+        adat_clock_last = Signal()
+        nco_tick        = Signal()
+        m.d.sync += adat_clock_last.eq(adat_clock)
+
+        m.d.comb += [
+            self.adat_clock_out.eq(adat_clock),
+            self.dac_clock_out.eq(phase[-1]),
+            nco_tick.eq(adat_clock & ~adat_clock_last),
+        ]
+
+        phase_error      = self.phase_error_out
+        max_phase_error  = 2**(self.PHASE_ERROR_BITS - 1) - 1
+        integral         = Signal(signed(Shape.cast(range(-self._integral_limit, self._integral_limit + 1)).width))
+        next_integral    = Signal(signed(integral.width + 1))
+        correction       = Signal(signed(integral.width + 2))
+        abs_phase_error  = Signal(self.PHASE_ERROR_BITS)
+        update_counter   = Signal(range(self._update_interval))
+        lock_counter     = Signal(range(self._lock_updates + 1))
+
+        m.d.comb += [
+            next_integral.eq(integral + phase_error),
+            correction.eq((phase_error << self._kp_shift) + (integral >> self._ki_shift)),
+            abs_phase_error.eq(Mux(phase_error < 0, -phase_error, phase_error)),
+        ]
+
+        with m.If(~self.reference_valid_in):
+            # free run at the last frequency until the reference comes back
+            m.d.sync += [
+                phase_error.eq(0),
+                integral.eq(0),
+                update_counter.eq(0),
+                lock_counter.eq(0),
+                self.locked_out.eq(0),
+            ]
+
+        with m.Else():
+            # phase detector
+            with m.If(self.reference_strobe_in & ~nco_tick & (phase_error < max_phase_error)):
+                m.d.sync += phase_error.eq(phase_error + 1)
+            with m.Elif(nco_tick & ~self.reference_strobe_in & (phase_error > -max_phase_error)):
+                m.d.sync += phase_error.eq(phase_error - 1)
+
+            # loop filter
+            m.d.sync += update_counter.eq(update_counter + 1)
+            with m.If(update_counter == self._update_interval - 1):
+                m.d.sync += update_counter.eq(0)
+
+                with m.If(next_integral > self._integral_limit):
+                    m.d.sync += integral.eq(self._integral_limit)
+                with m.Elif(next_integral < -self._integral_limit):
+                    m.d.sync += integral.eq(-self._integral_limit)
+                with m.Else():
+                    m.d.sync += integral.eq(next_integral)
+
+                with m.If(correction > self._max_correction):
+                    m.d.sync += frequency_word.eq(self._nominal + self._max_correction)
+                with m.Elif(correction < -self._max_correction):
+                    m.d.sync += frequency_word.eq(self._nominal - self._max_correction)
+                with m.Else():
+                    m.d.sync += frequency_word.eq(self._nominal + correction)
+
+                # lock detector
+                with m.If(abs_phase_error <= self._lock_threshold):
+                    with m.If(lock_counter == self._lock_updates):
+                        m.d.sync += self.locked_out.eq(1)
+                    with m.Else():
+                        m.d.sync += lock_counter.eq(lock_counter + 1)
+                with m.Else():
+                    m.d.sync += lock_counter.eq(0)
+
+                with m.If(abs_phase_error > self._unlock_threshold):
+                    m.d.sync += self.locked_out.eq(0)
+
+        return m
+
+
+class AudioClockSelect(Elaboratable):
+    """ switches the clock muxes of the audio clock domains, for example
+        between the local PLL and an external clock, or between sample rates
+
+        The audio clock domains are held in reset for hold_cycles before and after
+        the clock muxes switch, so that a glitch of a mux cannot corrupt the audio logic.
+        select_in are the requested mux selects, select_out drives the muxes.
+    """
+    def __init__(self, width: int=1, hold_cycles: int=1024):
+        self._hold_cycles = hold_cycles
+
+        # I/O
+        self.select_in             = Signal(width)
+        self.select_out            = Signal(width)
+        self.audio_clock_reset_out = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        next_select  = Signal.like(self.select_in)
+        hold_counter = Signal(range(self._hold_cycles + 1))
+
+        with m.FSM(name="audio_clock_select_fsm"):
+            with m.State("RUNNING"):
+                with m.If(self.select_in != self.select_out):
+                    m.d.sync += [
+                        next_select.eq(self.select_in),
+                        hold_counter.eq(0),
+                    ]
+                    m.next = "HOLD_BEFORE_SWITCH"
+
+            with m.State("HOLD_BEFORE_SWITCH"):
+                m.d.comb += self.audio_clock_reset_out.eq(1)
+                m.d.sync += hold_counter.eq(hold_counter + 1)
+                with m.If(hold_counter == self._hold_cycles):
+                    m.d.sync += [
+                        self.select_out.eq(next_select),
+                        hold_counter.eq(0),
+                    ]
+                    m.next = "HOLD_AFTER_SWITCH"
+
+            with m.State("HOLD_AFTER_SWITCH"):
+                m.d.comb += self.audio_clock_reset_out.eq(1)
+                m.d.sync += hold_counter.eq(hold_counter + 1)
+                with m.If(hold_counter == self._hold_cycles):
+                    m.next = "RUNNING"
+
+        return m
+
+
+class ADATClockRecoveryTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = ADATClockRecovery
+    # 8 fast clock cycles per ADAT bit, with gains fast enough for simulation
+    FRAGMENT_ARGUMENTS  = dict(clk_freq=8 * 12.288e6, update_interval=16, kp_shift=10, ki_shift=2,
+                               lock_updates=16)
+
+    def send_strobes(self, no_strobes, period=8, slow_every=None):
+        for i in range(no_strobes):
+            yield self.dut.reference_strobe_in.eq(1)
+            yield
+            yield self.dut.reference_strobe_in.eq(0)
+            cycles = period + (1 if slow_every and (i % slow_every == 0) else 0)
+            yield from self.advance_cycles(cycles - 1)
+
+    @sync_test_case
+    def test_lock_to_nominal(self):
+        dut = self.dut
+        nominal = (yield dut.frequency_word_out)
+        self.assertEqual(nominal, 2**32 // 32)
+
+        yield dut.reference_valid_in.eq(1)
+        yield from self.send_strobes(400)
+        self.assertEqual((yield dut.locked_out), 1)
+
+        # losing the reference unlocks, but keeps the frequency
+        frequency = (yield dut.frequency_word_out)
+        yield dut.reference_valid_in.eq(0)
+        yield from self.advance_cycles(3)
+        self.assertEqual((yield dut.locked_out), 0)
+        self.assertEqual((yield dut.frequency_word_out), frequency)
+
+    @sync_test_case
+    def test_follow_slow_reference(self):
+        dut = self.dut
+        nominal = (yield dut.frequency_word_out)
+
+        yield dut.reference_valid_in.eq(1)
+        yield from self.send_strobes(2000, slow_every=16)
+        self.assertLess((yield dut.frequency_word_out), nominal)
+
+
+class AudioClockSelectTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = AudioClockSelect
+    FRAGMENT_ARGUMENTS  = dict(width=2, hold_cycles=8)
+
+    @sync_test_case
+    def test_switch_and_switch_back(self):
+        dut = self.dut
+        yield from self.advance_cycles(4)
+        self.assertEqual((yield dut.audio_clock_reset_out), 0)
+
+        yield dut.select_in.eq(0b10)
+        yield from self.advance_cycles(4)
+        # the domains are in reset before the mux switches...
+        self.assertEqual((yield dut.audio_clock_reset_out), 1)
+        self.assertEqual((yield dut.select_out), 0)
+        yield from self.advance_cycles(8)
+        # ... and stay in reset a while after it
+        self.assertEqual((yield dut.audio_clock_reset_out), 1)
+        self.assertEqual((yield dut.select_out), 0b10)
+        yield from self.advance_cycles(10)
+        self.assertEqual((yield dut.audio_clock_reset_out), 0)
+
+        yield dut.select_in.eq(0)
+        yield from self.advance_cycles(24)
+        self.assertEqual((yield dut.select_out), 0)
+        self.assertEqual((yield dut.audio_clock_reset_out), 0)
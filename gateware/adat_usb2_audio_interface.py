@@ -2,7 +2,9 @@
 #
 # Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
 # SPDX-License-Identifier: CERN-OHL-W-2.0
+import io
 import os
+import sys
 
 from amaranth            import *
 from amaranth.lib.fifo   import AsyncFIFOBuffered, AsyncFIFO, SyncFIFOBuffered, SyncFIFO
@@ -38,14 +40,25 @@ from channel_stream_combiner import ChannelStreamCombiner
 from channel_stream_splitter import ChannelStreamSplitter
 from bundle_multiplexer      import BundleMultiplexer
 from bundle_demultiplexer    import BundleDemultiplexer
+from feedback_controller     import FeedbackController
+from adat_clock_recovery     import ADATClockRecovery, AudioClockSelect
+from drift_compensator       import DriftCompensator
+from sof_timing_monitor      import SOFTimingMonitor
 from stereopair_extractor    import StereoPairExtractor
 from requesthandlers         import UAC2RequestHandlers
 from debug                   import setup_ila, add_debug_led_array
+from din_midi                import DINMIDIIn, DINMIDIOut, DIN_MIDI_CABLE
+from usb_midi                import MIDIEventSerializer, MIDIEventDeserializer, EVENT_BYTES
+from midi_router             import MIDIRouter
+from telemetry               import TelemetryPeripheral, fifo_write_blocked
+from control_mailbox         import ControlMailboxPeripheral
 
 from usb_descriptors import USBDescriptors
+from wav_io          import load_impulse_response
+from build_cache     import BuildCache, file_contents, package_version, write_if_changed
 
-import wave
-import numpy as np
+import usb_descriptors
+import wav_io
 
 class USB2AudioInterface(Elaboratable):
     """ USB Audio Class v2 interface """
@@ -63,11 +76,63 @@ class USB2AudioInterface(Elaboratable):
 
     USE_DEBUG_LED_ARRAY = False
 
+    # stream modules which get registered skid buffers on their ports to close timing,
+    # any of "bundle_demultiplexer", "bundle_multiplexer", "channels_to_usb_stream"
+    PIPELINED_STREAM_MODULES = ()
+
     USE_CONVOLUTION = False
+    # impulse response file per DAC number, DACs without one stay dry.
+    # Every entry adds a convolver with CONVOLUTION_TAPS taps, so only DAC1 has one by default,
+    # add 2: 'IRs/DT990_crossfeed_4800taps.wav' to convolve DAC2 as well
+    CONVOLUTION_IRS = {
+        1: 'IRs/DT990_crossfeed_4800taps.wav',
+    }
+    # 4096 taps - more is failing to synthesize right now. 4800 would be the goal for 100ms.
+    CONVOLUTION_TAPS = 4096
+
+    NO_DACS = 2
+
+    # USB rate feedback PI controller, see feedback_controller.py
+    # the target fill level is a fraction of the FIFO depth
+    FEEDBACK_TARGET_FILL     = 0.5
+    FEEDBACK_KP_SHIFT        = 10
+    FEEDBACK_KI_SHIFT        = 16
+    FEEDBACK_UPDATE_INTERVAL = 8
+
+    # lock the audio clocks to the ADAT input selected by the UAC2 clock selector
+    USE_ADAT_CLOCK_SLAVE = False
+
+    # let the host switch USB1 to 44.1kHz, on the boards whose clock generator supports it.
+    # The local audio clocks then run through a global clock switch, see car.py
+    USE_44_1K = False
+
+    # bridge USB2 OUT to USB1 IN through a buffer which slips whole frames
+    # when the two hosts drift apart, instead of a plain FIFO
+    USE_DRIFT_COMPENSATION = False
+
+    # histograms of the SOF timing of both hosts against the ADAT clock,
+    # readable with the READ_SOF_STATS vendor request, see sof_stats.py
+    USE_SOF_MONITOR = False
+
+    # DIN MIDI in and out on the UART header, as a second MIDI cable of USB1 next to the USB2 MIDI loop.
+    # The rev0 baseboard has no MIDI jacks, the UART pins need an opto-isolated adapter.
+    USE_DIN_MIDI = False
 
     USE_SOC = False
 
+    # hand the USB1 class and vendor requests which the gateware does not handle
+    # to the SoC firmware, see control_mailbox.py, needs USE_SOC
+    USE_CONTROL_MAILBOX = False
+
+    # results of the firmware build, the descriptors and the IRs are cached here
+    # by the hash of their inputs, None disables the cache
+    BUILD_CACHE_DIRECTORY = ".build_cache"
+
+    FIRMWARE_SOURCES = ["firmware/Makefile", "firmware/start.S", "firmware/firmware.c", "firmware/riscv_standalone.ld"]
+
     def __init__(self) -> None:
+        self.build_cache = BuildCache(self.BUILD_CACHE_DIRECTORY)
+
         if self.USE_SOC:
             self.soc = soc = SimpleSoC()
 
@@ -85,14 +150,36 @@ class USB2AudioInterface(Elaboratable):
             timer = TimerPeripheral(24)
             soc.add_peripheral(timer)
 
-            with open("firmware/soc.ld", 'w') as ld:
-                soc.generate_ld_script(file=ld)
-            with open("firmware/resources.h", 'w') as res_header:
-                soc.generate_c_header(file=res_header)
-
-            result = os.system("(cd firmware; make)")
-            assert result == 0, "compilation failed, aborting...."
+            # FIFO levels, counters and status for the firmware, see telemetry_sources()
+            telemetry = TelemetryPeripheral([source[:3] for source in self.telemetry_sources()])
+            soc.add_peripheral(telemetry)
+            self.telemetry = telemetry
+
+            if self.USE_CONTROL_MAILBOX:
+                # the responses are limited to one packet of the control endpoint
+                mailbox = ControlMailboxPeripheral(buffer_size=64)
+                soc.add_peripheral(mailbox)
+                self.control_mailbox = mailbox
+
+            # lets the firmware know which of the optional peripherals are there
+            config_header = f"#define USE_CONTROL_MAILBOX {int(self.USE_CONTROL_MAILBOX)}\n"
+
+            ld         = io.StringIO()
+            res_header = io.StringIO()
+            soc.generate_ld_script(file=ld)
+            soc.generate_c_header(file=res_header)
+            write_if_changed("firmware/soc.ld",      ld.getvalue())
+            write_if_changed("firmware/resources.h", res_header.getvalue())
+            write_if_changed("firmware/config.h",    config_header)
+
+            firmware_inputs = [ld.getvalue(), res_header.getvalue(), config_header] + \
+                              [file_contents(source) for source in self.FIRMWARE_SOURCES]
+            result = self.build_cache.build_files("firmware", firmware_inputs, ["firmware/firmware.bin"],
+                                                  lambda: os.system("(cd firmware; make)") == 0)
+            assert result, "compilation failed, aborting...."
             print("firmware compilation succeeded.")
+        else:
+            assert not self.USE_CONTROL_MAILBOX, "the control mailbox needs the SoC"
 
         super().__init__()
 
@@ -104,10 +191,15 @@ class USB2AudioInterface(Elaboratable):
         usb2_number_of_channels      = self.USB2_NO_CHANNELS
         usb2_number_of_channels_bits = Shape.cast(range(usb2_number_of_channels)).width
         audio_bits                   = 24
+        # nominal sample rate, the convolution IRs are designed for it
         samplerate                   = 48000
         adat_number_of_channels      = usb1_number_of_channels - usb2_number_of_channels
 
-        m.submodules.car = platform.clock_domain_generator()
+        m.submodules.car = car = platform.clock_domain_generator()
+
+        # the sample rate is switched by USB1, USB2 follows it
+        samplerates = [44100, 48000] if self.USE_44_1K and car.SUPPORTS_44_1k else [48000]
+        car.switch_44_1k = len(samplerates) > 1
 
         #
         # SoC
@@ -123,30 +215,38 @@ class USB2AudioInterface(Elaboratable):
         #
         # USB
         #
-        ulpi1 = platform.request("ulpi", 1)
-        ulpi2 = platform.request("ulpi", 2)
-        m.submodules.usb1 = usb1 = USBDevice(bus=ulpi1)
-        m.submodules.usb2 = usb2 = USBDevice(bus=ulpi2)
+        m.submodules.usb1 = usb1 = self.create_usb_device(platform, 1)
+        m.submodules.usb2 = usb2 = self.create_usb_device(platform, 2)
 
         descriptors = USBDescriptors(ila_max_packet_size=self.ILA_MAX_PACKET_SIZE, \
-                                     use_ila=self.USE_ILA)
+                                     use_ila=self.USE_ILA, \
+                                     use_clock_selector=self.USE_ADAT_CLOCK_SLAVE, \
+                                     samplerates=samplerates, \
+                                     use_din_midi=self.USE_DIN_MIDI)
 
         usb1_control_ep = usb1.add_control_endpoint()
-        usb1_descriptors = descriptors.create_usb1_descriptors(usb1_number_of_channels, self.USB1_MAX_PACKET_SIZE)
+        usb1_descriptors = self.build_cache.get_or_compute("descriptors",
+            self.descriptor_cache_inputs(1, usb1_number_of_channels, self.USB1_MAX_PACKET_SIZE, samplerates),
+            lambda: descriptors.create_usb1_descriptors(usb1_number_of_channels, self.USB1_MAX_PACKET_SIZE))
         usb1_control_ep.add_standard_request_handlers(usb1_descriptors, blacklist=[
             lambda setup:   (setup.type    == USBRequestType.STANDARD)
                           & (setup.request == USBStandardRequests.SET_INTERFACE)
         ])
-        usb1_class_request_handler = UAC2RequestHandlers()
+        usb1_class_request_handler = UAC2RequestHandlers(no_dacs=self.NO_DACS, no_channels=self.USB1_NO_CHANNELS,
+                                                         clock_selector=self.USE_ADAT_CLOCK_SLAVE, samplerates=samplerates,
+                                                         sof_stats=self.USE_SOF_MONITOR,
+                                                         mailbox=self.control_mailbox.mailbox if self.USE_CONTROL_MAILBOX else None)
         usb1_control_ep.add_request_handler(usb1_class_request_handler)
 
         usb2_control_ep = usb2.add_control_endpoint()
-        usb2_descriptors = descriptors.create_usb2_descriptors(usb2_number_of_channels, self.USB2_MAX_PACKET_SIZE)
+        usb2_descriptors = self.build_cache.get_or_compute("descriptors",
+            self.descriptor_cache_inputs(2, usb2_number_of_channels, self.USB2_MAX_PACKET_SIZE, samplerates),
+            lambda: descriptors.create_usb2_descriptors(usb2_number_of_channels, self.USB2_MAX_PACKET_SIZE))
         usb2_control_ep.add_standard_request_handlers(usb2_descriptors, blacklist=[
             lambda setup:   (setup.type    == USBRequestType.STANDARD)
                           & (setup.request == USBStandardRequests.SET_INTERFACE)
         ])
-        usb2_class_request_handler = UAC2RequestHandlers()
+        usb2_class_request_handler = UAC2RequestHandlers(samplerates=samplerates, samplerate_follower=True)
         usb2_control_ep.add_request_handler(usb2_class_request_handler)
 
         # audio out ports of the host
@@ -213,7 +313,7 @@ class USB2AudioInterface(Elaboratable):
             self.calculate_usb_input_frame_size(m, "usb2", usb2_ep1_out, usb2_ep2_in, usb2_number_of_channels, self.USB2_MAX_PACKET_SIZE)
 
         usb1_sof_counter, usb1_to_output_fifo_level, usb1_to_output_fifo_depth, \
-        usb2_sof_counter, usb2_to_usb1_fifo_level, usb2_to_usb1_fifo_depth = \
+        usb2_sof_counter, usb2_to_usb1_fifo_level, usb2_to_usb1_fifo_depth, feedback_controllers = \
             self.create_sample_rate_feedback_circuit(m, usb1, usb1_ep1_in, usb2, usb2_ep1_in)
 
         usb1_audio_in_active  = self.detect_active_audio_in (m, "usb1", usb1, usb1_ep2_in)
@@ -235,9 +335,11 @@ class USB2AudioInterface(Elaboratable):
             DomainRenamer("usb")(ChannelStreamSplitter(adat_number_of_channels, usb2_number_of_channels))
 
         m.submodules.channels_to_usb1_stream = channels_to_usb1_stream = \
-            DomainRenamer("usb")(ChannelsToUSBStream(usb1_number_of_channels, max_packet_size=self.USB1_MAX_PACKET_SIZE))
+            DomainRenamer("usb")(ChannelsToUSBStream(usb1_number_of_channels, max_packet_size=self.USB1_MAX_PACKET_SIZE,
+                                                     pipelined="channels_to_usb_stream" in self.PIPELINED_STREAM_MODULES))
         m.submodules.channels_to_usb2_stream = channels_to_usb2_stream = \
-            DomainRenamer("usb")(ChannelsToUSBStream(usb2_number_of_channels, max_packet_size=self.USB2_MAX_PACKET_SIZE))
+            DomainRenamer("usb")(ChannelsToUSBStream(usb2_number_of_channels, max_packet_size=self.USB2_MAX_PACKET_SIZE,
+                                                     pipelined="channels_to_usb_stream" in self.PIPELINED_STREAM_MODULES))
 
         usb1_no_channels      = Signal(range(usb1_number_of_channels * 2), reset=2)
         usb1_no_channels_sync = Signal.like(usb1_no_channels)
@@ -271,11 +373,17 @@ class USB2AudioInterface(Elaboratable):
         m.submodules.usb_to_output_fifo = usb1_to_output_fifo = \
             AsyncFIFO(width=audio_bits + usb1_number_of_channels_bits + 2, depth=usb1_to_output_fifo_depth, w_domain="usb", r_domain="sync")
 
-        m.submodules.usb2_to_usb1_fifo = usb2_to_usb1_fifo = \
-            DomainRenamer("usb")(SyncFIFOBuffered(width=audio_bits + usb2_number_of_channels_bits + 2, depth=usb2_to_usb1_fifo_depth))
+        if self.USE_DRIFT_COMPENSATION:
+            m.submodules.usb2_to_usb1_drift_compensator = usb2_to_usb1_drift_compensator = \
+                DomainRenamer("usb")(DriftCompensator(usb2_number_of_channels, usb2_to_usb1_fifo_depth // usb2_number_of_channels))
+        else:
+            m.submodules.usb2_to_usb1_fifo = usb2_to_usb1_fifo = \
+                DomainRenamer("usb")(SyncFIFOBuffered(width=audio_bits + usb2_number_of_channels_bits + 2, depth=usb2_to_usb1_fifo_depth))
 
-        m.submodules.bundle_demultiplexer = bundle_demultiplexer = BundleDemultiplexer()
-        m.submodules.bundle_multiplexer   = bundle_multiplexer   = DomainRenamer("fast")(BundleMultiplexer())
+        m.submodules.bundle_demultiplexer = bundle_demultiplexer = \
+            BundleDemultiplexer(pipelined="bundle_demultiplexer" in self.PIPELINED_STREAM_MODULES)
+        m.submodules.bundle_multiplexer   = bundle_multiplexer   = \
+            DomainRenamer("fast")(BundleMultiplexer(pipelined="bundle_multiplexer" in self.PIPELINED_STREAM_MODULES))
 
         adat_transmitters = []
         adat_receivers    = []
@@ -398,32 +506,52 @@ class USB2AudioInterface(Elaboratable):
         usb2_first_bit_pos     = usb2_channel_bits_end
         usb2_last_bit_pos      = usb2_first_bit_pos + 1
 
-        usb2_channel_nr        = usb2_to_usb1_fifo.r_data[chnr_start:usb2_channel_bits_end]
-        m.d.comb +=[
+        m.d.comb += [
             usb2_to_channel_stream.usb_stream_in.stream_eq(usb2_ep1_out.stream),
-            *connect_stream_to_fifo(usb2_to_channel_stream.channel_stream_out, usb2_to_usb1_fifo),
+            usb1_channel_stream_combiner.upper_channels_active_in.eq(~usb2.suspended & usb2_audio_out_active),
+        ]
+
+        if self.USE_DRIFT_COMPENSATION:
+            m.d.comb += [
+                usb2_to_usb1_drift_compensator.channel_stream_in.stream_eq(usb2_to_channel_stream.channel_stream_out),
+                usb2_to_usb1_drift_compensator.no_channels_in.eq(usb2_no_channels),
+                usb2_to_usb1_drift_compensator.active_in.eq(~usb2.suspended & usb2_audio_out_active),
 
-            usb2_to_usb1_fifo.w_data[channel_bits_start:usb2_channel_bits_end]
-                .eq(usb2_to_channel_stream.channel_stream_out.channel_nr),
+                # the feedback controller expects the level in FIFO entries
+                usb2_to_usb1_fifo_level
+                    .eq(usb2_to_usb1_drift_compensator.level_out * usb2_number_of_channels),
 
-            usb2_to_usb1_fifo.w_data[usb2_first_bit_pos]
-                .eq(usb2_to_channel_stream.channel_stream_out.first),
+                # connect USB2 OUT channels to USB1 IN
+                usb1_channel_stream_combiner.upper_channel_stream_in.stream_eq(usb2_to_usb1_drift_compensator.channel_stream_out),
+            ]
 
-            usb2_to_usb1_fifo.w_data[usb2_last_bit_pos]
-                .eq(usb2_to_channel_stream.channel_stream_out.last),
+        else:
+            usb2_channel_nr = usb2_to_usb1_fifo.r_data[chnr_start:usb2_channel_bits_end]
+            m.d.comb += [
+                *connect_stream_to_fifo(usb2_to_channel_stream.channel_stream_out, usb2_to_usb1_fifo),
 
-            usb2_to_usb1_fifo_level
-                .eq(usb2_to_usb1_fifo.w_level),
+                usb2_to_usb1_fifo.w_data[channel_bits_start:usb2_channel_bits_end]
+                    .eq(usb2_to_channel_stream.channel_stream_out.channel_nr),
 
-            # connect USB2 OUT channels to USB1 IN
-            usb1_channel_stream_combiner.upper_channels_active_in           .eq(~usb2.suspended & usb2_audio_out_active),
-            usb1_channel_stream_combiner.upper_channel_stream_in.payload    .eq(usb2_to_usb1_fifo.r_data[0:chnr_start]),
-            usb1_channel_stream_combiner.upper_channel_stream_in.channel_nr .eq(usb2_channel_nr),
-            usb1_channel_stream_combiner.upper_channel_stream_in.first      .eq(usb2_to_usb1_fifo.r_data[usb2_first_bit_pos]),
-            usb1_channel_stream_combiner.upper_channel_stream_in.last       .eq(usb2_to_usb1_fifo.r_data[usb2_last_bit_pos]),
-            usb1_channel_stream_combiner.upper_channel_stream_in.valid      .eq(usb2_to_usb1_fifo.r_rdy),
-            usb2_to_usb1_fifo.r_en.eq(usb1_channel_stream_combiner.upper_channel_stream_in.ready),
+                usb2_to_usb1_fifo.w_data[usb2_first_bit_pos]
+                    .eq(usb2_to_channel_stream.channel_stream_out.first),
 
+                usb2_to_usb1_fifo.w_data[usb2_last_bit_pos]
+                    .eq(usb2_to_channel_stream.channel_stream_out.last),
+
+                usb2_to_usb1_fifo_level
+                    .eq(usb2_to_usb1_fifo.w_level),
+
+                # connect USB2 OUT channels to USB1 IN
+                usb1_channel_stream_combiner.upper_channel_stream_in.payload    .eq(usb2_to_usb1_fifo.r_data[0:chnr_start]),
+                usb1_channel_stream_combiner.upper_channel_stream_in.channel_nr .eq(usb2_channel_nr),
+                usb1_channel_stream_combiner.upper_channel_stream_in.first      .eq(usb2_to_usb1_fifo.r_data[usb2_first_bit_pos]),
+                usb1_channel_stream_combiner.upper_channel_stream_in.last       .eq(usb2_to_usb1_fifo.r_data[usb2_last_bit_pos]),
+                usb1_channel_stream_combiner.upper_channel_stream_in.valid      .eq(usb2_to_usb1_fifo.r_rdy),
+                usb2_to_usb1_fifo.r_en.eq(usb1_channel_stream_combiner.upper_channel_stream_in.ready),
+            ]
+
+        m.d.comb += [
             # connect USB2 IN channels to USB1 OUT
             channels_to_usb2_stream.channel_stream_in.stream_eq(usb1_channel_stream_splitter.upper_channel_stream_out),
             channels_to_usb2_stream.data_requested_in .eq(usb2_ep2_in.data_requested),
@@ -435,13 +563,24 @@ class USB2AudioInterface(Elaboratable):
         #
         # I2S DACs
         #
-        dac1_fifo_depth = 32 if self.USE_CONVOLUTION else 16 #when introducing delay with the convolver we need a larger fifo
-        m.submodules.dac1_transmitter = dac1 = DomainRenamer("usb")(I2STransmitter(sample_width=audio_bits, fifo_depth=dac1_fifo_depth))
-        m.submodules.dac2_transmitter = dac2 = DomainRenamer("usb")(I2STransmitter(sample_width=audio_bits))
-        m.submodules.dac1_extractor   = dac1_extractor = DomainRenamer("usb")(StereoPairExtractor(usb1_number_of_channels, usb1_to_output_fifo_depth))
-        m.submodules.dac2_extractor   = dac2_extractor = DomainRenamer("usb")(StereoPairExtractor(usb1_number_of_channels, usb1_to_output_fifo_depth))
-        dac1_pads = platform.request("i2s", 1)
-        dac2_pads = platform.request("i2s", 2)
+        dacs          = []
+        dac_extractor = []
+        dac_pads      = []
+        for i in range(1, self.NO_DACS + 1):
+            convolving     = self.USE_CONVOLUTION and (self.CONVOLUTION_IRS.get(i) is not None)
+            dac_fifo_depth = 32 if convolving else 16 #when introducing delay with the convolver we need a larger fifo
+            dac = DomainRenamer("usb")(I2STransmitter(sample_width=audio_bits, fifo_depth=dac_fifo_depth))
+            setattr(m.submodules, f"dac{i}_transmitter", dac)
+            dacs.append(dac)
+
+            extractor = DomainRenamer("usb")(StereoPairExtractor(usb1_number_of_channels, usb1_to_output_fifo_depth))
+            setattr(m.submodules, f"dac{i}_extractor", extractor)
+            dac_extractor.append(extractor)
+
+            dac_pads.append(platform.request("i2s", i))
+
+        dac1,           dac2           = dacs
+        dac1_extractor, dac2_extractor = dac_extractor
 
         # divide bitclock to get word clock
         # each half cycle has 32 bits in it
@@ -451,58 +590,59 @@ class USB2AudioInterface(Elaboratable):
         m.d.dac   += bit_counter.eq(bit_counter + 1)
         m.d.comb  += lrclk.eq(bit_counter[-1])
 
-        # hardwire DAC1 to channels 0/1 and DAC2 to 2/3
-        # until making it switchable via USB request
-        m.d.comb += [
-            dac1_extractor.selected_channel_in.eq(0),
+        # by default DAC1 is wired to channels 0/1 and DAC2 to 2/3.
+        # The host can route any channel pair to the DACs
+        # with the SELECT_DAC_CHANNELS vendor request, see requesthandlers.py
+        dac_default_channel = [
+            0,
             # if stereo mode is enabled we want the second DAC to be wired
             # to main lef/right channels, just as the first one
-            dac2_extractor.selected_channel_in.eq(Mux(usb1_no_channels == 2, 0, 2)),
+            Mux(usb1_no_channels == 2, 0, 2),
         ]
 
+        for i in range(self.NO_DACS):
+            m.d.comb += dac_extractor[i].selected_channel_in.eq(
+                Mux(usb1_class_request_handler.dac_channel_selected[i],
+                    usb1_class_request_handler.dac_channel_select[i],
+                    dac_default_channel[i]))
+
+        # every DAC which has an impulse response assigned gets its own convolver
+        convolvers        = [None] * self.NO_DACS
+        enable_convolvers = [None] * self.NO_DACS
         if self.USE_CONVOLUTION:
-            enable_convolver = Signal()
+            for i in range(self.NO_DACS):
+                ir_file = self.CONVOLUTION_IRS.get(i + 1)
+                if ir_file is None:
+                    continue
 
-            # load the IR data
-            with wave.open('IRs/DT990_crossfeed_4800taps.wav', 'rb') as wav:
-                ir_data = wav.readframes(wav.getnframes())
-                ir_sample_rate = wav.getframerate()
+                taps = self.load_impulse_response(ir_file, samplerate, audio_bits)
 
-            ir_sig = np.zeros((len(ir_data) // 6, 2), dtype='int32')
-            for i in range(0, len(ir_sig), 6):
-                ir_sig[i // 6, 0] = int.from_bytes(ir_data[i:i + 3], byteorder='little', signed=True)
-                ir_sig[i // 6, 1] = int.from_bytes(ir_data[i + 3:i + 6], byteorder='little', signed=True)
+                convolver = DomainRenamer("usb")(StereoConvolutionMAC(taps=taps, samplerate=samplerate, clockfrequency=60e6,
+                                                 bitwidth=audio_bits, convolutionMode=ConvolutionMode.CROSSFEED))
+                setattr(m.submodules, f"dac{i + 1}_convolver", convolver)
+                convolvers[i]        = convolver
+                enable_convolvers[i] = Signal(name=f"enable_dac{i + 1}_convolver")
 
-            # tapcount 4096 - more is failing to synthesize right now. 4800 would be the goal for 100ms.
-            taps = ir_sig[:4096,:]
+        for i in range(self.NO_DACS):
+            self.wire_up_dac(m, usb1_to_channel_stream, dac_extractor[i], dacs[i], lrclk, dac_pads[i], convolvers[i], enable_convolvers[i])
 
-            m.submodules.convolver = convolver = DomainRenamer("usb")(StereoConvolutionMAC(taps=taps, samplerate=samplerate, clockfrequency=60e6,
-                                     bitwidth=audio_bits, convolutionMode=ConvolutionMode.CROSSFEED))
+        if self.USE_CONVOLUTION:
+            # the convolvers can be toggled in-/active either all at once via the first button on the devboard
+            # or per DAC via the TOGGLE_CONVOLUTION(1) vendor request, with wIndex being the DAC number, 0 for DAC1
+            m.submodules.button_debouncer = button_debouncer = Debouncer()
+            m.d.comb += button_debouncer.btn_in.eq(platform.request("core_button")[0])
 
-            # validate the IR file
-            assert ir_sample_rate == samplerate, f"Unsupported samplerate {ir_sample_rate} for IR file. Required samplerate is {samplerate}"
-            for tap in range(len(taps)):
-                assert -1 * 2 ** (audio_bits - 1) <= taps[tap, 0] <= 1 * 2 ** (audio_bits - 1) - 1,\
-                        f"Tap #{tap} is out of range for bitwidth {audio_bits}: {taps[tap, 0]}"
-        else:
-            convolver = None
-            enable_convolver = None
+            for i in range(self.NO_DACS):
+                if convolvers[i] is None:
+                    continue
 
-        self.wire_up_dac(m, usb1_to_channel_stream, dac1_extractor, dac1, lrclk, dac1_pads, convolver, enable_convolver)
-        self.wire_up_dac(m, usb1_to_channel_stream, dac2_extractor, dac2, lrclk, dac2_pads)
+                request_debouncer = Debouncer()
+                setattr(m.submodules, f"dac{i + 1}_request_debouncer", request_debouncer)
+                m.d.comb += request_debouncer.btn_in.eq(usb1_class_request_handler.enable_convolution[i])
 
-        if self.USE_CONVOLUTION:
-            # the convolver can be toggled in-/active either via the first button on the devboard or via the
-            # TOGGLE_CONVOLUTION(1) vendor request
-            m.submodules.button_debouncer = button_debouncer = Debouncer()
-            m.submodules.request_debouncer = request_debouncer = Debouncer()
-            m.d.comb += [
-                button_debouncer.btn_in.eq(platform.request("core_button")[0]),
-                request_debouncer.btn_in.eq(usb1_class_request_handler.enable_convolution)
-            ]
-            with m.If(button_debouncer.btn_up_out | request_debouncer.btn_up_out):  # toggle convolution on/off
-                m.d.sync += enable_convolver.eq(~enable_convolver)
-                m.d.comb += dac1.enable_in.eq(0)  # reset the DAC once we toggle its signal source
+                with m.If(button_debouncer.btn_up_out | request_debouncer.btn_up_out):  # toggle convolution on/off
+                    m.d.sync += enable_convolvers[i].eq(~enable_convolvers[i])
+                    m.d.comb += dacs[i].enable_in.eq(0)  # reset the DAC once we toggle its signal source
 
         #
         # USB => output FIFO level debug signals
@@ -516,21 +656,60 @@ class USB2AudioInterface(Elaboratable):
         with m.If(usb1_to_output_fifo_level < min_fifo_level):
             m.d.sync += min_fifo_level.eq(usb1_to_output_fifo_level)
 
+        external_clock_selected = Const(0)
+        if self.USE_ADAT_CLOCK_SLAVE:
+            external_clock_selected = \
+                self.create_adat_clock_slave_circuit(m, platform, car, usb1_class_request_handler, adat_receivers)
+
+        if self.USE_ADAT_CLOCK_SLAVE or car.switch_44_1k:
+            self.create_audio_clock_select_circuit(m, car, usb1_class_request_handler, external_clock_selected,
+                                                   [usb1_class_request_handler, usb2_class_request_handler],
+                                                   feedback_controllers)
+
+        if self.USE_SOF_MONITOR:
+            self.create_sof_timing_monitors(m, usb1, usb2, usb1_class_request_handler, feedback_controllers)
+
         #
         # USB MIDI
         #
-        usb_midi_fifo_depth = USBDescriptors.MAX_PACKET_SIZE_MIDI
-        m.submodules.usb1_to_usb2_midi_fifo = usb1_to_usb2_midi_fifo = \
-            DomainRenamer("usb")(SyncFIFOBuffered(width=8+2, depth=usb_midi_fifo_depth))
-        m.submodules.usb2_to_usb1_midi_fifo = usb2_to_usb1_midi_fifo = \
-            DomainRenamer("usb")(SyncFIFOBuffered(width=8+2, depth=usb_midi_fifo_depth))
+        # the router FIFOs hold two full packets of events for each destination
+        usb_midi_fifo_depth = 2 * USBDescriptors.MAX_PACKET_SIZE_MIDI // EVENT_BYTES
+        usb1_midi_port, usb2_midi_port, din_midi_port = range(3)
+        no_midi_ports = 3 if self.USE_DIN_MIDI else 2
+
+        # USB1 and USB2 are looped through to each other, the DIN port goes to and comes from USB1.
+        # The DIN output is slow, it holds its sources back instead of dropping their events.
+        # On USB1 the loop is cable 0 and the DIN port cable 1, see usb_descriptors.py
+        midi_routes       = [(usb1_midi_port, usb2_midi_port), (usb2_midi_port, usb1_midi_port)]
+        midi_cable_routes = []
+        if self.USE_DIN_MIDI:
+            midi_routes      += [(usb1_midi_port, din_midi_port), (din_midi_port, usb1_midi_port)]
+            midi_cable_routes = [(usb1_midi_port, usb2_midi_port, 0), (usb1_midi_port, din_midi_port, DIN_MIDI_CABLE),
+                                 (usb2_midi_port, usb1_midi_port, 0)]
+
+        m.submodules.midi_router = midi_router = DomainRenamer("usb")(
+            MIDIRouter(no_sources=no_midi_ports, no_destinations=no_midi_ports, routes=midi_routes,
+                       fifo_depth=usb_midi_fifo_depth,
+                       blocking_destinations=[din_midi_port] if self.USE_DIN_MIDI else [],
+                       cable_routes=midi_cable_routes))
+
+        for port, (ep_out, ep_in) in enumerate([(usb1_ep3_out, usb1_ep3_in), (usb2_ep3_out, usb2_ep3_in)]):
+            deserializer = DomainRenamer("usb")(MIDIEventDeserializer())
+            serializer   = DomainRenamer("usb")(MIDIEventSerializer(USBDescriptors.MAX_PACKET_SIZE_MIDI))
+            setattr(m.submodules, f"usb{port + 1}_midi_deserializer", deserializer)
+            setattr(m.submodules, f"usb{port + 1}_midi_serializer",   serializer)
 
-        m.d.comb += [
-            *connect_stream_to_fifo(usb1_ep3_out.stream,    usb1_to_usb2_midi_fifo, firstBit=-2, lastBit=-1),
-            *connect_fifo_to_stream(usb1_to_usb2_midi_fifo, usb2_ep3_in.stream,     firstBit=-2, lastBit=-1),
-            *connect_stream_to_fifo(usb2_ep3_out.stream,    usb2_to_usb1_midi_fifo, firstBit=-2, lastBit=-1),
-            *connect_fifo_to_stream(usb2_to_usb1_midi_fifo, usb1_ep3_in.stream,     firstBit=-2, lastBit=-1),
-        ]
+            m.d.comb += [
+                deserializer.usb_stream_in.stream_eq(ep_out.stream),
+                midi_router.events_in[port].stream_eq(deserializer.event_out),
+                serializer.event_in.stream_eq(midi_router.events_out[port]),
+                ep_in.stream.stream_eq(serializer.usb_stream_out),
+            ]
+
+        din_midi_in = self.create_din_midi_circuit(m, platform, midi_router, din_midi_port) if self.USE_DIN_MIDI else None
+
+        if self.USE_SOC:
+            self.create_telemetry_circuit(m, locals())
 
         # Internal Logic Analyzer
         if self.USE_ILA:
@@ -539,6 +718,9 @@ class USB2AudioInterface(Elaboratable):
         if self.USE_DEBUG_LED_ARRAY:
             add_debug_led_array(locals())
 
+        # lets simulations look at the internals, see system_simulation.py
+        self.probe(locals())
+
         usb_aux1 = platform.request("usb_aux", 1)
         usb_aux2 = platform.request("usb_aux", 2)
 
@@ -559,11 +741,20 @@ class USB2AudioInterface(Elaboratable):
 
         if self.USE_CONVOLUTION:
             convolver_led = platform.request("core_led", 0)
-            m.d.comb += convolver_led.o.eq(enable_convolver)
+            m.d.comb += convolver_led.o.eq(Cat(e for e in enable_convolvers if e is not None).any())
 
         return m
 
 
+    def create_usb_device(self, platform, usb_nr: int):
+        return USBDevice(bus=platform.request("ulpi", usb_nr))
+
+
+    def probe(self, elaboration_locals: dict):
+        """called with the locals of elaborate() when it is done, for simulations to override"""
+        pass
+
+
     def detect_active_audio_in(self, m, name: str, usb, ep2_in):
         audio_in_seen   = Signal(name=f"{name}_audio_in_seen")
         audio_in_active = Signal(name=f"{name}_audio_in_active")
@@ -598,7 +789,8 @@ class USB2AudioInterface(Elaboratable):
         return audio_out_active
 
 
-    def calculate_usb_input_frame_size(self, m: Module, usb_name: str, ep1_out, ep2_in, number_of_channels: int, max_packet_size: int):
+    @staticmethod
+    def calculate_usb_input_frame_size(m: Module, usb_name: str, ep1_out, ep2_in, number_of_channels: int, max_packet_size: int):
         """calculate the number of bytes one packet of audio input contains"""
 
         audio_in_frame_byte_counter   = Signal(range(max_packet_size), name=f"{usb_name}_audio_in_frame_byte_counter", reset=24 * number_of_channels)
@@ -639,75 +831,46 @@ class USB2AudioInterface(Elaboratable):
             adat_clock_tick.eq(adat_clock_usb_pulse.pulse_out),
         ]
 
-        usb1_feedback_value     = Signal(32, reset=0x60000)
         usb1_bit_pos            = Signal(5)
-        usb2_feedback_value     = Signal(32, reset=0x60000)
         usb2_bit_pos            = Signal(5)
 
-        # this tracks the number of ADAT frames in N microframes
-        # with 12.288MHz / 8kHz = 1536 samples per microframe
-        # we have N = 256, so we need
-        # math.ceil(math.log2(1536 * 256)) = 19 bits
-        usb1_adat_clock_counter      = Signal(19)
-        usb2_adat_clock_counter      = Signal(19)
-
-        # according to USB2 standard chapter 5.12.4.2
-        # we need at least 2**13 / 2**8 = 2**5 = 32 SOF-frames of
-        # sample master frequency counter to get the minimal
-        # precision for the sample frequency estimate
-        # / 2**8 because the ADAT-clock = 256 times = 2**8
-        # the sample frequency
-        # we average over 256 microframes, because that gives
-        # us the maximum precision needed by the feedback endpoint
-        usb1_sof_counter        = Signal(8)
-        usb2_sof_counter        = Signal(8)
-
         # since samples are constantly consumed from the FIFO
         # half the maximum USB packet size should be more than enough
         usb1_to_output_fifo_depth = self.USB1_MAX_PACKET_SIZE // 2
         usb1_to_output_fifo_level = Signal(range(usb1_to_output_fifo_depth + 1))
         print("usb1_to_output_fifo_depth in bits: " + str(usb1_to_output_fifo_level.width))
-        usb1_fifo_level_feedback  = Signal.like(usb1_to_output_fifo_level)
-        m.d.comb += usb1_fifo_level_feedback.eq(usb1_to_output_fifo_level >> (usb1_to_output_fifo_level.width - 7))
 
         usb2_to_usb1_fifo_depth = self.USB2_MAX_PACKET_SIZE // 2
         usb2_to_usb1_fifo_level = Signal(range(usb2_to_usb1_fifo_depth + 1))
         print("usb2_to_usb1_fifo_depth in bits: " + str(usb2_to_usb1_fifo_level.width))
-        usb2_fifo_level_feedback  = Signal.like(usb2_to_usb1_fifo_level)
-        m.d.comb += usb2_fifo_level_feedback.eq(usb2_to_usb1_fifo_level >> (usb2_to_usb1_fifo_level.width - 4))
-
-        with m.If(adat_clock_tick):
-            m.d.usb += [
-                usb1_adat_clock_counter.eq(usb1_adat_clock_counter + 1),
-                usb2_adat_clock_counter.eq(usb2_adat_clock_counter + 1),
-            ]
 
-        with m.If(usb1.sof_detected):
-            m.d.usb += usb1_sof_counter.eq(usb1_sof_counter + 1)
-
-            with m.If(usb1_sof_counter == 0):
-                # when feedbackValue == adat_clock_counter the
-                # FIFO underflows slowly, but also when
-                # feedbackValue == adat_clock_counter + 1
-                # the FIFO slowly but surely fills to overflow.
-                # since both of those feedback values are only one apart,
-                # we need to start with the slowly overflowing value and
-                # provide negative feedback proportional to the fill level
-                # of the FIFO
-                m.d.usb += [
-                    usb1_feedback_value.eq(usb1_adat_clock_counter + 1 - usb1_fifo_level_feedback),
-                    usb1_adat_clock_counter.eq(0),
-                ]
+        # the controllers measure the sample rate over 256 microframes,
+        # which according to USB2 standard chapter 5.12.4.2 is more than
+        # the 2**13 / 2**8 = 32 SOF-frames needed for the minimal precision,
+        # and keep the FIFOs at their target fill level with a PI term
+        usb1_feedback_controller, usb2_feedback_controller = feedback_controllers = [
+            DomainRenamer("usb")(FeedbackController(
+                fifo_depth      = fifo_depth,
+                target_fill     = int(fifo_depth * self.FEEDBACK_TARGET_FILL),
+                kp_shift        = self.FEEDBACK_KP_SHIFT,
+                ki_shift        = self.FEEDBACK_KI_SHIFT,
+                update_interval = self.FEEDBACK_UPDATE_INTERVAL))
+            for fifo_depth in [usb1_to_output_fifo_depth, usb2_to_usb1_fifo_depth]]
+
+        m.submodules.usb1_feedback_controller = usb1_feedback_controller
+        m.submodules.usb2_feedback_controller = usb2_feedback_controller
 
-        with m.If(usb2.sof_detected):
-            m.d.usb += usb2_sof_counter.eq(usb2_sof_counter + 1)
-
-            with m.If(usb2_sof_counter == 0):
-                m.d.usb += [
-                    usb2_feedback_value.eq(usb2_adat_clock_counter + 1 - usb2_fifo_level_feedback),
-                    usb2_adat_clock_counter.eq(0),
-                ]
+        m.d.comb += [
+            usb1_feedback_controller.sof_in.eq(usb1.sof_detected),
+            usb1_feedback_controller.fifo_level_in.eq(usb1_to_output_fifo_level),
+            usb2_feedback_controller.sof_in.eq(usb2.sof_detected),
+            usb2_feedback_controller.fifo_level_in.eq(usb2_to_usb1_fifo_level),
+        ] + [controller.adat_tick_in.eq(adat_clock_tick) for controller in feedback_controllers]
 
+        usb1_feedback_value = usb1_feedback_controller.feedback_value_out
+        usb2_feedback_value = usb2_feedback_controller.feedback_value_out
+        usb1_sof_counter    = usb1_feedback_controller.sof_counter_out
+        usb2_sof_counter    = usb2_feedback_controller.sof_counter_out
 
         m.d.comb += [
             usb1_ep1_in.bytes_in_frame.eq(4),
@@ -720,7 +883,202 @@ class USB2AudioInterface(Elaboratable):
         ]
 
         return (usb1_sof_counter, usb1_to_output_fifo_level, usb1_to_output_fifo_depth, \
-                usb2_sof_counter, usb2_to_usb1_fifo_level, usb2_to_usb1_fifo_depth)
+                usb2_sof_counter, usb2_to_usb1_fifo_level, usb2_to_usb1_fifo_depth, feedback_controllers)
+
+
+    def create_adat_clock_slave_circuit(self, m: Module, platform, car, request_handler, adat_receivers):
+        #
+        # ADAT clock slave: lock the adat and dac domains to the selected ADAT input
+        #
+        no_inputs = len(adat_receivers)
+
+        m.submodules.adat_clock_recovery = clock_recovery = \
+            DomainRenamer("fast")(ADATClockRecovery(platform.fast_domain_clock_freq))
+
+        clock_selection_fast = Signal.like(request_handler.clock_selection)
+        m.submodules.clock_selection_sync = \
+            FFSynchronizer(request_handler.clock_selection, clock_selection_fast, o_domain="fast")
+
+        # clock selection 0 is the internal clock, 1-4 are the ADAT inputs
+        reference_strobes = Array([Const(0)] + [receiver.recovered_clock_out for receiver in adat_receivers])
+        reference_valids  = Array([Const(0)] + [receiver.synced_out for receiver in adat_receivers])
+
+        m.d.comb += [
+            clock_recovery.reference_strobe_in.eq(reference_strobes[clock_selection_fast]),
+            clock_recovery.reference_valid_in .eq(reference_valids[clock_selection_fast]),
+        ]
+
+        adat_synced_usb  = Signal(no_inputs)
+        dpll_locked_usb  = Signal()
+        m.submodules.adat_synced_usb_sync = \
+            FFSynchronizer(Cat(receiver.synced_out for receiver in adat_receivers), adat_synced_usb, o_domain="usb")
+        m.submodules.dpll_locked_usb_sync = \
+            FFSynchronizer(clock_recovery.locked_out, dpll_locked_usb, o_domain="usb")
+
+        selection = request_handler.clock_selection
+        m.d.comb += [
+            car.external_adat_clock_in .eq(clock_recovery.adat_clock_out),
+            car.external_dac_clock_in  .eq(clock_recovery.dac_clock_out),
+        ]
+
+        # an input is a valid clock when it is synced, and the selected one also needs the DPLL to be locked
+        m.d.comb += request_handler.external_clock_valid_in.eq(
+            Cat(adat_synced_usb[i] & ((selection != i + 1) | dpll_locked_usb) for i in range(no_inputs)))
+
+        # only switch over to the external clock when the DPLL is locked, and fall back when it loses lock
+        external_clock_selected = Signal()
+        m.d.comb += external_clock_selected.eq((selection != 0) & dpll_locked_usb)
+        return external_clock_selected
+
+
+    def create_audio_clock_select_circuit(self, m: Module, car, request_handler, external_clock_selected,
+                                          request_handlers, feedback_controllers):
+        #
+        # switch the audio clock sources, while holding the audio domains in reset
+        #
+        m.submodules.audio_clock_select = audio_clock_select = \
+            DomainRenamer("usb")(AudioClockSelect(width=2))
+
+        external_clock_active = audio_clock_select.select_out[0]
+        samplerate_44_1k      = audio_clock_select.select_out[1]
+        audio_clock_reset     = audio_clock_select.audio_clock_reset_out
+
+        m.d.comb += [
+            audio_clock_select.select_in.eq(Cat(external_clock_selected, request_handler.samplerate_44_1k_out)),
+
+            car.select_external_in   .eq(external_clock_active),
+            car.samplerate_44_1k_in  .eq(samplerate_44_1k),
+            car.audio_clock_reset_in .eq(audio_clock_reset),
+        ]
+
+        m.d.comb += [handler.samplerate_44_1k_in.eq(samplerate_44_1k) for handler in request_handlers]
+
+        # the measured feedback value follows the adat clock by itself,
+        # but after a switch it has to start over from the new nominal value
+        for controller in feedback_controllers:
+            m.d.comb += [
+                controller.restart_in.eq(audio_clock_reset),
+                controller.nominal_in.eq(Mux(samplerate_44_1k,
+                                             FeedbackController.nominal_feedback_value(44100),
+                                             FeedbackController.nominal_feedback_value(48000))),
+            ]
+
+
+    def create_sof_timing_monitors(self, m: Module, usb1, usb2, request_handler, feedback_controllers):
+        #
+        # SOF timing histograms of both hosts, read out by USB1 vendor requests
+        #
+        usb1_sof_monitor, usb2_sof_monitor = sof_monitors = [
+            DomainRenamer("usb")(SOFTimingMonitor()) for _ in range(2)]
+        m.submodules.usb1_sof_monitor = usb1_sof_monitor
+        m.submodules.usb2_sof_monitor = usb2_sof_monitor
+
+        m.d.comb += [
+            usb1_sof_monitor.sof_in.eq(usb1.sof_detected),
+            usb2_sof_monitor.sof_in.eq(usb2.sof_detected),
+            request_handler.sof_stats_data_in.eq(Mux(request_handler.sof_stats_port_out,
+                                                     usb2_sof_monitor.read_data_out,
+                                                     usb1_sof_monitor.read_data_out)),
+        ]
+
+        for port, monitor in enumerate(sof_monitors):
+            m.d.comb += [
+                # the same ADAT clock ticks the feedback controllers measure the sample rate with
+                monitor.adat_tick_in.eq(feedback_controllers[0].adat_tick_in),
+                monitor.samplerate_44_1k_in.eq(request_handler.samplerate_44_1k_in),
+                monitor.read_address_in.eq(request_handler.sof_stats_address_out),
+                monitor.clear_in.eq(request_handler.sof_stats_clear_out[port]),
+            ]
+
+
+    def create_din_midi_circuit(self, m: Module, platform, midi_router, port: int):
+        #
+        # DIN MIDI in and out, on the UART pins
+        #
+        assert not self.USE_SOC, "DIN MIDI and the SoC both need the UART pins"
+        uart_pads = platform.request("uart", 0)
+
+        m.submodules.din_midi_in  = din_midi_in  = DomainRenamer("usb")(DINMIDIIn(cable=DIN_MIDI_CABLE))
+        m.submodules.din_midi_out = din_midi_out = DomainRenamer("usb")(DINMIDIOut())
+
+        m.d.comb += [
+            din_midi_in.rx_in.eq(uart_pads.rx),
+            midi_router.events_in[port].stream_eq(din_midi_in.event_out),
+            din_midi_out.event_in.stream_eq(midi_router.events_out[port]),
+            uart_pads.tx.eq(din_midi_out.tx_out),
+        ]
+
+        return din_midi_in
+
+
+    def telemetry_sources(self):
+        """ the entries of the telemetry peripheral, each with a function
+            which finds its input in the locals of elaborate() """
+        sources = [
+            ("level", "usb1_to_output_fifo",     "usb",  lambda v: v["usb1_to_output_fifo_level"]),
+            ("level", "usb2_to_usb1_fifo",       "usb",  lambda v: v["usb2_to_usb1_fifo_level"]),
+            ("level", "input_to_usb_fifo",       "usb",  lambda v: v["input_to_usb_fifo"].r_level),
+            ("level", "channels_to_usb1_stream", "usb",  lambda v: v["channels_to_usb1_stream"].level),
+            ("level", "channels_to_usb2_stream", "usb",  lambda v: v["channels_to_usb2_stream"].level),
+            ("level", "midi_to_usb1",            "usb",  lambda v: v["midi_router"].levels_out[v["usb1_midi_port"]]),
+            ("level", "midi_to_usb2",            "usb",  lambda v: v["midi_router"].levels_out[v["usb2_midi_port"]]),
+
+            ("value", "usb1_feedback",           "usb",  lambda v: v["feedback_controllers"][0].feedback_value_out),
+            ("value", "usb2_feedback",           "usb",  lambda v: v["feedback_controllers"][1].feedback_value_out),
+            ("value", "adat_sync",               "fast", lambda v: Cat(receiver.synced_out for receiver in v["adat_receivers"])),
+            ("value", "midi_dropped_usb1",       "usb",  lambda v: v["midi_router"].dropped_out[v["usb1_midi_port"]]),
+            ("value", "midi_dropped_usb2",       "usb",  lambda v: v["midi_router"].dropped_out[v["usb2_midi_port"]]),
+
+            # the splitter holds back USB1 while the output FIFO is full, which
+            # in turn stalls the OUT endpoint
+            ("count", "usb1_to_output_fifo_stall",  "usb",
+                lambda v: fifo_write_blocked(v["usb1_channel_stream_splitter"].lower_channel_stream_out.valid,
+                                             v["usb1_to_output_fifo"])),
+            ("count", "input_to_usb_fifo_overflow", "fast",
+                lambda v: fifo_write_blocked(v["bundle_multiplexer"].channel_stream_out.valid,
+                                             v["input_to_usb_fifo"])),
+        ]
+
+        for i in range(4):
+            sources += [
+                ("level", f"adat{i + 1}_receive_fifo", "fast", lambda v, i=i: v["bundle_multiplexer"].levels[i]),
+                ("count", f"adat{i + 1}_underflow",    "adat", lambda v, i=i: v["adat_transmitters"][i].underflow_out),
+            ]
+
+        if self.USE_DRIFT_COMPENSATION:
+            sources += [
+                ("value", "usb2_to_usb1_frames_dropped",  "usb",
+                    lambda v: v["usb2_to_usb1_drift_compensator"].frames_dropped_out),
+                ("value", "usb2_to_usb1_frames_repeated", "usb",
+                    lambda v: v["usb2_to_usb1_drift_compensator"].frames_repeated_out),
+            ]
+
+        # no DIN MIDI entries: the DIN port and the SoC both need the UART pins
+
+        return sources
+
+
+    def create_telemetry_circuit(self, m: Module, v: dict):
+        #
+        # telemetry peripheral of the SoC
+        #
+        m.d.comb += [self.telemetry.inputs[name].eq(source(v))
+                     for kind, name, domain, source in self.telemetry_sources()]
+
+
+    def load_impulse_response(self, filename: str, samplerate: int, audio_bits: int):
+        """load a stereo impulse response and validate it against the sample rate and bit width"""
+        inputs = [file_contents(filename), file_contents(wav_io.__file__), samplerate, audio_bits, self.CONVOLUTION_TAPS]
+        return self.build_cache.get_or_compute("impulse_responses", inputs,
+            lambda: load_impulse_response(filename, samplerate, audio_bits, tapcount=self.CONVOLUTION_TAPS))
+
+
+    def descriptor_cache_inputs(self, usb_nr: int, no_channels: int, max_packet_size: int, samplerates):
+        """everything the descriptors of one USB port depend on"""
+        # the sample rates also decide whether the internal clock is host programmable
+        return [file_contents(usb_descriptors.__file__), package_version("usb-protocol"),
+                usb_nr, no_channels, max_packet_size, sorted(samplerates),
+                self.USE_ILA, self.ILA_MAX_PACKET_SIZE, self.USE_ADAT_CLOCK_SLAVE, self.USE_DIN_MIDI]
 
 
     def wire_up_dac(self, m, usb_to_channel_stream, dac_extractor, dac, lrclk, dac_pads, convolver=None, enable_convolver=None):
@@ -772,4 +1130,10 @@ if __name__ == "__main__":
     os.environ["AMARANTH_nextpnr_opts"] = "--timing-allow-fail"
     os.environ["LUNA_PLATFORM"] = "platforms:ADATFaceColorlight"
 
-    top_level_cli(USB2AudioInterface)
+    # --incremental: skip synthesis and place and route if the netlist did not change
+    if "--incremental" in sys.argv:
+        from luna         import get_appropriate_platform
+        from netlist_hash import build_incremental
+        build_incremental(get_appropriate_platform(), USB2AudioInterface())
+    else:
+        top_level_cli(USB2AudioInterface)
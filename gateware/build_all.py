@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import argparse
+import json
+import os
+import time
+import traceback
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from netlist_hash import build_incremental, unchanged
+
+PLATFORMS = ["ADATFaceColorlight", "ADATFaceCycloneIV", "ADATFaceCycloneV", "ADATFaceCyclone10", "ADATFaceArtix7"]
+
+# feature flags of USB2AudioInterface for each variant
+VARIANTS = {
+    "default":     {},
+    "ila":         dict(USE_ILA=True),
+    "convolution": dict(USE_CONVOLUTION=True),
+    "soc":         dict(USE_SOC=True),
+    "44_1k":       dict(USE_44_1K=True),
+    "debug_leds":  dict(USE_DEBUG_LED_ARRAY=True),
+    "pipelined":   dict(PIPELINED_STREAM_MODULES=("bundle_demultiplexer", "bundle_multiplexer", "channels_to_usb_stream")),
+}
+
+# toolchain options per platform, as the __main__ of adat_usb2_audio_interface.py sets them
+PLATFORM_ENVIRONMENT = {
+    "ADATFaceColorlight": {
+        "AMARANTH_synth_opts":   "-abc9",
+        "AMARANTH_nextpnr_opts": "--timing-allow-fail",
+    },
+}
+
+class BuildJob():
+    def __init__(self, platform: str, variant: str, flags: dict):
+        self.platform = platform
+        self.variant  = variant
+        self.flags    = flags
+
+    @property
+    def name(self):
+        return f"{self.platform}_{self.variant}"
+
+    def __repr__(self):
+        return f"BuildJob({self.name})"
+
+
+def build_jobs(platforms, variants: dict):
+    """ returns the build matrix as a list of job groups
+
+        The jobs of a group run one after another in the same worker:
+        all variants with the SoC share the firmware directory, so they must not build at the same time.
+    """
+    groups     = []
+    soc_group  = []
+    for platform in platforms:
+        for variant, flags in variants.items():
+            job = BuildJob(platform, variant, flags)
+            if flags.get("USE_SOC"):
+                soc_group.append(job)
+            else:
+                groups.append([job])
+
+    if soc_group:
+        groups.insert(0, soc_group)
+    return groups
+
+
+def run_job(job: BuildJob, build_dir: str, synthesize: bool) -> dict:
+    """ elaborates one platform / variant combination and writes its RTLIL / Verilog to build_dir """
+    start  = time.time()
+    result = dict(name=job.name, platform=job.platform, variant=job.variant, flags=job.flags)
+    # the worker runs the jobs of other platforms after this one, which must not see its toolchain options
+    saved_environment = dict(os.environ)
+    try:
+        os.environ.update(PLATFORM_ENVIRONMENT.get(job.platform, {}))
+
+        import platforms
+        from adat_usb2_audio_interface import USB2AudioInterface
+
+        design_class   = type(f"USB2AudioInterface_{job.variant}", (USB2AudioInterface,), dict(job.flags))
+        platform       = getattr(platforms, job.platform)()
+        job_build_dir  = os.path.join(build_dir, job.platform, job.variant)
+
+        if synthesize:
+            _, report = build_incremental(platform, design_class(), name=job.name, build_dir=job_build_dir, verbose=False)
+            result.update(rebuilt=not unchanged(report), changes=report)
+        else:
+            plan = platform.build(design_class(), name=job.name, build_dir=job_build_dir, do_build=False)
+            plan.extract(job_build_dir)
+
+        result.update(status="ok", files=sorted(os.listdir(job_build_dir)))
+    except Exception:
+        result.update(status="failed", error=traceback.format_exc())
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environment)
+
+    result["seconds"] = round(time.time() - start, 1)
+    return result
+
+
+def run_group(jobs, build_dir: str, synthesize: bool):
+    return [run_job(job, build_dir, synthesize) for job in jobs]
+
+
+def build_all(groups, build_dir: str, jobs: int=None, synthesize: bool=False, verbose: bool=True):
+    """ runs all job groups in a process pool, returns the results of all jobs """
+    os.makedirs(build_dir, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_group, group, build_dir, synthesize) for group in groups]
+        for future in as_completed(futures):
+            for result in future.result():
+                results.append(result)
+                if verbose:
+                    reused = ", reused" if result.get("rebuilt") is False else ""
+                    print(f"{result['status']:>6} {result['name']} ({result['seconds']}s{reused})", flush=True)
+
+    results.sort(key=lambda result: result["name"])
+    with open(os.path.join(build_dir, "summary.json"), 'w') as summary:
+        json.dump(results, summary, indent=2)
+    return results
+
+
+class BuildJobsTest(unittest.TestCase):
+    def test_matrix(self):
+        groups = build_jobs(["A", "B"], VARIANTS)
+        jobs   = [job for group in groups for job in group]
+        self.assertEqual(len(jobs), 2 * len(VARIANTS))
+        self.assertEqual(len(set(job.name for job in jobs)), len(jobs))
+
+    def test_soc_variants_are_serialized(self):
+        groups = build_jobs(["A", "B"], dict(default={}, soc=dict(USE_SOC=True)))
+        self.assertEqual([job.name for job in groups[0]], ["A_soc", "B_soc"])
+        self.assertTrue(all(len(group) == 1 for group in groups[1:]))
+
+    def test_environment_is_restored(self):
+        environment = dict(os.environ)
+        PLATFORM_ENVIRONMENT["NoSuchPlatform"] = {"BUILD_ALL_TEST_OPTION": "1"}
+        try:
+            with tempfile.TemporaryDirectory() as build_dir:
+                result = run_job(BuildJob("NoSuchPlatform", "default", {}), build_dir, synthesize=False)
+        finally:
+            del PLATFORM_ENVIRONMENT["NoSuchPlatform"]
+        self.assertEqual(result["status"], "failed")
+        self.assertEqual(dict(os.environ), environment)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="elaborate the design for a matrix of platforms and feature variants in parallel")
+    parser.add_argument("--platforms", nargs="+", choices=PLATFORMS, default=PLATFORMS)
+    parser.add_argument("--variants", nargs="+", choices=list(VARIANTS.keys()), default=["default"])
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--build-dir", default="build")
+    parser.add_argument("--synthesize", action="store_true", help="also run the vendor toolchains, skipped for variants whose netlist did not change since their last build")
+    args = parser.parse_args()
+
+    groups  = build_jobs(args.platforms, { variant: VARIANTS[variant] for variant in args.variants })
+    results = build_all(groups, args.build_dir, args.jobs, args.synthesize)
+
+    failed = [result for result in results if result["status"] != "ok"]
+    for result in failed:
+        print(f"\n{result['name']} failed:\n{result['error']}")
+
+    print(f"\n{len(results) - len(failed)} of {len(results)} builds succeeded, summary in {args.build_dir}/summary.json")
+    exit(1 if failed else 0)
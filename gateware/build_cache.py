@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from importlib import metadata
+
+def file_contents(filename: str) -> bytes:
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def package_version(name: str) -> str:
+    """ the installed version of a python package, so that cached results expire when it is updated """
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return ""
+
+def write_if_changed(filename: str, content: str) -> bool:
+    """ writes a generated file only if its content changed, which keeps its mtime for make """
+    if os.path.exists(filename) and file_contents(filename) == content.encode():
+        return False
+    with open(filename, 'w') as f:
+        f.write(content)
+    return True
+
+
+class BuildCache():
+    """ content addressed cache for the slow steps of elaboration
+
+        Results are stored under directory/<namespace>/<key>, where the key is a hash of
+        everything the result depends on: the contents of input files, the source of the
+        code producing it and its parameters. So a changed input simply misses the cache,
+        and there is nothing to invalidate. With directory=None nothing is cached.
+    """
+    def __init__(self, directory: str=".build_cache"):
+        self._directory = directory
+        self._memory    = {}
+        self.hits       = 0
+        self.misses     = 0
+
+    @staticmethod
+    def key(*inputs) -> str:
+        """ hashes bytes inputs as they are and everything else by its repr """
+        digest = hashlib.sha256()
+        for item in inputs:
+            data = item if isinstance(item, bytes) else repr(item).encode()
+            # length prefix, so that concatenations of different inputs do not collide
+            digest.update(len(data).to_bytes(8, "little"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _path(self, namespace: str, key: str) -> str:
+        return os.path.join(self._directory, namespace, key)
+
+    def get_or_compute(self, namespace: str, inputs: list, compute):
+        """ returns the cached result of compute() for inputs, calling it only on a miss """
+        key = self.key(*inputs)
+        if (namespace, key) in self._memory:
+            self.hits += 1
+            return self._memory[(namespace, key)]
+
+        result = None
+        found  = False
+        if self._directory is not None:
+            path = self._path(namespace, key) + ".pickle"
+            if os.path.exists(path):
+                try:
+                    with open(path, 'rb') as f:
+                        result = pickle.load(f)
+                    found = True
+                except Exception:
+                    # a truncated or incompatible entry is just a miss
+                    found = False
+
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+            result = compute()
+            if self._directory is not None:
+                self._store_pickle(path, result)
+
+        self._memory[(namespace, key)] = result
+        return result
+
+    def _store_pickle(self, path: str, result):
+        try:
+            data = pickle.dumps(result)
+        except Exception:
+            # results which cannot be pickled are only cached in memory
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so that parallel builds never see half an entry
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+    def build_files(self, namespace: str, inputs: list, outputs: list, build) -> bool:
+        """ makes sure the output files match inputs: restores them from the cache on a hit,
+            otherwise calls build(), which returns whether it succeeded, and stores them """
+        if self._directory is None:
+            return build()
+
+        entry = self._path(namespace, self.key(*inputs))
+        if all(os.path.exists(os.path.join(entry, os.path.basename(output))) for output in outputs):
+            self.hits += 1
+            for output in outputs:
+                cached = os.path.join(entry, os.path.basename(output))
+                if not os.path.exists(output) or file_contents(output) != file_contents(cached):
+                    shutil.copyfile(cached, output)
+            return True
+
+        self.misses += 1
+        if not build():
+            return False
+
+        os.makedirs(entry, exist_ok=True)
+        for output in outputs:
+            shutil.copyfile(output, os.path.join(entry, os.path.basename(output)))
+        return True
+
+
+class BuildCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_or_compute(self):
+        calls = []
+        def compute(value):
+            calls.append(value)
+            return [value] * 3
+
+        cache = BuildCache(os.path.join(self.directory, "cache"))
+        self.assertEqual(cache.get_or_compute("test", [b"data", 1], lambda: compute(1)), [1, 1, 1])
+        self.assertEqual(cache.get_or_compute("test", [b"data", 1], lambda: compute(1)), [1, 1, 1])
+        self.assertEqual(calls, [1])
+
+        # a new instance finds the entry on disk
+        cache = BuildCache(os.path.join(self.directory, "cache"))
+        self.assertEqual(cache.get_or_compute("test", [b"data", 1], lambda: compute(1)), [1, 1, 1])
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+        # changed inputs miss
+        self.assertEqual(cache.get_or_compute("test", [b"data", 2], lambda: compute(2)), [2, 2, 2])
+        self.assertEqual(calls, [1, 2])
+
+    def test_key_separates_inputs(self):
+        self.assertNotEqual(BuildCache.key(b"ab", b"c"), BuildCache.key(b"a", b"bc"))
+        self.assertNotEqual(BuildCache.key(1), BuildCache.key("1"))
+
+    def test_build_files(self):
+        output = os.path.join(self.directory, "firmware.bin")
+        builds = []
+        def build(content):
+            builds.append(content)
+            with open(output, 'wb') as f:
+                f.write(content)
+            return True
+
+        cache = BuildCache(os.path.join(self.directory, "cache"))
+        self.assertTrue(cache.build_files("firmware", [b"v1"], [output], lambda: build(b"v1")))
+        self.assertTrue(cache.build_files("firmware", [b"v2"], [output], lambda: build(b"v2")))
+
+        # going back to v1 restores the output without building
+        self.assertTrue(cache.build_files("firmware", [b"v1"], [output], lambda: build(b"v1")))
+        self.assertEqual(builds, [b"v1", b"v2"])
+        self.assertEqual(file_contents(output), b"v1")
+
+        # failed builds are not cached
+        self.assertFalse(cache.build_files("firmware", [b"v3"], [output], lambda: False))
+        self.assertTrue(cache.build_files("firmware", [b"v3"], [output], lambda: build(b"v3")))
+
+    def test_write_if_changed(self):
+        filename = os.path.join(self.directory, "soc.ld")
+        self.assertTrue(write_if_changed(filename, "MEMORY {}"))
+        self.assertFalse(write_if_changed(filename, "MEMORY {}"))
+        self.assertTrue(write_if_changed(filename, "MEMORY { rom }"))
+
+    def test_disabled(self):
+        calls = []
+        cache = BuildCache(None)
+        cache.get_or_compute("test", [1], lambda: calls.append(1))
+        cache.get_or_compute("test", [1], lambda: calls.append(1))
+        # still memoized within the same elaboration
+        self.assertEqual(calls, [1])
+        self.assertEqual(os.listdir(self.directory), [])
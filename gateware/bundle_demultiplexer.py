@@ -3,16 +3,22 @@ from functools import reduce
 
 from amaranth         import *
 from amaranth.build   import Platform
+from amaranth.sim     import Settle
 from amlib.stream     import StreamInterface
 from amlib.test       import GatewareTestCase, sync_test_case
 
+from stream_skid_buffer import StreamSkidBuffer
+
 class BundleDemultiplexer(Elaboratable):
     NO_CHANNELS_ADAT = 8
     SAMPLE_WIDTH     = 24
 
-    def __init__(self, no_bundles=4):
+    def __init__(self, no_bundles=4, pipelined=False):
         # parameters
         self._no_bundles          = no_bundles
+        # register the input and the outputs with skid buffers,
+        # so that the Array indexed ready does not reach channel_stream_in.ready
+        self._pipelined           = pipelined
         self._channel_bits        = Shape.cast(range(no_bundles * self.NO_CHANNELS_ADAT)).width
         self._bundle_channel_bits = Shape.cast(range(self.NO_CHANNELS_ADAT)).width
 
@@ -39,6 +45,19 @@ class BundleDemultiplexer(Elaboratable):
         m.d.sync += keep_sync.eq(1)
 
         channel_stream  = self.channel_stream_in
+        bundles_out     = self.bundles_out
+
+        if self._pipelined:
+            m.submodules.input_skid_buffer = input_buffer = StreamSkidBuffer.like(self.channel_stream_in)
+            m.d.comb += input_buffer.stream_in.stream_eq(self.channel_stream_in)
+            channel_stream = input_buffer.stream_out
+
+            output_buffers = [StreamSkidBuffer.like(bundle) for bundle in self.bundles_out]
+            for i, output_buffer in enumerate(output_buffers):
+                setattr(m.submodules, f"output_skid_buffer{i}", output_buffer)
+                m.d.comb += self.bundles_out[i].stream_eq(output_buffer.stream_out)
+            bundles_out = Array(output_buffer.stream_in for output_buffer in output_buffers)
+
         bundle_ready    = Signal()
         bundle_nr       = Signal(range(self._no_bundles))
         channel_nr      = Signal(range(self.NO_CHANNELS_ADAT))
@@ -52,17 +71,17 @@ class BundleDemultiplexer(Elaboratable):
             channel_nr           .eq(channel_stream.channel_nr & channel_mask),
             last_channel         .eq(Mux(self.no_channels_in == 2, 1, 7)),
 
-            bundle_ready         .eq(self.bundles_out[bundle_nr].ready),
+            bundle_ready         .eq(bundles_out[bundle_nr].ready),
             channel_stream.ready .eq(bundle_ready),
         ]
 
         with m.If(bundle_ready & channel_stream.valid):
             m.d.comb += [
-                self.bundles_out[bundle_nr].valid.eq(1),
-                self.bundles_out[bundle_nr].payload.eq(channel_stream.payload),
-                self.bundles_out[bundle_nr].channel_nr.eq(channel_nr),
-                self.bundles_out[bundle_nr].first.eq(channel_nr == 0),
-                self.bundles_out[bundle_nr].last.eq(channel_nr == last_channel),
+                bundles_out[bundle_nr].valid.eq(1),
+                bundles_out[bundle_nr].payload.eq(channel_stream.payload),
+                bundles_out[bundle_nr].channel_nr.eq(channel_nr),
+                bundles_out[bundle_nr].first.eq(channel_nr == 0),
+                bundles_out[bundle_nr].last.eq(channel_nr == last_channel),
             ]
 
         return m
@@ -93,3 +112,33 @@ class BundleDemultiplexerTest(GatewareTestCase):
 
         yield
         yield
+
+class BundleDemultiplexerPipelinedTest(BundleDemultiplexerTest):
+    FRAGMENT_ARGUMENTS  = dict(pipelined=True)
+
+    @sync_test_case
+    def test_routing_with_backpressure(self):
+        dut      = self.dut
+        channels = 4 * BundleDemultiplexer.NO_CHANNELS_ADAT
+        received = [[] for _ in range(4)]
+
+        channel = 0
+        for cycle in range(200):
+            # bundle 2 stalls every other cycle
+            for bundle in range(4):
+                yield dut.bundles_out[bundle].ready.eq((bundle != 2) | (cycle % 2 == 0))
+            yield dut.channel_stream_in.channel_nr.eq(channel % channels)
+            yield dut.channel_stream_in.payload.eq(channel)
+            yield dut.channel_stream_in.valid.eq(channel < 2 * channels)
+            yield Settle()
+
+            if (yield dut.channel_stream_in.valid) and (yield dut.channel_stream_in.ready):
+                channel += 1
+            for bundle in range(4):
+                if (yield dut.bundles_out[bundle].valid) and (yield dut.bundles_out[bundle].ready):
+                    received[bundle].append(((yield dut.bundles_out[bundle].payload), (yield dut.bundles_out[bundle].channel_nr)))
+            yield
+
+        for bundle in range(4):
+            expected = [(sample, sample % 8) for sample in range(2 * channels) if (sample % channels) // 8 == bundle]
+            self.assertEqual(received[bundle], expected)
@@ -1,18 +1,24 @@
 from amaranth            import *
 from amaranth.build      import Platform
 from amaranth.lib.fifo   import SyncFIFO
+from amaranth.sim        import Settle
 
 from amlib.stream        import StreamInterface, connect_stream_to_fifo
 from amlib.test          import GatewareTestCase, sync_test_case
 
+from stream_skid_buffer  import StreamSkidBuffer
+
 class BundleMultiplexer(Elaboratable):
     NO_CHANNELS_ADAT = 8
     SAMPLE_WIDTH     = 24
     FIFO_DEPTH       = 32 * NO_CHANNELS_ADAT
 
-    def __init__(self, no_bundles=4):
+    def __init__(self, no_bundles=4, pipelined=False):
         # parameters
         self._no_bundles           = no_bundles
+        # register channel_stream_out with a skid buffer,
+        # so that its ready does not go through the Array muxes
+        self._pipelined            = pipelined
         self._channel_bits         = Shape.cast(range(no_bundles * self.NO_CHANNELS_ADAT)).width
         self._bundle_channel_bits  = Shape.cast(range(self.NO_CHANNELS_ADAT)).width
 
@@ -40,6 +46,12 @@ class BundleMultiplexer(Elaboratable):
         sample_width = self.SAMPLE_WIDTH
         bundle_bits  = self._bundle_channel_bits
 
+        channel_stream_out = self.channel_stream_out
+        if self._pipelined:
+            m.submodules.output_skid_buffer = output_buffer = StreamSkidBuffer.like(self.channel_stream_out)
+            m.d.comb += self.channel_stream_out.stream_eq(output_buffer.stream_out)
+            channel_stream_out = output_buffer.stream_in
+
         bundle_ready   = Array(Signal(              name=f"bundle{i}_ready")   for i in range(self._no_bundles))
         bundle_sample  = Array(Signal(sample_width, name=f"bundle{i}_sample")  for i in range(self._no_bundles))
         bundle_channel = Array(Signal(bundle_bits,  name=f"bundle{i}_channel") for i in range(self._no_bundles))
@@ -77,7 +89,7 @@ class BundleMultiplexer(Elaboratable):
 
         def handle_last_channel():
             with m.If(last_bundle):
-                m.d.comb += self.channel_stream_out.last.eq(1)
+                m.d.comb += channel_stream_out.last.eq(1)
                 m.d.sync += [
                     current_bundle.eq(0),
                     first_bundle_channel.eq(0),
@@ -88,16 +100,16 @@ class BundleMultiplexer(Elaboratable):
                     first_bundle_channel.eq(first_bundle_channel + self.no_channels_in[current_bundle])
                 ]
 
-        with m.If(self.channel_stream_out.ready):
+        with m.If(channel_stream_out.ready):
             # bundle is active (ie. ADAT cable plugged in and synced)
             with m.If(self.bundle_active_in[current_bundle]):
                 with m.If(bundle_ready[current_bundle]):
                     m.d.comb += [
-                        self.channel_stream_out.payload.eq(bundle_sample[current_bundle]),
-                        self.channel_stream_out.channel_nr.eq(first_bundle_channel + bundle_channel[current_bundle]),
+                        channel_stream_out.payload.eq(bundle_sample[current_bundle]),
+                        channel_stream_out.channel_nr.eq(first_bundle_channel + bundle_channel[current_bundle]),
                         read_enable[current_bundle].eq(1),
-                        self.channel_stream_out.valid.eq(1),
-                        self.channel_stream_out.first.eq((current_bundle == 0) & (bundle_channel[current_bundle] == 0))
+                        channel_stream_out.valid.eq(1),
+                        channel_stream_out.first.eq((current_bundle == 0) & (bundle_channel[current_bundle] == 0))
                     ]
 
                     with m.If(last[current_bundle]):
@@ -107,11 +119,11 @@ class BundleMultiplexer(Elaboratable):
             with m.Else():
                 last_channel = Signal()
                 m.d.comb += [
-                    self.channel_stream_out.payload.eq(0),
-                    self.channel_stream_out.channel_nr.eq(first_bundle_channel + current_channel),
-                    self.channel_stream_out.valid.eq(1),
-                    self.channel_stream_out.first.eq(0),
-                    self.channel_stream_out.last.eq(0),
+                    channel_stream_out.payload.eq(0),
+                    channel_stream_out.channel_nr.eq(first_bundle_channel + current_channel),
+                    channel_stream_out.valid.eq(1),
+                    channel_stream_out.first.eq(0),
+                    channel_stream_out.last.eq(0),
                     last_channel.eq(current_channel == (self.no_channels_in[current_bundle] - 1))
                 ]
                 m.d.sync += current_channel.eq(current_channel + 1)
@@ -231,3 +243,30 @@ class BundleMultiplexerTest(GatewareTestCase):
             yield from self.send_all_bundle_frame()
 
         yield from self.advance_cycles(64)
+
+
+class BundleMultiplexerPipelinedTest(BundleMultiplexerTest):
+    FRAGMENT_ARGUMENTS  = dict(pipelined=True)
+
+    @sync_test_case
+    def test_order_with_backpressure(self):
+        dut = self.dut
+        for bundle in range(4):
+            yield self.dut.no_channels_in[bundle].eq(8)
+            yield dut.bundle_active_in[bundle].eq(1)
+
+        # fill the FIFOs with two frames of all bundles
+        yield dut.channel_stream_out.ready.eq(0)
+        for _ in range(2):
+            yield from self.send_all_bundle_frame()
+
+        received = []
+        for cycle in range(100):
+            yield dut.channel_stream_out.ready.eq(cycle % 3 != 0)
+            yield Settle()
+            if (yield dut.channel_stream_out.valid) and (yield dut.channel_stream_out.ready):
+                received.append(((yield dut.channel_stream_out.channel_nr), (yield dut.channel_stream_out.payload)))
+            yield
+
+        expected = [(bundle * 8 + channel, (bundle << 16) | channel) for bundle in range(4) for channel in range(8)]
+        self.assertEqual(received, 2 * expected)
@@ -1,31 +1,111 @@
 from amaranth         import *
 from amaranth.build   import *
-from amaranth.lib.cdc import ResetSynchronizer
+from amaranth.lib.cdc import FFSynchronizer, ResetSynchronizer
 
 from amlib.utils import SimpleClockDivider
 
+from pll_solver import ALTPLL, EHXPLLL, PLLE2
+
 
 class ClockDomainGeneratorBase():
     NO_PHASE_SHIFT  = 0
+    # whether the local PLLs also provide audio clocks for 44.1kHz
+    SUPPORTS_44_1k  = False
+
+    # description of the PLLs for pll_solver.py:
+    # the PLL primitive, the clocks of the audio PLL
+    # and whether the audio PLL is fed by the "usb" clock or the board "clk"
+    PLL_FAMILY          = None
+    AUDIO_PLL_CLOCKS    = ("adat", "dac", "sync", "fast")
+    AUDIO_PLL_REFERENCE = "usb"
+
+    def __init__(self):
+        # external audio clocks, for example recovered from an ADAT input
+        self.external_adat_clock_in  = Signal()
+        self.external_dac_clock_in   = Signal()
+        self.select_external_in      = Signal()
+        # selects the 44.1kHz local audio clocks, if SUPPORTS_44_1k and switch_44_1k
+        self.samplerate_44_1k_in     = Signal()
+        # set by the design before elaboration, to build the 44.1kHz clock switch
+        self.switch_44_1k            = False
+        # holds the audio domains in reset while their clock source switches
+        self.audio_clock_reset_in    = Signal()
+
+    def wire_up_audio_clocks(self, m, adat_clock, dac_clock, adat_clock_44_1k=None, dac_clock_44_1k=None):
+        """ drives the adat and dac domains either from the local PLL or from the external clocks
+
+            The external clocks come from the NCO of ADATClockRecovery, so their edges
+            snap to the fast clock: they have up to one fast clock period (9ns at 110.6MHz)
+            of jitter. The ADAT receivers on the other end recover their own clock, but
+            a DAC converts straight from its bit clock, so while slaved to an ADAT input
+            the DACs are only good for monitoring.
+        """
+        if self.switch_44_1k:
+            assert self.SUPPORTS_44_1k, f"{type(self).__name__} has no 44.1kHz audio clocks"
+            adat_clock = self.switch_audio_clock(m, "adat", adat_clock, adat_clock_44_1k)
+            dac_clock  = self.switch_audio_clock(m, "dac",  dac_clock,  dac_clock_44_1k)
+
+        m.d.comb += [
+            ClockSignal("adat").eq(self.global_clock_buffer(m, "adat",
+                self.clock_mux(m, "adat", self.select_external_in, adat_clock, self.external_adat_clock_in))),
+            ClockSignal("dac") .eq(self.global_clock_buffer(m, "dac",
+                self.clock_mux(m, "dac",  self.select_external_in, dac_clock,  self.external_dac_clock_in))),
+        ]
+
+    def clock_mux(self, m, name, select, clock0, clock1):
+        """ glitch free multiplexer of two unrelated clocks, for select from any domain
+
+            Each clock is gated on its falling edge, and only enabled after the
+            other one was disabled, so the output never has a short pulse.
+        """
+        clocks  = [clock0, clock1]
+        wanted  = [~select, select]
+        enables = [Signal(name=f"{name}_clock{i}_enable") for i in range(2)]
+
+        for i in range(2):
+            domain = f"{name}_clock{i}"
+            m.domains += ClockDomain(domain, clk_edge="neg", reset_less=True, local=True)
+            m.d.comb  += ClockSignal(domain).eq(clocks[i])
+
+            enable_in = Signal(name=f"{name}_clock{i}_enable_in")
+            m.d.comb += enable_in.eq(wanted[i] & ~enables[1 - i])
+            setattr(m.submodules, f"{name}_clock{i}_enable_sync",
+                    FFSynchronizer(enable_in, enables[i], o_domain=domain))
+
+        muxed_clock = Signal(name=f"{name}_clock_muxed")
+        m.d.comb += muxed_clock.eq((clock0 & enables[0]) | (clock1 & enables[1]))
+        return muxed_clock
+
+    def global_clock_buffer(self, m, name, clock):
+        """ returns clock on a global clock network. The families override this
+            with their clock buffer, here it is left to the toolchain """
+        return clock
 
     def wire_up_reset(self, m, reset):
+        audio_reset = reset | self.audio_clock_reset_in
         m.submodules.reset_sync_fast = ResetSynchronizer(reset, domain="fast")
         m.submodules.reset_sync_usb  = ResetSynchronizer(reset, domain="usb")
         m.submodules.reset_sync_sync = ResetSynchronizer(reset, domain="sync")
-        m.submodules.reset_sync_dac  = ResetSynchronizer(reset, domain="dac")
-        m.submodules.reset_sync_adat = ResetSynchronizer(reset, domain="adat")
+        m.submodules.reset_sync_dac  = ResetSynchronizer(audio_reset, domain="dac")
+        m.submodules.reset_sync_adat = ResetSynchronizer(audio_reset, domain="adat")
 
 class IntelCycloneIVClockDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
+    SUPPORTS_44_1k  = True
+    PLL_FAMILY      = ALTPLL
+
     ADAT_DIV_48k    = 83
     ADAT_MULT_48k   = 17
 
+    # 50MHz * 14 / 62 = 11.29032MHz is 64ppm above 44.1kHz * 256. The next closer
+    # fraction, 492 / 2179, exceeds the ALTPLL counters. The 48kHz clocks are 94ppm fast,
+    # 60MHz * 17 / 83, so both rates stay well within what the feedback endpoint corrects.
     ADAT_DIV_44_1k  = 62
     ADAT_MULT_44_1k = 14
 
     DUTY_CYCLE      = 50
 
     def __init__(self, *, clock_frequencies=None, clock_signal_name=None):
-        pass
+        super().__init__()
 
     def elaborate(self, platform):
         m = Module()
@@ -149,20 +229,56 @@ class IntelCycloneIVClockDomainGenerator(Elaboratable, ClockDomainGeneratorBase)
             reset.eq(~(sys_locked & audio_locked & fast_locked)),
             ClockSignal("fast").eq(fast_clock_48k),
             ClockSignal("usb") .eq(main_clocks[0]),
-            ClockSignal("adat").eq(audio_clocks[0]),
-            ClockSignal("dac").eq(audio_clocks[1]),
             ClockSignal("sync").eq(audio_clocks[3]),
         ]
 
+        self.wire_up_audio_clocks(m, adat_clock=audio_clocks[0], dac_clock=audio_clocks[1],
+                                  adat_clock_44_1k=main_clocks[1], dac_clock_44_1k=main_clocks[2])
+
         self.wire_up_reset(m, reset)
 
         return m
 
+    def switch_audio_clock(self, m, name, clock_48k, clock_44_1k):
+        """ returns the clock selected by samplerate_44_1k_in, from a global clock control block """
+        # a LUT multiplexer would glitch on a switch and put the clock on local routing,
+        # the glitch free switch over of the clock control block does neither.
+        # Its inclk[0] and inclk[1] are for dedicated clock pins, only inclk[2] and inclk[3]
+        # can be selected dynamically between PLL outputs. Which counters reach them is fixed
+        # for each clock control block: the 48kHz clocks are C0 (adat) and C1 (dac) of the
+        # audio PLL, the 44.1kHz clocks C1 (adat) and C2 (dac) of the main PLL, and the
+        # fitter places each switch on a block which is fed by both of its counters.
+        switched_clock = Signal(name=f"{name}_clock_switched")
+        setattr(m.submodules, f"{name}_clock_switch", Instance("altclkctrl",
+            p_clock_type                                   = "GLOBAL CLOCK",
+            p_number_of_clocks                             = 4,
+            p_ena_register_mode                            = "falling edge",
+            p_use_glitch_free_switch_over_implementation   = "ON",
+
+            i_inclk     = Cat(Const(0, 2), clock_48k, clock_44_1k),
+            i_clkselect = Cat(self.samplerate_44_1k_in, Const(1, 1)),
+            i_ena       = 1,
+            o_outclk    = switched_clock,
+        ))
+        return switched_clock
+
+    def global_clock_buffer(self, m, name, clock):
+        buffered_clock = Signal(name=f"{name}_clock_global")
+        setattr(m.submodules, f"{name}_clock_buffer", Instance("altclkctrl",
+            p_clock_type       = "GLOBAL CLOCK",
+            p_number_of_clocks = 1,
+
+            i_inclk  = clock,
+            i_ena    = 1,
+            o_outclk = buffered_clock,
+        ))
+        return buffered_clock
+
 
 class IntelCycloneVClockDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
 
     def __init__(self, *, clock_frequencies=None, clock_signal_name=None):
-        pass
+        super().__init__()
 
     def elaborate(self, platform):
         m = Module()
@@ -228,23 +344,30 @@ class IntelCycloneVClockDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
         m.d.comb += [
             reset.eq(~(sys_locked & audio_locked)),
             ClockSignal("usb") .eq(main_clock),
-            ClockSignal("adat").eq(audio_clocks[0]),
-            ClockSignal("dac").eq(audio_clocks[1]),
             ClockSignal("sync").eq(audio_clocks[2]),
             ClockSignal("fast").eq(audio_clocks[3])
         ]
 
+        self.wire_up_audio_clocks(m, adat_clock=audio_clocks[0], dac_clock=audio_clocks[1])
+
         self.wire_up_reset(m, reset)
 
         return m
 
+    # the same clock control block as on Cyclone IV
+    global_clock_buffer = IntelCycloneIVClockDomainGenerator.global_clock_buffer
+
+
 class Xilinx7SeriesClockDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
+    PLL_FAMILY       = PLLE2
+    # the DAC clock needs a larger divider than one PLLE2 output has
+    AUDIO_PLL_CLOCKS = ("adat", "sync", "fast")
     ADAT_DIV_48k    = 83
     ADAT_MULT_48k   = 17
     DUTY_CYCLE      = 0.5
 
     def __init__(self, *, clock_frequencies=None, clock_signal_name=None):
-        pass
+        super().__init__()
 
     def elaborate(self, platform):
         m = Module()
@@ -361,22 +484,35 @@ class Xilinx7SeriesClockDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
             reset.eq(~(sys_locked & audio_locked & fast_locked)),
             ClockSignal("fast").eq(fast_clock_48k),
             ClockSignal("usb") .eq(main_clocks[0]),
-            ClockSignal("adat").eq(audio_clocks[0]),
-            ClockSignal("dac").eq(audio_clocks[1]),
             ClockSignal("sync").eq(audio_clocks[3]),
         ]
 
+        self.wire_up_audio_clocks(m, adat_clock=audio_clocks[0], dac_clock=audio_clocks[1])
+
         self.wire_up_reset(m, reset)
 
         return m
 
+    def global_clock_buffer(self, m, name, clock):
+        buffered_clock = Signal(name=f"{name}_clock_global")
+        setattr(m.submodules, f"{name}_clock_buffer", Instance("BUFG",
+            i_I = clock,
+            o_O = buffered_clock,
+        ))
+        return buffered_clock
+
+
 class ColorlightDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
     """ Clock generator for the Colorlight I5 board. """
+    PLL_FAMILY          = EHXPLLL
+    # sync runs from the USB clock and the DAC clock is divided down from the ADAT clock
+    AUDIO_PLL_CLOCKS    = ("adat", "fast")
+    AUDIO_PLL_REFERENCE = "clk"
     FastDomainDivider = 7
     FastClockFreq     = 25e6 * 29 / FastDomainDivider
 
     def __init__(self, clock_frequencies=None):
-        pass
+        super().__init__()
 
     def elaborate(self, platform):
         m = Module()
@@ -461,8 +597,9 @@ class ColorlightDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
                 a_MFG_GMCREF_SEL="2"
         )
 
-        audio_feedback = Signal()
-        audio_locked   = Signal()
+        audio_feedback   = Signal()
+        audio_locked     = Signal()
+        local_adat_clock = Signal()
         m.submodules.audio_pll = Instance("EHXPLLL",
 
                 # Status.
@@ -523,7 +660,7 @@ class ColorlightDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
 
                 # Generated clock outputs.
                 o_CLKOP=audio_feedback,
-                o_CLKOS=ClockSignal("adat"),
+                o_CLKOS=local_adat_clock,
                 o_CLKOS3=ClockSignal("fast"),
 
                 # Synthesis attributes.
@@ -548,7 +685,6 @@ class ColorlightDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
         m.d.comb += [
             ClockSignal("usb")     .eq(main_feedback),
             ClockSignal("sync")    .eq(ClockSignal("usb")),
-            ClockSignal("dac")     .eq(clk_div.clock_out),
             clk_div.clock_enable_in.eq(1),
 
             reset.eq(~(main_locked & audio_locked)),
@@ -560,6 +696,18 @@ class ColorlightDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
 
         ]
 
+        # the local DAC clock is divided down from the adat domain, so it follows the selected clock
+        self.wire_up_audio_clocks(m, adat_clock=local_adat_clock, dac_clock=clk_div.clock_out)
+
         self.wire_up_reset(m, reset)
 
         return m
+
+    def global_clock_buffer(self, m, name, clock):
+        buffered_clock = Signal(name=f"{name}_clock_global")
+        setattr(m.submodules, f"{name}_clock_buffer", Instance("DCCA",
+            i_CLKI = clock,
+            i_CE   = 1,
+            o_CLKO = buffered_clock,
+        ))
+        return buffered_clock
@@ -4,12 +4,17 @@ from amaranth.lib.fifo   import SyncFIFO
 from amlib.stream        import StreamInterface, connect_fifo_to_stream
 from amlib.test          import GatewareTestCase, sync_test_case
 
+from stream_skid_buffer  import StreamSkidBuffer
+
 class ChannelsToUSBStream(Elaboratable):
-    def __init__(self, max_nr_channels=2, sample_width=24, max_packet_size=256):
+    def __init__(self, max_nr_channels=2, sample_width=24, max_packet_size=256, pipelined=False):
         assert sample_width in [16, 24, 32]
 
         # parameters
         self._max_nr_channels = max_nr_channels
+        # register usb_stream_out with a skid buffer, so that its ready
+        # does not go through the postprocess FSM into the FIFO read enable
+        self._pipelined       = pipelined
         self._channel_bits    = Shape.cast(range(max_nr_channels)).width
         self._sample_width    = sample_width
         self._fifo_depth      = 2 * max_packet_size
@@ -40,6 +45,12 @@ class ChannelsToUSBStream(Elaboratable):
         m = Module()
         m.submodules.out_fifo = out_fifo = SyncFIFO(width=8 + self._channel_bits, depth=self._fifo_depth, fwft=True)
 
+        usb_stream_out = self.usb_stream_out
+        if self._pipelined:
+            m.submodules.output_skid_buffer = output_buffer = StreamSkidBuffer.like(self.usb_stream_out)
+            m.d.comb += self.usb_stream_out.stream_eq(output_buffer.stream_out)
+            usb_stream_out = output_buffer.stream_in
+
         channel_stream  = self.channel_stream_in
         channel_valid   = Signal()
         channel_ready   = Signal()
@@ -64,10 +75,10 @@ class ChannelsToUSBStream(Elaboratable):
             ]
 
         m.d.comb += [
-            self.usb_stream_out.payload.eq(out_fifo.r_data[:8]),
+            usb_stream_out.payload.eq(out_fifo.r_data[:8]),
             self.out_channel.eq(out_fifo.r_data[8:]),
-            self.usb_stream_out.valid.eq(out_valid),
-            out_stream_ready.eq(self.usb_stream_out.ready),
+            usb_stream_out.valid.eq(out_valid),
+            out_stream_ready.eq(usb_stream_out.ready),
             channel_valid.eq(channel_stream.valid),
             channel_stream.ready.eq(channel_ready),
             self.level.eq(out_fifo.r_level),
@@ -75,7 +86,7 @@ class ChannelsToUSBStream(Elaboratable):
             self.fifo_read.eq(out_fifo.r_en),
         ]
 
-        with m.If(self.usb_stream_out.valid & self.usb_stream_out.ready):
+        with m.If(usb_stream_out.valid & usb_stream_out.ready):
             m.d.sync += self.done.eq(self.done + 1)
 
         with m.If(self.data_requested_in):
@@ -158,7 +169,12 @@ class ChannelsToUSBStream(Elaboratable):
         ]
 
         with m.If(self.frame_finished_in):
-            m.d.sync += byte_pos.eq(0)
+            if self._pipelined:
+                # the host reads whole samples, so the bytes the skid buffer
+                # prefetched past the end of the frame start the next packet
+                m.d.sync += byte_pos.eq(output_buffer.level_out + (out_valid & out_stream_ready))
+            else:
+                m.d.sync += byte_pos.eq(0)
 
         # this FSM handles reading fron the FIFO
         # this FSM provides robustness against
@@ -168,7 +184,7 @@ class ChannelsToUSBStream(Elaboratable):
         with m.FSM(name="fifo_postprocess") as fsm:
             with m.State("NORMAL"):
                 m.d.comb += [
-                    out_fifo.r_en.eq(self.usb_stream_out.ready),
+                    out_fifo.r_en.eq(usb_stream_out.ready),
                     out_valid.eq(out_fifo.r_rdy)
                 ]
 
@@ -187,7 +203,7 @@ class ChannelsToUSBStream(Elaboratable):
                     with m.If((self.out_channel != channel_counter)):
                         m.d.comb += [
                             out_fifo.r_en.eq(0),
-                            self.usb_stream_out.payload.eq(0),
+                            usb_stream_out.payload.eq(0),
                             out_valid.eq(1),
                             self.filling.eq(1),
                         ]
@@ -206,6 +222,10 @@ class ChannelsToUSBStream(Elaboratable):
                         m.next = "DISCARD"
 
             with m.State("DISCARD"):
+                if self._pipelined:
+                    # prefetched bytes of the discarded samples must not go out either
+                    m.d.comb += output_buffer.flush_in.eq(1)
+
                 with m.If(out_fifo.r_rdy):
                     m.d.comb += [
                         out_fifo.r_en.eq(1),
@@ -217,13 +237,21 @@ class ChannelsToUSBStream(Elaboratable):
                         m.next = "NORMAL"
 
             with m.State("FILL"):
-                channel_is_ok = fifo_level_sufficient & (self.out_channel == channel_counter)
-                with m.If(self.frame_finished_in | channel_is_ok):
+                # only leave at a sample boundary, otherwise the FIFO bytes
+                # would go out in the wrong byte positions of the packet
+                channel_is_ok = fifo_level_sufficient & (self.out_channel == channel_counter) & first_byte
+                frame_ended   = self.frame_finished_in
+                if self._pipelined:
+                    # fill bytes which the skid buffer holds at the end of the frame
+                    # start the next packet: complete their sample before reading again
+                    frame_ended = self.frame_finished_in & (output_buffer.level_out == 0)
+
+                with m.If(frame_ended | channel_is_ok):
                     m.next = "NORMAL"
                 with m.Else():
                     m.d.comb += [
                         out_fifo.r_en.eq(0),
-                        self.usb_stream_out.payload.eq(0),
+                        usb_stream_out.payload.eq(0),
                         out_valid.eq(1),
                         self.filling.eq(1),
                     ]
@@ -290,4 +318,8 @@ class ChannelsToUSBStreamTest(GatewareTestCase):
         yield from self.send_one_frame(0x737271, 7)
         yield dut.channel_stream_in.valid.eq(0)
         yield
-        for _ in range(45): yield
\ No newline at end of file
+        for _ in range(45): yield
+
+
+class ChannelsToUSBStreamPipelinedTest(ChannelsToUSBStreamTest):
+    FRAGMENT_ARGUMENTS = dict(max_nr_channels=8, pipelined=True)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    mailbox which hands USB control requests to the SoC firmware and its responses back
+
+    UAC2RequestHandlers puts the requests it does not handle itself into the mailbox,
+    together with the data stage of OUT requests, and NAKs until the firmware has written
+    the response data, or asked to stall the request.
+"""
+from amaranth          import *
+from amaranth.build    import Platform
+from amaranth.lib.cdc  import FFSynchronizer
+from amaranth.sim      import Settle
+from amlib.test        import GatewareTestCase, sync_test_case
+
+from lambdasoc.periph  import Peripheral
+
+# the setup packet: bmRequestType, bRequest, wValue, wIndex, wLength
+SETUP_WIDTH = 64
+
+class ControlMailbox(Elaboratable):
+    """ the request and response buffers, and the handshake between the USB and the SoC clock domain
+
+        The USB side hands over a request with a pulse on request_in, after it has
+        written the data stage of an OUT request into the request buffer.
+        pending_out then tells the SoC side, which reads the request with
+        address_in/data_out, writes the response with address_in/data_in and
+        finishes it with respond_in. Then response_ready_out is set on the USB side,
+        until the next request. A request which is replaced by a newer one before
+        the firmware responds is never answered.
+    """
+    def __init__(self, buffer_size: int=64, usb_domain: str="usb"):
+        self._buffer_size = buffer_size
+        self._usb_domain  = usb_domain
+        address_width     = Shape.cast(range(buffer_size)).width
+
+        # USB side
+        self.setup_in            = Signal(SETUP_WIDTH)
+        self.request_in          = Signal()
+        self.out_write_in        = Signal()
+        self.out_address_in      = Signal(address_width)
+        self.out_data_in         = Signal(8)
+        self.response_ready_out  = Signal()
+        self.response_stall_out  = Signal()
+        self.response_length_out = Signal(range(buffer_size + 1))
+        self.in_address_in       = Signal(address_width)
+        self.in_data_out         = Signal(8)
+
+        # SoC side
+        self.setup_out           = Signal(SETUP_WIDTH)
+        self.pending_out         = Signal()
+        self.address_in          = Signal(address_width)
+        self.data_out            = Signal(8)
+        self.data_write_in       = Signal()
+        self.data_in             = Signal(8)
+        self.respond_in          = Signal()
+        self.respond_stall_in    = Signal()
+        self.respond_length_in   = Signal(range(buffer_size + 1))
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        request_buffer  = Memory(width=8, depth=self._buffer_size)
+        response_buffer = Memory(width=8, depth=self._buffer_size)
+
+        m.submodules.request_write  = request_write  = request_buffer.write_port(domain=self._usb_domain)
+        m.submodules.request_read   = request_read   = request_buffer.read_port(domain="comb")
+        m.submodules.response_write = response_write = response_buffer.write_port(domain="sync")
+        m.submodules.response_read  = response_read  = response_buffer.read_port(domain="comb")
+
+        m.d.comb += [
+            request_write.addr.eq(self.out_address_in),
+            request_write.data.eq(self.out_data_in),
+            request_write.en.eq(self.out_write_in),
+            request_read.addr.eq(self.address_in),
+            self.data_out.eq(request_read.data),
+
+            response_write.addr.eq(self.address_in),
+            response_write.data.eq(self.data_in),
+            response_write.en.eq(self.data_write_in),
+            response_read.addr.eq(self.in_address_in),
+            self.in_data_out.eq(response_read.data),
+        ]
+
+        # each request flips request_toggle, the response to it sets response_toggle to the same value
+        request_toggle      = Signal()
+        setup               = Signal(SETUP_WIDTH)
+        with m.If(self.request_in):
+            m.d[self._usb_domain] += [
+                request_toggle.eq(~request_toggle),
+                setup.eq(self.setup_in),
+            ]
+
+        request_toggle_soc  = Signal()
+        seen_toggle         = Signal()
+        response_toggle     = Signal()
+        m.submodules.request_synchronizer = FFSynchronizer(request_toggle, request_toggle_soc)
+
+        # setup is stable by the time its request toggle made it through the synchronizer
+        with m.If(request_toggle_soc != seen_toggle):
+            m.d.sync += [
+                seen_toggle.eq(request_toggle_soc),
+                self.setup_out.eq(setup),
+                self.pending_out.eq(1),
+            ]
+        with m.Elif(self.respond_in & self.pending_out):
+            m.d.sync += [
+                response_toggle.eq(seen_toggle),
+                self.response_stall_out.eq(self.respond_stall_in),
+                self.response_length_out.eq(self.respond_length_in),
+                self.pending_out.eq(0),
+            ]
+
+        response_toggle_usb = Signal()
+        m.submodules.response_synchronizer = \
+            FFSynchronizer(response_toggle, response_toggle_usb, o_domain=self._usb_domain)
+
+        # stall and length are stable by the time the response toggle made it through the synchronizer
+        m.d.comb += self.response_ready_out.eq((response_toggle_usb == request_toggle) & ~self.request_in)
+
+        return m
+
+
+class ControlMailboxPeripheral(Peripheral, Elaboratable):
+    """ CSR peripheral which gives the firmware access to the control mailbox
+
+        pending reads one while a request waits for its response, setup_low holds
+        bmRequestType, bRequest and wValue, setup_high wIndex and wLength.
+        address sets the position in the buffers, reading request_data returns the
+        next byte of the data stage and writing response_data stores the next byte of
+        the response. Writing respond with the length of the response, or with bit 7
+        set to stall the request, finishes it.
+    """
+    def __init__(self, buffer_size: int=64, usb_domain: str="usb"):
+        super().__init__()
+
+        self.mailbox = ControlMailbox(buffer_size=buffer_size, usb_domain=usb_domain)
+        address_width = len(self.mailbox.address_in)
+
+        bank                 = self.csr_bank()
+        self._pending        = bank.csr(1,  "r")
+        self._setup_low      = bank.csr(32, "r")
+        self._setup_high     = bank.csr(32, "r")
+        self._address        = bank.csr(address_width, "w")
+        self._request_data   = bank.csr(8,  "r")
+        self._response_data  = bank.csr(8,  "w")
+        self._respond        = bank.csr(8,  "w")
+
+        self._bridge         = self.bridge(data_width=32, granularity=8, alignment=2)
+        self.bus             = self._bridge.bus
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+        m.submodules.bridge  = self._bridge
+        m.submodules.mailbox = mailbox = self.mailbox
+
+        address = mailbox.address_in
+
+        m.d.comb += [
+            self._pending.r_data.eq(mailbox.pending_out),
+            self._setup_low.r_data.eq(mailbox.setup_out[:32]),
+            self._setup_high.r_data.eq(mailbox.setup_out[32:]),
+            self._request_data.r_data.eq(mailbox.data_out),
+
+            mailbox.data_in.eq(self._response_data.w_data),
+            mailbox.data_write_in.eq(self._response_data.w_stb),
+
+            mailbox.respond_in.eq(self._respond.w_stb),
+            mailbox.respond_length_in.eq(self._respond.w_data[:7]),
+            mailbox.respond_stall_in.eq(self._respond.w_data[7]),
+        ]
+
+        # reading or writing data advances to the next byte
+        with m.If(self._address.w_stb):
+            m.d.sync += address.eq(self._address.w_data)
+        with m.Elif(self._request_data.r_stb | self._response_data.w_stb):
+            m.d.sync += address.eq(address + 1)
+
+        return m
+
+
+class ControlMailboxTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = ControlMailbox
+    FRAGMENT_ARGUMENTS  = dict(buffer_size=8, usb_domain="sync")
+
+    def wait_for(self, signal, value=1, cycles=8):
+        for _ in range(cycles):
+            yield Settle()
+            if (yield signal) == value:
+                return
+            yield
+        self.fail(f"{signal.name} did not become {value}")
+
+    def request(self, setup, data=()):
+        dut = self.dut
+        for address, byte in enumerate(data):
+            yield dut.out_address_in.eq(address)
+            yield dut.out_data_in.eq(byte)
+            yield dut.out_write_in.eq(1)
+            yield
+        yield dut.out_write_in.eq(0)
+        yield dut.setup_in.eq(setup)
+        yield dut.request_in.eq(1)
+        yield
+        yield dut.request_in.eq(0)
+
+    def respond(self, response, stall=False):
+        dut = self.dut
+        for address, byte in enumerate(response):
+            yield dut.address_in.eq(address)
+            yield dut.data_in.eq(byte)
+            yield dut.data_write_in.eq(1)
+            yield
+        yield dut.data_write_in.eq(0)
+        yield dut.respond_length_in.eq(len(response))
+        yield dut.respond_stall_in.eq(stall)
+        yield dut.respond_in.eq(1)
+        yield
+        yield dut.respond_in.eq(0)
+
+    @sync_test_case
+    def test_in_request(self):
+        dut   = self.dut
+        setup = 0x0004_0000_0000_01c0
+        yield from self.request(setup)
+        yield Settle()
+        self.assertFalse((yield dut.response_ready_out))
+
+        yield from self.wait_for(dut.pending_out)
+        self.assertEqual((yield dut.setup_out), setup)
+        yield from self.respond([0xde, 0xad, 0xbe])
+        self.assertFalse((yield dut.pending_out))
+
+        yield from self.wait_for(dut.response_ready_out)
+        self.assertEqual((yield dut.response_length_out), 3)
+        self.assertFalse((yield dut.response_stall_out))
+        received = []
+        for address in range(3):
+            yield dut.in_address_in.eq(address)
+            yield Settle()
+            received.append((yield dut.in_data_out))
+        self.assertEqual(received, [0xde, 0xad, 0xbe])
+
+    @sync_test_case
+    def test_out_request(self):
+        dut = self.dut
+        yield from self.request(0x0002_0000_0000_0140, data=[0x12, 0x34])
+        yield from self.wait_for(dut.pending_out)
+        received = []
+        for address in range(2):
+            yield dut.address_in.eq(address)
+            yield Settle()
+            received.append((yield dut.data_out))
+        self.assertEqual(received, [0x12, 0x34])
+
+        yield from self.respond([], stall=True)
+        yield from self.wait_for(dut.response_ready_out)
+        self.assertTrue((yield dut.response_stall_out))
+
+        # the next request needs a response of its own
+        yield from self.request(0x0000_0000_0000_0140)
+        yield Settle()
+        self.assertFalse((yield dut.response_ready_out))
+        yield from self.wait_for(dut.pending_out)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import argparse
+import unittest
+from collections import deque
+
+import numpy as np
+
+from amaranth.sim               import Simulator
+from amlib.dsp.convolution.mac  import StereoConvolutionMAC, ConvolutionMode
+
+from wav_io import WavReader, rescale, load_impulse_response
+
+class ReferenceConvolver():
+    """ Bit exact, streaming NumPy model of the fixed point stereo FIR in StereoConvolutionMAC
+
+        The convolution runs as FFT overlap-add. To keep it exact, the taps are split into
+        8 bit limbs: each partial convolution then stays well below the 53 bit mantissa
+        of a double, so rounding the inverse FFT gives back the exact integer result.
+    """
+    LIMB_BITS = 8
+    NO_LIMBS  = 3
+
+    def __init__(self, taps, mode=ConvolutionMode.CROSSFEED, bitwidth: int=24, output_shift: int=None):
+        assert bitwidth <= self.LIMB_BITS * self.NO_LIMBS, f"taps wider than {self.LIMB_BITS * self.NO_LIMBS} bits are not supported"
+        self._taps         = np.asarray(taps, dtype=np.int64)
+        self._mode         = mode
+        self._bitwidth     = bitwidth
+        # multiplying two Q1.(bitwidth-1) numbers yields a Q2.(2*bitwidth-2) product
+        self._output_shift = bitwidth - 1 if output_shift is None else output_shift
+
+        # [input channel, output channel] -> IR channel
+        if mode == ConvolutionMode.CROSSFEED:
+            self._routing = { (0, 0): 0, (1, 0): 1, (1, 1): 0, (0, 1): 1 }
+        elif mode == ConvolutionMode.STEREO:
+            self._routing = { (0, 0): 0, (1, 1): 1 }
+        else:
+            self._routing = { (0, 0): 0, (1, 1): 0 }
+
+        mask        = (1 << self.LIMB_BITS) - 1
+        self._limbs = [[(self._taps[:, ch] >> (self.LIMB_BITS * limb)) & mask for limb in range(self.NO_LIMBS - 1)] +
+                       [self._taps[:, ch] >> (self.LIMB_BITS * (self.NO_LIMBS - 1))]
+                       for ch in range(2)]
+        self._limb_spectra = {}
+
+        self._tail = np.zeros((len(self._taps) - 1, 2), dtype=np.int64)
+
+    def _spectra(self, fft_size: int):
+        if fft_size not in self._limb_spectra:
+            self._limb_spectra[fft_size] = [[np.fft.rfft(limb, fft_size) for limb in channel] for channel in self._limbs]
+        return self._limb_spectra[fft_size]
+
+    def _convolve(self, signal_spectrum, ir_channel: int, fft_size: int, length: int):
+        result = np.zeros(length, dtype=np.int64)
+        for nr, limb_spectrum in enumerate(self._spectra(fft_size)[ir_channel]):
+            partial = np.fft.irfft(signal_spectrum * limb_spectrum, fft_size)[:length]
+            result += np.rint(partial).astype(np.int64) << (self.LIMB_BITS * nr)
+        return result
+
+    def accumulate(self, signal):
+        """ returns the full precision accumulator values for the next chunk of stereo input frames """
+        signal  = np.asarray(signal, dtype=np.int64)
+        length  = len(signal) + len(self._taps) - 1
+        fft_size = 1 << (length - 1).bit_length()
+
+        spectra = [np.fft.rfft(signal[:, ch], fft_size) for ch in range(2)]
+
+        acc = np.zeros((length, 2), dtype=np.int64)
+        acc[:len(self._tail)] += self._tail
+        for (in_channel, out_channel), ir_channel in self._routing.items():
+            acc[:, out_channel] += self._convolve(spectra[in_channel], ir_channel, fft_size, length)
+
+        self._tail = acc[len(signal):]
+        return acc[:len(signal)]
+
+    def process(self, signal):
+        """ returns the output samples, as the hardware emits them, for the next chunk of stereo input frames """
+        shifted = self.accumulate(signal) >> self._output_shift
+        # the output payload is bitwidth bits wide, so it wraps around
+        offset = 1 << (self._bitwidth - 1)
+        return ((shifted + offset) & ((1 << self._bitwidth) - 1)) - offset
+
+
+class ConvolutionReport():
+    def __init__(self):
+        self.frames       = 0
+        self.max_error    = 0
+        self.signal_power = 0.0
+        self.error_power  = 0.0
+
+    def add(self, dut_output, reference_output):
+        error = np.asarray(dut_output, dtype=np.int64) - reference_output
+        self.frames       += len(reference_output)
+        self.max_error     = max(self.max_error, int(np.abs(error).max(initial=0)))
+        self.signal_power += float(np.sum(reference_output.astype(np.float64) ** 2))
+        self.error_power  += float(np.sum(error.astype(np.float64) ** 2))
+
+    @property
+    def snr(self):
+        if self.error_power == 0:
+            return float("inf")
+        if self.signal_power == 0:
+            return float("-inf")
+        return 10 * np.log10(self.signal_power / self.error_power)
+
+    def __str__(self):
+        return f"frames: {self.frames} max error: {self.max_error} LSB SNR: {self.snr:.2f} dB"
+
+
+class ConvolutionRegression():
+    """ streams stereo input through a simulation of StereoConvolutionMAC
+        and compares the output against the ReferenceConvolver, chunk by chunk """
+
+    def __init__(self, taps, *, mode=ConvolutionMode.CROSSFEED, bitwidth: int=24, samplerate: int=48000,
+                 clockfrequency: float=60e6, output_shift: int=None):
+        self._bitwidth       = bitwidth
+        self._clockfrequency = clockfrequency
+        self.dut = StereoConvolutionMAC(taps=taps, samplerate=samplerate, clockfrequency=clockfrequency,
+                                        bitwidth=bitwidth, convolutionMode=mode)
+        self.reference = ReferenceConvolver(taps, mode, bitwidth, output_shift)
+        self.report    = ConvolutionReport()
+        # the output frames of the DUT, if run() is asked to keep them
+        self.output    = []
+
+    def run(self, signal_chunks, *, timeout_cycles: int=100000, vcd_file: str=None, verbose: bool=False,
+            keep_output: bool=False):
+        """ runs the simulation over an iterable of (frames, 2) chunks, returns a ConvolutionReport """
+        dut        = self.dut
+        pending    = deque()
+        received   = []
+        state      = dict(sent=0, done=False)
+        sign_bit   = 1 << (self._bitwidth - 1)
+
+        def send_sample(payload, first):
+            yield dut.signal_in.payload.eq(int(payload) & ((1 << self._bitwidth) - 1))
+            yield dut.signal_in.first.eq(first)
+            yield dut.signal_in.last.eq(not first)
+            yield dut.signal_in.valid.eq(1)
+            yield
+            while not (yield dut.signal_in.ready):
+                yield
+            yield dut.signal_in.valid.eq(0)
+
+        def feeder():
+            for chunk in signal_chunks:
+                pending.append(self.reference.process(chunk))
+                for left, right in chunk:
+                    yield from send_sample(left,  first=True)
+                    yield from send_sample(right, first=False)
+                    state["sent"] += 1
+            state["done"] = True
+
+        def collector():
+            yield dut.signal_out.ready.eq(1)
+            frame      = []
+            idle       = 0
+            compared   = 0
+            while not (state["done"] and compared == state["sent"]):
+                yield
+                idle += 1
+                assert idle < timeout_cycles, f"convolver stopped producing output after {compared} frames"
+
+                if not (yield dut.signal_out.valid):
+                    continue
+
+                idle = 0
+                payload = yield dut.signal_out.payload
+                frame.append((payload ^ sign_bit) - sign_bit)
+                if len(frame) < 2:
+                    continue
+
+                received.append(frame)
+                frame = []
+
+                if pending and len(received) == len(pending[0]):
+                    reference = pending.popleft()
+                    self.report.add(np.array(received), reference)
+                    if keep_output:
+                        self.output.extend(received)
+                    compared += len(received)
+                    received.clear()
+                    if verbose:
+                        print(self.report)
+
+        sim = Simulator(dut)
+        sim.add_clock(1.0/self._clockfrequency)
+        sim.add_sync_process(feeder)
+        sim.add_sync_process(collector)
+
+        if vcd_file is not None:
+            with sim.write_vcd(vcd_file):
+                sim.run()
+        else:
+            sim.run()
+
+        return self.report
+
+
+class ReferenceConvolverTest(unittest.TestCase):
+    def direct_convolution(self, signal, taps, bitwidth):
+        left  = np.convolve(signal[:, 0], taps[:, 0]) + np.convolve(signal[:, 1], taps[:, 1])
+        right = np.convolve(signal[:, 1], taps[:, 0]) + np.convolve(signal[:, 0], taps[:, 1])
+        return np.stack([left, right], axis=1)[:len(signal)] >> (bitwidth - 1)
+
+    def test_chunked_matches_direct_convolution(self):
+        rng    = np.random.default_rng(42)
+        taps   = rng.integers(-2**23, 2**23, size=(300, 2), dtype=np.int64)
+        signal = rng.integers(-2**23, 2**23, size=(1000, 2), dtype=np.int64)
+
+        reference = ReferenceConvolver(taps, ConvolutionMode.CROSSFEED, bitwidth=24)
+        accumulated = np.concatenate([reference.accumulate(signal[i:i + 137]) for i in range(0, len(signal), 137)])
+
+        np.testing.assert_array_equal(accumulated >> 23, self.direct_convolution(signal, taps, 24))
+
+
+class ConvolutionRegressionTest(unittest.TestCase):
+    # the reference is bit exact, so this leaves room for one LSB of rounding at most
+    MAX_ERROR_LSB = 1
+    MIN_SNR_DB    = 100
+
+    def test_short_signal(self):
+        rng    = np.random.default_rng(23)
+        taps   = rng.integers(-2**20, 2**20, size=(16, 2), dtype=np.int64).astype(np.int32)
+        signal = rng.integers(-2**20, 2**20, size=(24, 2), dtype=np.int64)
+
+        regression = ConvolutionRegression(taps)
+        report = regression.run([signal[:12], signal[12:]])
+        self.assertEqual(report.frames, len(signal))
+        self.assertLessEqual(report.max_error, self.MAX_ERROR_LSB)
+        self.assertGreaterEqual(report.snr, self.MIN_SNR_DB)
+
+    def test_output_shift(self):
+        # a single tap of one half in Q1.23 and an impulse, so the MAC output shows its actual shift
+        bitwidth = 24
+        taps     = np.zeros((16, 2), dtype=np.int32)
+        taps[0, 0] = 1 << (bitwidth - 2)
+        signal   = np.zeros((8, 2), dtype=np.int64)
+        signal[0, 0] = 1 << 20
+
+        regression = ConvolutionRegression(taps, bitwidth=bitwidth)
+        report = regression.run([signal], keep_output=True)
+        output = np.array(regression.output)
+
+        accumulated = ReferenceConvolver(taps, bitwidth=bitwidth).accumulate(signal)
+        self.assertEqual(accumulated[0, 0], 1 << (20 + bitwidth - 2))
+        # crossfeed: the left input goes to the left output through IR channel 0
+        self.assertEqual(output[0, 0], 1 << 19)
+        self.assertEqual(output[0, 0], accumulated[0, 0] >> (bitwidth - 1))
+        self.assertEqual(report.max_error, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare the simulated convolver against the NumPy reference")
+    parser.add_argument("signal", help="stereo WAV file to stream through the convolver")
+    parser.add_argument("--ir", default="IRs/DT990_crossfeed_4800taps.wav", help="stereo impulse response WAV file")
+    parser.add_argument("--taps", type=int, default=64, help="number of IR taps to use")
+    parser.add_argument("--frames", type=int, default=None, help="stop after this many frames of the signal")
+    parser.add_argument("--chunk", type=int, default=1024, help="frames per simulation chunk")
+    parser.add_argument("--bitwidth", type=int, default=24)
+    parser.add_argument("--output-shift", type=int, default=None, help="accumulator right shift, defaults to bitwidth - 1")
+    parser.add_argument("--vcd", default=None, help="write a VCD of the simulation to this file")
+    args = parser.parse_args()
+
+    with WavReader(args.signal) as wav:
+        assert wav.channels == 2, "the test signal needs to be stereo"
+        taps = load_impulse_response(args.ir, wav.samplerate, args.bitwidth, tapcount=args.taps)
+
+        def chunks():
+            remaining = args.frames
+            for chunk in wav.chunks(args.chunk):
+                if remaining is not None:
+                    chunk = chunk[:remaining]
+                    remaining -= len(chunk)
+                yield rescale(chunk, wav.sample_bits, args.bitwidth)
+                if remaining == 0:
+                    return
+
+        regression = ConvolutionRegression(taps, bitwidth=args.bitwidth, samplerate=wav.samplerate,
+                                           output_shift=args.output_shift)
+        report = regression.run(chunks(), vcd_file=args.vcd, verbose=True)
+
+    print(report)
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import argparse
+import ctypes
+import importlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import contextmanager
+
+from amaranth.hdl.ast import Const, Signal, Slice, Assign, Value
+from amaranth.hdl.ir  import Fragment
+from amaranth.back    import rtlil
+from amaranth.sim     import Simulator as PythonSimulator, Settle, Delay, Tick, Passive
+
+from build_cache        import BuildCache
+from resource_benchmark import elaboratable_ports
+
+# selects the simulator for create_simulator(), "pysim" or "cxxrtl"
+ENGINE_VARIABLE = "GATEWARE_SIMULATOR"
+
+CXXRTL_CACHE_DIRECTORY = os.path.join(".build_cache", "cxxrtl")
+
+# a C interface which does not depend on the layout of struct cxxrtl_object,
+# which changes between yosys versions
+SHIM = r"""
+#include <cstring>
+#include "design.cc"
+#include CAPI_SOURCE
+
+extern "C" {
+    cxxrtl_handle sim_create() { return cxxrtl_create(cxxrtl_design_create()); }
+    void sim_destroy(cxxrtl_handle handle) { cxxrtl_destroy(handle); }
+    size_t sim_step(cxxrtl_handle handle) { return cxxrtl_step(handle); }
+
+    cxxrtl_object *sim_get(cxxrtl_handle handle, const char *name) {
+        size_t parts = 0;
+        cxxrtl_object *object = cxxrtl_get_parts(handle, name, &parts);
+        return parts == 1 ? object : nullptr;
+    }
+    size_t sim_width(cxxrtl_object *object) { return object->width; }
+
+    void sim_read(cxxrtl_object *object, uint32_t *chunks) {
+        std::memcpy(chunks, object->curr, ((object->width + 31) / 32) * sizeof(uint32_t));
+    }
+    void sim_write(cxxrtl_object *object, const uint32_t *chunks) {
+        uint32_t *target = object->next ? object->next : object->curr;
+        std::memcpy(target, chunks, ((object->width + 31) / 32) * sizeof(uint32_t));
+    }
+}
+"""
+
+def cxxrtl_sources(yosys):
+    """ the include directory and the C API source of the CXXRTL runtime bundled with yosys """
+    include = os.path.join(str(yosys.data_dir()), "include")
+    runtime = os.path.join(include, "backends", "cxxrtl", "runtime")
+    if os.path.isdir(runtime):
+        return runtime, "<cxxrtl/capi/cxxrtl_capi.cc>"
+    return include, "<backends/cxxrtl/cxxrtl_capi.cc>"
+
+def compile_cxxrtl(il: str, cache_directory: str=CXXRTL_CACHE_DIRECTORY, compiler: str=None) -> str:
+    """ translates RTLIL to C++ with the bundled yosys and compiles it into a shared library,
+        which is cached by the hash of the RTLIL """
+    from amaranth._toolchain.yosys import find_yosys
+
+    yosys    = find_yosys(lambda version: version >= (0, 10))
+    compiler = compiler or os.environ.get("CXX", "c++")
+    flags    = ["-std=c++14", "-O1", "-shared", "-fPIC"]
+    library  = os.path.join(cache_directory, BuildCache.key(il, SHIM, compiler, flags) + ".so")
+    if os.path.exists(library):
+        return library
+
+    include, capi_source = cxxrtl_sources(yosys)
+    os.makedirs(cache_directory, exist_ok=True)
+    with tempfile.TemporaryDirectory() as directory:
+        il_file   = os.path.join(directory, "design.il")
+        shim_file = os.path.join(directory, "shim.cc")
+        with open(il_file, 'w') as f:
+            f.write(il)
+        with open(shim_file, 'w') as f:
+            f.write(SHIM)
+        yosys.run(["-q", "-p", f"read_rtlil {il_file}; write_cxxrtl -header {os.path.join(directory, 'design.cc')}"],
+                  ignore_warnings=True)
+        # write to a temporary name first, so that parallel test runs never load half a library
+        temporary = library + f".{os.getpid()}"
+        subprocess.check_call([compiler, *flags, f"-I{include}", f"-I{directory}", f"-DCAPI_SOURCE={capi_source}",
+                               shim_file, "-o", temporary])
+        os.replace(temporary, library)
+    return library
+
+
+class _Process():
+    def __init__(self, function, domain=None, sync=False):
+        self.function  = function
+        self.domain    = domain
+        self.sync      = sync
+        self.restart()
+
+    def restart(self):
+        self.generator = self.function()
+        self.passive   = False
+        self.send      = None
+        # None: runnable, a domain name: waiting for its clock edge, a number: waiting for that time.
+        # Like in the Python simulator, sync processes start after the first clock edge
+        self.waiting   = self.domain if self.sync else None
+        self.done      = False
+
+
+class CxxrtlSimulator():
+    """ runs amaranth simulator processes against a compiled CXXRTL model of the design
+
+        Supports the subset of the simulator API the test cases and benches of this repository use:
+        add_clock, add_sync_process, add_process, run, run_until, reset and write_vcd (which does nothing),
+        and the process commands: reading values, assigning constants, bare yield, Tick, Settle, Delay and Passive.
+
+        Only the ports can be accessed. The ports are all signals in the public attributes of the design,
+        like in resource_benchmark.py.
+
+        Reads always see settled values, as if every read was preceded by Settle(). The Python simulator
+        returns the values from before the last assignments and clock edge instead, until the process
+        settles. So a process which reads without Settle() can see a different value here. The test cases
+        of this repository settle before every read which depends on the current cycle, and then see the
+        same values on both simulators, which CxxrtlSimulatorTest.test_same_trace checks on a design.
+    """
+    def __init__(self, elaboratable, ports=None):
+        ports    = elaboratable_ports(elaboratable) if ports is None else ports
+        fragment = Fragment.get(elaboratable, None).prepare(ports=ports)
+        il, name_map = rtlil.convert_fragment(fragment, name="top")
+
+        self._library = ctypes.CDLL(compile_cxxrtl(il))
+        self._library.sim_create.restype  = ctypes.c_void_p
+        self._library.sim_step.argtypes   = [ctypes.c_void_p]
+        self._library.sim_get.restype     = ctypes.c_void_p
+        self._library.sim_get.argtypes    = [ctypes.c_void_p, ctypes.c_char_p]
+        self._library.sim_width.restype   = ctypes.c_size_t
+        self._library.sim_width.argtypes  = [ctypes.c_void_p]
+        self._library.sim_read.argtypes   = [ctypes.c_void_p, ctypes.c_void_p]
+        self._library.sim_write.argtypes  = [ctypes.c_void_p, ctypes.c_void_p]
+        self._library.sim_destroy.argtypes = [ctypes.c_void_p]
+        self._handle = self._library.sim_create()
+
+        self._name_map  = name_map
+        self._objects   = {}
+        self._clocks    = { name: domain.clk for name, domain in fragment.domains.items() }
+        self._periods   = {}
+        self._processes = []
+        self._dirty     = True
+        self._time      = 0.0
+
+    def __del__(self):
+        if getattr(self, "_handle", None):
+            self._library.sim_destroy(self._handle)
+
+    #
+    # signal access
+    #
+    def _object(self, signal: Signal):
+        if signal not in self._objects:
+            if signal not in self._name_map:
+                raise ValueError(f"{signal!r} is not part of the compiled design")
+            # CXXRTL separates the levels of the hierarchy with spaces, without the top module
+            name   = " ".join(part.lstrip("\\") for part in self._name_map[signal][1:])
+            object = self._library.sim_get(self._handle, name.encode())
+            if not object:
+                raise ValueError(f"{signal!r} ({name}) is not accessible in the compiled design, only ports are")
+            self._objects[signal] = (object, (self._library.sim_width(object) + 31) // 32)
+        return self._objects[signal]
+
+    def _settle(self):
+        if self._dirty:
+            self._library.sim_step(self._handle)
+            self._dirty = False
+
+    def _read_signal(self, signal: Signal) -> int:
+        self._settle()
+        object, chunks = self._object(signal)
+        buffer = (ctypes.c_uint32 * chunks)()
+        self._library.sim_read(object, buffer)
+        value = sum(chunk << (32 * i) for i, chunk in enumerate(buffer))
+        if signal.shape().signed and value & (1 << (len(signal) - 1)):
+            value -= 1 << len(signal)
+        return value
+
+    def _write_signal(self, signal: Signal, value: int):
+        object, chunks = self._object(signal)
+        value &= (1 << len(signal)) - 1
+        buffer = (ctypes.c_uint32 * chunks)(*[(value >> (32 * i)) & 0xffffffff for i in range(chunks)])
+        self._library.sim_write(object, buffer)
+        self._dirty = True
+
+    def _read(self, value: Value) -> int:
+        if isinstance(value, Signal):
+            return self._read_signal(value)
+        if isinstance(value, Const):
+            return value.value
+        if isinstance(value, Slice):
+            return (self._read(value.value) >> value.start) & ((1 << (value.stop - value.start)) - 1)
+        raise TypeError(f"reading {value!r} is not supported by the compiled simulator")
+
+    def _assign(self, statement: Assign):
+        rhs = Value.cast(statement.rhs)
+        if not isinstance(rhs, Const):
+            rhs = Const(self._read(rhs), len(rhs))
+        lhs = statement.lhs
+        if isinstance(lhs, Signal):
+            self._write_signal(lhs, rhs.value)
+        elif isinstance(lhs, Slice) and isinstance(lhs.value, Signal):
+            width = lhs.stop - lhs.start
+            mask  = ((1 << width) - 1) << lhs.start
+            old   = self._read_signal(lhs.value)
+            self._write_signal(lhs.value, (old & ~mask) | ((rhs.value << lhs.start) & mask))
+        else:
+            raise TypeError(f"assigning to {lhs!r} is not supported by the compiled simulator")
+
+    #
+    # simulator API
+    #
+    def add_clock(self, period, *, phase=None, domain="sync", if_exists=False):
+        if domain in self._periods:
+            if if_exists:
+                return
+            raise ValueError(f"domain {domain!r} already has a clock")
+        if domain not in self._clocks:
+            raise ValueError(f"domain {domain!r} is not used by the design")
+        self._periods[domain] = (period, period / 2 if phase is None else phase)
+
+    def add_process(self, process):
+        self._processes.append(_Process(process))
+
+    def add_sync_process(self, process, *, domain="sync"):
+        self._processes.append(_Process(process, domain, sync=True))
+
+    def reset(self):
+        """ starts over with a fresh model, at time zero, and restarts all processes """
+        self._library.sim_destroy(self._handle)
+        self._handle  = self._library.sim_create()
+        # the objects belong to the old model
+        self._objects = {}
+        self._dirty   = True
+        self._time    = 0.0
+        for process in self._processes:
+            process.restart()
+
+    @contextmanager
+    def write_vcd(self, *args, **kwargs):
+        yield
+
+    def _run_process(self, process: _Process):
+        while True:
+            try:
+                command = process.generator.send(process.send)
+            except StopIteration:
+                process.done = True
+                return
+            process.send = None
+
+            if command is None:
+                process.waiting = process.domain
+                return
+            elif isinstance(command, Tick):
+                process.waiting = command.domain
+                return
+            elif isinstance(command, Settle):
+                self._settle()
+            elif isinstance(command, Delay):
+                if command.interval:
+                    process.waiting = self._time + command.interval
+                    return
+                self._settle()
+            elif isinstance(command, Passive):
+                process.passive = True
+            elif isinstance(command, Assign):
+                self._assign(command)
+            elif isinstance(command, Value):
+                process.send = self._read(command)
+            else:
+                raise TypeError(f"command {command!r} is not supported by the compiled simulator")
+
+    def _edges(self):
+        """ the time of the next edge of each clock, and whether it rises """
+        for domain, (period, phase) in self._periods.items():
+            if self._time < phase:
+                yield phase, domain, True
+                continue
+            elapsed = (self._time - phase) % period
+            half    = period / 2
+            if elapsed < half:
+                yield self._time - elapsed + half, domain, False
+            else:
+                yield self._time - elapsed + period, domain, True
+
+    def _advance(self) -> bool:
+        """ runs all runnable processes, then advances to the next event. False once only passive processes remain """
+        for process in self._processes:
+            if not process.done and process.waiting is None:
+                self._run_process(process)
+
+        if all(process.done or process.passive for process in self._processes):
+            return False
+
+        events = list(self._edges())
+        timers = [process.waiting for process in self._processes
+                  if not process.done and isinstance(process.waiting, float)]
+        next_time = min([time for time, _, _ in events] + timers)
+        self._time = next_time
+
+        rising = []
+        for time, domain, rises in events:
+            if time == next_time:
+                self._write_signal(self._clocks[domain], int(rises))
+                if rises:
+                    rising.append(domain)
+        self._settle()
+
+        for process in self._processes:
+            if process.done:
+                continue
+            if process.waiting in rising or process.waiting == next_time:
+                process.waiting = None
+        return True
+
+    def run(self):
+        while self._advance():
+            pass
+
+    def run_until(self, deadline, *, run_passive=False):
+        while self._time < deadline:
+            if not self._advance() and not run_passive:
+                break
+
+
+def create_simulator(elaboratable, engine: str=None):
+    """ the simulator selected by engine or the GATEWARE_SIMULATOR environment variable """
+    engine = engine or os.environ.get(ENGINE_VARIABLE, "pysim")
+    if engine == "cxxrtl":
+        return CxxrtlSimulator(elaboratable)
+    return PythonSimulator(elaboratable)
+
+
+def run_tests(modules, engine: str) -> (unittest.TestResult, float):
+    """ runs the test cases of the given modules, with the GatewareTestCases on the given simulator """
+    import amlib.test
+    original = amlib.test.Simulator
+    amlib.test.Simulator = CxxrtlSimulator if engine == "cxxrtl" else PythonSimulator
+    try:
+        loader = unittest.TestLoader()
+        suite  = unittest.TestSuite(loader.loadTestsFromModule(importlib.import_module(module)) for module in modules)
+        start  = time.time()
+        result = unittest.TextTestRunner(verbosity=1).run(suite)
+        return result, time.time() - start
+    finally:
+        amlib.test.Simulator = original
+
+
+class CxxrtlSimulatorTest(unittest.TestCase):
+    def test_edges(self):
+        simulator = CxxrtlSimulator.__new__(CxxrtlSimulator)
+        simulator._time    = 0.0
+        simulator._periods = dict(sync=(10.0, 5.0), fast=(4.0, 2.0))
+        self.assertEqual(sorted(simulator._edges()), [(2.0, "fast", True), (5.0, "sync", True)])
+        simulator._time = 5.0
+        self.assertEqual(sorted(simulator._edges()), [(6.0, "fast", True), (10.0, "sync", False)])
+
+    def trace(self, simulator_class, cycles=200, reset=False):
+        """ drives a MIDI router with random events and reads back all its outputs every cycle """
+        from midi_router import MIDIRouter
+
+        dut = MIDIRouter(no_sources=2, no_destinations=2, routes=[(0, 0), (1, 0), (0, 1)], fifo_depth=4)
+        simulator = simulator_class(dut)
+        simulator.add_clock(1e-6)
+        trace = []
+
+        def process():
+            rng = random.Random(0)
+            for cycle in range(cycles):
+                for stream in dut.events_in:
+                    yield stream.payload.eq(rng.getrandbits(32))
+                    yield stream.valid.eq(rng.random() < 0.7)
+                for stream in dut.events_out:
+                    yield stream.ready.eq(rng.random() < 0.3)
+                yield Settle()
+                row = []
+                for stream in dut.events_in:
+                    row.append((yield stream.ready))
+                for stream, level, dropped in zip(dut.events_out, dut.levels_out, dut.dropped_out):
+                    row += [(yield stream.valid), (yield stream.payload), (yield level), (yield dropped)]
+                trace.append(row)
+                yield
+
+        simulator.add_sync_process(process)
+        simulator.run()
+        if reset:
+            trace.clear()
+            simulator.reset()
+            simulator.run()
+        return trace
+
+    def test_same_trace(self):
+        if shutil.which(os.environ.get("CXX", "c++")) is None:
+            self.skipTest("no C++ compiler for CXXRTL")
+        pysim_trace  = self.trace(PythonSimulator)
+        cxxrtl_trace = self.trace(CxxrtlSimulator)
+        self.assertEqual(len(cxxrtl_trace), len(pysim_trace))
+        for cycle, (pysim_row, cxxrtl_row) in enumerate(zip(pysim_trace, cxxrtl_trace)):
+            self.assertEqual(cxxrtl_row, pysim_row, f"cycle {cycle}")
+
+        # after a reset, the same stimulus has to give the same trace again
+        self.assertEqual(self.trace(CxxrtlSimulator, reset=True), pysim_trace)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run the gateware test cases on the compiled CXXRTL simulator, "
+                                                 "optionally comparing the run time against the Python simulator")
+    parser.add_argument("modules", nargs="+", help="modules with test cases, like bundle_demultiplexer")
+    parser.add_argument("--compare", action="store_true", help="also run on the Python simulator and report the speedup")
+    args = parser.parse_args()
+
+    # compiling is part of the first run, so warm up the cache
+    cxxrtl_result, cxxrtl_time = run_tests(args.modules, "cxxrtl")
+    if args.compare:
+        cxxrtl_result, cxxrtl_time = run_tests(args.modules, "cxxrtl")
+        pysim_result,  pysim_time  = run_tests(args.modules, "pysim")
+        print(f"pysim:  {pysim_time:8.2f}s, {len(pysim_result.failures) + len(pysim_result.errors)} failed")
+
+    print(f"cxxrtl: {cxxrtl_time:8.2f}s, {len(cxxrtl_result.failures) + len(cxxrtl_result.errors)} failed")
+    if args.compare:
+        print(f"speedup: {pysim_time / cxxrtl_time:.1f}x")
+    sys.exit(0 if cxxrtl_result.wasSuccessful() else 1)
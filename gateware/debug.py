@@ -23,9 +23,10 @@ def add_debug_led_array(v):
     usb2_audio_in_active      = v['usb2_audio_in_active']
     bundle_multiplexer        = v['bundle_multiplexer']
     adat_transmitters         = v['adat_transmitters']
-    usb1_to_usb2_midi_fifo    = v['usb1_to_usb2_midi_fifo']
-    usb2_to_usb1_midi_fifo    = v['usb2_to_usb1_midi_fifo']
+    midi_router               = v['midi_router']
     usb_midi_fifo_depth       = v['usb_midi_fifo_depth']
+    usb1_midi_port            = v['usb1_midi_port']
+    usb2_midi_port            = v['usb2_midi_port']
 
 
     adat1_underflow_count = Signal(16)
@@ -69,6 +70,8 @@ def add_debug_led_array(v):
     m.d.comb += [
         usb2_output_fifo_bar.value_in.eq(usb2_to_usb1_fifo_level),
         usb2_input_fifo_bar.value_in.eq(channels_to_usb2_stream.level),
+        usb2_to_usb1_bar.value_in.eq(midi_router.levels_out[usb1_midi_port]),
+        usb1_to_usb2_bar.value_in.eq(midi_router.levels_out[usb2_midi_port]),
         led_display.digits_in[usb2(0)][0].eq(usb2_audio_out_active),
         led_display.digits_in[usb2(0)][7].eq(usb2_audio_in_active),
         led_display.digits_in[usb2(1)].eq(Cat(usb2_output_fifo_bar.bitbar_out)),
@@ -83,7 +86,12 @@ def add_debug_led_array(v):
     ]
 
 
-def setup_ila(v, ila_max_packet_size, use_convolution):
+def ila_signal_groups(v, use_convolution):
+    """ the named signal sets to debug the design with, and the single bit events to enable or trigger on
+
+        v are the locals of the top level elaborate(). Used by setup_ila()
+        and by the simulation traces.
+    """
     examined_usb                 = "usb1"
     m                            = v['m']
     usb1_sof_counter             = v['usb1_sof_counter']
@@ -116,13 +124,13 @@ def setup_ila(v, ila_max_packet_size, use_convolution):
     usb1_channel_stream_combiner = v['usb1_channel_stream_combiner']
     usb1_channel_stream_splitter = v['usb1_channel_stream_splitter']
 
-    usb1_to_usb2_midi_fifo       = v['usb1_to_usb2_midi_fifo']
-    usb2_to_usb1_midi_fifo       = v['usb2_to_usb1_midi_fifo']
+    midi_router                  = v['midi_router']
+    usb1_midi_port               = v['usb1_midi_port']
 
     dac1_extractor               = v['dac1_extractor']
     dac1 = v['dac1']
-    convolver = v['convolver']
-    enable_convolver = v['enable_convolver']
+    convolver                    = v['convolvers'][0]
+    enable_convolver             = v['enable_convolvers'][0]
 
     adat_clock = Signal()
     m.d.comb += adat_clock.eq(ClockSignal("adat"))
@@ -487,7 +495,7 @@ def setup_ila(v, ila_max_packet_size, use_convolution):
         midi_out_stream.payload,
         midi_out_stream.first,
         midi_out_stream.last,
-        usb2_to_usb1_midi_fifo.r_level,
+        midi_router.levels_out[usb1_midi_port],
         in_ready,
         midi_in_stream.valid,
         midi_in_stream.payload,
@@ -551,10 +559,59 @@ def setup_ila(v, ila_max_packet_size, use_convolution):
         enable_convolver,
     ]
 
+    groups = dict(
+        channels_to_usb_input_frame   = channels_to_usb_input_frame,
+        channels_to_usb_debug         = channels_to_usb_debug,
+        usb_out_debug                 = usb_out_debug,
+        ep1_out_fifo_debug            = ep1_out_fifo_debug,
+        receiver_debug                = receiver_debug,
+        adat_debug                    = adat_debug,
+        adat_transmitter_debug        = adat_transmitter_debug,
+        multiplexer_debug             = multiplexer_debug,
+        demultiplexer_debug           = demultiplexer_debug,
+        levels                        = levels,
+        frame_counts                  = frame_counts,
+        channel_stream_combiner_debug = channel_stream_combiner_debug,
+        channel_stream_splitter_debug = channel_stream_splitter_debug,
+        midi_out                      = midi_out,
+        dac_extractor_debug           = dac_extractor_debug,
+        convolution_debug             = convolution_debug,
+    )
+
+    events = dict(
+        sof_wrap                       = sof_wrap,
+        weird_packet                   = weird_packet,
+        input_active                   = input_active,
+        output_active                  = output_active,
+        input_or_output_active         = input_or_output_active,
+        strange_input                  = strange_input,
+        garbage                        = garbage,
+        usb_frame_borders              = usb_frame_borders,
+        weird_frame_size               = weird_frame_size,
+        usb_outputting                 = usb_outputting,
+        usb_out_level_maxed            = usb_out_level_maxed,
+        usb_channel_outputting         = usb_channel_outputting,
+        adat_first                     = adat_first,
+        multiplexer_enable             = multiplexer_enable,
+        demultiplexer_enable           = demultiplexer_enable,
+        channel_stream_combiner_active = channel_stream_combiner_active,
+        channel_stream_splitter_active = channel_stream_splitter_active,
+        midi_active                    = midi_active,
+    )
+
+    return groups, events
+
+
+def setup_ila(v, ila_max_packet_size, use_convolution):
+    m    = v['m']
+    usb1 = v['usb1']
+
+    groups, events = ila_signal_groups(v, use_convolution)
+
     #
     # signals to trace
     #
-    signals = adat_transmitter_debug
+    signals = groups["adat_transmitter_debug"]
 
     signals_bits = sum([s.width for s in signals])
     m.submodules.ila = ila = \
@@ -578,9 +635,9 @@ def setup_ila(v, ila_max_packet_size, use_convolution):
 
     m.d.comb += [
         stream_ep.stream.stream_eq(ila.stream),
-        # ila.enable.eq(input_or_output_active | garbage | usb_frame_borders),
+        # ila.enable.eq(events["input_or_output_active"] | events["garbage"] | events["usb_frame_borders"]),
         ila.trigger.eq(1),
-        ila.enable .eq(input_or_output_active),
+        ila.enable .eq(events["input_or_output_active"]),
     ]
 
     ILACoreParameters(ila).pickle()
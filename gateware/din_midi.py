@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    DIN MIDI ports: 31250 baud, 8N1 UARTs and the conversion to and from USB-MIDI event packets
+
+    A received byte is out in the middle of its stop bit, and the event it completes one
+    cycle later, so a three byte message is ready for the USB IN endpoint 0.3 ms after
+    the start bit of its last byte.
+"""
+from amaranth         import *
+from amaranth.build   import Platform
+from amaranth.lib.cdc import FFSynchronizer
+from amaranth.lib.fifo import SyncFIFOBuffered
+from amaranth.sim     import Settle
+from amlib.stream     import StreamInterface
+from amlib.test       import GatewareTestCase, sync_test_case
+
+from usb_midi         import MIDIEventPacketizer, MIDIEventDepacketizer, midi_to_events
+
+MIDI_BAUDRATE = 31250
+
+# the cable number of the DIN port on USB1, cable 0 is the MIDI loop to USB2
+DIN_MIDI_CABLE = 1
+
+class MIDIUARTReceiver(Elaboratable):
+    """ receives 8N1 serial data, sampling each bit in its middle
+
+        data_out is valid for one cycle, in the middle of the stop bit.
+        A low stop bit signals framing_error_out instead, and the receiver
+        then waits for the line to go high again before the next start bit.
+    """
+    def __init__(self, clk_freq: float=60e6, baudrate: int=MIDI_BAUDRATE):
+        self._divisor = int(clk_freq // baudrate)
+
+        # I/O
+        self.rx_in             = Signal(reset=1)
+        self.data_out          = Signal(8)
+        self.valid_out         = Signal()
+        self.framing_error_out = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        divisor = self._divisor
+        rx      = Signal(reset=1)
+        counter = Signal(range(divisor))
+        bit     = Signal(range(8))
+        shift   = Signal(8)
+
+        m.submodules.rx_synchronizer = FFSynchronizer(self.rx_in, rx, reset=1)
+
+        m.d.sync += [
+            self.valid_out.eq(0),
+            self.framing_error_out.eq(0),
+        ]
+
+        with m.If(counter != 0):
+            m.d.sync += counter.eq(counter - 1)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(~rx):
+                    m.d.sync += counter.eq(divisor // 2 - 1)
+                    m.next = "START"
+
+            with m.State("START"):
+                with m.If(counter == 0):
+                    with m.If(rx):
+                        # too short for a start bit
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.d.sync += [
+                            counter.eq(divisor - 1),
+                            bit.eq(0),
+                        ]
+                        m.next = "DATA"
+
+            with m.State("DATA"):
+                with m.If(counter == 0):
+                    m.d.sync += [
+                        shift.eq(Cat(shift[1:], rx)),
+                        bit.eq(bit + 1),
+                        counter.eq(divisor - 1),
+                    ]
+                    with m.If(bit == 7):
+                        m.next = "STOP"
+
+            with m.State("STOP"):
+                with m.If(counter == 0):
+                    with m.If(rx):
+                        m.d.sync += [
+                            self.data_out.eq(shift),
+                            self.valid_out.eq(1),
+                        ]
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.d.sync += self.framing_error_out.eq(1)
+                        m.next = "BREAK"
+
+            with m.State("BREAK"):
+                with m.If(rx):
+                    m.next = "IDLE"
+
+        return m
+
+
+class MIDIUARTTransmitter(Elaboratable):
+    """ sends the bytes of stream_in as 8N1 serial data """
+    def __init__(self, clk_freq: float=60e6, baudrate: int=MIDI_BAUDRATE):
+        self._divisor = int(clk_freq // baudrate)
+
+        # I/O
+        self.stream_in = StreamInterface(name="uart_in", payload_width=8)
+        self.tx_out    = Signal(reset=1)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        divisor   = self._divisor
+        stream_in = self.stream_in
+        # start bit, eight data bits, stop bit
+        shift     = Signal(10, reset=(1 << 10) - 1)
+        bits_left = Signal(range(11))
+        counter   = Signal(range(divisor))
+
+        m.d.sync += self.tx_out.eq(shift[0])
+        m.d.comb += stream_in.ready.eq(bits_left == 0)
+
+        with m.If(bits_left == 0):
+            with m.If(stream_in.valid):
+                m.d.sync += [
+                    shift.eq(Cat(C(0, 1), stream_in.payload, C(1, 1))),
+                    bits_left.eq(10),
+                    counter.eq(divisor - 1),
+                ]
+        with m.Elif(counter == 0):
+            m.d.sync += [
+                shift.eq(Cat(shift[1:], C(1, 1))),
+                bits_left.eq(bits_left - 1),
+                counter.eq(divisor - 1),
+            ]
+        with m.Else():
+            m.d.sync += counter.eq(counter - 1)
+
+        return m
+
+
+class DINMIDIIn(Elaboratable):
+    """ a MIDI input port, which delivers USB-MIDI event packets
+
+        The UART can't wait, so events which find the FIFO full
+        are dropped and counted in dropped_out.
+    """
+    def __init__(self, clk_freq: float=60e6, cable: int=0, fifo_depth: int=16):
+        self._clk_freq   = clk_freq
+        self._cable      = cable
+        self._fifo_depth = fifo_depth
+
+        # I/O
+        self.rx_in             = Signal(reset=1)
+        self.event_out         = StreamInterface(name="din_midi_event_out", payload_width=32)
+        self.dropped_out       = Signal(16)
+        self.framing_error_out = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.receiver   = receiver   = MIDIUARTReceiver(self._clk_freq)
+        m.submodules.packetizer = packetizer = MIDIEventPacketizer(self._cable)
+        m.submodules.fifo       = fifo       = SyncFIFOBuffered(width=32, depth=self._fifo_depth)
+
+        event_out = self.event_out
+
+        m.d.comb += [
+            receiver.rx_in.eq(self.rx_in),
+            self.framing_error_out.eq(receiver.framing_error_out),
+            packetizer.data_in.eq(receiver.data_out),
+            packetizer.valid_in.eq(receiver.valid_out),
+
+            fifo.w_data.eq(packetizer.event_out),
+            fifo.w_en.eq(packetizer.valid_out),
+
+            event_out.payload.eq(fifo.r_data),
+            event_out.valid.eq(fifo.r_rdy),
+            event_out.first.eq(1),
+            event_out.last.eq(1),
+            fifo.r_en.eq(event_out.ready),
+        ]
+
+        with m.If(packetizer.valid_out & ~fifo.w_rdy & (self.dropped_out != (2**16 - 1))):
+            m.d.sync += self.dropped_out.eq(self.dropped_out + 1)
+
+        return m
+
+
+class DINMIDIOut(Elaboratable):
+    """ a MIDI output port, which sends USB-MIDI event packets
+
+        Backpressure goes all the way back to event_in,
+        so nothing is dropped when the host sends faster than 31250 baud.
+    """
+    def __init__(self, clk_freq: float=60e6, fifo_depth: int=16):
+        self._clk_freq   = clk_freq
+        self._fifo_depth = fifo_depth
+
+        # I/O
+        self.event_in = StreamInterface(name="din_midi_event_in", payload_width=32)
+        self.tx_out   = Signal(reset=1)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.fifo         = fifo         = SyncFIFOBuffered(width=32, depth=self._fifo_depth)
+        m.submodules.depacketizer = depacketizer = MIDIEventDepacketizer()
+        m.submodules.transmitter  = transmitter  = MIDIUARTTransmitter(self._clk_freq)
+
+        event_in = self.event_in
+
+        m.d.comb += [
+            fifo.w_data.eq(event_in.payload),
+            fifo.w_en.eq(event_in.valid),
+            event_in.ready.eq(fifo.w_rdy),
+
+            depacketizer.event_in.payload.eq(fifo.r_data),
+            depacketizer.event_in.valid.eq(fifo.r_rdy),
+            fifo.r_en.eq(depacketizer.event_in.ready),
+
+            transmitter.stream_in.stream_eq(depacketizer.data_out),
+            self.tx_out.eq(transmitter.tx_out),
+        ]
+
+        return m
+
+
+class DINMIDITest(GatewareTestCase):
+    # eight clock cycles per bit keeps the simulation short
+    FRAGMENT_UNDER_TEST = DINMIDIIn
+    FRAGMENT_ARGUMENTS  = dict(clk_freq=8 * MIDI_BAUDRATE, cable=0, fifo_depth=4)
+
+    DIVISOR = 8
+
+    def send_byte(self, byte, stop_bit=1):
+        bits = [0] + [(byte >> i) & 1 for i in range(8)] + [stop_bit]
+        for bit in bits:
+            yield self.dut.rx_in.eq(bit)
+            for _ in range(self.DIVISOR):
+                yield
+        yield self.dut.rx_in.eq(1)
+
+    def read_events(self):
+        events = []
+        yield self.dut.event_out.ready.eq(1)
+        yield Settle()
+        while (yield self.dut.event_out.valid):
+            events.append((yield self.dut.event_out.payload))
+            yield
+            yield Settle()
+        yield self.dut.event_out.ready.eq(0)
+        return events
+
+    @sync_test_case
+    def test_receive(self):
+        data = [0x90, 0x3c, 0x7f, 0xf8, 0x3e, 0x40]
+        for byte in data:
+            yield from self.send_byte(byte)
+            for _ in range(self.DIVISOR):
+                yield
+        events = yield from self.read_events()
+        self.assertEqual(events, midi_to_events(data))
+
+    @sync_test_case
+    def test_latency(self):
+        dut = self.dut
+        yield from self.send_byte(0x90)
+        yield from self.send_byte(0x3c)
+        # the last byte, which completes the event
+        for bit in [0] + [(0x7f >> i) & 1 for i in range(8)]:
+            yield dut.rx_in.eq(bit)
+            for _ in range(self.DIVISOR):
+                yield
+        yield dut.rx_in.eq(1)
+        for cycle in range(2 * self.DIVISOR):
+            yield Settle()
+            if (yield dut.event_out.valid):
+                break
+            yield
+        else:
+            self.fail("no event within the stop bit")
+        # synchronizer, middle of the stop bit, packetizer and FIFO
+        self.assertLess(cycle, self.DIVISOR // 2 + 8)
+        self.assertEqual((yield dut.event_out.payload), midi_to_events([0x90, 0x3c, 0x7f])[0])
+
+    @sync_test_case
+    def test_framing_error_and_overflow(self):
+        dut = self.dut
+        yield from self.send_byte(0x90, stop_bit=0)
+        for _ in range(2 * self.DIVISOR):
+            yield
+        # more realtime events than the FIFO holds
+        for _ in range(8):
+            yield from self.send_byte(0xf8)
+            yield
+        events = yield from self.read_events()
+        self.assertEqual(events, midi_to_events([0xf8] * len(events)))
+        self.assertEqual((yield dut.dropped_out), 8 - len(events))
+        self.assertGreater((yield dut.dropped_out), 0)
+
+
+class DINMIDIOutTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = DINMIDIOut
+    FRAGMENT_ARGUMENTS  = dict(clk_freq=8 * MIDI_BAUDRATE, fifo_depth=4)
+
+    DIVISOR = 8
+
+    @sync_test_case
+    def test_send(self):
+        dut    = self.dut
+        data   = [0x90, 0x3c, 0x7f, 0x3e, 0x7f, 0xf8]
+        events = midi_to_events(data)
+
+        for value in events:
+            yield dut.event_in.payload.eq(value)
+            yield dut.event_in.valid.eq(1)
+            yield Settle()
+            while not (yield dut.event_in.ready):
+                yield
+                yield Settle()
+            yield
+        yield dut.event_in.valid.eq(0)
+
+        # sample the line in the middle of each bit
+        received = []
+        while len(received) < len(data):
+            for _ in range(40 * self.DIVISOR):
+                if not (yield dut.tx_out):
+                    break
+                yield
+            else:
+                self.fail("no start bit")
+            for _ in range(self.DIVISOR // 2):
+                yield
+            bits = []
+            for _ in range(10):
+                bits.append((yield dut.tx_out))
+                for _ in range(self.DIVISOR):
+                    yield
+            self.assertEqual((bits[0], bits[9]), (0, 1))
+            received.append(sum(bit << i for i, bit in enumerate(bits[1:9])))
+
+        # the second note on goes out with running status
+        self.assertEqual(received, [0x90, 0x3c, 0x7f, 0x3e, 0x7f, 0xf8])
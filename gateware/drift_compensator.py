@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+from amaranth       import *
+from amaranth.build import Platform
+from amaranth.sim   import Settle
+
+from amlib.stream   import StreamInterface
+from amlib.test     import GatewareTestCase, sync_test_case
+
+class DriftCompensator(Elaboratable):
+    """ frame aligned elastic buffer between two audio streams paced by different hosts
+
+        When the two sides drift apart, whole frames slip instead of the output stalling
+        or the channels getting out of order:
+        A frame which arrives while the buffer is full is dropped,
+        and when a frame is requested while the buffer is empty, the last frame is repeated.
+        While active_in is low, the buffer is flushed. After that the output plays
+        silence until the buffer is half full again.
+
+        The input never exerts back pressure, the output is always valid while active.
+    """
+    SAMPLE_WIDTH = 24
+    COUNTER_BITS = 16
+
+    def __init__(self, max_channels: int, depth_frames: int):
+        self._max_channels = max_channels
+        self._depth        = depth_frames
+        self._channel_bits = Shape.cast(range(max_channels)).width
+
+        # I/O
+        self.channel_stream_in   = StreamInterface(name="drift_compensator_in", payload_width=self.SAMPLE_WIDTH,
+                                                   extra_fields=[("channel_nr", self._channel_bits)])
+        self.channel_stream_out  = StreamInterface(name="drift_compensator_out", payload_width=self.SAMPLE_WIDTH,
+                                                   extra_fields=[("channel_nr", self._channel_bits)])
+        self.no_channels_in      = Signal(range(max_channels + 1), reset=max_channels)
+        self.active_in           = Signal()
+
+        # buffered frames
+        self.level_out           = Signal(range(depth_frames + 1))
+        # slip counters, they wrap around
+        self.frames_dropped_out  = Signal(self.COUNTER_BITS)
+        self.frames_repeated_out = Signal(self.COUNTER_BITS)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        depth        = self._depth
+        max_channels = self._max_channels
+
+        m.submodules.memory_write = write_port = Memory(width=self.SAMPLE_WIDTH, depth=depth * max_channels).write_port()
+        read_port = write_port.memory.read_port(domain="comb")
+        m.submodules.memory_read = read_port
+
+        stream_in  = self.channel_stream_in
+        stream_out = self.channel_stream_out
+        level      = self.level_out
+
+        write_frame   = Signal(range(depth))
+        dropping      = Signal()
+        drop_frame    = Signal()
+        commit        = Signal()
+
+        read_frame    = Signal(range(depth))
+        last_frame    = Signal(range(depth))
+        read_channel  = Signal(self._channel_bits)
+        priming       = Signal(reset=1)
+        consume       = Signal()
+
+        # how the current output frame is played, decided on its first sample
+        play          = Signal()
+        silence       = Signal()
+        frame_play    = Signal()
+        frame_silence = Signal()
+
+        m.d.comb += [
+            stream_in.ready.eq(1),
+            last_frame.eq(Mux(read_frame == 0, depth - 1, read_frame - 1)),
+        ]
+
+        with m.If(~self.active_in):
+            m.d.sync += [
+                write_frame.eq(0),
+                dropping.eq(0),
+                read_frame.eq(0),
+                read_channel.eq(0),
+                priming.eq(1),
+                level.eq(0),
+            ]
+
+        with m.Else():
+            #
+            # write side
+            #
+            m.d.comb += drop_frame.eq(Mux(stream_in.first, level == depth, dropping))
+
+            with m.If(stream_in.valid):
+                with m.If(stream_in.first):
+                    m.d.sync += dropping.eq(drop_frame)
+
+                m.d.comb += [
+                    write_port.addr.eq(write_frame * max_channels + stream_in.channel_nr),
+                    write_port.data.eq(stream_in.payload),
+                    write_port.en.eq(~drop_frame),
+                ]
+
+                with m.If(stream_in.last):
+                    with m.If(drop_frame):
+                        m.d.sync += self.frames_dropped_out.eq(self.frames_dropped_out + 1)
+                    with m.Else():
+                        m.d.comb += commit.eq(1)
+                        m.d.sync += write_frame.eq(Mux(write_frame == depth - 1, 0, write_frame + 1))
+
+            #
+            # read side
+            #
+            with m.If(read_channel == 0):
+                m.d.comb += [
+                    silence.eq(priming & (level < (depth + 1) // 2)),
+                    play.eq(~silence & (level > 0)),
+                ]
+            with m.Else():
+                m.d.comb += [
+                    silence.eq(frame_silence),
+                    play.eq(frame_play),
+                ]
+
+            m.d.comb += [
+                read_port.addr.eq(Mux(play, read_frame, last_frame) * max_channels + read_channel),
+                stream_out.payload.eq(Mux(silence, 0, read_port.data)),
+                stream_out.channel_nr.eq(read_channel),
+                stream_out.first.eq(read_channel == 0),
+                stream_out.last.eq(read_channel == self.no_channels_in - 1),
+                stream_out.valid.eq(1),
+            ]
+
+            with m.If(stream_out.ready):
+                with m.If(read_channel == 0):
+                    m.d.sync += [
+                        frame_play.eq(play),
+                        frame_silence.eq(silence),
+                        priming.eq(silence),
+                    ]
+                    with m.If(~play & ~silence):
+                        m.d.sync += self.frames_repeated_out.eq(self.frames_repeated_out + 1)
+
+                with m.If(stream_out.last):
+                    m.d.sync += read_channel.eq(0)
+                    with m.If(play):
+                        m.d.comb += consume.eq(1)
+                        m.d.sync += read_frame.eq(Mux(read_frame == depth - 1, 0, read_frame + 1))
+                with m.Else():
+                    m.d.sync += read_channel.eq(read_channel + 1)
+
+            m.d.sync += level.eq(level + commit - consume)
+
+        return m
+
+
+class DriftCompensatorTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = DriftCompensator
+    FRAGMENT_ARGUMENTS  = dict(max_channels=4, depth_frames=4)
+
+    def send_frame(self, value):
+        stream = self.dut.channel_stream_in
+        for channel in range(4):
+            yield stream.payload.eq(value + channel)
+            yield stream.channel_nr.eq(channel)
+            yield stream.first.eq(channel == 0)
+            yield stream.last.eq(channel == 3)
+            yield stream.valid.eq(1)
+            yield
+        yield stream.valid.eq(0)
+        yield
+
+    def receive_frame(self):
+        stream = self.dut.channel_stream_out
+        frame  = []
+        yield stream.ready.eq(1)
+        yield Settle()
+        for channel in range(4):
+            self.assertEqual((yield stream.valid), 1)
+            self.assertEqual((yield stream.channel_nr), channel)
+            self.assertEqual((yield stream.first), channel == 0)
+            self.assertEqual((yield stream.last), channel == 3)
+            frame.append((yield stream.payload))
+            yield
+            yield Settle()
+        yield stream.ready.eq(0)
+        return frame
+
+    @sync_test_case
+    def test_pass_through_and_slips(self):
+        dut = self.dut
+        yield dut.active_in.eq(1)
+        yield
+
+        # silence until half full
+        self.assertEqual((yield from self.receive_frame()), [0, 0, 0, 0])
+        yield from self.send_frame(0x10)
+        yield from self.send_frame(0x20)
+        self.assertEqual((yield dut.level_out), 2)
+        self.assertEqual((yield from self.receive_frame()), [0x10, 0x11, 0x12, 0x13])
+        self.assertEqual((yield from self.receive_frame()), [0x20, 0x21, 0x22, 0x23])
+        self.assertEqual((yield dut.frames_repeated_out), 0)
+
+        # underrun: the last frame is repeated
+        self.assertEqual((yield from self.receive_frame()), [0x20, 0x21, 0x22, 0x23])
+        self.assertEqual((yield dut.frames_repeated_out), 1)
+
+        # overflow: the frame which does not fit is dropped
+        for value in [0x30, 0x40, 0x50, 0x60, 0x70]:
+            yield from self.send_frame(value)
+        self.assertEqual((yield dut.level_out), 4)
+        self.assertEqual((yield dut.frames_dropped_out), 1)
+        for value in [0x30, 0x40, 0x50, 0x60]:
+            self.assertEqual((yield from self.receive_frame()), [value + channel for channel in range(4)])
+        self.assertEqual((yield dut.level_out), 0)
+
+        # deactivating flushes the buffer
+        yield from self.send_frame(0x80)
+        yield dut.active_in.eq(0)
+        yield
+        self.assertEqual((yield dut.level_out), 0)
+        self.assertEqual((yield dut.channel_stream_out.valid), 0)
+        yield dut.active_in.eq(1)
+        self.assertEqual((yield from self.receive_frame()), [0, 0, 0, 0])
+
+    @sync_test_case
+    def test_two_channels(self):
+        dut = self.dut
+        yield dut.active_in.eq(1)
+        yield dut.no_channels_in.eq(2)
+        yield dut.channel_stream_out.ready.eq(1)
+        yield
+        yield Settle()
+        self.assertEqual((yield dut.channel_stream_out.last), 0)
+        yield
+        yield Settle()
+        self.assertEqual((yield dut.channel_stream_out.channel_nr), 1)
+        self.assertEqual((yield dut.channel_stream_out.last), 1)
+        yield
+        yield Settle()
+        self.assertEqual((yield dut.channel_stream_out.channel_nr), 0)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+from amaranth import *
+from amaranth.build import Platform
+
+from amlib.test import GatewareTestCase, sync_test_case
+
+class FeedbackController(Elaboratable):
+    """ PI controller for the USB audio rate feedback endpoint
+
+        The sample rate is measured by counting ADAT clock ticks over 256 SOFs.
+        Because the ADAT clock runs at 256 times the sample rate, that count already
+        is the number of samples per microframe in 16.16 format.
+        On top of that measurement a PI term of the FIFO fill level error
+        keeps the FIFO near target_fill.
+
+        The error is (target_fill - fifo_level) in FIFO entries, scaled up
+        by ERROR_FRACTION_BITS to allow gains below one LSB per entry.
+        Gains are given as right shifts of the scaled error:
+            p_term = scaled_error >> kp_shift
+            i_term = sum(scaled_error) >> ki_shift
+        The integral is updated every update_interval SOFs and is clamped,
+        as is the total correction, to keep the controller from winding up
+        while the host is not streaming.
+    """
+    ERROR_FRACTION_BITS    = 8
+    MEASUREMENT_SOFS       = 256
+    # 48kHz / 8kHz = 6 samples per microframe
+    NOMINAL_FEEDBACK_VALUE = 6 << 16
+
+    @staticmethod
+    def nominal_feedback_value(samplerate: int) -> int:
+        """ samples per microframe in 16.16 format """
+        return round(samplerate / 8000 * 2**16)
+
+    def __init__(self, fifo_depth: int, target_fill: int=None, kp_shift: int=10, ki_shift: int=16,
+                 update_interval: int=8, max_correction: int=1 << 15, nominal: int=NOMINAL_FEEDBACK_VALUE):
+        assert update_interval & (update_interval - 1) == 0, "update_interval needs to be a power of two"
+        assert update_interval <= self.MEASUREMENT_SOFS
+
+        self._fifo_depth      = fifo_depth
+        self._target_fill     = fifo_depth // 2 if target_fill is None else target_fill
+        self._kp_shift        = kp_shift
+        self._ki_shift        = ki_shift
+        self._update_interval = update_interval
+        self._max_correction  = max_correction
+        # the integral alone may produce the full correction, but not more
+        self._integral_limit  = max_correction << ki_shift
+
+        # I/O
+        self.sof_in               = Signal()
+        self.adat_tick_in         = Signal()
+        self.fifo_level_in        = Signal(range(fifo_depth + 1))
+        # restarting returns the output to nominal_in and clears the measurement and the integral
+        self.restart_in           = Signal()
+        self.nominal_in           = Signal(32, reset=nominal)
+        self.feedback_value_out   = Signal(32, reset=nominal)
+
+        # debug signals
+        self.measured_rate_out    = Signal(32)
+        self.sof_counter_out      = Signal(range(self.MEASUREMENT_SOFS))
+        self.error_out            = Signal(signed(self.fifo_level_in.width + 1))
+        self.integral_out         = Signal(signed(Shape.cast(range(-self._integral_limit, self._integral_limit + 1)).width))
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        # 1536 ADAT ticks per microframe at 48kHz, times 256 SOFs, with a bit of headroom
+        adat_clock_counter = Signal(20)
+        sof_counter        = self.sof_counter_out
+        measured_rate      = Signal(20)
+        # the first window after a restart is incomplete, so it is discarded
+        window_started     = Signal()
+        measurement_valid  = Signal()
+
+        error              = self.error_out
+        scaled_error       = Signal(signed(error.width + self.ERROR_FRACTION_BITS))
+        integral           = self.integral_out
+        next_integral      = Signal(signed(integral.width + 1))
+        p_term             = Signal(signed(32))
+        i_term             = Signal(signed(32))
+        correction         = Signal(signed(33))
+        clamped_correction = Signal(signed(33))
+
+        update_mask = self._update_interval - 1
+
+        m.d.comb += [
+            # the subtraction of two unsigned numbers wraps, but is one bit wider
+            # than both operands, so interpreting it as signed yields the difference
+            error.eq(self._target_fill - self.fifo_level_in),
+            scaled_error.eq(error << self.ERROR_FRACTION_BITS),
+            next_integral.eq(integral + scaled_error),
+            p_term.eq(scaled_error >> self._kp_shift),
+            i_term.eq(integral >> self._ki_shift),
+            correction.eq(p_term + i_term),
+            self.measured_rate_out.eq(measured_rate),
+        ]
+
+        with m.If(correction > self._max_correction):
+            m.d.comb += clamped_correction.eq(self._max_correction)
+        with m.Elif(correction < -self._max_correction):
+            m.d.comb += clamped_correction.eq(-self._max_correction)
+        with m.Else():
+            m.d.comb += clamped_correction.eq(correction)
+
+        with m.If(self.adat_tick_in):
+            m.d.sync += adat_clock_counter.eq(adat_clock_counter + 1)
+
+        with m.If(self.restart_in):
+            m.d.sync += [
+                adat_clock_counter.eq(0),
+                sof_counter.eq(0),
+                window_started.eq(0),
+                measurement_valid.eq(0),
+                integral.eq(0),
+                self.feedback_value_out.eq(self.nominal_in),
+            ]
+
+        with m.Elif(self.sof_in):
+            m.d.sync += sof_counter.eq(sof_counter + 1)
+
+            with m.If(sof_counter == 0):
+                m.d.sync += [
+                    window_started.eq(1),
+                    # do not lose a tick which coincides with the SOF
+                    adat_clock_counter.eq(self.adat_tick_in),
+                ]
+
+                with m.If(window_started):
+                    m.d.sync += [
+                        measured_rate.eq(adat_clock_counter),
+                        measurement_valid.eq(1),
+                    ]
+
+            with m.If(((sof_counter & update_mask) == 0) & measurement_valid):
+                with m.If(next_integral > self._integral_limit):
+                    m.d.sync += integral.eq(self._integral_limit)
+                with m.Elif(next_integral < -self._integral_limit):
+                    m.d.sync += integral.eq(-self._integral_limit)
+                with m.Else():
+                    m.d.sync += integral.eq(next_integral)
+
+                m.d.sync += self.feedback_value_out.eq(measured_rate + clamped_correction)
+
+        return m
+
+
+class FeedbackControllerTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = FeedbackController
+    FRAGMENT_ARGUMENTS  = dict(fifo_depth=64, kp_shift=6, ki_shift=10)
+
+    SOF_PERIOD      = 12
+    TICKS_PER_SOF   = 6
+
+    def run_sofs(self, no_sofs):
+        """ runs no_sofs microframes, each with TICKS_PER_SOF ADAT ticks """
+        for _ in range(no_sofs):
+            yield self.dut.sof_in.eq(1)
+            yield
+            yield self.dut.sof_in.eq(0)
+            for tick in range(self.SOF_PERIOD - 1):
+                yield self.dut.adat_tick_in.eq(tick < self.TICKS_PER_SOF)
+                yield
+            yield self.dut.adat_tick_in.eq(0)
+
+    @sync_test_case
+    def test_nominal_before_first_measurement(self):
+        dut = self.dut
+        yield dut.fifo_level_in.eq(0)
+        yield from self.run_sofs(self.dut.MEASUREMENT_SOFS)
+        self.assertEqual((yield dut.feedback_value_out), FeedbackController.NOMINAL_FEEDBACK_VALUE)
+
+    @sync_test_case
+    def test_measurement_and_correction(self):
+        dut = self.dut
+        expected_rate = self.TICKS_PER_SOF * FeedbackController.MEASUREMENT_SOFS
+
+        # FIFO at target: the output is the measured rate
+        yield dut.fifo_level_in.eq(32)
+        yield from self.run_sofs(2 * FeedbackController.MEASUREMENT_SOFS + 1)
+        self.assertEqual((yield dut.measured_rate_out), expected_rate)
+        self.assertEqual((yield dut.feedback_value_out), expected_rate)
+
+        # FIFO too empty: ask for more samples
+        yield dut.fifo_level_in.eq(16)
+        yield from self.run_sofs(9)
+        low_fill = (yield dut.feedback_value_out)
+        self.assertGreater(low_fill, expected_rate)
+
+        # the integral keeps growing while the error persists
+        yield from self.run_sofs(64)
+        self.assertGreater((yield dut.feedback_value_out), low_fill)
+        self.assertGreater((yield dut.integral_out), 0)
+
+        # FIFO too full: ask for fewer samples
+        yield dut.fifo_level_in.eq(63)
+        yield from self.run_sofs(256)
+        self.assertLess((yield dut.feedback_value_out), expected_rate)
+
+        # restart returns to nominal
+        yield dut.restart_in.eq(1)
+        yield
+        yield dut.restart_in.eq(0)
+        yield
+        self.assertEqual((yield dut.feedback_value_out), FeedbackController.NOMINAL_FEEDBACK_VALUE)
+        self.assertEqual((yield dut.integral_out), 0)
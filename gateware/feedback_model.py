@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import argparse
+import unittest
+from collections import deque
+
+import numpy as np
+
+class FeedbackLoopResult():
+    """ per configuration results of a FeedbackLoopModel run, all arrays have the shape of the parameter grid,
+        followed by an axis of length segments if the run was split into segments """
+
+    def __init__(self, shape, seconds, trace_interval, segments=1, **arrays):
+        self.shape          = shape
+        self.seconds        = seconds
+        self.trace_interval = trace_interval
+        self.segments       = segments
+        for name, value in arrays.items():
+            setattr(self, name, value.reshape(shape + value.shape[1:]))
+
+    @property
+    def xrun(self):
+        return self.overflow | self.underflow
+
+    def summary(self, parameters: dict=None):
+        """ one line per configuration, optionally prefixed with the given parameter arrays """
+        lines = []
+        for config in np.ndindex(*self.shape):
+            prefix = " ".join(f"{name}={np.broadcast_to(value, self.shape)[config]}"
+                              for name, value in (parameters or {}).items())
+            for segment in range(self.segments):
+                index = config + (segment,) if self.segments > 1 else config
+                label = f"{prefix} segment={segment}" if self.segments > 1 else prefix
+                first_xrun = self.first_xrun_time[index]
+                lines.append(f"{label} level: {self.min_level[index]}..{self.max_level[index]} "
+                             f"deviation: {self.settled_deviation[index]} "
+                             f"feedback: 0x{self.final_feedback[index]:x} "
+                             + (f"XRUN at {first_xrun:.3f}s ({self.xrun_steps[index]} steps)" if self.xrun[index] else "ok"))
+        return "\n".join(lines)
+
+
+class FeedbackLoopModel():
+    """ discrete-time model of the USB audio rate feedback loop
+
+        Models the host packet scheduler, which sends (accumulator + feedback) >> 16
+        samples per microframe and keeps the fractional part, the drift and jitter
+        between the host SOF clock and the ADAT clock, the fill level of the FIFO
+        between USB and the audio outputs, and the exact integer arithmetic
+        of the feedback circuit, either the original proportional one ("legacy")
+        or FeedbackController ("pi").
+
+        Every parameter except mode, step_sofs, seed and update_interval may be an
+        array. All of them are broadcast against each other and every element of
+        the result is one configuration, so a whole parameter grid runs at once.
+        The model advances step_sofs microframes per step, one feedback update
+        interval, with a Python loop over the steps and NumPy over the configurations,
+        so the cost per simulated second is almost independent of the number of
+        configurations. A run can also be split into independent segments, which
+        run side by side like further configurations, see run().
+    """
+    SOFS_PER_SECOND         = 8000
+    MEASUREMENT_SOFS        = 256
+    ADAT_CLOCKS_PER_SAMPLE  = 256
+    ERROR_FRACTION_BITS     = 8
+    LEGACY_COUNTER_BITS     = 19
+    MEASURED_RATE_BITS      = 20
+
+    def __init__(self, mode: str="pi", *,
+                 # defaults match usb1_to_output_fifo: 36 channels, USB1_MAX_PACKET_SIZE // 2 entries
+                 fifo_depth=504, channels=36, samplerate=48000, initial_fill=None,
+                 target_fill=None, kp_shift=10, ki_shift=16, max_correction=1 << 15,
+                 update_interval: int=8, legacy_level_bits=7,
+                 adat_ppm=0.0, host_ppm=0.0, sof_jitter_ns=0.0, host_latency: int=1,
+                 step_sofs: int=8, seed: int=0):
+        assert mode in ("pi", "legacy"), f"unknown feedback mode: {mode}"
+        assert self.MEASUREMENT_SOFS % step_sofs == 0, "step_sofs needs to divide the measurement window"
+        assert mode == "legacy" or update_interval % step_sofs == 0, "update_interval needs to be a multiple of step_sofs"
+
+        self.mode            = mode
+        self.update_interval = update_interval
+        self.step_sofs       = step_sofs
+        self.host_latency    = host_latency
+        self.seed            = seed
+
+        fifo_depth  = np.asarray(fifo_depth)
+        if target_fill is None:
+            target_fill = fifo_depth // 2
+        if initial_fill is None:
+            initial_fill = target_fill
+
+        parameters = dict(fifo_depth=fifo_depth, channels=channels, samplerate=samplerate,
+                          initial_fill=initial_fill, target_fill=target_fill,
+                          kp_shift=kp_shift, ki_shift=ki_shift, max_correction=max_correction,
+                          legacy_level_bits=legacy_level_bits,
+                          adat_ppm=adat_ppm, host_ppm=host_ppm, sof_jitter_ns=sof_jitter_ns)
+        arrays = np.broadcast_arrays(*[np.asarray(value) for value in parameters.values()])
+        self.shape      = arrays[0].shape
+        self.no_configs = int(np.prod(self.shape, dtype=np.int64))
+        self.parameters = {}
+        for name, array in zip(parameters, arrays):
+            self.parameters[name] = array
+            setattr(self, name, array.ravel())
+
+        int_parameters = ("fifo_depth", "channels", "initial_fill", "target_fill",
+                          "kp_shift", "ki_shift", "max_correction", "legacy_level_bits")
+        for name in int_parameters:
+            setattr(self, name, getattr(self, name).astype(np.int64))
+
+        # same as Signal(range(fifo_depth + 1)).width
+        self.level_width = np.array([int(depth).bit_length() for depth in self.fifo_depth], dtype=np.int64)
+        self.integral_limit = self.max_correction << self.ki_shift
+        self.nominal = np.rint(self.samplerate / self.SOFS_PER_SECOND * (1 << 16)).astype(np.int64)
+
+    def _adat_ticks(self, rng, sof_numbers, phase, ticks_per_sof, jitter_ticks):
+        """ number of ADAT clock ticks since the start of the simulation at the given SOFs """
+        jitter = rng.standard_normal((len(phase), len(sof_numbers))) * jitter_ticks[:, None]
+        return np.floor(phase[:, None] + sof_numbers[None, :] * ticks_per_sof[:, None] + jitter).astype(np.int64)
+
+    def run(self, seconds: float, trace_interval: float=0.1, chunk_steps: int=512,
+            segments: int=1, settle_seconds: float=None):
+        """ simulates the given number of seconds and returns a FeedbackLoopResult
+
+            With segments > 1 the time after settle_seconds is split into that many segments,
+            which are simulated side by side like further configurations. Each of them is an
+            independent run of settle_seconds plus its share of the time, which starts from
+            the initial state with its own random clock phase and jitter, so the segments are
+            not one continuous run. Their results are reported per segment, along the last axis
+            of each result array, with times counted from the start of the segment.
+            settle_seconds is the time after which the settled deviation is taken, half the
+            run by default, or at most 10 seconds with segments.
+        """
+        C   = self.no_configs
+        S   = segments
+        U   = self.step_sofs
+        rng = np.random.default_rng(self.seed)
+
+        if settle_seconds is None:
+            settle_seconds = seconds / 2 if S == 1 else min(10.0, seconds / 2)
+
+        total_steps     = int(seconds * self.SOFS_PER_SECOND) // U
+        settle_steps    = int(settle_seconds * self.SOFS_PER_SECOND) // U
+        segment_steps   = total_steps if S == 1 else (total_steps - settle_steps) // S
+        assert segment_steps > 0, "the run is too short for this number of segments"
+        no_steps        = total_steps if S == 1 else settle_steps + segment_steps
+        steps_per_trace = max(1, int(trace_interval * self.SOFS_PER_SECOND) // U)
+
+        # one row per segment of each configuration, the segments of a configuration are next to each other
+        def per_row(value):
+            return np.repeat(value, S)
+
+        fifo_depth        = per_row(self.fifo_depth)
+        channels          = per_row(self.channels)
+        target_fill       = per_row(self.target_fill)
+        kp_shift          = per_row(self.kp_shift)
+        ki_shift          = per_row(self.ki_shift)
+        max_correction    = per_row(self.max_correction)
+        integral_limit    = per_row(self.integral_limit)
+        level_width       = per_row(self.level_width)
+        legacy_level_bits = per_row(self.legacy_level_bits)
+
+        # the host SOFs are the time reference, so a fast host clock looks like a slow ADAT clock
+        tick_rate     = self.ADAT_CLOCKS_PER_SAMPLE * per_row(self.samplerate) * (1 + per_row(self.adat_ppm) * 1e-6)
+        sof_period    = (1 + per_row(self.host_ppm) * 1e-6) / self.SOFS_PER_SECOND
+        ticks_per_sof = tick_rate * sof_period
+        jitter_ticks  = tick_rate * per_row(self.sof_jitter_ns) * 1e-9
+        phase         = rng.uniform(0, self.ADAT_CLOCKS_PER_SAMPLE, C * S)
+
+        # state of the device
+        level             = per_row(self.initial_fill)
+        feedback          = per_row(self.nominal)
+        window_ticks      = np.zeros(C * S, dtype=np.int64)
+        window_started    = False
+        measured_rate     = np.zeros(C * S, dtype=np.int64)
+        measurement_valid = False
+        integral          = np.zeros(C * S, dtype=np.int64)
+
+        # state of the host
+        accumulator      = np.zeros(C * S, dtype=np.int64)
+        feedback_history = deque([feedback] * (self.host_latency + 1), maxlen=self.host_latency + 1)
+
+        # results
+        overflow        = np.zeros(C * S, dtype=bool)
+        underflow       = np.zeros(C * S, dtype=bool)
+        first_xrun_time = np.full(C * S, np.nan)
+        xrun_steps      = np.zeros(C * S, dtype=np.int64)
+        min_level       = level.copy()
+        max_level       = level.copy()
+        deviation       = np.zeros(C * S, dtype=np.int64)
+        level_trace     = np.zeros((C * S, no_steps // steps_per_trace), dtype=np.int64)
+
+        packet_offsets = np.arange(1, U + 1, dtype=np.int64)
+        legacy_mask    = (1 << self.LEGACY_COUNTER_BITS) - 1
+        rate_mask      = (1 << self.MEASURED_RATE_BITS) - 1
+
+        ticks = self._adat_ticks(rng, np.array([0]), phase, ticks_per_sof, jitter_ticks)
+        for chunk_start in range(0, no_steps, chunk_steps):
+            chunk_length = min(chunk_steps, no_steps - chunk_start)
+            first_sof    = chunk_start * U
+            sof_numbers  = np.arange(first_sof + 1, first_sof + chunk_length * U + 1)
+            # the last SOF of the previous chunk is the first one of this chunk
+            ticks  = np.concatenate([ticks[:, -1:], self._adat_ticks(rng, sof_numbers, phase, ticks_per_sof, jitter_ticks)], axis=1)
+            frames = ticks // self.ADAT_CLOCKS_PER_SAMPLE
+
+            for local_step in range(chunk_length):
+                step = chunk_start + local_step
+                sof  = step * U
+                i    = local_step * U
+
+                #
+                # device: feedback circuit, which runs on the SOF at the start of this step
+                #
+                pi_update = (self.mode == "pi") and (sof % self.update_interval == 0) and measurement_valid
+                if pi_update:
+                    error        = target_fill - level
+                    scaled_error = error << self.ERROR_FRACTION_BITS
+                    correction   = np.clip((scaled_error >> kp_shift) + (integral >> ki_shift),
+                                           -max_correction, max_correction)
+                    integral     = np.clip(integral + scaled_error, -integral_limit, integral_limit)
+                    feedback     = measured_rate + correction
+
+                if sof % self.MEASUREMENT_SOFS == 0:
+                    adat_clock_counter = ticks[:, i] - window_ticks
+                    if self.mode == "legacy":
+                        # the legacy circuit starts counting at reset, which has no
+                        # defined relation to the SOFs, so its first window is skipped
+                        if window_started:
+                            level_feedback = level >> (level_width - legacy_level_bits)
+                            feedback = ((adat_clock_counter & legacy_mask) + 1 - level_feedback) & 0xffffffff
+                    else:
+                        if window_started:
+                            measured_rate     = adat_clock_counter & rate_mask
+                            measurement_valid = True
+                    window_started = True
+                    window_ticks   = ticks[:, i]
+
+                feedback_history.append(feedback)
+
+                #
+                # host: one packet per microframe, sized by the feedback value it has seen
+                #
+                host_feedback     = feedback_history[0]
+                arrived           = (accumulator[:, None] + host_feedback[:, None] * packet_offsets[None, :]) >> 16
+                accumulator       = (accumulator + U * host_feedback) & 0xffff
+                arrived_before    = np.concatenate([np.zeros((C * S, 1), dtype=np.int64), arrived[:, :-1]], axis=1)
+                consumed          = frames[:, i:i + U] - frames[:, i:i + 1]
+
+                # fill levels right before and right after each packet
+                before_packet = level[:, None] + (arrived_before - consumed) * channels[:, None]
+                after_packet  = level[:, None] + (arrived        - consumed) * channels[:, None]
+                level         = level + (arrived[:, -1] - (frames[:, i + U] - frames[:, i])) * channels
+
+                lowest  = before_packet.min(axis=1)
+                highest = after_packet.max(axis=1)
+                min_level = np.minimum(min_level, lowest)
+                max_level = np.maximum(max_level, highest)
+
+                step_underflow = lowest < 0
+                step_overflow  = highest > fifo_depth
+                step_xrun      = step_underflow | step_overflow
+                if step_xrun.any():
+                    underflow |= step_underflow
+                    overflow  |= step_overflow
+                    xrun_steps += step_xrun
+                    first_xrun_time = np.where(step_xrun & np.isnan(first_xrun_time),
+                                               sof / self.SOFS_PER_SECOND, first_xrun_time)
+                    # the FIFO drops what does not fit and the output repeats when it runs empty
+                    level = np.clip(level, 0, fifo_depth)
+
+                if step >= settle_steps:
+                    deviation = np.maximum(deviation, np.abs(level - target_fill))
+
+                if step % steps_per_trace == 0 and step // steps_per_trace < level_trace.shape[1]:
+                    level_trace[:, step // steps_per_trace] = level
+
+        # the segments of each configuration along the last axis
+        def per_config(array):
+            return array.reshape((C, S) + array.shape[1:]) if S > 1 else array
+
+        run_seconds = seconds if S == 1 else no_steps * U / self.SOFS_PER_SECOND
+        return FeedbackLoopResult(self.shape, run_seconds, trace_interval, segments=S,
+                                  overflow=per_config(overflow),
+                                  underflow=per_config(underflow),
+                                  first_xrun_time=per_config(first_xrun_time),
+                                  xrun_steps=per_config(xrun_steps),
+                                  min_level=per_config(min_level),
+                                  max_level=per_config(max_level),
+                                  settled_deviation=per_config(deviation),
+                                  final_level=per_config(level),
+                                  final_feedback=per_config(feedback),
+                                  level_trace=per_config(level_trace))
+
+
+class FeedbackLoopModelTest(unittest.TestCase):
+    def test_pi_settles_with_clock_drift(self):
+        model  = FeedbackLoopModel("pi", fifo_depth=1024, channels=8, kp_shift=8, ki_shift=18,
+                                   adat_ppm=np.array([-100, 0, 100]), sof_jitter_ns=20)
+        result = model.run(seconds=20)
+        self.assertFalse(result.xrun.any())
+        self.assertTrue((result.settled_deviation < 2 * 6 * 8).all())
+
+    def test_segments(self):
+        model  = FeedbackLoopModel("pi", fifo_depth=1024, channels=8, kp_shift=8, ki_shift=18,
+                                   adat_ppm=np.array([-100, 100]), sof_jitter_ns=20)
+        result = model.run(seconds=60, segments=5, settle_seconds=10)
+        self.assertEqual(result.final_feedback.shape, (2, 5))
+        self.assertFalse(result.xrun.any())
+        self.assertTrue((result.settled_deviation < 2 * 6 * 8).all())
+        # each segment is 10 seconds of settling and 10 seconds of its own, traced every 0.1 seconds
+        self.assertEqual(result.seconds, 20)
+        self.assertEqual(result.level_trace.shape, (2, 5, 200))
+        self.assertEqual(len(result.summary().splitlines()), 10)
+
+    def test_legacy_mode_runs(self):
+        model  = FeedbackLoopModel("legacy", fifo_depth=1024, channels=8, legacy_level_bits=np.array([4, 7]))
+        result = model.run(seconds=5)
+        self.assertEqual(result.final_feedback.shape, (2,))
+        self.assertTrue((result.final_feedback > 0x50000).all())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sweep the gains of the USB rate feedback loop")
+    parser.add_argument("--mode", choices=["pi", "legacy"], default="pi")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--fifo-depth", type=int, default=504)
+    parser.add_argument("--channels", type=int, default=36)
+    parser.add_argument("--target-fill", type=int, default=None)
+    parser.add_argument("--kp-shifts", type=int, nargs="+", default=list(range(6, 13)))
+    parser.add_argument("--ki-shifts", type=int, nargs="+", default=list(range(12, 19)))
+    parser.add_argument("--update-interval", type=int, default=8)
+    parser.add_argument("--adat-ppm", type=float, default=50)
+    parser.add_argument("--host-ppm", type=float, default=-50)
+    parser.add_argument("--jitter-ns", type=float, default=50)
+    parser.add_argument("--host-latency", type=int, default=1)
+    parser.add_argument("--segments", type=int, default=1, help="simulate this many independent segments side by side")
+    parser.add_argument("--settle-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    kp_shift = np.array(args.kp_shifts)[:, None]
+    ki_shift = np.array(args.ki_shifts)[None, :]
+
+    model = FeedbackLoopModel(args.mode, fifo_depth=args.fifo_depth, channels=args.channels,
+                              target_fill=args.target_fill, kp_shift=kp_shift, ki_shift=ki_shift,
+                              update_interval=args.update_interval,
+                              adat_ppm=args.adat_ppm, host_ppm=args.host_ppm, sof_jitter_ns=args.jitter_ns,
+                              host_latency=args.host_latency)
+    result = model.run(args.seconds, segments=args.segments, settle_seconds=args.settle_seconds)
+    print(result.summary(dict(kp_shift=kp_shift, ki_shift=ki_shift)))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+from amaranth          import *
+from amaranth.build    import Platform
+from amaranth.lib.fifo import SyncFIFOBuffered
+from amaranth.sim      import Settle
+from amlib.stream      import StreamInterface
+from amlib.test        import GatewareTestCase, sync_test_case
+
+class MIDIRouter(Elaboratable):
+    """ routes USB-MIDI event packets from any of its sources to any of its destinations
+
+        routes_in has one bit for each pair of source and destination, at
+        source * no_destinations + destination, and resets to the given routes.
+        An event goes to all destinations of its source in the same cycle and each
+        destination has a FIFO of whole events, so events of different sources merge
+        without interleaving. The sources take turns, one per cycle.
+
+        cable_routes restricts the route of a (source, destination, cable) to the events
+        with that cable number, so that the cables of one USB port can go to different ports.
+
+        While the FIFO of one of the blocking_destinations is full, the sources routed
+        to it have to wait. The other destinations drop events which find their FIFO full
+        and count them in dropped_out, so a host which does not read its MIDI port
+        can't stall the other ports.
+    """
+    def __init__(self, no_sources: int=2, no_destinations: int=2, routes=(), fifo_depth: int=32,
+                 blocking_destinations=(), cable_routes=()):
+        self._no_sources            = no_sources
+        self._no_destinations       = no_destinations
+        self._fifo_depth            = fifo_depth
+        self._blocking_destinations = blocking_destinations
+        self._cable_routes          = cable_routes
+
+        # I/O
+        self.events_in   = [StreamInterface(name=f"midi_router_in_{i}",  payload_width=32) for i in range(no_sources)]
+        self.events_out  = [StreamInterface(name=f"midi_router_out_{i}", payload_width=32) for i in range(no_destinations)]
+        self.routes_in   = Signal(no_sources * no_destinations,
+                                  reset=sum(1 << (source * no_destinations + destination) for source, destination in routes))
+        self.dropped_out = [Signal(16, name=f"midi_dropped_{i}") for i in range(no_destinations)]
+        self.levels_out  = [Signal(range(fifo_depth + 1), name=f"midi_level_{i}") for i in range(no_destinations)]
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        fifos = []
+        for i in range(self._no_destinations):
+            fifo = SyncFIFOBuffered(width=32, depth=self._fifo_depth)
+            setattr(m.submodules, f"fifo{i}", fifo)
+            fifos.append(fifo)
+
+        events_in = Array(self.events_in)
+        source    = Signal(range(self._no_sources))
+        selected  = events_in[source]
+        routes    = Signal(self._no_destinations)
+        cable_ok  = Signal(self._no_destinations)
+        blocked   = Signal()
+        accept    = Signal()
+
+        # the cable number is the upper nibble of the first byte of an event
+        cable = selected.payload[4:8]
+        for destination in range(self._no_destinations):
+            conditions = [(source != route_source) | (cable == route_cable)
+                          for route_source, route_destination, route_cable in self._cable_routes
+                          if route_destination == destination]
+            m.d.comb += cable_ok[destination].eq(Cat(conditions).all() if conditions else 1)
+
+        m.d.comb += [
+            routes.eq(self.routes_in.word_select(source, self._no_destinations) & cable_ok),
+            # events without a destination are taken and dropped, so they can't hold up the source
+            accept.eq(selected.valid & ~blocked),
+            selected.ready.eq(accept),
+        ]
+
+        if self._blocking_destinations:
+            m.d.comb += blocked.eq(Cat(routes[i] & ~fifos[i].w_rdy for i in self._blocking_destinations).any())
+
+        m.d.sync += source.eq(Mux(source == self._no_sources - 1, 0, source + 1))
+
+        for i, fifo in enumerate(fifos):
+            events_out  = self.events_out[i]
+            dropped_out = self.dropped_out[i]
+
+            m.d.comb += [
+                fifo.w_data.eq(selected.payload),
+                fifo.w_en.eq(accept & routes[i]),
+
+                events_out.payload.eq(fifo.r_data),
+                events_out.valid.eq(fifo.r_rdy),
+                events_out.first.eq(1),
+                events_out.last.eq(1),
+                fifo.r_en.eq(events_out.ready),
+                self.levels_out[i].eq(fifo.r_level),
+            ]
+
+            with m.If(fifo.w_en & ~fifo.w_rdy & (dropped_out != (2**16 - 1))):
+                m.d.sync += dropped_out.eq(dropped_out + 1)
+
+        return m
+
+
+def run_router(dut, events, cycles, read):
+    """ offers the events of each source and collects what the destinations put out """
+    positions = [0] * len(events)
+    received  = [[] for _ in dut.events_out]
+    for destination, stream in enumerate(dut.events_out):
+        yield stream.ready.eq(read[destination])
+
+    for _ in range(cycles):
+        for source, stream in enumerate(dut.events_in):
+            if positions[source] < len(events[source]):
+                yield stream.payload.eq(events[source][positions[source]])
+                yield stream.valid.eq(1)
+            else:
+                yield stream.valid.eq(0)
+        yield Settle()
+        for source, stream in enumerate(dut.events_in):
+            if (yield stream.valid) and (yield stream.ready):
+                positions[source] += 1
+        for destination, stream in enumerate(dut.events_out):
+            if (yield stream.valid) and (yield stream.ready):
+                received[destination].append((yield stream.payload))
+        yield
+
+    return positions, received
+
+
+class MIDIRouterTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = MIDIRouter
+    FRAGMENT_ARGUMENTS  = dict(no_sources=2, no_destinations=2, routes=[(0, 0), (1, 0), (0, 1)], fifo_depth=4)
+
+    @sync_test_case
+    def test_merge(self):
+        events = [[0x100 + i for i in range(10)], [0x200 + i for i in range(10)]]
+        positions, received = yield from run_router(self.dut, events, 60, read=[1, 1])
+        self.assertEqual(positions, [10, 10])
+        self.assertEqual(sorted(received[0]), sorted(events[0] + events[1]))
+        for source in range(2):
+            self.assertEqual([value for value in received[0] if value >> 8 == source + 1], events[source])
+        # source 1 is not routed to destination 1
+        self.assertEqual(received[1], events[0])
+        for dropped in self.dut.dropped_out:
+            self.assertEqual((yield dropped), 0)
+
+    @sync_test_case
+    def test_full_destination_drops(self):
+        dut    = self.dut
+        events = [[0x100 + i for i in range(10)], []]
+        positions, received = yield from run_router(self.dut, events, 40, read=[0, 1])
+        # destination 0 is not read, which must not hold up destination 1
+        self.assertEqual(received[1], events[0])
+        level   = (yield dut.levels_out[0])
+        dropped = (yield dut.dropped_out[0])
+        self.assertGreater(dropped, 0)
+        self.assertEqual(level + dropped, 10)
+
+
+class MIDIRouterCableTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = MIDIRouter
+    FRAGMENT_ARGUMENTS  = dict(no_sources=2, no_destinations=2, routes=[(0, 0), (0, 1), (1, 0)], fifo_depth=8,
+                               cable_routes=[(0, 0, 0), (0, 1, 1)])
+
+    @sync_test_case
+    def test_cables(self):
+        # note on events, with the cable number in bits 4 to 7
+        events = [[(i << 8) | ((i % 2) << 4) | 0x9 for i in range(1, 9)],
+                  [(i << 8) | (1 << 4) | 0x9 for i in range(0x11, 0x15)]]
+        positions, received = yield from run_router(self.dut, events, 40, read=[1, 1])
+        self.assertEqual(positions, [8, 4])
+        # cable 0 of source 0 goes to destination 0, cable 1 to destination 1
+        self.assertEqual([value for value in received[0] if value & 0x10 == 0],
+                         [value for value in events[0] if value & 0x10 == 0])
+        self.assertEqual(received[1], [value for value in events[0] if value & 0x10])
+        # source 1 has no cable route, all its events go through
+        self.assertEqual(sorted(value for value in received[0] if value & 0x10), sorted(events[1]))
+
+
+class MIDIRouterBlockingTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = MIDIRouter
+    FRAGMENT_ARGUMENTS  = dict(no_sources=2, no_destinations=2, routes=[(0, 0), (0, 1), (1, 1)], fifo_depth=4,
+                               blocking_destinations=[0])
+
+    @sync_test_case
+    def test_blocking_destination(self):
+        dut    = self.dut
+        events = [[0x100 + i for i in range(10)], [0x200 + i for i in range(10)]]
+        positions, received = yield from run_router(self.dut, events, 60, read=[0, 1])
+        # source 0 waits for destination 0, source 1 is not held up by it
+        self.assertEqual(positions[0], (yield dut.levels_out[0]))
+        self.assertEqual(positions[1], 10)
+        self.assertEqual([value for value in received[1] if value >> 8 == 2], events[1])
+        for dropped in dut.dropped_out:
+            self.assertEqual((yield dropped), 0)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import argparse
+import hashlib
+import json
+import os
+import re
+import unittest
+
+# source location attributes change with every edit above a line of gateware code,
+# without changing the netlist, so they are left out of the hash
+RTLIL_SRC_ATTRIBUTE   = re.compile(r"^\s*attribute \\src .*$\n?", re.MULTILINE)
+VERILOG_SRC_ATTRIBUTE = re.compile(r"\(\*\s*src\s*=\s*\"[^\"]*\"\s*\*\)\s*")
+
+RTLIL_MODULE   = re.compile(r"^module \\?(\S+)\n(.*?)^end$", re.MULTILINE | re.DOTALL)
+VERILOG_MODULE = re.compile(r"^module \\?(\S+?)\s*\((.*?)^endmodule", re.MULTILINE | re.DOTALL)
+
+def normalize(filename: str, content: str) -> str:
+    if filename.endswith(".il"):
+        return RTLIL_SRC_ATTRIBUTE.sub("", content)
+    if filename.endswith(".v"):
+        return VERILOG_SRC_ATTRIBUTE.sub("", content)
+    return content
+
+def digest(data) -> str:
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+def module_digests(filename: str, content: str) -> dict:
+    """ the digest of each module of a RTLIL or Verilog netlist, by module name """
+    pattern = RTLIL_MODULE if filename.endswith(".il") else VERILOG_MODULE
+    return { match.group(1): digest(match.group(2)) for match in pattern.finditer(normalize(filename, content)) }
+
+def plan_digests(files: dict) -> dict:
+    """ digests of all files of a build plan, and of each module of the netlists among them """
+    result = dict(files={}, modules={})
+    for filename, content in sorted(files.items()):
+        if isinstance(content, bytes) and filename.endswith((".il", ".v")):
+            content = content.decode()
+        result["files"][filename] = digest(normalize(filename, content) if isinstance(content, str) else content)
+        if filename.endswith((".il", ".v")):
+            result["modules"].update(module_digests(filename, content))
+    return result
+
+def compare_digests(old: dict, new: dict) -> dict:
+    """ the modules and files which were changed, added or removed """
+    report = {}
+    for kind in ["files", "modules"]:
+        old_items = (old or {}).get(kind, {})
+        new_items = new.get(kind, {})
+        report[kind] = dict(
+            changed = sorted(name for name in new_items if name in old_items and old_items[name] != new_items[name]),
+            added   = sorted(name for name in new_items if name not in old_items),
+            removed = sorted(name for name in old_items if name not in new_items),
+        )
+    return report
+
+def unchanged(report: dict) -> bool:
+    return not any(names for kind in report.values() for names in kind.values())
+
+def format_report(report: dict) -> str:
+    lines = []
+    for kind, changes in report.items():
+        for change, names in changes.items():
+            for name in names:
+                lines.append(f"  {change:>7} {kind[:-1]}: {name}")
+    return "\n".join(lines) if lines else "  no changes"
+
+
+class IncrementalBuild():
+    """ skips the toolchain when the netlist of a build plan did not change since the last successful build
+
+        The digests of the last successful build are kept in build_dir/<name>.digests.json.
+    """
+    def __init__(self, build_dir: str, name: str):
+        self._digest_file = os.path.join(build_dir, f"{name}.digests.json")
+        self.report       = None
+
+    def load(self):
+        if not os.path.exists(self._digest_file):
+            return None
+        with open(self._digest_file) as f:
+            return json.load(f)
+
+    def needs_build(self, files: dict) -> bool:
+        """ compares the files of a build plan against the last successful build """
+        self._digests = plan_digests(files)
+        previous      = self.load()
+        self.report   = compare_digests(previous, self._digests)
+        return previous is None or not unchanged(self.report)
+
+    def succeeded(self):
+        """ call after the toolchain ran successfully """
+        os.makedirs(os.path.dirname(self._digest_file) or ".", exist_ok=True)
+        with open(self._digest_file, 'w') as f:
+            json.dump(self._digests, f, indent=2)
+
+
+def build_incremental(platform, elaboratable, name: str="top", build_dir: str="build", verbose: bool=True, **kwargs):
+    """ like platform.build(), but reuses the synthesis and place and route results in build_dir
+        when the netlist did not change. Returns the build products and the report of changes. """
+    from amaranth.build.run import LocalBuildProducts
+
+    plan  = platform.build(elaboratable, name=name, build_dir=build_dir, do_build=False, **kwargs)
+    build = IncrementalBuild(build_dir, name)
+    if build.needs_build(plan.files):
+        if verbose:
+            print(f"netlist of {name} changed, rebuilding:\n{format_report(build.report)}", flush=True)
+        products = plan.execute_local(build_dir)
+        build.succeeded()
+    else:
+        if verbose:
+            print(f"netlist of {name} unchanged, reusing the results in {build_dir}", flush=True)
+        products = LocalBuildProducts(os.path.abspath(build_dir))
+    return products, build.report
+
+
+class NetlistHashTest(unittest.TestCase):
+    RTLIL = """attribute \\generator "Amaranth"
+module \\top.sub
+  attribute \\src "gateware/sub.py:10"
+  wire width 1 input 0 \\a
+  wire width 1 output 1 \\y
+  connect \\y \\a
+end
+module \\top
+  attribute \\src "gateware/top.py:20"
+  wire width 1 input 0 \\clk
+  cell \\top.sub \\sub
+    connect \\a \\clk
+  end
+end
+"""
+
+    def test_module_digests(self):
+        digests = module_digests("top.il", self.RTLIL)
+        self.assertEqual(set(digests.keys()), {"top.sub", "top"})
+
+    def test_source_locations_are_ignored(self):
+        moved = self.RTLIL.replace("sub.py:10", "sub.py:42")
+        self.assertEqual(module_digests("top.il", self.RTLIL), module_digests("top.il", moved))
+        self.assertTrue(unchanged(compare_digests(plan_digests({"top.il": self.RTLIL}), plan_digests({"top.il": moved}))))
+
+    def test_changed_module_is_reported(self):
+        changed = self.RTLIL.replace("connect \\y \\a", "connect \\y 1'0")
+        report  = compare_digests(plan_digests({"top.il": self.RTLIL}), plan_digests({"top.il": changed}))
+        self.assertEqual(report["modules"]["changed"], ["top.sub"])
+        self.assertEqual(report["files"]["changed"], ["top.il"])
+
+    def test_verilog(self):
+        verilog = '(* src = "a.py:1" *)\nmodule top(clk);\n  input clk;\nendmodule\nmodule \\top.sub (a);\nendmodule\n'
+        self.assertEqual(set(module_digests("top.v", verilog).keys()), {"top", "top.sub"})
+
+    def test_incremental_build(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as build_dir:
+            build = IncrementalBuild(build_dir, "top")
+            self.assertTrue(build.needs_build({"top.il": self.RTLIL}))
+            # a failed build does not count
+            self.assertTrue(build.needs_build({"top.il": self.RTLIL}))
+            build.succeeded()
+            self.assertFalse(build.needs_build({"top.il": self.RTLIL, }))
+            self.assertTrue(build.needs_build({"top.il": self.RTLIL, "top.sdc": "new constraint"}))
+            self.assertEqual(build.report["files"]["added"], ["top.sdc"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare the modules of two RTLIL or Verilog netlists")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    args = parser.parse_args()
+
+    with open(args.old) as old, open(args.new) as new:
+        report = compare_digests(plan_digests({args.old: old.read()}), plan_digests({args.old: new.read()}))
+    print(format_report(report))
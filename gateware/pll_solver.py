@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import argparse
+import math
+import unittest
+from fractions import Fraction
+
+USB_CLOCK_FREQUENCY = 60e6
+
+def audio_clock_frequencies(samplerate: int, fast_multiplier: float=9) -> dict:
+    """ the clocks of the audio domains for a given sample rate, in Hz """
+    adat_clock = samplerate * 256
+    return dict(
+        # ADAT clock = fs * 256
+        adat = adat_clock,
+        # I2S DAC clock = fs * 32 bit * 2 channels
+        dac  = samplerate * 64,
+        # ADAT transmit domain clock = fs * 256 * 5 output terminals
+        sync = adat_clock * 5,
+        # ADAT sampling clock = fs * 256 * fast_multiplier times oversampling
+        fast = adat_clock * fast_multiplier,
+    )
+
+def ppm_error(actual: float, requested: float) -> float:
+    return (actual - requested) / requested * 1e6
+
+
+class PLLFamily():
+    """ divider ranges and frequency limits of a PLL primitive
+
+        All outputs of a PLL share one VCO:
+            vco_freq    = input_freq / input_divider * feedback multiplier
+            output_freq = vco_freq / output_divider
+        Dividers are given as (minimum, maximum, step) ranges,
+        a step below one means the divider is fractional.
+    """
+    INSTANCE       = None
+    MAX_OUTPUTS    = None
+    INPUT_DIVIDER  = None
+    FEEDBACK       = None
+    OUTPUT_DIVIDER = None
+    PFD_RANGE      = None
+    VCO_RANGE      = None
+
+    @classmethod
+    def output_divider(cls, index: int):
+        return cls.OUTPUT_DIVIDER
+
+    @classmethod
+    def feedback_settings(cls, pfd_freq: float):
+        """ yields (feedback parameters, vco frequency) for all feedback settings which keep the VCO in range """
+        minimum, maximum, step = cls.FEEDBACK
+        vco_min, vco_max       = cls.VCO_RANGE
+        first = max(minimum, math.ceil(vco_min / pfd_freq / step) * step)
+        last  = min(maximum, math.floor(vco_max / pfd_freq / step) * step)
+        for multiplier in _divider_values(first, last, step):
+            yield dict(multiplier=multiplier), pfd_freq * multiplier
+
+    @classmethod
+    def best_divider(cls, index: int, vco_freq: float, frequency: float):
+        """ the divider of output index which comes closest to frequency, or None if it is out of reach """
+        minimum, maximum, step = cls.output_divider(index)
+        ideal      = vco_freq / frequency / step
+        candidates = [d * step for d in (math.floor(ideal), math.ceil(ideal)) if minimum <= d * step <= maximum]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda divider: abs(vco_freq / divider - frequency))
+
+    @classmethod
+    def instance_parameters(cls, solution) -> dict:
+        """ the parameters of the Instance of this PLL, in amaranth Instance keyword form """
+        raise NotImplementedError
+
+
+class ALTPLL(PLLFamily):
+    """ Intel Cyclone IV / Cyclone 10 LP ALTPLL """
+    INSTANCE       = "ALTPLL"
+    MAX_OUTPUTS    = 5
+    INPUT_DIVIDER  = (1, 512, 1)
+    FEEDBACK       = (1, 512, 1)
+    OUTPUT_DIVIDER = (1, 512, 1)
+    PFD_RANGE      = (5e6, 325e6)
+    VCO_RANGE      = (600e6, 1300e6)
+
+    @classmethod
+    def instance_parameters(cls, solution) -> dict:
+        # ALTPLL takes the ratio of each output and derives its counters itself
+        parameters = dict(
+            p_BANDWIDTH_TYPE         = "AUTO",
+            p_INCLK0_INPUT_FREQUENCY = round(1e12 / solution.input_freq),
+            p_OPERATION_MODE         = "NORMAL",
+        )
+        for index, output in enumerate(solution.outputs):
+            ratio = Fraction(solution.feedback["multiplier"]) / (solution.input_divider * output.divider)
+            parameters.update({
+                f"p_CLK{index}_DIVIDE_BY":   ratio.denominator,
+                f"p_CLK{index}_DUTY_CYCLE":  50,
+                f"p_CLK{index}_MULTIPLY_BY": ratio.numerator,
+                f"p_CLK{index}_PHASE_SHIFT": 0,
+            })
+        return parameters
+
+
+class EHXPLLL(PLLFamily):
+    """ Lattice ECP5 EHXPLLL, fed back from CLKOP
+
+        CLKOP is the feedback clock, so the VCO runs at
+            input_freq / CLKI_DIV * CLKFB_DIV * CLKOP_DIV
+        and the requested clocks come out of CLKOS, CLKOS2 and CLKOS3.
+    """
+    INSTANCE       = "EHXPLLL"
+    MAX_OUTPUTS    = 3
+    OUTPUTS        = ["CLKOS", "CLKOS2", "CLKOS3"]
+    INPUT_DIVIDER  = (1, 128, 1)
+    FEEDBACK       = (1, 128, 1)
+    OUTPUT_DIVIDER = (1, 128, 1)
+    PFD_RANGE      = (3.125e6, 400e6)
+    VCO_RANGE      = (400e6, 800e6)
+    OUTPUT_RANGE   = (3.125e6, 400e6)
+
+    @classmethod
+    def feedback_settings(cls, pfd_freq: float):
+        vco_min, vco_max = cls.VCO_RANGE
+        out_min, out_max = cls.OUTPUT_RANGE
+        for feedback_divider in range(1, cls.FEEDBACK[1] + 1):
+            clkop_freq = pfd_freq * feedback_divider
+            if not (out_min <= clkop_freq <= out_max):
+                continue
+            first = max(1, math.ceil(vco_min / clkop_freq))
+            last  = min(cls.OUTPUT_DIVIDER[1], math.floor(vco_max / clkop_freq))
+            for clkop_divider in range(first, last + 1):
+                yield dict(CLKFB_DIV=feedback_divider, CLKOP_DIV=clkop_divider), clkop_freq * clkop_divider
+
+    @classmethod
+    def instance_parameters(cls, solution) -> dict:
+        parameters = dict(
+            p_PLLRST_ENA      = "DISABLED",
+            p_INTFB_WAKE      = "DISABLED",
+            p_STDBY_ENABLE    = "DISABLED",
+            p_DPHASE_SOURCE   = "DISABLED",
+            p_OUTDIVIDER_MUXA = "DIVA",
+            p_OUTDIVIDER_MUXB = "DIVB",
+            p_OUTDIVIDER_MUXC = "DIVC",
+            p_OUTDIVIDER_MUXD = "DIVD",
+            p_CLKI_DIV        = solution.input_divider,
+            p_CLKOP_ENABLE    = "ENABLED",
+            p_CLKOP_DIV       = solution.feedback["CLKOP_DIV"],
+            p_CLKOP_CPHASE    = 0,
+            p_CLKOP_FPHASE    = 0,
+            p_FEEDBK_PATH     = "CLKOP",
+            p_CLKFB_DIV       = solution.feedback["CLKFB_DIV"],
+            a_FREQUENCY_PIN_CLKI = f"{solution.input_freq / 1e6:g}",
+        )
+        for name, output in zip(cls.OUTPUTS, solution.outputs):
+            parameters.update({
+                f"p_{name}_ENABLE": "ENABLED",
+                f"p_{name}_DIV":    output.divider,
+                f"p_{name}_CPHASE": 0,
+                f"p_{name}_FPHASE": 0,
+                f"a_FREQUENCY_PIN_{name}": f"{output.frequency / 1e6:.6g}",
+            })
+        return parameters
+
+
+class PLLE2(PLLFamily):
+    """ Xilinx 7 series PLLE2_ADV, speed grade -1 """
+    INSTANCE       = "PLLE2_ADV"
+    MAX_OUTPUTS    = 6
+    INPUT_DIVIDER  = (1, 56, 1)
+    FEEDBACK       = (2, 64, 1)
+    OUTPUT_DIVIDER = (1, 128, 1)
+    PFD_RANGE      = (19e6, 450e6)
+    VCO_RANGE      = (800e6, 1600e6)
+
+    MULTIPLIER_PARAMETER = "p_CLKFBOUT_MULT"
+    DIVIDER_PARAMETERS   = ["p_CLKOUT{}_DIVIDE"] * 6
+
+    @classmethod
+    def instance_parameters(cls, solution) -> dict:
+        parameters = {
+            "p_CLKIN1_PERIOD":         round(1e9 / solution.input_freq, 3),
+            "p_BANDWIDTH":             "OPTIMIZED",
+            "p_COMPENSATION":          "ZHOLD",
+            "p_STARTUP_WAIT":          "FALSE",
+            "p_DIVCLK_DIVIDE":         solution.input_divider,
+            cls.MULTIPLIER_PARAMETER:  solution.feedback["multiplier"],
+            "p_CLKFBOUT_PHASE":        0,
+        }
+        for index, output in enumerate(solution.outputs):
+            parameters.update({
+                cls.DIVIDER_PARAMETERS[index].format(index): output.divider,
+                f"p_CLKOUT{index}_PHASE":      0,
+                f"p_CLKOUT{index}_DUTY_CYCLE": 0.5,
+            })
+        return parameters
+
+
+class MMCME2(PLLE2):
+    """ Xilinx 7 series MMCME2_ADV, speed grade -1
+
+        The feedback multiplier and the divider of CLKOUT0 are fractional in steps of 1/8.
+    """
+    INSTANCE       = "MMCME2_ADV"
+    MAX_OUTPUTS    = 7
+    INPUT_DIVIDER  = (1, 106, 1)
+    FEEDBACK       = (2, 64, 0.125)
+    OUTPUT_DIVIDER = (1, 128, 1)
+    PFD_RANGE      = (10e6, 450e6)
+    VCO_RANGE      = (600e6, 1200e6)
+
+    MULTIPLIER_PARAMETER = "p_CLKFBOUT_MULT_F"
+    DIVIDER_PARAMETERS   = ["p_CLKOUT{}_DIVIDE_F"] + ["p_CLKOUT{}_DIVIDE"] * 6
+
+    @classmethod
+    def output_divider(cls, index: int):
+        return (2, 128, 0.125) if index == 0 else cls.OUTPUT_DIVIDER
+
+
+class PLLOutput():
+    def __init__(self, name: str, requested: float, divider, frequency: float):
+        self.name      = name
+        self.requested = requested
+        self.divider   = divider
+        self.frequency = frequency
+
+    @property
+    def ppm(self) -> float:
+        return ppm_error(self.frequency, self.requested)
+
+    def __str__(self):
+        return f"{self.name:>6}: {self.frequency / 1e6:12.6f} MHz (requested {self.requested / 1e6:.6f} MHz, " \
+               f"divider {self.divider:g}, {self.ppm:+9.3f} ppm)"
+
+
+class PLLSolution():
+    def __init__(self, family, input_freq: float, input_divider: int, feedback: dict, vco_freq: float, outputs):
+        self.family        = family
+        self.input_freq    = input_freq
+        self.input_divider = input_divider
+        self.feedback      = feedback
+        self.vco_freq      = vco_freq
+        self.outputs       = outputs
+
+    @property
+    def max_ppm(self) -> float:
+        return max(abs(output.ppm) for output in self.outputs)
+
+    def output(self, name: str) -> PLLOutput:
+        return next(output for output in self.outputs if output.name == name)
+
+    def instance_parameters(self) -> dict:
+        return self.family.instance_parameters(self)
+
+    def __str__(self):
+        feedback = " ".join(f"{name}={value:g}" for name, value in self.feedback.items())
+        header   = f"{self.family.INSTANCE}: input {self.input_freq / 1e6:g} MHz / {self.input_divider}, " \
+                   f"{feedback}, VCO {self.vco_freq / 1e6:.3f} MHz, worst error {self.max_ppm:.3f} ppm"
+        return "\n".join([header] + [f"    {output}" for output in self.outputs])
+
+
+def _divider_values(first, last, step):
+    count = round((last - first) / step)
+    return [first + i * step if step < 1 else int(first + i * step) for i in range(count + 1)]
+
+def solve(family, input_freq: float, clocks: dict) -> PLLSolution:
+    """ searches the divider space of family for the setting with the smallest worst case
+        ppm error over clocks, a dict of output name to frequency in Hz
+
+        Ties are broken in favour of the higher VCO frequency, which has less jitter.
+        Returns None if no setting reaches all clocks.
+    """
+    assert len(clocks) <= family.MAX_OUTPUTS, f"{family.INSTANCE} has only {family.MAX_OUTPUTS} outputs"
+    pfd_min, pfd_max = family.PFD_RANGE
+
+    best     = None
+    best_key = None
+    for input_divider in _divider_values(*family.INPUT_DIVIDER):
+        pfd_freq = input_freq / input_divider
+        if not (pfd_min <= pfd_freq <= pfd_max):
+            continue
+
+        for feedback, vco_freq in family.feedback_settings(pfd_freq):
+            worst    = 0
+            dividers = []
+            for index, frequency in enumerate(clocks.values()):
+                divider = family.best_divider(index, vco_freq, frequency)
+                if divider is None:
+                    break
+                dividers.append(divider)
+                worst = max(worst, abs(ppm_error(vco_freq / divider, frequency)))
+            else:
+                key = (round(worst, 9), -vco_freq)
+                if best_key is None or key < best_key:
+                    best_key = key
+                    best     = (input_divider, feedback, vco_freq, dividers)
+
+    if best is None:
+        return None
+
+    input_divider, feedback, vco_freq, dividers = best
+    outputs = [PLLOutput(name, frequency, divider, vco_freq / divider)
+               for (name, frequency), divider in zip(clocks.items(), dividers)]
+    return PLLSolution(family, input_freq, input_divider, feedback, vco_freq, outputs)
+
+def solve_clock_domain_generator(generator, reference_freq: float, samplerates=(44100, 48000), fast_multiplier: float=9):
+    """ solves the USB PLL and, for each sample rate, the audio PLL of a clock domain generator class from car.py
+
+        Returns a dict with the solution for "usb" and one for each sample rate.
+    """
+    family    = generator.PLL_FAMILY
+    solutions = dict(usb=solve(family, reference_freq, dict(usb=USB_CLOCK_FREQUENCY)))
+
+    audio_reference = USB_CLOCK_FREQUENCY if generator.AUDIO_PLL_REFERENCE == "usb" else reference_freq
+    for samplerate in samplerates:
+        frequencies = audio_clock_frequencies(samplerate, fast_multiplier)
+        clocks = { name: frequencies[name] for name in generator.AUDIO_PLL_CLOCKS }
+        solutions[samplerate] = solve(family, audio_reference, clocks)
+
+    return solutions
+
+
+class PLLSolverTest(unittest.TestCase):
+    def check_limits(self, solution):
+        family = solution.family
+        self.assertTrue(family.VCO_RANGE[0] <= solution.vco_freq <= family.VCO_RANGE[1])
+        self.assertTrue(family.PFD_RANGE[0] <= solution.input_freq / solution.input_divider <= family.PFD_RANGE[1])
+        for index, output in enumerate(solution.outputs):
+            minimum, maximum, step = family.output_divider(index)
+            self.assertTrue(minimum <= output.divider <= maximum)
+            self.assertAlmostEqual(output.divider / step, round(output.divider / step))
+
+    def test_exact_usb_clock(self):
+        for family, input_freq in [(ALTPLL, 50e6), (EHXPLLL, 25e6), (PLLE2, 50e6), (MMCME2, 50e6)]:
+            solution = solve(family, input_freq, dict(usb=USB_CLOCK_FREQUENCY))
+            self.check_limits(solution)
+            self.assertAlmostEqual(solution.output("usb").ppm, 0)
+
+    def test_not_worse_than_hand_computed(self):
+        # car.py: Cyclone IV audio PLL 60MHz * 17 / 83, Colorlight 25MHz * 29 / 59
+        adat_clock = audio_clock_frequencies(48000)["adat"]
+        solution = solve(ALTPLL, USB_CLOCK_FREQUENCY, dict(adat=adat_clock))
+        self.assertLessEqual(abs(solution.output("adat").ppm), abs(ppm_error(60e6 * 17 / 83, adat_clock)))
+
+        solution = solve(EHXPLLL, 25e6, dict(adat=adat_clock))
+        self.check_limits(solution)
+        self.assertLessEqual(abs(solution.output("adat").ppm), abs(ppm_error(25e6 * 29 / 59, adat_clock)))
+
+    def test_fractional_mmcm_divider(self):
+        # the DAC clock is below the range of a single 7 series output divider
+        frequencies = audio_clock_frequencies(44100)
+        del frequencies["dac"]
+        solution = solve(MMCME2, USB_CLOCK_FREQUENCY, frequencies)
+        self.check_limits(solution)
+        # only CLKOUT0 may be fractional
+        for output in solution.outputs[1:]:
+            self.assertEqual(output.divider, int(output.divider))
+        self.assertLessEqual(solution.max_ppm, solve(PLLE2, USB_CLOCK_FREQUENCY, frequencies).max_ppm)
+
+    def test_instance_parameters(self):
+        solution   = solve(ALTPLL, USB_CLOCK_FREQUENCY, audio_clock_frequencies(48000))
+        parameters = solution.instance_parameters()
+        for index, output in enumerate(solution.outputs):
+            ratio = parameters[f"p_CLK{index}_MULTIPLY_BY"] / parameters[f"p_CLK{index}_DIVIDE_BY"]
+            self.assertAlmostEqual(USB_CLOCK_FREQUENCY * ratio, output.frequency, places=3)
+
+        solution   = solve(EHXPLLL, 25e6, dict(adat=12.288e6, fast=98.304e6))
+        parameters = solution.instance_parameters()
+        self.assertEqual(parameters["p_CLKOS_DIV"], solution.output("adat").divider)
+        self.assertEqual(parameters["p_CLKOS2_DIV"], solution.output("fast").divider)
+        self.assertAlmostEqual(25e6 / parameters["p_CLKI_DIV"] * parameters["p_CLKFB_DIV"] * parameters["p_CLKOP_DIV"],
+                               solution.vco_freq)
+
+    def test_clock_domain_generator(self):
+        class Generator():
+            PLL_FAMILY          = EHXPLLL
+            AUDIO_PLL_CLOCKS    = ("adat", "fast")
+            AUDIO_PLL_REFERENCE = "clk"
+
+        solutions = solve_clock_domain_generator(Generator, 25e6)
+        self.assertEqual(set(solutions.keys()), {"usb", 44100, 48000})
+        self.assertEqual([output.name for output in solutions[44100].outputs], ["adat", "fast"])
+        self.assertEqual(solutions[48000].input_freq, 25e6)
+
+    def test_unreachable(self):
+        self.assertIsNone(solve(ALTPLL, 50e6, dict(slow=1e3)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="solve the PLL dividers of the clock domain generators of all platforms")
+    parser.add_argument("--platform", default=None, help="only solve this platform class from platforms.py")
+    parser.add_argument("--samplerates", type=int, nargs="+", default=[44100, 48000])
+    parser.add_argument("--parameters", action="store_true", help="print the Instance parameters of each solution")
+    args = parser.parse_args()
+
+    import platforms
+
+    platform_classes = [cls for name, cls in vars(platforms).items()
+                        if isinstance(cls, type) and hasattr(cls, "clock_domain_generator")
+                        and (args.platform is None or name == args.platform)]
+
+    for platform_class in platform_classes:
+        platform  = platform_class()
+        generator = platform_class.clock_domain_generator
+        print(f"{platform_class.__name__} ({generator.__name__})")
+
+        if generator.PLL_FAMILY is None:
+            print("    no PLL model for this clock domain generator")
+            continue
+
+        fast_multiplier = platform.fast_domain_clock_freq / (48e3 * 256)
+        solutions = solve_clock_domain_generator(generator, platform.default_clk_frequency,
+                                                 args.samplerates, fast_multiplier)
+        for name, solution in solutions.items():
+            print(f"  {name}:")
+            if solution is None:
+                print("    no solution")
+                continue
+            print("    " + str(solution).replace("\n", "\n    "))
+            if args.parameters:
+                for parameter, value in solution.instance_parameters().items():
+                    print(f"        {parameter} = {value!r},")
+        print()
@@ -1,5 +1,7 @@
 from enum import IntEnum
 from amaranth import *
+from amaranth.sim import Settle
+from amlib.test   import GatewareTestCase, sync_test_case
 from luna.gateware.usb.usb2.request   import USBRequestHandler
 from luna.gateware.stream.generator   import StreamSerializer
 
@@ -8,20 +10,71 @@ from usb_protocol.types.descriptors.uac2      import AudioClassSpecificRequestCo
 from luna.gateware.usb.stream                 import USBInStreamInterface
 
 from usb_descriptors import USBDescriptors
+from control_mailbox import ControlMailbox
 
 class VendorRequests(IntEnum):
-    ILA_STOP_CAPTURE = 0
-    TOGGLE_CONVOLUTION = 1
+    ILA_STOP_CAPTURE    = 0
+    # wIndex: number of the DAC whose convolver should be toggled, 0 for DAC1,
+    # requests for a DAC which does not exist are stalled
+    TOGGLE_CONVOLUTION  = 1
+    # wIndex: number of the DAC, 0 for DAC1, wValue: first channel of the stereo pair to route to it,
+    # 0 for the first USB channel. Both are 0-based, unlike the 1-based channel numbers of the
+    # descriptors, and requests for a DAC or a channel pair which does not exist are stalled
+    SELECT_DAC_CHANNELS = 2
+    # wIndex: 0 for the SOF timing monitor of USB1, 1 for USB2, wValue: address, returns 4 bytes little endian
+    READ_SOF_STATS      = 3
+    # wIndex: 0 for the SOF timing monitor of USB1, 1 for USB2
+    CLEAR_SOF_STATS     = 4
+    # with a control mailbox, all other vendor requests are handled by the firmware,
+    # which numbers its requests from here on, see firmware.c
+    FIRMWARE_REQUESTS   = 0x80
 
 class UAC2RequestHandlers(USBRequestHandler):
     """ request handlers to implement UAC2 functionality. """
-    def __init__(self):
+    # UAC2 clock selector control selector
+    CX_CLOCK_SELECTOR_CONTROL = 0x01
+
+    def __init__(self, no_dacs=2, no_channels=2, clock_selector=False, samplerates=(48000,), samplerate_follower=False,
+                 sof_stats=False, mailbox=None):
         super().__init__()
 
+        assert set(samplerates) <= {44100, 48000}, f"unsupported sample rates: {samplerates}"
+
+        self._no_dacs          = no_dacs
+        self._no_channels      = no_channels
+        self._clock_selector   = clock_selector
+        self._samplerates      = sorted(samplerates)
+        # the sample rate is set through another USB interface, so only the one
+        # currently running is advertised, and SET CUR only accepts that one
+        self._samplerate_follower = samplerate_follower
+        self._sof_stats        = sof_stats
+        # ControlMailbox, which gets the class and vendor requests not handled here
+        self._mailbox          = mailbox
+        self._no_external_clocks = len(USBDescriptors.EXTERNAL_CLOCK_IDS)
+
         self.output_interface_altsetting_nr = Signal(3)
         self.input_interface_altsetting_nr  = Signal(3)
         self.interface_settings_changed     = Signal()
-        self.enable_convolution = Signal()
+        self.enable_convolution             = Signal(no_dacs)
+
+        # DAC routing table, written by the SELECT_DAC_CHANNELS vendor request
+        self.dac_channel_select             = Array(Signal(8, name=f"dac{i + 1}_channel_select") for i in range(no_dacs))
+        self.dac_channel_selected           = Signal(no_dacs)
+
+        # clock selector: 0 is the internal clock, n is the clock recovered from ADAT input n
+        self.clock_selection                = Signal(range(self._no_external_clocks + 1))
+        self.external_clock_valid_in        = Signal(self._no_external_clocks)
+
+        # the sample rate the audio clocks currently run at (for GET CUR),
+        # and the one the host asked for with SET CUR
+        self.samplerate_44_1k_in            = Signal()
+        self.samplerate_44_1k_out           = Signal()
+
+        # SOF timing monitor access, for the READ_SOF_STATS and CLEAR_SOF_STATS vendor requests
+        self.sof_stats_port_out             = Signal()
+        self.sof_stats_address_out          = Signal(16)
+        self.sof_stats_data_in              = Signal(32)
+        self.sof_stats_clear_out            = Signal(2)
 
     def elaborate(self, platform):
         m = Module()
@@ -29,16 +82,88 @@ class UAC2RequestHandlers(USBRequestHandler):
         interface         = self.interface
         setup             = self.interface.setup
 
+        no_samplerate_ranges = 1 if self._samplerate_follower else len(self._samplerates)
         m.submodules.transmitter = transmitter = \
-            StreamSerializer(data_length=14, domain="usb", stream_type=USBInStreamInterface, max_length_width=14)
+            StreamSerializer(data_length=2 + 12 * no_samplerate_ranges, domain="usb", stream_type=USBInStreamInterface, max_length_width=14)
 
         m.d.usb += self.interface_settings_changed.eq(0)
-        m.d.comb += self.enable_convolution.eq(0)
+        m.d.comb += [
+            self.enable_convolution.eq(0),
+            self.sof_stats_clear_out.eq(0),
+        ]
+
+        # the entity ID is in the high byte of wIndex, the interface number (0) in the low byte
+        entity_id            = setup.index[8:16]
+        is_control_interface = setup.index[0:8] == 0
+        is_internal_clock    = is_control_interface & (entity_id == USBDescriptors.CLOCK_ID)
+        is_external_clock    = Signal()
+        external_clock_valid = Signal()
+
+        if self._clock_selector:
+            for clock_nr, clock_id in enumerate(USBDescriptors.EXTERNAL_CLOCK_IDS):
+                with m.If(is_control_interface & (entity_id == clock_id)):
+                    m.d.comb += [
+                        is_external_clock.eq(1),
+                        external_clock_valid.eq(self.external_clock_valid_in[clock_nr]),
+                    ]
+
+        is_clock_source = is_internal_clock | is_external_clock
+
+        clock_freq =   (setup.value == Const(ClockSourceControlSelectors.CS_SAM_FREQ_CONTROL << 8, 16)) \
+                     & is_clock_source
+
+        clock_valid =   (setup.value == Const(ClockSourceControlSelectors.CS_CLOCK_VALID_CONTROL << 8, 16)) \
+                      & is_clock_source
+
+        clock_selector =   (setup.value == Const(self.CX_CLOCK_SELECTOR_CONTROL << 8, 16)) \
+                         & (setup.index == Const(USBDescriptors.CLOCK_SELECTOR_ID << 8, 16)) \
+                         & self._clock_selector
+
+        request_clock_freq     = clock_freq     & setup.is_in_request
+        set_clock_freq         = clock_freq     & ~setup.is_in_request
+        request_clock_valid    = clock_valid    & setup.is_in_request
+        request_clock_selector = clock_selector & setup.is_in_request
+        set_clock_selector     = clock_selector & ~setup.is_in_request
+
+        SRATE_44_1k = Const(44100, 32)
+        SRATE_48k   = Const(48000, 32)
+        ZERO        = Const(0, 32)
+
+        # the sample rate can only be set on the internal clock, external clocks dictate their rate
+        samplerate_settable = set_clock_freq & is_internal_clock & (len(self._samplerates) > 1)
+        samplerate_buffer   = Signal(32)
+        current_samplerate  = Mux(self.samplerate_44_1k_in, SRATE_44_1k, SRATE_48k)
+
+        if self._samplerate_follower:
+            advertised_samplerates = [current_samplerate]
+            samplerate_accepted    = samplerate_buffer == current_samplerate
+        else:
+            advertised_samplerates = [Const(samplerate, 32) for samplerate in self._samplerates]
+            samplerate_accepted    = Cat(samplerate_buffer == samplerate for samplerate in advertised_samplerates).any()
+
+        # the requests which are handled by the gateware, the mailbox gets the others
+        class_request_handled = \
+              ((setup.request == AudioClassSpecificRequestCodes.RANGE) & request_clock_freq) \
+            | ((setup.request == AudioClassSpecificRequestCodes.CUR) &
+               (set_clock_selector | samplerate_settable |
+                (request_clock_freq & (setup.length == 4)) |
+                ((request_clock_valid | request_clock_selector) & (setup.length == 1))))
+        vendor_request_handled = Cat(setup.request == request for request in VendorRequests
+                                     if request < VendorRequests.FIRMWARE_REQUESTS).any()
+
+        forward_to_mailbox = Signal()
+        if self._mailbox is not None:
+            m.d.comb += forward_to_mailbox.eq(
+                  ((setup.type == USBRequestType.CLASS)  & ~class_request_handled)
+                | ((setup.type == USBRequestType.VENDOR) & ~vendor_request_handled))
 
         #
         # Class request handlers.
         #
-        with m.If(setup.type == USBRequestType.STANDARD):
+        with m.If(forward_to_mailbox):
+            self.handle_mailbox_request(m)
+
+        with m.Elif(setup.type == USBRequestType.STANDARD):
             with m.If((setup.recipient == USBRequestRecipient.INTERFACE) &
                       (setup.request == USBStandardRequests.SET_INTERFACE)):
 
@@ -65,16 +190,6 @@ class UAC2RequestHandlers(USBRequestHandler):
                 with m.If(interface.status_requested):
                     m.d.comb += self.send_zlp()
 
-        clock_freq =   (setup.value == Const(ClockSourceControlSelectors.CS_SAM_FREQ_CONTROL << 8, 16)) \
-                     & (setup.index == Const(USBDescriptors.CLOCK_ID << 8, 16))
-
-        request_clock_freq     = clock_freq     & setup.is_in_request
-        set_clock_freq         = clock_freq     & ~setup.is_in_request
-
-        SRATE_44_1k = Const(44100, 32)
-        SRATE_48k   = Const(48000, 32)
-        ZERO        = Const(0, 32)
-
         with m.Elif(setup.type == USBRequestType.CLASS):
             with m.Switch(setup.request):
                 with m.Case(AudioClassSpecificRequestCodes.RANGE):
@@ -83,10 +198,11 @@ class UAC2RequestHandlers(USBRequestHandler):
                     with m.If(request_clock_freq):
                         m.d.comb += [
                             Cat(transmitter.data).eq(
-                                Cat(Const(0x1,   16),   # no triples
-                                    SRATE_48k,   # MIN
-                                    SRATE_48k,   # MAX
-                                    ZERO)),      # RES
+                                Cat(Const(len(advertised_samplerates), 16), # number of triples
+                                    *[Cat(samplerate, # MIN
+                                          samplerate, # MAX
+                                          ZERO)       # RES
+                                      for samplerate in advertised_samplerates])),
                             transmitter.max_length.eq(setup.length)
                         ]
                     with m.Else():
@@ -101,22 +217,61 @@ class UAC2RequestHandlers(USBRequestHandler):
                         m.d.comb += interface.handshakes_out.ack.eq(1)
 
                 with m.Case(AudioClassSpecificRequestCodes.CUR):
-                    m.d.comb += transmitter.stream.attach(self.interface.tx)
-                    with m.If(request_clock_freq & (setup.length == 4)):
-                        m.d.comb += [
-                            Cat(transmitter.data[0:4]).eq(Const(48000, 32)),
-                            transmitter.max_length.eq(4)
-                        ]
+                    with m.If(set_clock_selector):
+                        # the data stage contains the 1-based number of the selected input pin
+                        with m.If(interface.rx.valid & interface.rx.next):
+                            with m.If((interface.rx.payload >= 1) & (interface.rx.payload <= self._no_external_clocks + 1)):
+                                m.d.usb += self.clock_selection.eq(interface.rx.payload - 1)
+
+                        with m.If(interface.rx_ready_for_response):
+                            m.d.comb += interface.handshakes_out.ack.eq(1)
+
+                        with m.If(interface.status_requested):
+                            m.d.comb += self.send_zlp()
+
+                    with m.Elif(samplerate_settable):
+                        # the data stage contains the sample rate as 32 bit little endian
+                        with m.If(interface.rx.valid & interface.rx.next):
+                            m.d.usb += samplerate_buffer.eq(Cat(samplerate_buffer[8:], interface.rx.payload))
+
+                        with m.If(interface.rx_ready_for_response):
+                            m.d.comb += interface.handshakes_out.ack.eq(1)
+
+                        with m.If(interface.status_requested):
+                            with m.If(samplerate_accepted):
+                                m.d.comb += self.send_zlp()
+                                if not self._samplerate_follower:
+                                    m.d.usb += self.samplerate_44_1k_out.eq(samplerate_buffer == SRATE_44_1k)
+                            with m.Else():
+                                m.d.comb += interface.handshakes_out.stall.eq(1)
+
                     with m.Else():
-                        m.d.comb += interface.handshakes_out.stall.eq(1)
+                        m.d.comb += transmitter.stream.attach(self.interface.tx)
+                        with m.If(request_clock_freq & (setup.length == 4)):
+                            m.d.comb += [
+                                Cat(transmitter.data[0:4]).eq(current_samplerate),
+                                transmitter.max_length.eq(4)
+                            ]
+                        with m.Elif(request_clock_valid & (setup.length == 1)):
+                            m.d.comb += [
+                                transmitter.data[0].eq(Mux(is_external_clock, external_clock_valid, 1)),
+                                transmitter.max_length.eq(1)
+                            ]
+                        with m.Elif(request_clock_selector & (setup.length == 1)):
+                            m.d.comb += [
+                                transmitter.data[0].eq(self.clock_selection + 1),
+                                transmitter.max_length.eq(1)
+                            ]
+                        with m.Else():
+                            m.d.comb += interface.handshakes_out.stall.eq(1)
 
-                    # ... trigger it to respond when data's requested...
-                    with m.If(interface.data_requested):
-                        m.d.comb += transmitter.start.eq(1)
+                        # ... trigger it to respond when data's requested...
+                        with m.If(interface.data_requested):
+                            m.d.comb += transmitter.start.eq(1)
 
-                    # ... and ACK our status stage.
-                    with m.If(interface.status_requested):
-                        m.d.comb += interface.handshakes_out.ack.eq(1)
+                        # ACK our status stage
+                        with m.If(interface.status_requested):
+                            m.d.comb += interface.handshakes_out.ack.eq(1)
 
                 with m.Default():
                     #
@@ -128,13 +283,63 @@ class UAC2RequestHandlers(USBRequestHandler):
         with m.Elif(setup.type == USBRequestType.VENDOR):
             with m.Switch(setup.request):
                 with m.Case(VendorRequests.TOGGLE_CONVOLUTION):
-                    m.d.comb += self.enable_convolution.eq(1)
-                    # m.d.usb += self.enable_convolution.eq(~self.enable_convolution)
-                    # ... and ACK our status stage.
-                    with m.If(interface.status_requested | interface.data_requested):
-                        m.d.comb += interface.handshakes_out.ack.eq(1)
-                    # m.d.comb += self.interface.handshakes_out.stall.eq(1)
-                    # pass
+                    with m.If(setup.index < self._no_dacs):
+                        with m.Switch(setup.index):
+                            for dac in range(self._no_dacs):
+                                with m.Case(dac):
+                                    m.d.comb += self.enable_convolution[dac].eq(1)
+                        # ACK our status stage
+                        with m.If(interface.status_requested | interface.data_requested):
+                            m.d.comb += interface.handshakes_out.ack.eq(1)
+                    with m.Else():
+                        with m.If(interface.status_requested | interface.data_requested):
+                            m.d.comb += interface.handshakes_out.stall.eq(1)
+
+                with m.Case(VendorRequests.SELECT_DAC_CHANNELS):
+                    # both channels of the pair have to exist
+                    with m.If((setup.index < self._no_dacs) & (setup.value < self._no_channels - 1)):
+                        with m.Switch(setup.index):
+                            for dac in range(self._no_dacs):
+                                with m.Case(dac):
+                                    m.d.usb += [
+                                        self.dac_channel_select[dac].eq(setup.value),
+                                        self.dac_channel_selected[dac].eq(1),
+                                    ]
+
+                        with m.If(interface.status_requested | interface.data_requested):
+                            m.d.comb += interface.handshakes_out.ack.eq(1)
+
+                    with m.Else():
+                        m.d.comb += interface.handshakes_out.stall.eq(1)
+
+                with m.Case(VendorRequests.READ_SOF_STATS):
+                    if self._sof_stats:
+                        m.d.comb += [
+                            self.sof_stats_port_out.eq(setup.index[0]),
+                            self.sof_stats_address_out.eq(setup.value),
+                            transmitter.stream.attach(self.interface.tx),
+                            Cat(transmitter.data[0:4]).eq(self.sof_stats_data_in),
+                            transmitter.max_length.eq(4),
+                        ]
+
+                        with m.If(interface.data_requested):
+                            m.d.comb += transmitter.start.eq(1)
+
+                        with m.If(interface.status_requested):
+                            m.d.comb += interface.handshakes_out.ack.eq(1)
+                    else:
+                        m.d.comb += interface.handshakes_out.stall.eq(1)
+
+                with m.Case(VendorRequests.CLEAR_SOF_STATS):
+                    if self._sof_stats:
+                        with m.If(interface.status_requested):
+                            m.d.comb += [
+                                self.sof_stats_clear_out.eq(Mux(setup.index[0], 0b10, 0b01)),
+                                self.send_zlp(),
+                            ]
+                    else:
+                        m.d.comb += interface.handshakes_out.stall.eq(1)
+
                 with m.Case(VendorRequests.ILA_STOP_CAPTURE):
                     # TODO - will be implemented when needed
                     pass
@@ -146,3 +351,163 @@ class UAC2RequestHandlers(USBRequestHandler):
             m.d.comb += self.interface.handshakes_out.stall.eq(1)
 
         return m
+
+    def handle_mailbox_request(self, m: Module):
+        """ hands the current request to the firmware and sends its response
+
+            IN requests go to the mailbox right away, OUT requests once their data
+            stage is complete. Until the firmware has responded, the data stage of IN
+            requests and the status stage of OUT requests are NAKed.
+        """
+        interface    = self.interface
+        setup        = interface.setup
+        mailbox      = self._mailbox
+        buffer_size  = 2**len(mailbox.in_address_in)
+
+        handed_over  = Signal()
+        out_position = Signal(range(buffer_size + 1))
+        in_position  = Signal(range(buffer_size))
+        sending      = Signal()
+        in_length    = Signal(range(buffer_size + 1))
+        ready        = mailbox.response_ready_out & handed_over
+
+        m.d.comb += [
+            mailbox.setup_in.eq(Cat(setup.recipient, setup.type, setup.is_in_request,
+                                    setup.request, setup.value, setup.index, setup.length)),
+            in_length.eq(Mux(setup.length < mailbox.response_length_out, setup.length, mailbox.response_length_out)),
+        ]
+
+        # not in the cycle of setup.received, which clears handed_over below,
+        # or the request would be handed over twice
+        with m.If(~handed_over & ~setup.received & (setup.is_in_request | interface.status_requested)):
+            m.d.comb += mailbox.request_in.eq(1)
+            m.d.usb  += handed_over.eq(1)
+
+        # the data stage of OUT requests goes into the request buffer, as far as it fits
+        with m.If(interface.rx.valid & interface.rx.next & (out_position < buffer_size)):
+            m.d.comb += [
+                mailbox.out_address_in.eq(out_position),
+                mailbox.out_data_in.eq(interface.rx.payload),
+                mailbox.out_write_in.eq(1),
+            ]
+            m.d.usb += out_position.eq(out_position + 1)
+
+        with m.If(interface.rx_ready_for_response):
+            m.d.comb += interface.handshakes_out.ack.eq(1)
+
+        with m.If(interface.data_requested):
+            with m.If(~ready):
+                m.d.comb += interface.handshakes_out.nak.eq(1)
+            with m.Elif(mailbox.response_stall_out):
+                m.d.comb += interface.handshakes_out.stall.eq(1)
+            with m.Elif(in_length == 0):
+                m.d.comb += self.send_zlp()
+            with m.Else():
+                m.d.usb += [
+                    sending.eq(1),
+                    in_position.eq(0),
+                ]
+
+        with m.If(sending):
+            m.d.comb += [
+                mailbox.in_address_in.eq(in_position),
+                interface.tx.valid.eq(1),
+                interface.tx.payload.eq(mailbox.in_data_out),
+                interface.tx.first.eq(in_position == 0),
+                interface.tx.last.eq(in_position == in_length - 1),
+            ]
+            with m.If(interface.tx.ready):
+                m.d.usb += in_position.eq(in_position + 1)
+                with m.If(interface.tx.last):
+                    m.d.usb += sending.eq(0)
+
+        with m.If(interface.status_requested):
+            with m.If(setup.is_in_request):
+                m.d.comb += interface.handshakes_out.ack.eq(1)
+            with m.Elif(~ready):
+                m.d.comb += interface.handshakes_out.nak.eq(1)
+            with m.Elif(mailbox.response_stall_out | (out_position > setup.length) | (setup.length > buffer_size)):
+                m.d.comb += interface.handshakes_out.stall.eq(1)
+            with m.Else():
+                m.d.comb += self.send_zlp()
+
+        # every setup packet starts a new request
+        with m.If(setup.received):
+            m.d.usb += [
+                handed_over.eq(0),
+                out_position.eq(0),
+                sending.eq(0),
+            ]
+
+
+class MailboxRequestHandlers(Elaboratable):
+    """ UAC2RequestHandlers with a ControlMailbox, both in the sync domain, for the tests """
+    def __init__(self):
+        self.mailbox  = ControlMailbox(buffer_size=8, usb_domain="sync")
+        self.handlers = UAC2RequestHandlers(mailbox=self.mailbox)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.mailbox  = self.mailbox
+        m.submodules.handlers = DomainRenamer("sync")(self.handlers)
+        return m
+
+class UAC2RequestHandlersMailboxTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = MailboxRequestHandlers
+    FRAGMENT_ARGUMENTS  = dict()
+
+    @sync_test_case
+    def test_in_request(self):
+        dut       = self.dut
+        mailbox   = dut.mailbox
+        interface = dut.handlers.interface
+        setup     = interface.setup
+
+        yield setup.type.eq(USBRequestType.VENDOR)
+        yield setup.recipient.eq(USBRequestRecipient.DEVICE)
+        yield setup.is_in_request.eq(1)
+        yield setup.request.eq(VendorRequests.FIRMWARE_REQUESTS)
+        yield setup.length.eq(4)
+        yield setup.received.eq(1)
+        yield
+        yield setup.received.eq(0)
+
+        # the data stage is NAKed until the firmware has responded
+        yield interface.data_requested.eq(1)
+        requests = 0
+        for _ in range(8):
+            yield Settle()
+            requests += (yield mailbox.request_in)
+            self.assertTrue((yield interface.handshakes_out.nak))
+            yield
+        yield interface.data_requested.eq(0)
+        self.assertEqual(requests, 1)
+
+        self.assertTrue((yield mailbox.pending_out))
+        self.assertEqual((yield mailbox.setup_out), 0x0004_0000_0000_80c0)
+        self.assertFalse((yield mailbox.response_ready_out))
+
+        yield mailbox.data_in.eq(0x42)
+        yield mailbox.data_write_in.eq(1)
+        yield
+        yield mailbox.data_write_in.eq(0)
+        yield mailbox.respond_length_in.eq(1)
+        yield mailbox.respond_in.eq(1)
+        yield
+        yield mailbox.respond_in.eq(0)
+        for _ in range(4):
+            yield
+        yield Settle()
+        self.assertTrue((yield mailbox.response_ready_out))
+
+        # now the response goes out
+        yield interface.data_requested.eq(1)
+        yield Settle()
+        self.assertFalse((yield interface.handshakes_out.nak))
+        yield
+        yield interface.data_requested.eq(0)
+        yield interface.tx.ready.eq(1)
+        yield Settle()
+        self.assertTrue((yield interface.tx.valid))
+        self.assertTrue((yield interface.tx.last))
+        self.assertEqual((yield interface.tx.payload), 0x42)
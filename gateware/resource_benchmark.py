@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import argparse
+import json
+import os
+import tempfile
+import unittest
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resource_baseline.json")
+
+RESOURCES = ["LUT", "FF", "LUTRAM", "BRAM", "DSP", "CARRY"]
+
+# yosys cell types of each resource, per synthesis target
+CELL_TYPES = {
+    "ecp5": {
+        "LUT":    ["LUT4"],
+        "FF":     ["TRELLIS_FF"],
+        "LUTRAM": ["TRELLIS_DPR16X4"],
+        "BRAM":   ["DP16KD", "PDPW16KD"],
+        "DSP":    ["MULT18X18D", "ALU54B"],
+        "CARRY":  ["CCU2C"],
+    },
+    "xilinx": {
+        "LUT":    ["LUT1", "LUT2", "LUT3", "LUT4", "LUT5", "LUT6"],
+        "FF":     ["FDRE", "FDSE", "FDCE", "FDPE"],
+        "LUTRAM": ["RAM32M", "RAM64M", "RAM32X1D", "RAM64X1D", "RAM128X1D", "SRL16E", "SRLC32E"],
+        "BRAM":   ["RAMB18E1", "RAMB36E1"],
+        "DSP":    ["DSP48E1"],
+        "CARRY":  ["CARRY4"],
+    },
+}
+
+SYNTH_COMMANDS = {
+    "ecp5":   "synth_ecp5 -top top",
+    "xilinx": "synth_xilinx -top top -family xc7",
+}
+
+def benchmarks():
+    """ the modules to synthesize, with the parameters the top level uses """
+    from channels_to_usb_stream  import ChannelsToUSBStream
+    from usb_stream_to_channels  import USBStreamToChannels
+    from channel_stream_combiner import ChannelStreamCombiner
+    from channel_stream_splitter import ChannelStreamSplitter
+    from bundle_multiplexer      import BundleMultiplexer
+    from bundle_demultiplexer    import BundleDemultiplexer
+    from stereopair_extractor    import StereoPairExtractor
+    from drift_compensator       import DriftCompensator
+    from sof_timing_monitor      import SOFTimingMonitor
+    from adat_usb2_audio_interface import USB2AudioInterface as top
+
+    return {
+        "ChannelsToUSBStream(36)":            lambda: ChannelsToUSBStream(top.USB1_NO_CHANNELS, max_packet_size=top.USB1_MAX_PACKET_SIZE),
+        "ChannelsToUSBStream(4)":             lambda: ChannelsToUSBStream(top.USB2_NO_CHANNELS, max_packet_size=top.USB2_MAX_PACKET_SIZE),
+        "USBStreamToChannels(36)":            lambda: USBStreamToChannels(top.USB1_NO_CHANNELS),
+        "USBStreamToChannels(4)":             lambda: USBStreamToChannels(top.USB2_NO_CHANNELS),
+        "ChannelStreamCombiner(32, 4)":       lambda: ChannelStreamCombiner(32, top.USB2_NO_CHANNELS),
+        "ChannelStreamSplitter(32, 4)":       lambda: ChannelStreamSplitter(32, top.USB2_NO_CHANNELS),
+        "BundleMultiplexer":                  lambda: BundleMultiplexer(),
+        "BundleDemultiplexer":                lambda: BundleDemultiplexer(),
+        "ChannelsToUSBStream(36, pipelined)": lambda: ChannelsToUSBStream(top.USB1_NO_CHANNELS, max_packet_size=top.USB1_MAX_PACKET_SIZE, pipelined=True),
+        "BundleMultiplexer(pipelined)":       lambda: BundleMultiplexer(pipelined=True),
+        "BundleDemultiplexer(pipelined)":     lambda: BundleDemultiplexer(pipelined=True),
+        "StereoPairExtractor(36)":            lambda: StereoPairExtractor(top.USB1_NO_CHANNELS, top.USB1_MAX_PACKET_SIZE // 2),
+        "DriftCompensator(4)":                lambda: DriftCompensator(top.USB2_NO_CHANNELS, top.USB2_MAX_PACKET_SIZE // 2 // top.USB2_NO_CHANNELS),
+        "SOFTimingMonitor":                   lambda: SOFTimingMonitor(),
+    }
+
+def elaboratable_ports(elaboratable) -> list:
+    """ all signals of the I/O attributes of a module, with records and arrays flattened """
+    from amaranth.hdl.ast import Array, Signal, SignalSet
+    from amaranth.hdl.rec import Record
+
+    def flatten(value):
+        if isinstance(value, Signal):
+            yield value
+        elif isinstance(value, Record):
+            for field in value.fields.values():
+                yield from flatten(field)
+        elif isinstance(value, (Array, list, tuple)):
+            for element in value:
+                yield from flatten(element)
+
+    ports = SignalSet()
+    for name, value in vars(elaboratable).items():
+        if not name.startswith("_"):
+            ports.update(flatten(value))
+    return list(ports)
+
+def count_resources(cells_by_type: dict, target: str) -> dict:
+    """ sums the cells of a yosys stat report into resource counts """
+    counts = { resource: 0 for resource in RESOURCES }
+    for resource, cell_types in CELL_TYPES[target].items():
+        counts[resource] = sum(cells_by_type.get(cell_type, 0) for cell_type in cell_types)
+    return counts
+
+def synthesize(elaboratable, target: str="ecp5") -> dict:
+    """ synthesizes one module on its own with the bundled yosys and returns its resource counts """
+    from amaranth.back             import rtlil
+    from amaranth._toolchain.yosys import find_yosys
+
+    yosys = find_yosys(lambda version: version >= (0, 10))
+    il    = rtlil.convert(elaboratable, name="top", ports=elaboratable_ports(elaboratable))
+
+    with tempfile.TemporaryDirectory() as directory:
+        il_file    = os.path.join(directory, "top.il")
+        stats_file = os.path.join(directory, "stats.json")
+        with open(il_file, 'w') as f:
+            f.write(il)
+        yosys.run(["-q", "-p", f"read_rtlil {il_file}; {SYNTH_COMMANDS[target]}; tee -q -o {stats_file} stat -json"],
+                  ignore_warnings=True)
+        with open(stats_file) as f:
+            stats = json.load(f)
+
+    top = stats["modules"].get("\\top") or next(iter(stats["modules"].values()))
+    return count_resources(top["num_cells_by_type"], target)
+
+def compare(baseline: dict, results: dict, tolerance: float=0.02) -> list:
+    """ returns (module, resource, baseline, result) for every count which grew by more than tolerance """
+    regressions = []
+    for module, counts in results.items():
+        if module not in baseline:
+            continue
+        for resource, count in counts.items():
+            old = baseline[module].get(resource, 0)
+            if count > old and count > old * (1 + tolerance):
+                regressions.append((module, resource, old, count))
+    return regressions
+
+def missing_baselines(baseline: dict, results: dict) -> list:
+    """ returns the modules which have results but no baseline to compare them with """
+    return [module for module in results if module not in baseline]
+
+def format_results(results: dict, baseline: dict) -> str:
+    lines = [f"{'module':<36}" + "".join(f"{resource:>14}" for resource in RESOURCES)]
+    for module, counts in results.items():
+        line = f"{module:<36}"
+        for resource in RESOURCES:
+            count = counts[resource]
+            old   = baseline.get(module, {}).get(resource)
+            delta = f" ({count - old:+d})" if old is not None and old != count else ""
+            line += f"{str(count) + delta:>14}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class ResourceBenchmarkTest(unittest.TestCase):
+    def test_count_resources(self):
+        counts = count_resources({ "LUT4": 100, "TRELLIS_FF": 50, "DP16KD": 2, "CCU2C": 8, "PFUMX": 3 }, "ecp5")
+        self.assertEqual(counts, dict(LUT=100, FF=50, LUTRAM=0, BRAM=2, DSP=0, CARRY=8))
+
+        counts = count_resources({ "LUT2": 10, "LUT6": 5, "FDRE": 7, "FDSE": 1, "RAMB36E1": 1 }, "xilinx")
+        self.assertEqual((counts["LUT"], counts["FF"], counts["BRAM"]), (15, 8, 1))
+
+    def test_compare(self):
+        baseline = { "a": dict(LUT=100, FF=50, BRAM=1), "b": dict(LUT=10) }
+        results  = { "a": dict(LUT=101, FF=60, BRAM=1), "b": dict(LUT=9), "new": dict(LUT=1000) }
+        self.assertEqual(compare(baseline, results), [("a", "FF", 50, 60)])
+        self.assertEqual(compare(baseline, results, tolerance=0), [("a", "LUT", 100, 101), ("a", "FF", 50, 60)])
+
+    def test_compare_from_zero(self):
+        self.assertEqual(compare({ "a": dict(DSP=0) }, { "a": dict(DSP=1) }), [("a", "DSP", 0, 1)])
+
+    def test_missing_baselines(self):
+        self.assertEqual(missing_baselines({ "a": dict(LUT=1) }, { "a": dict(LUT=1), "new": dict(LUT=1) }), ["new"])
+        self.assertEqual(missing_baselines({}, { "a": dict(LUT=1) }), ["a"])
+
+    @unittest.skipUnless(os.path.exists(BASELINE_FILE), "no baseline yet, create it with --update-baseline")
+    def test_baseline_file(self):
+        with open(BASELINE_FILE) as f:
+            baselines = json.load(f)
+        self.assertEqual(sorted(baselines.keys()), sorted(SYNTH_COMMANDS.keys()))
+        for target, baseline in baselines.items():
+            for module, counts in baseline.items():
+                self.assertEqual(sorted(counts.keys()), sorted(RESOURCES), f"{target} {module}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="synthesize each stream module on its own and compare its resource usage against a baseline")
+    parser.add_argument("--target", choices=list(SYNTH_COMMANDS.keys()), default="ecp5")
+    parser.add_argument("--modules", nargs="+", help="only these modules, as named in the report")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--tolerance", type=float, default=0.02, help="relative growth of any count which is still accepted")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(args.target, {})
+
+    results = {}
+    for name, constructor in benchmarks().items():
+        if args.modules and name not in args.modules:
+            continue
+        print(f"synthesizing {name}...", flush=True)
+        results[name] = synthesize(constructor(), args.target)
+
+    print(format_results(results, baseline))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ args.target: results }, f, indent=2)
+
+    if args.update_baseline:
+        baselines[args.target] = { **baseline, **results }
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"baseline updated: {args.baseline}")
+        exit(0)
+
+    # before the first --update-baseline there is nothing to compare with
+    if not os.path.exists(args.baseline):
+        print(f"no baseline in {args.baseline} yet, create it with --update-baseline")
+        exit(0)
+
+    # a module without a baseline would pass unchecked
+    missing = missing_baselines(baseline, results)
+    for module in missing:
+        print(f"NO BASELINE: {module} for {args.target} in {args.baseline}, add it with --update-baseline")
+
+    regressions = compare(baseline, results, args.tolerance)
+    for module, resource, old, new in regressions:
+        print(f"REGRESSION: {module} {resource} {old} -> {new}")
+    exit(1 if regressions or missing else 0)
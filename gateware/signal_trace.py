@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    Selective waveform traces for long simulations
+
+    Instead of dumping every signal of the design like write_vcd(), a SignalTrace
+    samples only the signals of some named groups once per clock cycle. With a
+    trigger, it keeps only windows of cycles around the cycles in which the trigger
+    is set, like the ILA does on the hardware. The VCD it writes only contains
+    value changes within the windows, and gets gzipped if the file name ends
+    with .gz, which GTKWave reads as it is.
+"""
+import gzip
+import unittest
+from collections import deque
+
+from amaranth.hdl.ast import Signal, Value
+from amaranth.hdl.rec import Record
+from amaranth.sim     import Passive, Settle
+
+def flatten_signals(name: str, value) -> list:
+    """ (name, signal) of all signals in a signal, record or list of them """
+    if isinstance(value, Signal):
+        return [(name, value)]
+    if isinstance(value, Record):
+        return [item for field_name, field in value.fields.items() for item in flatten_signals(f"{name}.{field_name}", field)]
+    if isinstance(value, (list, tuple)):
+        return [item for element in value for item in flatten_signals(getattr(element, "name", name), element)]
+    raise TypeError(f"cannot trace {value!r}")
+
+def vcd_identifier(index: int) -> str:
+    """ the shortest VCD identifier code for a variable index """
+    identifier = ""
+    while True:
+        identifier += chr(33 + index % 94)
+        index //= 94
+        if not index:
+            return identifier
+
+
+class TraceWindow():
+    def __init__(self, start: int, samples: list):
+        self.start    = start
+        self.samples  = samples
+        self.triggers = []
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.samples)
+
+
+class SignalTrace():
+    """ records named signal groups once per cycle of a clock domain
+
+        groups:        { group name: signal, record or list of them }
+        trigger:       a one bit value; None records all cycles
+        pre_trigger:   cycles to keep before each trigger
+        post_trigger:  cycles to keep after each trigger, a trigger within them extends the window
+        max_windows:   stop after this many windows
+        max_cycles:    without a trigger: keep only this many of the latest cycles
+        period:        of the clock, for the time scale of the VCD
+    """
+    def __init__(self, groups: dict, trigger: Value=None, *, pre_trigger=16, post_trigger=64,
+                 max_windows=None, max_cycles=None, period=1/60e6):
+        self.groups       = { group: flatten_signals(group, signals) for group, signals in groups.items() }
+        self.trigger      = trigger
+        self.pre_trigger  = pre_trigger
+        self.post_trigger = post_trigger
+        self.max_windows  = max_windows
+        self.max_cycles   = max_cycles
+        self.period       = period
+
+        self.signals      = [signal for signals in self.groups.values() for _, signal in signals]
+        self.windows      = []
+        self.triggers     = 0
+        self.cycles       = 0
+
+    def attach(self, simulator, domain="sync"):
+        simulator.add_sync_process(self._process, domain=domain)
+        return self
+
+    def _sample(self):
+        yield Settle()
+        values = []
+        for signal in self.signals:
+            values.append((yield signal))
+        return tuple(values)
+
+    def _process(self):
+        yield Passive()
+
+        if self.trigger is None:
+            window = TraceWindow(0, deque(maxlen=self.max_cycles))
+            self.windows.append(window)
+            while True:
+                window.samples.append((yield from self._sample()))
+                self.cycles += 1
+                window.start = self.cycles - len(window.samples)
+                yield
+
+        history   = deque(maxlen=self.pre_trigger)
+        window    = None
+        remaining = 0
+        while True:
+            values    = yield from self._sample()
+            triggered = (yield self.trigger)
+
+            if window is None and triggered:
+                window = TraceWindow(self.cycles - len(history), list(history))
+                self.windows.append(window)
+                history.clear()
+
+            if window is not None:
+                window.samples.append(values)
+                if triggered:
+                    window.triggers.append(self.cycles)
+                    self.triggers += 1
+                    remaining = self.post_trigger
+                else:
+                    remaining -= 1
+                    if remaining <= 0:
+                        window = None
+                        if self.max_windows is not None and len(self.windows) >= self.max_windows:
+                            return
+            else:
+                history.append(values)
+
+            self.cycles += 1
+            yield
+
+    def write(self, filename: str):
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "wt") as f:
+            self.write_vcd(f)
+
+    def write_vcd(self, f):
+        picoseconds = max(1, round(self.period * 1e12))
+
+        f.write("$timescale 1ps $end\n")
+        f.write("$scope module trace $end\n")
+        identifiers = []
+        trigger_id  = vcd_identifier(len(self.signals))
+        for group, signals in self.groups.items():
+            f.write(f"$scope module {group} $end\n")
+            names = set()
+            for name, signal in signals:
+                # signals of different records often share a name
+                unique, suffix = name, 1
+                while unique in names:
+                    unique, suffix = f"{name}_{suffix}", suffix + 1
+                names.add(unique)
+                identifier = vcd_identifier(len(identifiers))
+                identifiers.append(identifier)
+                f.write(f"$var wire {len(signal)} {identifier} {unique} $end\n")
+            f.write("$upscope $end\n")
+        if self.trigger is not None:
+            f.write(f"$var wire 1 {trigger_id} trigger $end\n")
+        f.write("$upscope $end\n$enddefinitions $end\n")
+
+        widths = [len(signal) for signal in self.signals]
+        def change(identifier, width, value):
+            if width == 1:
+                return f"{value & 1}{identifier}\n"
+            return f"b{value & ((1 << width) - 1):b} {identifier}\n"
+
+        for window in self.windows:
+            triggers = set(window.triggers)
+            last     = None
+            for offset, values in enumerate(window.samples):
+                cycle = window.start + offset
+                lines = [change(identifier, width, value)
+                         for identifier, width, value, old in zip(identifiers, widths, values, last or [None] * len(values))
+                         if value != old]
+                if self.trigger is not None and (last is None or cycle in triggers or cycle - 1 in triggers):
+                    lines.append(change(trigger_id, 1, cycle in triggers))
+                if lines:
+                    f.write(f"#{cycle * picoseconds}\n")
+                    f.writelines(lines)
+                last = values
+
+            # mark the end of the window, so that viewers do not stretch its last values over the gap
+            if self.trigger is not None and window.samples:
+                f.write(f"#{window.end * picoseconds}\n")
+                f.writelines(f"x{identifier}\n" if width == 1 else f"bx {identifier}\n" for identifier, width in zip(identifiers, widths))
+                f.write(change(trigger_id, 1, 0))
+
+    def summary(self) -> str:
+        kept = sum(len(window.samples) for window in self.windows)
+        return (f"{len(self.signals)} signals, {self.cycles} cycles, {self.triggers} triggers, "
+                f"{len(self.windows)} windows, {kept} cycles kept")
+
+
+class SignalTraceTest(unittest.TestCase):
+    def run_trace(self, trace, counter, cycles=100):
+        from amaranth     import Module
+        from amaranth.sim import Simulator
+
+        m = Module()
+        m.d.sync += counter.eq(counter + 1)
+
+        simulator = Simulator(m)
+        simulator.add_clock(1e-6)
+        trace.attach(simulator)
+
+        def process():
+            for _ in range(cycles):
+                yield
+        simulator.add_sync_process(process)
+        simulator.run()
+
+    def test_windows(self):
+        counter = Signal(8)
+        # sync processes start after the first clock edge, so the counter is one ahead
+        trigger = (counter == 11) | (counter == 13) | (counter == 51)
+        trace   = SignalTrace({ "counter": counter }, trigger, pre_trigger=2, post_trigger=3)
+        self.run_trace(trace, counter)
+        self.assertEqual([(window.start, window.end) for window in trace.windows], [(8, 16), (48, 54)])
+        self.assertEqual(trace.triggers, 3)
+
+    def test_max_cycles(self):
+        counter = Signal(8)
+        trace   = SignalTrace({ "counter": counter }, max_cycles=10)
+        self.run_trace(trace, counter)
+        self.assertEqual(len(trace.windows), 1)
+        self.assertEqual(len(trace.windows[0].samples), 10)
+
+    def test_flatten(self):
+        record = Record([("valid", 1), ("payload", 8)])
+        names  = [name for name, _ in flatten_signals("stream", record)]
+        self.assertEqual(names, ["stream.valid", "stream.payload"])
+
+    def test_vcd(self):
+        import io
+        trace = SignalTrace({ "group": [Signal(4, name="a"), Signal(name="b")] }, Signal(), period=1e-6)
+        trace.windows = [TraceWindow(5, [(1, 0), (1, 1), (3, 1)])]
+        trace.windows[0].triggers = [6]
+        f = io.StringIO()
+        trace.write_vcd(f)
+        vcd = f.getvalue()
+        self.assertIn("$var wire 4 ! a $end", vcd)
+        self.assertIn("#5000000\nb1 !\n0\"\n0#\n", vcd)
+        self.assertIn("#6000000\n1\"\n1#\n", vcd)
+
+    def test_identifiers(self):
+        self.assertEqual(vcd_identifier(0), "!")
+        self.assertEqual(len({ vcd_identifier(i) for i in range(10000) }), 10000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+from amaranth       import *
+from amaranth.build import Platform
+from amaranth.sim   import Settle
+
+from amlib.test     import GatewareTestCase, sync_test_case
+
+class SOFTimingMonitor(Elaboratable):
+    """ collects histograms of the SOF timing of a USB host in block RAM
+
+        interval histogram: the time between two SOFs in cycles of the clock domain of this module,
+            (interval - nominal) >> interval_shift, centered in the middle bin
+        drift histogram: the number of ADAT clock ticks over DRIFT_WINDOW_SOFS SOFs,
+            (ticks - nominal) >> drift_shift, centered in the middle bin
+        Values beyond either end land in the first or last bin. The bins saturate.
+
+        Read address map (read_data_out follows read_address_in one cycle later):
+            0 .. BINS - 1                  interval histogram
+            BINS .. 2 * BINS - 1           drift histogram
+            REGISTERS + Registers.<name>   the registers below
+    """
+    BINS              = 64
+    COUNTER_BITS      = 32
+    # 8192 microframes = 1.024 s
+    DRIFT_WINDOW_SOFS = 8192
+    REGISTERS         = 0x100
+
+    class Registers:
+        SOF_COUNT       = 0
+        MIN_INTERVAL    = 1
+        MAX_INTERVAL    = 2
+        # deviation of the last drift window from nominal, in ADAT clock ticks, signed
+        LAST_DRIFT      = 3
+        NOMINAL_INTERVAL = 4
+        # interval_shift in bits 0-7, drift_shift in bits 8-15
+        SHIFTS          = 5
+        NOMINAL_TICKS   = 6
+
+    @classmethod
+    def nominal_drift_ticks(cls, samplerate: int) -> int:
+        """ ADAT clock ticks in one drift window: 256 ticks per sample, 8000 microframes per second """
+        return round(samplerate * 256 * cls.DRIFT_WINDOW_SOFS / 8000)
+
+    def __init__(self, clk_freq: float=60e6, interval_shift: int=0, drift_shift: int=4):
+        self._nominal_interval = round(clk_freq / 8000)
+        self._interval_shift   = interval_shift
+        self._drift_shift      = drift_shift
+
+        # I/O
+        self.sof_in              = Signal()
+        self.adat_tick_in        = Signal()
+        self.samplerate_44_1k_in = Signal()
+        # clears the histograms and the registers, takes 2 * BINS cycles
+        self.clear_in            = Signal()
+
+        self.read_address_in     = Signal(range(self.REGISTERS + 8))
+        self.read_data_out       = Signal(self.COUNTER_BITS)
+
+        # registers
+        self.sof_count_out       = Signal(self.COUNTER_BITS)
+        self.min_interval_out    = Signal(16, reset=2**16 - 1)
+        self.max_interval_out    = Signal(16)
+        self.last_drift_out      = Signal(signed(24))
+
+    def bin_index(self, m: Module, deviation, shift: int, offset: int=0):
+        """ returns the histogram address for a signed deviation """
+        half    = self.BINS // 2
+        shifted = Signal.like(deviation)
+        index   = Signal(range(2 * self.BINS))
+        m.d.comb += shifted.eq(deviation >> shift)
+        with m.If(shifted < -half):
+            m.d.comb += index.eq(offset)
+        with m.Elif(shifted >= half):
+            m.d.comb += index.eq(offset + self.BINS - 1)
+        with m.Else():
+            m.d.comb += index.eq(offset + half + shifted)
+        return index
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        memory     = Memory(width=self.COUNTER_BITS, depth=2 * self.BINS)
+        m.submodules.update_read  = update_read  = memory.read_port(transparent=False)
+        m.submodules.update_write = update_write = memory.write_port()
+        m.submodules.host_read    = host_read    = memory.read_port(transparent=False)
+
+        nominal_ticks = Mux(self.samplerate_44_1k_in,
+                            self.nominal_drift_ticks(44100), self.nominal_drift_ticks(48000))
+
+        #
+        # interval measurement
+        #
+        interval           = Signal(16)
+        have_previous      = Signal()
+        interval_deviation = Signal(signed(17))
+        m.d.comb += interval_deviation.eq(interval - self._nominal_interval)
+        interval_bin = self.bin_index(m, interval_deviation, self._interval_shift)
+
+        with m.If(interval != 2**16 - 1):
+            m.d.sync += interval.eq(interval + 1)
+
+        #
+        # drift measurement
+        #
+        window_sofs     = Signal(range(self.DRIFT_WINDOW_SOFS))
+        window_ticks    = Signal(24)
+        window_started  = Signal()
+        drift_deviation = Signal(signed(25))
+        m.d.comb += drift_deviation.eq(window_ticks - nominal_ticks)
+        drift_bin = self.bin_index(m, drift_deviation, self._drift_shift, offset=self.BINS)
+
+        with m.If(self.adat_tick_in):
+            m.d.sync += window_ticks.eq(window_ticks + 1)
+
+        #
+        # histogram update: read, increment, write back
+        #
+        interval_pending = Signal()
+        drift_pending    = Signal()
+        pending_interval = Signal.like(interval_bin)
+        pending_drift    = Signal.like(drift_bin)
+        update_address   = Signal.like(interval_bin)
+        clear_address    = Signal(range(2 * self.BINS))
+
+        with m.If(self.sof_in & ~self.clear_in):
+            m.d.sync += [
+                interval.eq(1),
+                have_previous.eq(1),
+                self.sof_count_out.eq(self.sof_count_out + 1),
+                window_sofs.eq(window_sofs + 1),
+            ]
+
+            with m.If(have_previous):
+                m.d.sync += [
+                    interval_pending.eq(1),
+                    pending_interval.eq(interval_bin),
+                ]
+                with m.If(interval < self.min_interval_out):
+                    m.d.sync += self.min_interval_out.eq(interval)
+                with m.If(interval > self.max_interval_out):
+                    m.d.sync += self.max_interval_out.eq(interval)
+
+            with m.If(window_sofs == 0):
+                # do not lose a tick which coincides with the SOF
+                m.d.sync += [
+                    window_ticks.eq(self.adat_tick_in),
+                    window_started.eq(1),
+                ]
+                # the first window after a clear is incomplete
+                with m.If(window_started):
+                    m.d.sync += [
+                        drift_pending.eq(1),
+                        pending_drift.eq(drift_bin),
+                        self.last_drift_out.eq(drift_deviation),
+                    ]
+
+        with m.FSM(name="sof_monitor_fsm"):
+            with m.State("IDLE"):
+                with m.If(self.clear_in):
+                    m.d.sync += clear_address.eq(0)
+                    m.next = "CLEAR"
+                with m.Elif(interval_pending):
+                    m.d.sync += [
+                        interval_pending.eq(0),
+                        update_address.eq(pending_interval),
+                    ]
+                    m.next = "READ"
+                with m.Elif(drift_pending):
+                    m.d.sync += [
+                        drift_pending.eq(0),
+                        update_address.eq(pending_drift),
+                    ]
+                    m.next = "READ"
+
+            with m.State("READ"):
+                m.d.comb += update_read.addr.eq(update_address)
+                m.next = "WRITE"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    update_write.addr.eq(update_address),
+                    update_write.data.eq(update_read.data + 1),
+                    update_write.en.eq(update_read.data != 2**self.COUNTER_BITS - 1),
+                ]
+                m.next = "IDLE"
+
+            with m.State("CLEAR"):
+                m.d.comb += [
+                    update_write.addr.eq(clear_address),
+                    update_write.data.eq(0),
+                    update_write.en.eq(1),
+                ]
+                m.d.sync += clear_address.eq(clear_address + 1)
+                with m.If(clear_address == 2 * self.BINS - 1):
+                    m.next = "IDLE"
+
+        with m.If(self.clear_in):
+            m.d.sync += [
+                have_previous.eq(0),
+                window_sofs.eq(0),
+                window_started.eq(0),
+                interval_pending.eq(0),
+                drift_pending.eq(0),
+                self.sof_count_out.eq(0),
+                self.min_interval_out.eq(self.min_interval_out.reset),
+                self.max_interval_out.eq(0),
+                self.last_drift_out.eq(0),
+            ]
+
+        #
+        # host read port
+        #
+        register_address = Signal(3)
+        registers        = Array([
+            self.sof_count_out,
+            self.min_interval_out,
+            self.max_interval_out,
+            # sign extended to 32 bits
+            self.last_drift_out,
+            Const(self._nominal_interval, 16),
+            Const(self._interval_shift | (self._drift_shift << 8), 16),
+            nominal_ticks,
+            Const(0),
+        ])
+
+        register_read = Signal()
+        register_data = Signal(self.COUNTER_BITS)
+        m.d.comb += host_read.addr.eq(self.read_address_in)
+        m.d.sync += [
+            register_read.eq(self.read_address_in >= self.REGISTERS),
+            register_data.eq(registers[self.read_address_in[:3]]),
+        ]
+        m.d.comb += self.read_data_out.eq(Mux(register_read, register_data, host_read.data))
+
+        return m
+
+
+class SOFTimingMonitorTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = SOFTimingMonitor
+    # a microframe of 100 cycles with 4 ADAT ticks in it
+    FRAGMENT_ARGUMENTS  = dict(clk_freq=800e3)
+
+    def sof(self, interval):
+        yield self.dut.sof_in.eq(1)
+        yield
+        yield self.dut.sof_in.eq(0)
+        yield from self.advance_cycles(interval - 1)
+
+    def read(self, address):
+        yield self.dut.read_address_in.eq(address)
+        yield
+        yield
+        yield Settle()
+        return (yield self.dut.read_data_out)
+
+    @sync_test_case
+    def test_interval_histogram(self):
+        dut  = self.dut
+        half = SOFTimingMonitor.BINS // 2
+
+        for interval in [100, 100, 101, 99, 100, 500]:
+            yield from self.sof(interval)
+        yield from self.sof(10)
+        yield from self.sof(1)
+        yield from self.advance_cycles(4)
+
+        self.assertEqual((yield from self.read(half)), 3)
+        self.assertEqual((yield from self.read(half + 1)), 1)
+        self.assertEqual((yield from self.read(half - 1)), 1)
+        # way off goes into the last bin
+        self.assertEqual((yield from self.read(SOFTimingMonitor.BINS - 1)), 1)
+        # 10 cycles is 90 below nominal
+        self.assertEqual((yield from self.read(0)), 1)
+
+        registers = SOFTimingMonitor.REGISTERS
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.SOF_COUNT)), 8)
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.MIN_INTERVAL)), 10)
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.MAX_INTERVAL)), 500)
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.NOMINAL_INTERVAL)), 100)
+
+        yield dut.clear_in.eq(1)
+        yield
+        yield dut.clear_in.eq(0)
+        yield from self.advance_cycles(2 * SOFTimingMonitor.BINS + 2)
+        self.assertEqual((yield from self.read(half)), 0)
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.SOF_COUNT)), 0)
+
+
+class ShortWindowSOFTimingMonitor(SOFTimingMonitor):
+    # a power of two, like the real one, so the SOF counter wraps around
+    DRIFT_WINDOW_SOFS = 4
+
+class SOFTimingMonitorDriftTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = ShortWindowSOFTimingMonitor
+    FRAGMENT_ARGUMENTS  = dict(clk_freq=800e3)
+
+    sof  = SOFTimingMonitorTest.sof
+    read = SOFTimingMonitorTest.read
+
+    def drift_histogram(self):
+        bins      = SOFTimingMonitor.BINS
+        histogram = []
+        for i in range(bins):
+            histogram.append((yield from self.read(bins + i)))
+        return histogram
+
+    def clear(self):
+        yield self.dut.clear_in.eq(1)
+        yield
+        yield self.dut.clear_in.eq(0)
+        yield from self.advance_cycles(2 * SOFTimingMonitor.BINS + 2)
+
+    @sync_test_case
+    def test_drift_histogram(self):
+        dut       = self.dut
+        half      = SOFTimingMonitor.BINS // 2
+        registers = SOFTimingMonitor.REGISTERS
+        self.assertEqual(ShortWindowSOFTimingMonitor.nominal_drift_ticks(48000), 6144)
+        self.assertEqual(ShortWindowSOFTimingMonitor.nominal_drift_ticks(44100), 5645)
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.NOMINAL_TICKS)), 6144)
+
+        # with a tick in every cycle, a window of four SOFs 1546 cycles apart
+        # has 6184 ticks, 40 above nominal, which is bin 2 with drift_shift 4.
+        # The window starts with the first SOF, which has no window before it.
+        yield dut.adat_tick_in.eq(1)
+        for _ in range(4):
+            yield from self.sof(1546)
+        yield from self.sof(10)
+
+        histogram = yield from self.drift_histogram()
+        self.assertEqual(histogram[half + 2], 1)
+        self.assertEqual(sum(histogram), 1)
+        self.assertEqual((yield dut.last_drift_out), 40)
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.LAST_DRIFT)), 40)
+
+        # at 44.1kHz, 4 * 1403 ticks are 33 below nominal, which is bin -3
+        yield dut.samplerate_44_1k_in.eq(1)
+        yield from self.clear()
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.NOMINAL_TICKS)), 5645)
+        self.assertEqual((yield dut.last_drift_out), 0)
+
+        # after a clear, the window started by the first SOF is the first one counted
+        for _ in range(4):
+            yield from self.sof(1403)
+        yield from self.sof(10)
+
+        histogram = yield from self.drift_histogram()
+        self.assertEqual(histogram[half - 3], 1)
+        self.assertEqual(sum(histogram), 1)
+        self.assertEqual((yield dut.last_drift_out), -33)
+        self.assertEqual((yield from self.read(registers + SOFTimingMonitor.Registers.LAST_DRIFT)), -33 & 0xffff_ffff)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+from amaranth         import *
+from amaranth.build   import Platform
+from amaranth.sim     import Settle
+from amlib.stream     import StreamInterface
+from amlib.test       import GatewareTestCase, sync_test_case
+
+class StreamSkidBuffer(Elaboratable):
+    """ registered pipeline stage for a StreamInterface
+
+        All outputs in both directions come straight from flip flops, so the
+        combinational ready/valid paths of the modules on either side end here.
+        To keep full throughput, a second register catches the word which arrives
+        in the cycle the output stalls, because the sender only sees the
+        registered ready one cycle later.
+
+        flush_in drops the words in the buffer, level_out is their number.
+    """
+    def __init__(self, payload_width: int, extra_fields=[]):
+        # ports
+        self.stream_in  = StreamInterface(name="skid_in",  payload_width=payload_width, extra_fields=extra_fields)
+        self.stream_out = StreamInterface(name="skid_out", payload_width=payload_width, extra_fields=extra_fields)
+        self.flush_in   = Signal()
+        self.level_out  = Signal(range(3))
+
+    @staticmethod
+    def like(stream: StreamInterface) -> "StreamSkidBuffer":
+        """ creates a skid buffer with the same payload and extra fields as stream """
+        extra_fields = [(name, len(field)) for name, field in stream.fields.items()
+                        if name not in ("valid", "ready", "first", "last", "payload")]
+        return StreamSkidBuffer(len(stream.payload), extra_fields)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        stream_in   = self.stream_in
+        stream_out  = self.stream_out
+        data_fields = [name for name in stream_in.fields if name not in ("valid", "ready")]
+
+        skid_valid  = Signal()
+        skid        = { name: Signal.like(stream_in[name], name=f"skid_{name}") for name in data_fields }
+
+        m.d.comb += [
+            stream_in.ready.eq(~skid_valid),
+            self.level_out.eq(stream_out.valid + skid_valid),
+        ]
+
+        output_stalled = stream_out.valid & ~stream_out.ready
+
+        with m.If(~skid_valid):
+            with m.If(output_stalled):
+                with m.If(stream_in.valid):
+                    m.d.sync += skid_valid.eq(1)
+                    m.d.sync += [skid[name].eq(stream_in[name]) for name in data_fields]
+            with m.Else():
+                m.d.sync += stream_out.valid.eq(stream_in.valid)
+                m.d.sync += [stream_out[name].eq(stream_in[name]) for name in data_fields]
+
+        with m.Elif(stream_out.ready):
+            m.d.sync += [
+                stream_out.valid.eq(1),
+                skid_valid.eq(0),
+            ]
+            m.d.sync += [stream_out[name].eq(skid[name]) for name in data_fields]
+
+        with m.If(self.flush_in):
+            m.d.sync += [
+                stream_out.valid.eq(0),
+                skid_valid.eq(0),
+            ]
+
+        return m
+
+
+class StreamSkidBufferTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = StreamSkidBuffer
+    FRAGMENT_ARGUMENTS  = dict(payload_width=8, extra_fields=[("channel_nr", 3)])
+
+    @sync_test_case
+    def test_throughput_and_order(self):
+        dut = self.dut
+        # valid and ready patterns with stalls on both sides
+        valid_pattern = [1, 1, 1, 0, 1, 1, 0, 0, 1, 1, 1, 1, 1, 0, 1]
+        ready_pattern = [1, 0, 0, 1, 1, 0, 1, 1, 1, 1, 0, 1, 0, 0, 1, 1]
+
+        sent     = []
+        received = []
+        next_value = 0
+        for cycle in range(200):
+            valid = valid_pattern[cycle % len(valid_pattern)] and next_value < 100
+            yield dut.stream_in.valid.eq(valid)
+            yield dut.stream_in.payload.eq(next_value)
+            yield dut.stream_in.channel_nr.eq(next_value & 7)
+            yield dut.stream_in.first.eq(next_value % 8 == 0)
+            yield dut.stream_out.ready.eq(ready_pattern[cycle % len(ready_pattern)])
+            yield Settle()
+
+            if (yield dut.stream_in.valid) and (yield dut.stream_in.ready):
+                sent.append(next_value)
+                next_value += 1
+            if (yield dut.stream_out.valid) and (yield dut.stream_out.ready):
+                payload = (yield dut.stream_out.payload)
+                self.assertEqual((yield dut.stream_out.channel_nr), payload & 7)
+                self.assertEqual((yield dut.stream_out.first), int(payload % 8 == 0))
+                received.append(payload)
+            yield
+
+        self.assertEqual(sent, list(range(100)))
+        self.assertEqual(received, sent)
+
+    @sync_test_case
+    def test_full_throughput(self):
+        dut = self.dut
+        yield dut.stream_out.ready.eq(1)
+        yield dut.stream_in.valid.eq(1)
+        for value in range(10):
+            yield dut.stream_in.payload.eq(value)
+            yield Settle()
+            self.assertEqual((yield dut.stream_in.ready), 1)
+            if value > 0:
+                # one cycle of latency
+                self.assertEqual((yield dut.stream_out.valid), 1)
+                self.assertEqual((yield dut.stream_out.payload), value - 1)
+            yield
+
+    @sync_test_case
+    def test_flush(self):
+        dut = self.dut
+        yield dut.stream_out.ready.eq(0)
+        yield dut.stream_in.valid.eq(1)
+        yield
+        yield
+        yield
+        yield Settle()
+        self.assertEqual((yield dut.stream_in.ready), 0)
+        self.assertEqual((yield dut.stream_out.valid), 1)
+        self.assertEqual((yield dut.level_out), 2)
+        yield dut.stream_in.valid.eq(0)
+        yield dut.flush_in.eq(1)
+        yield
+        yield dut.flush_in.eq(0)
+        yield Settle()
+        self.assertEqual((yield dut.stream_in.ready), 1)
+        self.assertEqual((yield dut.stream_out.valid), 0)
+        self.assertEqual((yield dut.level_out), 0)
@@ -0,0 +1,803 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    Randomized stress tests for the channel stream modules
+
+    Every StreamInterface port is driven by a StreamSource or StreamSink whose
+    valid or ready follows an ActivityPattern: phases of random length which
+    alternate between full rate, starvation and random activity. The samples
+    carry their channel number and frame sequence number (see sample()), so a
+    Scoreboard can tell lost, duplicated and misrouted samples apart. Between
+    phases the tests change the channel counts, and some frames are truncated.
+
+    STREAM_STRESS_SEED selects a different set of random sequences,
+    STREAM_STRESS_VERBOSE=1 prints the throughput of every port.
+"""
+import os
+import random
+import unittest
+from collections import defaultdict, deque
+
+from amaranth.sim import Settle
+from amlib.test   import GatewareTestCase, sync_test_case
+
+from channels_to_usb_stream  import ChannelsToUSBStream
+from usb_stream_to_channels  import USBStreamToChannels
+from channel_stream_combiner import ChannelStreamCombiner
+from channel_stream_splitter import ChannelStreamSplitter
+from bundle_multiplexer      import BundleMultiplexer
+from bundle_demultiplexer    import BundleDemultiplexer
+from stereopair_extractor    import StereoPairExtractor
+
+STRESS_SEED    = int(os.environ.get("STREAM_STRESS_SEED", "0"))
+STRESS_VERBOSE = os.environ.get("STREAM_STRESS_VERBOSE", "0") == "1"
+
+def sample(seq: int, channel: int) -> int:
+    """ a nonzero 24 bit sample which identifies its channel and frame """
+    return ((seq & 0xffff) << 8) | (channel + 1)
+
+def sample_channel(value: int) -> int:
+    return (value & 0xff) - 1
+
+def sample_seq(value: int) -> int:
+    return value >> 8
+
+
+class ActivityPattern():
+    """ random sequence of 0 and 1 for valid or ready
+
+        It runs in phases of random length, each with its own probability of a 1,
+        so that full rate bursts and longer stalls occur as well as random jitter.
+    """
+    PROBABILITIES = (0.0, 0.25, 0.5, 0.75, 1.0)
+    FULL_RATE     = (1.0,)
+
+    def __init__(self, rng: random.Random, probabilities=PROBABILITIES, max_phase_length=32):
+        self._rng              = rng
+        self._probabilities    = probabilities
+        self._max_phase_length = max_phase_length
+        self._probability      = 0.0
+        self._left             = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> int:
+        if self._left == 0:
+            self._probability = self._rng.choice(self._probabilities)
+            self._left        = self._rng.randint(1, self._max_phase_length)
+        self._left -= 1
+        return int(self._rng.random() < self._probability)
+
+
+class StreamPort():
+    """ transfer statistics of a stream port """
+    def __init__(self, stream, pattern: ActivityPattern):
+        self.stream      = stream
+        self.pattern     = pattern
+        self.transfers   = 0
+        self.stalls      = 0
+        self.first_cycle = None
+        self.last_cycle  = None
+
+    def _transferred(self, cycle: int):
+        self.transfers += 1
+        if self.first_cycle is None:
+            self.first_cycle = cycle
+        self.last_cycle = cycle
+
+    @property
+    def throughput(self) -> float:
+        """ transfers per cycle, from the first to the last transfer """
+        if not self.transfers:
+            return 0.0
+        return self.transfers / (self.last_cycle - self.first_cycle + 1)
+
+
+class StreamSource(StreamPort):
+    """ sends the pushed words, with valid following the activity pattern
+
+        Like any well behaved sender, it keeps valid and the data
+        until the word is taken. Without backpressure, ready is ignored.
+    """
+    def __init__(self, stream, pattern: ActivityPattern, backpressure=True):
+        super().__init__(stream, pattern)
+        self.backpressure = backpressure
+        self.queue        = deque()
+        self._valid       = False
+
+    def push(self, **fields):
+        self.queue.append(dict(first=0, last=0, **fields))
+
+    @property
+    def idle(self) -> bool:
+        return not self.queue
+
+    def drive(self):
+        if not self._valid and self.queue and next(self.pattern):
+            self._valid = True
+            for name, value in self.queue[0].items():
+                yield self.stream[name].eq(value)
+        yield self.stream.valid.eq(self._valid)
+
+    def update(self, cycle: int):
+        if not self._valid:
+            return
+        if not self.backpressure or (yield self.stream.ready):
+            self.queue.popleft()
+            self._valid = False
+            self._transferred(cycle)
+        else:
+            self.stalls += 1
+
+
+class StreamSink(StreamPort):
+    """ receives words, with ready following the activity pattern, and hands them to on_word """
+    def __init__(self, stream, pattern: ActivityPattern, on_word):
+        super().__init__(stream, pattern)
+        self.on_word     = on_word
+        self.fields      = [name for name in stream.fields if name not in ("valid", "ready")]
+        self.idle_cycles = 0
+        self._ready      = 0
+
+    def drive(self):
+        self._ready = next(self.pattern)
+        yield self.stream.ready.eq(self._ready)
+
+    def update(self, cycle: int):
+        self.idle_cycles += 1
+        if not (yield self.stream.valid):
+            return
+        if not self._ready:
+            self.stalls += 1
+            return
+
+        word = {}
+        for name in self.fields:
+            word[name] = (yield self.stream[name])
+        self.idle_cycles = 0
+        self._transferred(cycle)
+        self.on_word(word)
+
+
+class Scoreboard():
+    """ checks received words against the expected ones, in order for each key
+
+        A received word which matches a later expected word counts the skipped
+        ones as lost. Words which match none are unexpected: corrupted, misrouted
+        or repeated. Expected words only need to name the fields they check.
+    """
+    def __init__(self):
+        self.expected   = defaultdict(deque)
+        self.matched    = 0
+        self.lost       = 0
+        self.unexpected = []
+
+    def expect(self, key, **word):
+        self.expected[key].append(word)
+
+    def receiver(self, key):
+        return lambda word: self.receive(key, word)
+
+    def receive(self, key, word: dict):
+        queue = self.expected[key]
+        for position, expected in enumerate(queue):
+            if all(word[name] == value for name, value in expected.items()):
+                break
+        else:
+            self.unexpected.append((key, word))
+            return
+
+        self.lost    += position
+        self.matched += 1
+        for _ in range(position + 1):
+            queue.popleft()
+
+    @property
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self.expected.values())
+
+    def summary(self) -> str:
+        return (f"{self.matched} matched, {self.lost} lost, {self.pending} pending, "
+                f"{len(self.unexpected)} unexpected {self.unexpected[:8]}")
+
+
+class StreamStressTestCase(GatewareTestCase):
+    """ base of the stress tests, which run all stream ports from one process """
+    TRUNCATION_PROBABILITY = 0.1
+
+    def setUp(self):
+        super().setUp()
+        self.rng   = random.Random(f"{STRESS_SEED}:{self.id()}")
+        self.cycle = 0
+
+    def pattern(self, probabilities=ActivityPattern.PROBABILITIES) -> ActivityPattern:
+        return ActivityPattern(self.rng, probabilities)
+
+    def truncated(self, length: int) -> int:
+        """ length, or sometimes a shorter one """
+        if length > 1 and self.rng.random() < self.TRUNCATION_PROBABILITY:
+            return self.rng.randint(1, length - 1)
+        return length
+
+    def run_streams(self, ports, until, monitor=None, max_cycles=50000):
+        """ runs the ports until until() is true, monitor is called every cycle after the inputs settled """
+        for _ in range(max_cycles):
+            for port in ports:
+                yield from port.drive()
+            yield Settle()
+
+            if monitor is not None:
+                yield from monitor()
+            for port in ports:
+                yield from port.update(self.cycle)
+
+            yield
+            self.cycle += 1
+            if until():
+                return
+
+        self.fail(f"streams did not finish within {max_cycles} cycles (seed {STRESS_SEED})")
+
+    def check(self, scoreboard: Scoreboard, lossless=True):
+        message = f"seed {STRESS_SEED}: {scoreboard.summary()}"
+        self.assertEqual(scoreboard.unexpected, [], message)
+        if lossless:
+            self.assertEqual(scoreboard.lost + scoreboard.pending, 0, message)
+
+    def report(self, scoreboard: Scoreboard=None, **ports):
+        if not STRESS_VERBOSE:
+            return
+        print(f"\n{self.id()} (seed {STRESS_SEED})")
+        if scoreboard is not None:
+            print(f"    {scoreboard.summary()}")
+        for name, port in ports.items():
+            print(f"    {name:<16} {port.transfers:6d} transfers {port.stalls:6d} stalls {port.throughput:6.3f} per cycle")
+
+
+class ActivityPatternTest(unittest.TestCase):
+    def test_full_rate(self):
+        pattern = ActivityPattern(random.Random(0), ActivityPattern.FULL_RATE)
+        self.assertEqual([next(pattern) for _ in range(100)], [1] * 100)
+
+    def test_phases(self):
+        pattern = ActivityPattern(random.Random(0), (0.0, 1.0), max_phase_length=8)
+        values  = [next(pattern) for _ in range(1000)]
+        # both phases occur
+        self.assertTrue(0.2 < sum(values) / len(values) < 0.8)
+
+
+class ScoreboardTest(unittest.TestCase):
+    def test_in_order(self):
+        scoreboard = Scoreboard()
+        for n in range(4):
+            scoreboard.expect("a", payload=n)
+        scoreboard.receive("a", dict(payload=0, channel_nr=3))
+        scoreboard.receive("a", dict(payload=2, channel_nr=3))
+        scoreboard.receive("a", dict(payload=2, channel_nr=3))
+        self.assertEqual((scoreboard.matched, scoreboard.lost, scoreboard.pending), (2, 1, 1))
+        self.assertEqual(scoreboard.unexpected, [("a", dict(payload=2, channel_nr=3))])
+
+    def test_keys(self):
+        scoreboard = Scoreboard()
+        scoreboard.expect(0, payload=1)
+        scoreboard.receive(1, dict(payload=1))
+        self.assertEqual((scoreboard.matched, scoreboard.pending, len(scoreboard.unexpected)), (0, 1, 1))
+
+    def test_sample(self):
+        value = sample(0x1234, 31)
+        self.assertLess(value, 1 << 24)
+        self.assertEqual((sample_seq(value), sample_channel(value)), (0x1234, 31))
+        self.assertNotEqual(sample(0, 0), 0)
+
+
+class ChannelStreamSplitterStressTest(StreamStressTestCase):
+    FRAGMENT_UNDER_TEST = ChannelStreamSplitter
+    FRAGMENT_ARGUMENTS  = dict(no_lower_channels=8, no_upper_channels=4)
+
+    def run_frames(self, frames, probabilities=ActivityPattern.PROBABILITIES):
+        dut        = self.dut
+        lower      = 8
+        scoreboard = Scoreboard()
+        source     = StreamSource(dut.combined_channel_stream_in, self.pattern(probabilities))
+        lower_sink = StreamSink(dut.lower_channel_stream_out, self.pattern(probabilities), scoreboard.receiver("lower"))
+        upper_sink = StreamSink(dut.upper_channel_stream_out, self.pattern(probabilities), scoreboard.receiver("upper"))
+
+        for seq in range(frames):
+            # stereo or full upper channels, and some truncated frames
+            channels = self.truncated(lower + self.rng.choice([2, 4]))
+            for channel in range(channels):
+                value = sample(seq, channel)
+                last  = channel == channels - 1
+                source.push(payload=value, channel_nr=channel, first=channel == 0, last=last)
+                if channel < lower:
+                    scoreboard.expect("lower", payload=value, channel_nr=channel, first=channel == 0, last=channel == lower - 1)
+                else:
+                    scoreboard.expect("upper", payload=value, channel_nr=channel - lower, first=channel == lower, last=last)
+
+        yield from self.run_streams([source, lower_sink, upper_sink], until=lambda: source.idle and not scoreboard.pending)
+        self.report(scoreboard, source=source, lower=lower_sink, upper=upper_sink)
+        self.check(scoreboard)
+        return source
+
+    @sync_test_case
+    def test_random_backpressure(self):
+        yield from self.run_frames(40)
+
+    @sync_test_case
+    def test_full_rate(self):
+        source = yield from self.run_frames(10, ActivityPattern.FULL_RATE)
+        self.assertGreater(source.throughput, 0.95)
+
+
+class ChannelStreamCombinerStressTest(StreamStressTestCase):
+    FRAGMENT_UNDER_TEST = ChannelStreamCombiner
+    FRAGMENT_ARGUMENTS  = dict(no_lower_channels=8, no_upper_channels=4)
+
+    def push_frames(self, scoreboard, lower_source, upper_source, frames, upper_active, seq):
+        lower = 8
+        upper = 4
+        for _ in range(frames):
+            lower_channels = self.truncated(lower)
+            for channel in range(lower_channels):
+                value = sample(seq, channel)
+                lower_source.push(payload=value, channel_nr=channel, first=channel == 0, last=channel == lower_channels - 1)
+                scoreboard.expect("out", payload=value, channel_nr=channel, first=channel == 0, last=0)
+
+            fill_from = 0
+            if upper_active:
+                upper_channels = self.truncated(self.rng.choice([2, upper]))
+                for channel in range(upper_channels):
+                    value = sample(seq, lower + channel)
+                    last  = channel == upper_channels - 1
+                    upper_source.push(payload=value, channel_nr=channel, first=channel == 0, last=last)
+                    scoreboard.expect("out", payload=value, channel_nr=lower + channel, first=0, last=last)
+                # stereo frames are filled up with silence, others end with their last channel
+                fill_from = 2 if upper_channels == 2 else upper
+
+            for channel in range(fill_from, upper):
+                scoreboard.expect("out", payload=0, channel_nr=lower + channel, first=0, last=channel == upper - 1)
+            seq += 1
+        return seq
+
+    def run_phases(self, phases, frames, probabilities=ActivityPattern.PROBABILITIES):
+        dut          = self.dut
+        scoreboard   = Scoreboard()
+        lower_source = StreamSource(dut.lower_channel_stream_in, self.pattern(probabilities))
+        upper_source = StreamSource(dut.upper_channel_stream_in, self.pattern(probabilities))
+        sink         = StreamSink(dut.combined_channel_stream_out, self.pattern(probabilities), scoreboard.receiver("out"))
+
+        seq = 0
+        for phase in range(phases):
+            upper_active = phase % 2 == 0
+            yield dut.upper_channels_active_in.eq(upper_active)
+            seq = self.push_frames(scoreboard, lower_source, upper_source, frames, upper_active, seq)
+            yield from self.run_streams([lower_source, upper_source, sink],
+                                        until=lambda: lower_source.idle and upper_source.idle and not scoreboard.pending)
+
+        self.report(scoreboard, lower=lower_source, upper=upper_source, combined=sink)
+        self.check(scoreboard)
+        return sink
+
+    @sync_test_case
+    def test_random_backpressure(self):
+        yield from self.run_phases(4, 10)
+
+    @sync_test_case
+    def test_full_rate(self):
+        sink = yield from self.run_phases(1, 10, ActivityPattern.FULL_RATE)
+        self.assertGreater(sink.throughput, 0.95)
+
+
+class BundleDemultiplexerStressTest(StreamStressTestCase):
+    FRAGMENT_UNDER_TEST = BundleDemultiplexer
+    FRAGMENT_ARGUMENTS  = dict()
+
+    def run_phases(self, channel_counts, frames, probabilities=ActivityPattern.PROBABILITIES):
+        dut        = self.dut
+        bundles    = 4
+        scoreboard = Scoreboard()
+        source     = StreamSource(dut.channel_stream_in, self.pattern(probabilities))
+        sinks      = [StreamSink(dut.bundles_out[bundle], self.pattern(probabilities), scoreboard.receiver(bundle))
+                      for bundle in range(bundles)]
+
+        seq = 0
+        for no_channels in channel_counts:
+            last_channel = 1 if no_channels == 2 else 7
+            yield dut.no_channels_in.eq(no_channels)
+
+            for _ in range(frames):
+                for channel in range(self.truncated(no_channels)):
+                    value          = sample(seq, channel)
+                    bundle_channel = channel & last_channel
+                    source.push(payload=value, channel_nr=channel, first=channel == 0, last=channel == no_channels - 1)
+                    scoreboard.expect(channel // 8, payload=value, channel_nr=bundle_channel,
+                                      first=bundle_channel == 0, last=bundle_channel == last_channel)
+                seq += 1
+
+            yield from self.run_streams([source, *sinks], until=lambda: source.idle and not scoreboard.pending)
+
+        self.report(scoreboard, source=source, **{ f"bundle{i}": sink for i, sink in enumerate(sinks) })
+        self.check(scoreboard)
+        return source
+
+    @sync_test_case
+    def test_random_backpressure(self):
+        # changes the channel count between ADAT, stereo and a single bundle
+        channel_counts = [32] + [self.rng.choice([2, 8, 32]) for _ in range(3)]
+        yield from self.run_phases(channel_counts, 6)
+
+    @sync_test_case
+    def test_full_rate(self):
+        source = yield from self.run_phases([32], 4, ActivityPattern.FULL_RATE)
+        self.assertGreater(source.throughput, 0.95)
+
+class BundleDemultiplexerPipelinedStressTest(BundleDemultiplexerStressTest):
+    FRAGMENT_ARGUMENTS  = dict(pipelined=True)
+
+
+class BundleMultiplexerStressTest(StreamStressTestCase):
+    FRAGMENT_UNDER_TEST = BundleMultiplexer
+    FRAGMENT_ARGUMENTS  = dict()
+
+    def run_phases(self, phases, frames, probabilities=ActivityPattern.PROBABILITIES):
+        dut        = self.dut
+        bundles    = 4
+        scoreboard = Scoreboard()
+        sources    = [StreamSource(dut.bundles_in[bundle], self.pattern(probabilities)) for bundle in range(bundles)]
+        sink       = StreamSink(dut.channel_stream_out, self.pattern(probabilities), scoreboard.receiver("out"))
+
+        seq = 0
+        for phase in range(phases):
+            # bundle 0 stays active, otherwise the multiplexer
+            # would keep filling in silence after the last frame
+            active      = [1] + [self.rng.randint(0, 1) if phase else 1 for _ in range(bundles - 1)]
+            no_channels = [self.rng.choice([2, 8]) if phase else 8 for _ in range(bundles)]
+            for bundle in range(bundles):
+                yield dut.bundle_active_in[bundle].eq(active[bundle])
+                yield dut.no_channels_in[bundle].eq(no_channels[bundle])
+
+            for _ in range(frames):
+                first_channel = 0
+                for bundle in range(bundles):
+                    channels = self.truncated(no_channels[bundle]) if active[bundle] else no_channels[bundle]
+                    for channel in range(channels):
+                        value = sample(seq, first_channel + channel) if active[bundle] else 0
+                        last  = channel == channels - 1
+                        if active[bundle]:
+                            sources[bundle].push(payload=value, channel_nr=channel, first=channel == 0, last=last)
+                        scoreboard.expect("out", payload=value, channel_nr=first_channel + channel,
+                                          first=(bundle == 0) and (channel == 0), last=(bundle == bundles - 1) and last)
+                    first_channel += no_channels[bundle]
+                seq += 1
+
+            yield from self.run_streams([*sources, sink],
+                                        until=lambda: all(source.idle for source in sources) and not scoreboard.pending)
+
+        self.report(scoreboard, out=sink, **{ f"bundle{i}": source for i, source in enumerate(sources) })
+        self.check(scoreboard)
+        return sink
+
+    @sync_test_case
+    def test_random_backpressure(self):
+        yield from self.run_phases(4, 4)
+
+    @sync_test_case
+    def test_full_rate(self):
+        sink = yield from self.run_phases(1, 4, ActivityPattern.FULL_RATE)
+        self.assertGreater(sink.throughput, 0.9)
+
+class BundleMultiplexerPipelinedStressTest(BundleMultiplexerStressTest):
+    FRAGMENT_ARGUMENTS  = dict(pipelined=True)
+
+
+class USBStreamToChannelsStressTest(StreamStressTestCase):
+    FRAGMENT_UNDER_TEST = USBStreamToChannels
+    FRAGMENT_ARGUMENTS  = dict(max_no_channels=8)
+
+    def run_phases(self, channel_counts, packets, probabilities=ActivityPattern.PROBABILITIES):
+        dut        = self.dut
+        scoreboard = Scoreboard()
+        source     = StreamSource(dut.usb_stream_in, self.pattern(probabilities))
+        sink       = StreamSink(dut.channel_stream_out, self.pattern(probabilities), scoreboard.receiver("out"))
+
+        garbage_expected = 0
+        garbage_seen     = [0]
+        partial_sample   = False
+
+        def count_garbage():
+            garbage_seen[0] += (yield dut.garbage_seen_out)
+
+        seq = 0
+        for no_channels in channel_counts:
+            yield dut.no_channels_in.eq(no_channels)
+
+            for _ in range(packets):
+                samples = self.rng.randint(1, 3) * no_channels
+                length  = self.truncated(4 * samples)
+                data    = []
+                for n in range(samples):
+                    value   = sample(seq + n // no_channels, n % no_channels)
+                    # the lowest byte of the 32 bit USB sample gets dropped
+                    data   += [self.rng.randrange(256), value & 0xff, (value >> 8) & 0xff, value >> 16]
+                    channel = n % no_channels
+                    if 4 * (n + 1) <= length:
+                        scoreboard.expect("out", payload=value, channel_nr=channel,
+                                          first=channel == 0, last=channel == no_channels - 1)
+                seq += samples // no_channels
+
+                # a packet which ended within a sample is garbage to the next one
+                garbage_expected += partial_sample
+                partial_sample    = length % 4 != 0
+                for position, byte in enumerate(data[:length]):
+                    source.push(payload=byte, first=position == 0, last=position == length - 1)
+
+            yield from self.run_streams([source, sink], monitor=count_garbage,
+                                        until=lambda: source.idle and not scoreboard.pending)
+
+        self.report(scoreboard, usb=source, channels=sink)
+        self.check(scoreboard)
+        self.assertEqual(garbage_seen[0], garbage_expected)
+        return source
+
+    @sync_test_case
+    def test_random_backpressure(self):
+        channel_counts = [8] + [self.rng.choice([2, 4, 8]) for _ in range(3)]
+        yield from self.run_phases(channel_counts, 8)
+
+    @sync_test_case
+    def test_full_rate(self):
+        self.TRUNCATION_PROBABILITY = 0
+        source = yield from self.run_phases([8], 4, ActivityPattern.FULL_RATE)
+        self.assertGreater(source.throughput, 0.95)
+
+
+class StereoPairExtractorStressTest(StreamStressTestCase):
+    FRAGMENT_UNDER_TEST = StereoPairExtractor
+    FRAGMENT_ARGUMENTS  = dict(max_no_channels=8, fifo_depth=32)
+
+    def push_frames(self, source, scoreboard, no_channels, selected, frames, seq):
+        for _ in range(frames):
+            for channel in range(self.truncated(no_channels)):
+                value = sample(seq, channel)
+                source.push(payload=value, channel_nr=channel, first=channel == 0, last=channel == no_channels - 1)
+                if channel in (selected, selected + 1):
+                    scoreboard.expect("out", payload=value, first=channel == selected, last=channel == selected + 1)
+            seq += 1
+        return seq
+
+    @sync_test_case
+    def test_random_backpressure(self):
+        dut        = self.dut
+        scoreboard = Scoreboard()
+        # the input has no ready, the extractor must keep up or drop samples
+        source     = StreamSource(dut.channel_stream_in, self.pattern(), backpressure=False)
+        sink       = StreamSink(dut.channel_stream_out, self.pattern(), scoreboard.receiver("out"))
+
+        seq = 0
+        for _ in range(4):
+            no_channels = self.rng.choice([4, 8])
+            selected    = self.rng.randrange(no_channels - 1)
+            yield dut.selected_channel_in.eq(selected)
+            # no phase sends more pairs than the FIFO holds, so none may get lost
+            seq = self.push_frames(source, scoreboard, no_channels, selected, 12, seq)
+            yield from self.run_streams([source, sink], until=lambda: source.idle and not scoreboard.pending)
+
+        self.report(scoreboard, source=source, sink=sink)
+        self.check(scoreboard)
+
+    @sync_test_case
+    def test_overflow(self):
+        dut        = self.dut
+        scoreboard = Scoreboard()
+        source     = StreamSource(dut.channel_stream_in, self.pattern(), backpressure=False)
+        sink       = StreamSink(dut.channel_stream_out, self.pattern((0.0,)), scoreboard.receiver("out"))
+
+        # twice as many pairs as the FIFO holds, while nothing is read
+        yield dut.selected_channel_in.eq(2)
+        self.push_frames(source, scoreboard, 8, 2, 32, 0)
+        yield from self.run_streams([source, sink], until=lambda: source.idle)
+        sink.pattern = self.pattern()
+        yield from self.run_streams([source, sink], until=lambda: sink.idle_cycles > 100)
+
+        self.report(scoreboard, source=source, sink=sink)
+        # the FIFO drops samples, but must not corrupt or reorder the others
+        self.check(scoreboard, lossless=False)
+        self.assertGreater(scoreboard.lost + scoreboard.pending, 0)
+        self.assertGreater(scoreboard.matched, 0)
+
+
+class IsochronousInHost():
+    """ reads the packets of an isochronous IN endpoint from ChannelsToUSBStream
+
+        Every microframe starts with data_requested_in. The host then reads
+        the requested bytes, or fewer after the deadline, but always whole samples,
+        and ends the packet with frame_finished_in. The next microframe starts
+        microframe_cycles after the last one, or when the packet ended. Every sample must be silence
+        or belong to the channel of its position in the packet; per channel, the
+        frame numbers must increase.
+
+        A packet which ends within a frame, or which was filled up with silence, leaves
+        a partial frame behind, which the module discards. The same goes for a change
+        of the channel count. The frames a channel skips after that count as discarded,
+        all other gaps as lost.
+    """
+    def __init__(self, dut, pattern: ActivityPattern, no_channels: int, packet_samples, microframe_cycles=200):
+        self.dut               = dut
+        self.pattern           = pattern
+        self.no_channels       = no_channels
+        self.packet_samples    = packet_samples
+        self.microframe_cycles = microframe_cycles
+
+        self.packets    = 0
+        self.short      = 0
+        self.samples    = 0
+        self.fills      = 0
+        self.misrouted  = 0
+        self.reordered  = 0
+        self.lost       = 0
+        self.discarded  = 0
+        self.transfers  = 0
+        self.stalls     = 0
+        self.throughput = 0.0
+
+        self._last_seq  = {}
+        self._excused   = set()
+        self._cycle     = microframe_cycles
+        self._state     = "IDLE"
+        self._packet    = []
+        self._requested = 0
+        self._ready     = 0
+
+    def set_no_channels(self, no_channels: int):
+        """ only between packets """
+        self.no_channels = no_channels
+        self._excused    = set(range(no_channels))
+
+    def drive(self):
+        if self._state == "IDLE" and self._cycle >= self.microframe_cycles:
+            self._cycle     = 0
+            self._packet    = []
+            self._requested = 4 * self.packet_samples()
+            self._state     = "REQUEST"
+
+        self._ready = int(self._state == "READ" and next(self.pattern))
+        yield self.dut.data_requested_in.eq(self._state == "REQUEST")
+        yield self.dut.frame_finished_in.eq(self._state == "FINISH")
+        yield self.dut.usb_stream_out.ready.eq(self._ready)
+
+    def update(self, cycle: int):
+        if (yield self.dut.usb_stream_out.valid):
+            if self._ready:
+                self._packet.append((yield self.dut.usb_stream_out.payload))
+                self.transfers += 1
+            else:
+                self.stalls += 1
+
+        if self._state == "REQUEST":
+            self._state = "READ"
+
+        elif self._state == "FINISH":
+            self.check_packet(self._packet)
+            self._state = "IDLE"
+
+        elif self._state == "READ":
+            past_deadline = self._cycle >= 3 * self.microframe_cycles // 4
+            if len(self._packet) >= self._requested or (past_deadline and len(self._packet) % 4 == 0):
+                self._state = "FINISH"
+
+        self._cycle    += 1
+        self.throughput = self.transfers / (cycle + 1)
+
+    def check_packet(self, packet: list):
+        self.packets += 1
+        self.short   += len(packet) < self._requested
+        fills         = self.fills
+
+        for position in range(0, len(packet) - 3, 4):
+            channel = (position // 4) % self.no_channels
+            low     = packet[position]
+            value   = packet[position + 1] | (packet[position + 2] << 8) | (packet[position + 3] << 16)
+
+            if low == 0 and value == 0:
+                self.fills += 1
+                continue
+
+            if low != 0 or sample_channel(value) != channel:
+                self.misrouted += 1
+                continue
+
+            seq  = sample_seq(value)
+            last = self._last_seq.get(channel)
+            if last is not None and seq <= last:
+                self.reordered += 1
+            elif last is not None and channel in self._excused:
+                self.discarded += seq - last - 1
+            elif last is not None:
+                self.lost += seq - last - 1
+            self._excused.discard(channel)
+            self._last_seq[channel] = seq
+            self.samples += 1
+
+        if (len(packet) // 4) % self.no_channels != 0 or self.fills > fills:
+            self._excused = set(range(self.no_channels))
+
+    def summary(self) -> str:
+        return (f"{self.packets} packets ({self.short} short), {self.samples} samples, {self.fills} fills, "
+                f"{self.discarded} discarded, {self.lost} lost, {self.misrouted} misrouted, {self.reordered} reordered")
+
+
+class ChannelsToUSBStreamStressTest(StreamStressTestCase):
+    FRAGMENT_UNDER_TEST = ChannelsToUSBStream
+    FRAGMENT_ARGUMENTS  = dict(max_nr_channels=4, max_packet_size=64)
+
+    def run_phases(self, channel_counts, microframes, probabilities=ActivityPattern.PROBABILITIES, truncate=True):
+        """ microframes with each of the channel counts, returns the host """
+        dut     = self.dut
+        frames  = 2
+        source  = StreamSource(dut.channel_stream_in, self.pattern(probabilities))
+
+        def packet_samples():
+            samples = frames * host.no_channels
+            return self.truncated(samples) if truncate else samples
+
+        host    = IsochronousInHost(dut, self.pattern(probabilities), channel_counts[0], packet_samples)
+
+        yield dut.audio_in_active.eq(1)
+
+        # the source always sends all channels, the module drops the ones above no_channels_in
+        for seq in range(len(channel_counts) * microframes * frames + 32):
+            for channel in range(4):
+                source.push(payload=sample(seq, channel), channel_nr=channel, first=channel == 0, last=channel == 3)
+
+        packets = 0
+        for no_channels in channel_counts:
+            # run_streams returns right after a packet ended, so the host is idle
+            host.set_no_channels(no_channels)
+            yield dut.no_channels_in.eq(no_channels)
+            packets += microframes
+            yield from self.run_streams([source, host], until=lambda: host.packets >= packets)
+
+        self.report(channels=source, usb=host)
+        if STRESS_VERBOSE:
+            print(f"    {host.summary()}")
+
+        message = f"seed {STRESS_SEED}: {host.summary()}"
+        self.assertEqual(host.misrouted, 0, message)
+        self.assertEqual(host.reordered, 0, message)
+        self.assertEqual(host.lost, 0, message)
+        self.assertGreater(host.samples, 0, message)
+        return host
+
+    @sync_test_case
+    def test_random_backpressure(self):
+        yield from self.run_phases([4], 30)
+
+    @sync_test_case
+    def test_stereo(self):
+        yield from self.run_phases([2], 30)
+
+    @sync_test_case
+    def test_channel_count_change(self):
+        # the channel count changes between packets, like on a change of the alternate setting
+        channel_counts = [4] + [self.rng.choice([2, 4]) for _ in range(3)]
+        yield from self.run_phases(channel_counts, 10)
+
+    @sync_test_case
+    def test_full_rate(self):
+        microframes = 10
+        host = yield from self.run_phases([4], microframes, ActivityPattern.FULL_RATE, truncate=False)
+        message = f"seed {STRESS_SEED}: {host.summary()}"
+        self.assertEqual(host.short, 0, message)
+        self.assertEqual(host.discarded, 0, message)
+        # only the first packet may have to wait for the samples
+        self.assertGreaterEqual(host.samples, (microframes - 1) * 2 * 4, message)
+
+class ChannelsToUSBStreamPipelinedStressTest(ChannelsToUSBStreamStressTest):
+    FRAGMENT_ARGUMENTS  = dict(max_nr_channels=4, max_packet_size=64, pipelined=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import argparse
+import json
+import unittest
+
+from amaranth         import *
+from amaranth.hdl.rec import Record
+from amaranth.sim     import Simulator, Settle
+
+from car                       import ClockDomainGeneratorBase
+from pll_solver                import USB_CLOCK_FREQUENCY, audio_clock_frequencies
+from requesthandlers           import UAC2RequestHandlers
+from adat_usb2_audio_interface import USB2AudioInterface
+from debug                     import ila_signal_groups
+from signal_trace              import SignalTrace
+
+MICROFRAME_CYCLES = int(USB_CLOCK_FREQUENCY // 8000)
+
+# layouts of the board resources the top level requests
+RESOURCES = {
+    "toslink":     [("tx", 1), ("rx", 1)],
+    "i2s":         [("sclk", 1), ("bclk", 1), ("lrclk", 1), ("data", 1)],
+    "usb_aux":     [("vbus", 1)],
+    "leds":        [("active1", 1), ("suspended1", 1), ("active2", 1), ("suspended2", 1), ("usb1", 1), ("usb2", 1)] +
+                   [(f"sync{i}", 1) for i in range(1, 5)],
+    "core_button": [("i", 1)],
+    "core_led":    [("o", 1)],
+    "uart":        [("rx", 1), ("tx", 1)],
+}
+
+class SimulationClockDomainGenerator(Elaboratable, ClockDomainGeneratorBase):
+    """ only creates the clock domains, the simulator drives their clocks """
+    def __init__(self):
+        super().__init__()
+
+    def elaborate(self, platform):
+        m = Module()
+        for domain in ["usb", "sync", "fast", "adat", "dac"]:
+            m.domains[domain] = ClockDomain(domain)
+        return m
+
+
+class SimulationPlatform():
+    """ stands in for the board: every resource is a plain record """
+    def __init__(self, samplerate: int=48000, fast_multiplier: int=9):
+        self.clock_frequencies       = dict(usb=USB_CLOCK_FREQUENCY, **audio_clock_frequencies(samplerate, fast_multiplier))
+        self.fast_domain_clock_freq  = self.clock_frequencies["fast"]
+        self.resources               = {}
+
+    def request(self, name: str, number: int=0):
+        if (name, number) not in self.resources:
+            self.resources[(name, number)] = Record(RESOURCES[name], name=f"{name}_{number}")
+        return self.resources[(name, number)]
+
+    def clock_domain_generator(self):
+        return SimulationClockDomainGenerator()
+
+
+class ControlEndpointModel():
+    """ keeps the request handlers without elaborating them,
+        so the simulation can drive their outputs, like the selected alternate setting """
+    def __init__(self):
+        self.descriptors      = None
+        self.request_handlers = []
+
+    def add_standard_request_handlers(self, descriptors, **kwargs):
+        self.descriptors = descriptors
+
+    def add_request_handler(self, handler):
+        self.request_handlers.append(handler)
+
+
+class USBDeviceModel(Elaboratable):
+    """ stands in for a USBDevice and its ULPI PHY
+
+        The endpoints are not elaborated either: their streams and status signals
+        are left undriven for the host model to drive.
+        They are kept by their class name, as the top level has one of each kind per port.
+    """
+    def __init__(self):
+        self.connect          = Signal()
+        self.full_speed_only  = Signal()
+        self.suspended        = Signal()
+        self.sof_detected     = Signal()
+        self.tx_activity_led  = Signal()
+        self.rx_activity_led  = Signal()
+
+        self.control_endpoint = None
+        self.endpoints        = {}
+
+    def add_control_endpoint(self):
+        self.control_endpoint = ControlEndpointModel()
+        return self.control_endpoint
+
+    def add_endpoint(self, endpoint):
+        self.endpoints[type(endpoint).__name__] = endpoint
+
+    def request_handler(self, handler_class):
+        return next(handler for handler in self.control_endpoint.request_handlers if isinstance(handler, handler_class))
+
+    def elaborate(self, platform):
+        return Module()
+
+
+class SimulatedUSB2AudioInterface(USB2AudioInterface):
+    BUILD_CACHE_DIRECTORY = None
+    # add the signal groups and events of the ILA, for selective traces
+    TRACE_ILA_GROUPS      = False
+
+    def __init__(self):
+        super().__init__()
+        self.usb_devices   = {}
+        self.internals     = {}
+        self.signal_groups = {}
+        self.signal_events = {}
+
+    def create_usb_device(self, platform, usb_nr: int):
+        self.usb_devices[usb_nr] = USBDeviceModel()
+        return self.usb_devices[usb_nr]
+
+    def probe(self, elaboration_locals: dict):
+        self.internals = elaboration_locals
+        if self.TRACE_ILA_GROUPS:
+            self.signal_groups, self.signal_events = ila_signal_groups(elaboration_locals, self.USE_CONVOLUTION)
+
+
+class SystemSimulation(Elaboratable):
+    """ the whole interface with the USB ports played by host models and the ADAT outputs looped back to the inputs """
+    def __init__(self, samplerate: int=48000, **flags):
+        self.platform = SimulationPlatform(samplerate)
+        design_class  = type("SimulatedUSB2AudioInterface", (SimulatedUSB2AudioInterface,), flags)
+        self.design   = design_class()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.design = Fragment.get(self.design, self.platform)
+
+        for i in range(1, 5):
+            toslink = self.platform.request("toslink", i)
+            m.d.comb += toslink.rx.eq(toslink.tx)
+
+        return m
+
+
+class SampleScoreboard():
+    """ checks the samples of one channel: each source channel sends (tag << 16) | sequence number,
+        so every received sample has to carry the expected tag and the next sequence number.
+        Everything before the first sample with the expected tag counts as startup. """
+    def __init__(self, expected_tag: int):
+        self.expected_tag = expected_tag
+        self.last         = None
+        self.samples      = 0
+        self.startup      = 0
+        self.dropouts     = 0
+        self.lost         = 0
+        self.repeated     = 0
+        self.misrouted    = 0
+
+    def check(self, sample: int):
+        self.samples += 1
+        tag, sequence = sample >> 16, sample & 0xffff
+        if self.last is None and tag != self.expected_tag:
+            self.startup += 1
+            return
+
+        if sample == 0:
+            self.dropouts += 1
+            return
+
+        if tag != self.expected_tag:
+            self.misrouted += 1
+            return
+
+        if self.last is not None:
+            gap = (sequence - self.last) & 0xffff
+            if gap == 0:
+                self.repeated += 1
+            elif gap > 1:
+                self.lost += gap - 1
+        self.last = sequence
+
+    @property
+    def errors(self) -> int:
+        return self.dropouts + self.lost + self.repeated + self.misrouted
+
+    def report(self) -> dict:
+        return dict(expected_tag=self.expected_tag, samples=self.samples, startup=self.startup, dropouts=self.dropouts,
+                    lost=self.lost, repeated=self.repeated, misrouted=self.misrouted)
+
+
+def source_tag(usb_nr: int, channel: int) -> int:
+    """ never 0, so that no sample is silence """
+    return (0x80 if usb_nr == 2 else 0) | (channel + 1)
+
+
+class USBHostModel():
+    """ plays the host on one USB port: sends a SOF and an isochronous OUT packet every microframe,
+        then requests an IN packet and hands its samples to the scoreboards """
+    def __init__(self, device: USBDeviceModel, usb_nr: int, no_channels: int, samplerate: int,
+                 expected_tags: list, ppm: float=0):
+        self._device        = device
+        self._usb_nr        = usb_nr
+        self._no_channels   = no_channels
+        self._samplerate    = samplerate
+        self._frame_cycles  = MICROFRAME_CYCLES * (1 + ppm * 1e-6)
+
+        self.audio_out      = device.endpoints["USBIsochronousOutStreamEndpoint"]
+        self.audio_in       = device.endpoints["USBIsochronousInStreamEndpoint"]
+        self.feedback       = device.endpoints["USBIsochronousInMemoryEndpoint"]
+        self.request_handler = device.request_handler(UAC2RequestHandlers)
+
+        self.scoreboards    = [SampleScoreboard(tag) for tag in expected_tags]
+        self.sequence       = 0
+        self.microframes    = 0
+        self.out_stalls     = 0
+        self.in_bytes       = 0
+        self.short_packets  = 0
+        self.feedback_value = None
+        self._cycle         = 0
+
+    def tick(self):
+        yield
+        self._cycle += 1
+
+    def out_samples(self):
+        """ one sample frame for all channels, 24 bit in a 32 bit USB sample, little endian """
+        data = []
+        for channel in range(self._no_channels):
+            sample = (source_tag(self._usb_nr, channel) << 16) | (self.sequence & 0xffff)
+            data += [0, sample & 0xff, (sample >> 8) & 0xff, (sample >> 16) & 0xff]
+        self.sequence += 1
+        return data
+
+    def send_out_packet(self, samples_in_microframe: int):
+        stream = self.audio_out.stream
+        data   = []
+        for _ in range(samples_in_microframe):
+            data += self.out_samples()
+
+        for pos, byte in enumerate(data):
+            yield stream.payload.eq(byte)
+            yield stream.valid.eq(1)
+            yield stream.first.eq(pos == 0)
+            yield stream.last.eq(pos == len(data) - 1)
+            while True:
+                yield Settle()
+                ready = (yield stream.ready)
+                yield from self.tick()
+                if ready:
+                    break
+                self.out_stalls += 1
+
+        yield stream.valid.eq(0)
+        yield stream.first.eq(0)
+        yield stream.last.eq(0)
+        return len(data)
+
+    def receive_in_packet(self):
+        yield self.audio_in.data_requested.eq(1)
+        yield from self.tick()
+        yield self.audio_in.data_requested.eq(0)
+
+        length   = (yield self.audio_in.bytes_in_frame)
+        received = []
+        yield self.audio_in.stream.ready.eq(1)
+        for _ in range(2 * length + 16):
+            if len(received) >= length:
+                break
+            yield Settle()
+            if (yield self.audio_in.stream.valid):
+                received.append((yield self.audio_in.stream.payload))
+            yield from self.tick()
+        yield self.audio_in.stream.ready.eq(0)
+
+        yield self.audio_in.frame_finished.eq(1)
+        yield from self.tick()
+        yield self.audio_in.frame_finished.eq(0)
+
+        self.in_bytes += len(received)
+        if len(received) < length:
+            self.short_packets += 1
+
+        bytes_per_frame = 4 * self._no_channels
+        for start in range(0, len(received) - bytes_per_frame + 1, bytes_per_frame):
+            frame = received[start:start + bytes_per_frame]
+            self.receive_frame([frame[4 * channel + 1] | (frame[4 * channel + 2] << 8) | (frame[4 * channel + 3] << 16)
+                                for channel in range(self._no_channels)])
+
+    def receive_frame(self, samples: list):
+        """ checks the 24 bit samples of one IN frame, one per channel """
+        for scoreboard, sample in zip(self.scoreboards, samples):
+            scoreboard.check(sample)
+
+    def read_feedback(self):
+        value = 0
+        for address in range(4):
+            yield self.feedback.address.eq(address)
+            yield Settle()
+            value |= (yield self.feedback.value) << (8 * address)
+        self.feedback_value = value
+
+    def process(self, microframes: int):
+        def process():
+            # select the alternate setting with all channels
+            yield self.request_handler.output_interface_altsetting_nr.eq(2)
+            yield self.audio_out.stream.valid.eq(0)
+            yield from self.read_feedback()
+
+            samples_owed = 0.0
+            next_sof     = 0.0
+            for _ in range(microframes):
+                samples_owed += self._samplerate / 8000
+                samples       = int(samples_owed)
+                samples_owed -= samples
+
+                yield self._device.sof_detected.eq(1)
+                yield from self.tick()
+                yield self._device.sof_detected.eq(0)
+
+                yield from self.send_out_packet(samples)
+                yield from self.receive_in_packet()
+                yield from self.read_feedback()
+                self.microframes += 1
+
+                # idle for the rest of the microframe
+                next_sof += self._frame_cycles
+                while self._cycle < int(next_sof):
+                    yield from self.tick()
+        return process
+
+    def report(self) -> dict:
+        return dict(
+            microframes   = self.microframes,
+            out_stalls    = self.out_stalls,
+            in_bytes      = self.in_bytes,
+            short_packets = self.short_packets,
+            # samples per microframe in 16.16 fixed point
+            feedback      = None if self.feedback_value is None else self.feedback_value / 2**16,
+            errors        = sum(scoreboard.errors for scoreboard in self.scoreboards),
+            channels      = [scoreboard.report() for scoreboard in self.scoreboards],
+        )
+
+
+class LevelMonitor():
+    """ minimum and maximum of FIFO levels, sampled every few cycles """
+    def __init__(self, levels: dict, interval: int=16):
+        self._levels   = levels
+        self._interval = interval
+        self.minimum   = {}
+        self.maximum   = {}
+
+    def process(self):
+        while True:
+            for name, level in self._levels.items():
+                value = (yield level)
+                self.minimum[name] = min(self.minimum.get(name, value), value)
+                self.maximum[name] = max(self.maximum.get(name, 0), value)
+            for _ in range(self._interval):
+                yield
+
+    def report(self) -> dict:
+        return { name: dict(min=self.minimum.get(name), max=self.maximum.get(name)) for name in self._levels }
+
+
+def run_system_simulation(microframes: int=16, samplerate: int=48000, usb2_ppm: float=0, vcd_file: str=None,
+                          trace_file: str=None, trace_groups=("channels_to_usb_debug",), trace_trigger: str=None,
+                          trace_window=(16, 64), **flags) -> dict:
+    """ runs the whole design for a number of microframes and returns the report
+
+        trace_file gets a SignalTrace of the named ILA signal groups (see debug.py),
+        in windows around the cycles of the named ILA event, if trace_trigger is given.
+    """
+    if trace_file:
+        flags = dict(flags, TRACE_ILA_GROUPS=True)
+    system      = SystemSimulation(samplerate, **flags)
+    design      = system.design
+    simulator   = Simulator(system)
+    for domain, frequency in system.platform.clock_frequencies.items():
+        simulator.add_clock(1 / frequency, domain=domain)
+
+    usb1_channels = design.USB1_NO_CHANNELS
+    usb2_channels = design.USB2_NO_CHANNELS
+    adat_channels = usb1_channels - usb2_channels
+
+    # USB1 IN: the ADAT channels come back from the loopback, the upper channels from USB2 OUT
+    usb1 = USBHostModel(design.usb_devices[1], 1, usb1_channels, samplerate,
+                        [source_tag(1, channel) for channel in range(adat_channels)] +
+                        [source_tag(2, channel) for channel in range(usb2_channels)])
+    # USB2 IN: the upper channels of USB1 OUT
+    usb2 = USBHostModel(design.usb_devices[2], 2, usb2_channels, samplerate,
+                        [source_tag(1, adat_channels + channel) for channel in range(usb2_channels)], ppm=usb2_ppm)
+
+    internals = design.internals
+    monitor   = LevelMonitor({
+        "usb1_to_output_fifo":  internals["usb1_to_output_fifo_level"],
+        "usb2_to_usb1_fifo":    internals["usb2_to_usb1_fifo_level"],
+        "input_to_usb_fifo":    internals["input_to_usb_fifo"].r_level,
+        "channels_to_usb1":     internals["channels_to_usb1_stream"].level,
+        "channels_to_usb2":     internals["channels_to_usb2_stream"].level,
+    })
+
+    simulator.add_sync_process(usb1.process(microframes), domain="usb")
+    simulator.add_sync_process(usb2.process(microframes), domain="usb")
+    simulator.add_sync_process(monitor.process, domain="usb")
+
+    trace = None
+    if trace_file:
+        trace = SignalTrace({ name: design.signal_groups[name] for name in trace_groups },
+                            design.signal_events[trace_trigger] if trace_trigger else None,
+                            pre_trigger=trace_window[0], post_trigger=trace_window[1],
+                            period=1 / system.platform.clock_frequencies["usb"])
+        trace.attach(simulator, domain="usb")
+
+    duration = microframes / 8000
+    if vcd_file:
+        with simulator.write_vcd(vcd_file):
+            simulator.run_until(duration, run_passive=True)
+    else:
+        simulator.run_until(duration, run_passive=True)
+
+    if trace is not None:
+        trace.write(trace_file)
+        print(f"trace: {trace.summary()}")
+
+    return dict(
+        samplerate  = samplerate,
+        usb1        = usb1.report(),
+        usb2        = usb2.report(),
+        fifo_levels = monitor.report(),
+        errors      = usb1.report()["errors"] + usb2.report()["errors"],
+    )
+
+
+def format_report(report: dict) -> str:
+    lines = []
+    for port in ["usb1", "usb2"]:
+        result = report[port]
+        lines.append(f"{port}: {result['microframes']} microframes, {result['in_bytes']} IN bytes, "
+                     f"{result['short_packets']} short IN packets, {result['out_stalls']} OUT stalls, "
+                     f"feedback {result['feedback']}, {result['errors']} sample errors")
+        for channel, scoreboard in enumerate(result["channels"]):
+            if scoreboard["dropouts"] or scoreboard["lost"] or scoreboard["repeated"] or scoreboard["misrouted"] \
+               or scoreboard["startup"] == scoreboard["samples"]:
+                lines.append(f"  IN channel {channel}: {scoreboard}")
+    for name, level in report["fifo_levels"].items():
+        lines.append(f"{name:>20} level {level['min']}..{level['max']}")
+    return "\n".join(lines)
+
+
+class SystemSimulationTest(unittest.TestCase):
+    def test_scoreboard(self):
+        scoreboard = SampleScoreboard(3)
+        for sample in [0, (5 << 16) | 7, (3 << 16) | 1, (3 << 16) | 2, (3 << 16) | 2, (3 << 16) | 5, 0, (4 << 16) | 6]:
+            scoreboard.check(sample)
+        self.assertEqual((scoreboard.startup, scoreboard.repeated, scoreboard.lost, scoreboard.dropouts, scoreboard.misrouted),
+                         (2, 1, 2, 1, 1))
+
+    def test_sequence_wraps(self):
+        scoreboard = SampleScoreboard(1)
+        for sequence in [0xfffe, 0xffff, 0, 1]:
+            scoreboard.check((1 << 16) | sequence)
+        self.assertEqual(scoreboard.errors, 0)
+
+    # the ADAT receivers need a few frames to lock, and the samples then still have to pass
+    # the output and input FIFOs, 48 microframes are 6ms or 288 ADAT frames at 48kHz
+    LOOPBACK_MICROFRAMES = 48
+
+    def test_loopback(self):
+        report = run_system_simulation(microframes=self.LOOPBACK_MICROFRAMES)
+        self.assertEqual(report["errors"], 0, format_report(report))
+        # every IN channel, over ADAT or from the other USB port, has to deliver its samples by now
+        for port in ["usb1", "usb2"]:
+            for channel, scoreboard in enumerate(report[port]["channels"]):
+                self.assertGreater(scoreboard["samples"], scoreboard["startup"],
+                                   f"{port} IN channel {channel} got no samples\n" + format_report(report))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="simulate the whole interface with host models on both USB ports and the ADAT outputs looped back")
+    parser.add_argument("--microframes", type=int, default=16, help="simulated time in 125us microframes")
+    parser.add_argument("--samplerate", type=int, default=48000)
+    parser.add_argument("--usb2-ppm", type=float, default=0, help="clock offset of the USB2 host against the USB1 host")
+    parser.add_argument("--drift-compensation", action="store_true", help="simulate with USE_DRIFT_COMPENSATION")
+    parser.add_argument("--vcd", help="write the waveforms of all signals to this file")
+    parser.add_argument("--trace", help="write a trace of only some signal groups to this file, gzipped if it ends in .gz")
+    parser.add_argument("--trace-groups", nargs="+", default=["channels_to_usb_debug"], help="ILA signal groups of debug.py to trace")
+    parser.add_argument("--trace-trigger", help="only trace windows around this ILA event of debug.py, like garbage")
+    parser.add_argument("--trace-window", type=int, nargs=2, default=[16, 64], metavar=("PRE", "POST"),
+                        help="cycles to trace before and after each trigger")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    flags = dict(USE_DRIFT_COMPENSATION=True) if args.drift_compensation else {}
+    report = run_system_simulation(args.microframes, args.samplerate, args.usb2_ppm, args.vcd,
+                                   trace_file=args.trace, trace_groups=args.trace_groups,
+                                   trace_trigger=args.trace_trigger, trace_window=args.trace_window, **flags)
+    print(format_report(report))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    exit(1 if report["errors"] else 0)
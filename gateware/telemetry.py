@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    FIFO levels, counters and status of the design, readable by the SoC
+
+    Each telemetry entry is a (kind, name, domain) tuple, where kind is one of
+      "level": a FIFO level, reported with its minimum and maximum since the last snapshot
+      "value": any value, like a feedback value, a sync status or a saturating counter
+      "count": a free running counter of the cycles in which its one bit input is high,
+               like underflow or overflow strobes
+    and domain is the clock domain of its input.
+"""
+from amaranth          import *
+from amaranth.build    import Platform
+from amaranth.lib.cdc  import FFSynchronizer
+from amaranth.lib.fifo import SyncFIFO
+from amaranth.sim      import Settle
+from amlib.test        import GatewareTestCase, sync_test_case
+
+from lambdasoc.periph  import Peripheral
+
+LEVEL_WIDTH = 16
+VALUE_WIDTH = 32
+COUNT_WIDTH = 32
+
+def register_names(kind: str, name: str) -> list:
+    """ the names of the registers of an entry """
+    return [name, f"{name}_min", f"{name}_max"] if kind == "level" else [name]
+
+def register_width(kind: str) -> int:
+    return dict(level=LEVEL_WIDTH, value=VALUE_WIDTH, count=COUNT_WIDTH)[kind]
+
+def fifo_write_blocked(valid, fifo):
+    """ input for a "count" entry: high while a sample for fifo waits, but fifo is full.
+        Our FIFO writes are gated with w_rdy, so w_en & ~w_rdy would never be high. """
+    return valid & ~fifo.w_rdy
+
+
+class TelemetryCapture(Elaboratable):
+    """ captures the telemetry entries of one clock domain
+
+        Every change of request_in, which may come from any clock domain, captures
+        all outputs at once. ack_out follows request_in when they are captured,
+        and they stay unchanged until the next request, so the other domain can
+        read them without further synchronization.
+    """
+    def __init__(self, entries):
+        self._entries = [(kind, name) for kind, name in entries]
+
+        # I/O
+        self.request_in = Signal()
+        self.ack_out    = Signal()
+        self.inputs     = {name: Signal(1 if kind == "count" else register_width(kind), name=f"{name}_in")
+                           for kind, name in self._entries}
+        self.outputs    = {register: Signal(register_width(kind), name=f"{register}_out")
+                           for kind, name in self._entries for register in register_names(kind, name)}
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        request = Signal()
+        m.submodules.request_synchronizer = FFSynchronizer(self.request_in, request)
+
+        capture = Signal()
+        m.d.comb += capture.eq(request != self.ack_out)
+        with m.If(capture):
+            m.d.sync += self.ack_out.eq(request)
+
+        for kind, name in self._entries:
+            value   = self.inputs[name]
+            outputs = self.outputs
+
+            if kind == "level":
+                minimum = Signal(LEVEL_WIDTH, reset=2**LEVEL_WIDTH - 1, name=f"{name}_minimum")
+                maximum = Signal(LEVEL_WIDTH, name=f"{name}_maximum")
+
+                with m.If(value < minimum):
+                    m.d.sync += minimum.eq(value)
+                with m.If(value > maximum):
+                    m.d.sync += maximum.eq(value)
+
+                with m.If(capture):
+                    m.d.sync += [
+                        outputs[name].eq(value),
+                        outputs[f"{name}_min"].eq(Mux(value < minimum, value, minimum)),
+                        outputs[f"{name}_max"].eq(Mux(value > maximum, value, maximum)),
+                        # the watermarks start over with each snapshot
+                        minimum.eq(value),
+                        maximum.eq(value),
+                    ]
+
+            elif kind == "count":
+                count = Signal(COUNT_WIDTH, name=f"{name}_count")
+                with m.If(value):
+                    m.d.sync += count.eq(count + 1)
+                with m.If(capture):
+                    m.d.sync += outputs[name].eq(count)
+
+            else:
+                with m.If(capture):
+                    m.d.sync += outputs[name].eq(value)
+
+        return m
+
+
+class TelemetryPeripheral(Peripheral, Elaboratable):
+    """ CSR peripheral with the telemetry registers of the design
+
+        Writing the snapshot register captures all registers at once, in the clock
+        domains of their inputs. Once busy reads zero, they can be read one by one.
+        There are three registers for a level, <name>, <name>_min and <name>_max,
+        and one register <name> for a value or a count.
+    """
+    def __init__(self, entries):
+        super().__init__()
+
+        self._domains = {}
+        for kind, name, domain in entries:
+            assert kind in ("level", "value", "count"), f"unknown telemetry entry kind {kind}"
+            self._domains.setdefault(domain, []).append((kind, name))
+        self._captures = {domain: TelemetryCapture(domain_entries) for domain, domain_entries in self._domains.items()}
+
+        # I/O
+        self.inputs = {name: capture.inputs[name]
+                       for capture in self._captures.values() for name in capture.inputs}
+
+        bank            = self.csr_bank()
+        self._snapshot  = bank.csr(1, "w")
+        self._busy      = bank.csr(1, "r")
+        self._registers = {register: bank.csr(register_width(kind), "r", name=register)
+                           for kind, name, domain in entries for register in register_names(kind, name)}
+
+        self._bridge    = self.bridge(data_width=32, granularity=8, alignment=2)
+        self.bus        = self._bridge.bus
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+        m.submodules.bridge = self._bridge
+
+        request = Signal()
+        with m.If(self._snapshot.w_stb):
+            m.d.sync += request.eq(~request)
+
+        busy = []
+        for domain, capture in self._captures.items():
+            setattr(m.submodules, f"{domain}_capture", DomainRenamer(domain)(capture))
+
+            ack = Signal(name=f"{domain}_ack")
+            setattr(m.submodules, f"{domain}_ack_synchronizer", FFSynchronizer(capture.ack_out, ack))
+
+            m.d.comb += capture.request_in.eq(request)
+            busy.append(ack != request)
+
+            for register, output in capture.outputs.items():
+                m.d.comb += self._registers[register].r_data.eq(output)
+
+        m.d.comb += self._busy.r_data.eq(Cat(busy).any())
+
+        return m
+
+
+class TelemetryCaptureTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = TelemetryCapture
+    FRAGMENT_ARGUMENTS  = dict(entries=[("level", "fifo"), ("value", "feedback"), ("count", "underflow")])
+
+    def snapshot(self):
+        dut = self.dut
+        yield dut.request_in.eq(1 - (yield dut.request_in))
+        for _ in range(8):
+            yield
+            if (yield dut.ack_out) == (yield dut.request_in):
+                break
+        else:
+            self.fail("the snapshot was not acknowledged")
+        # nothing changes until the next request
+        yield
+
+    @sync_test_case
+    def test_snapshot(self):
+        dut = self.dut
+        yield dut.inputs["feedback"].eq(0xc0000)
+        for level in [8, 12, 3, 7]:
+            yield dut.inputs["fifo"].eq(level)
+            yield dut.inputs["underflow"].eq(level == 3)
+            yield
+        yield dut.inputs["underflow"].eq(0)
+
+        yield from self.snapshot()
+        self.assertEqual((yield dut.outputs["fifo"]), 7)
+        self.assertEqual((yield dut.outputs["fifo_min"]), 3)
+        self.assertEqual((yield dut.outputs["fifo_max"]), 12)
+        self.assertEqual((yield dut.outputs["feedback"]), 0xc0000)
+        self.assertEqual((yield dut.outputs["underflow"]), 1)
+
+        # the watermarks start over, the counters keep counting
+        yield dut.inputs["fifo"].eq(9)
+        yield dut.inputs["underflow"].eq(1)
+        yield
+        yield
+        yield dut.inputs["underflow"].eq(0)
+        yield dut.inputs["feedback"].eq(0xc0001)
+        yield
+        yield from self.snapshot()
+        self.assertEqual((yield dut.outputs["fifo_min"]), 7)
+        self.assertEqual((yield dut.outputs["fifo_max"]), 9)
+        self.assertEqual((yield dut.outputs["feedback"]), 0xc0001)
+        self.assertEqual((yield dut.outputs["underflow"]), 3)
+
+        # the outputs hold while the inputs change
+        yield dut.inputs["fifo"].eq(1)
+        for _ in range(4):
+            yield
+        self.assertEqual((yield dut.outputs["fifo"]), 9)
+
+
+class FIFOTelemetry(Elaboratable):
+    """ a small FIFO, written like the FIFOs of the design, with its blocked writes counted """
+    def __init__(self):
+        self.valid_in = Signal()
+        self.r_en_in  = Signal()
+        self.fifo     = SyncFIFO(width=8, depth=2)
+        self.capture  = TelemetryCapture([("count", "overflow")])
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+        m.submodules.fifo    = fifo    = self.fifo
+        m.submodules.capture = capture = self.capture
+        m.d.comb += [
+            fifo.w_en.eq(self.valid_in & fifo.w_rdy),
+            fifo.r_en.eq(self.r_en_in),
+            capture.inputs["overflow"].eq(fifo_write_blocked(self.valid_in, fifo)),
+        ]
+        return m
+
+class FIFOTelemetryTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = FIFOTelemetry
+    FRAGMENT_ARGUMENTS  = dict()
+
+    def overflows(self):
+        capture = self.dut.capture
+        yield capture.request_in.eq(1 - (yield capture.request_in))
+        for _ in range(8):
+            yield
+            if (yield capture.ack_out) == (yield capture.request_in):
+                break
+        else:
+            self.fail("the snapshot was not acknowledged")
+        yield
+        return (yield capture.outputs["overflow"])
+
+    @sync_test_case
+    def test_overflow(self):
+        dut = self.dut
+        # the first two samples fit
+        yield dut.valid_in.eq(1)
+        yield
+        yield
+        yield dut.valid_in.eq(0)
+        yield
+        self.assertEqual((yield from self.overflows()), 0)
+        self.assertFalse((yield dut.fifo.w_rdy))
+
+        # with the FIFO full, each cycle with a sample waiting counts
+        yield dut.valid_in.eq(1)
+        for _ in range(5):
+            yield
+        yield dut.valid_in.eq(0)
+        self.assertEqual((yield from self.overflows()), 5)
+
+        # once there is room again, nothing is counted
+        yield dut.r_en_in.eq(1)
+        yield
+        yield dut.r_en_in.eq(0)
+        yield dut.valid_in.eq(1)
+        yield
+        yield dut.valid_in.eq(0)
+        self.assertEqual((yield from self.overflows()), 5)
+
+
+class TelemetryPeripheralTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = TelemetryPeripheral
+    FRAGMENT_ARGUMENTS  = dict(entries=[("level", "fifo", "sync"), ("count", "underflow", "sync")])
+
+    def address(self, register):
+        """ the word address of a CSR on the wishbone bus """
+        for resource, (start, end, width) in self.dut.bus.memory_map.all_resources():
+            if resource is register:
+                return start // 4
+        self.fail(f"{register.name} is not on the bus")
+
+    def access(self, register, data=None):
+        """ one wishbone cycle, which writes data or returns the value read """
+        bus = self.dut.bus
+        yield bus.adr.eq(self.address(register))
+        yield bus.sel.eq(0b1111)
+        yield bus.we.eq(data is not None)
+        yield bus.dat_w.eq(data or 0)
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        for _ in range(16):
+            yield
+            yield Settle()
+            if (yield bus.ack):
+                break
+        else:
+            self.fail("the wishbone cycle was not acknowledged")
+        value = (yield bus.dat_r)
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        yield
+        return value
+
+    def snapshot(self):
+        dut = self.dut
+        yield from self.access(dut._snapshot, 1)
+        # the capture domain acknowledges through two synchronizers, which takes a few cycles
+        yield Settle()
+        self.assertTrue((yield dut._busy.r_data))
+        for _ in range(8):
+            if not (yield from self.access(dut._busy)):
+                return
+        self.fail("busy did not clear")
+
+    @sync_test_case
+    def test_snapshot(self):
+        dut       = self.dut
+        registers = dut._registers
+        for level in [8, 12, 3, 7]:
+            yield dut.inputs["fifo"].eq(level)
+            yield dut.inputs["underflow"].eq(level == 3)
+            yield
+        yield dut.inputs["underflow"].eq(0)
+
+        yield from self.snapshot()
+        self.assertEqual((yield from self.access(registers["fifo"])),      7)
+        self.assertEqual((yield from self.access(registers["fifo_min"])),  3)
+        self.assertEqual((yield from self.access(registers["fifo_max"])), 12)
+        self.assertEqual((yield from self.access(registers["underflow"])), 1)
+
+        # the registers hold until the next snapshot
+        yield dut.inputs["fifo"].eq(20)
+        yield dut.inputs["underflow"].eq(1)
+        yield
+        yield dut.inputs["underflow"].eq(0)
+        self.assertEqual((yield from self.access(registers["fifo"])),      7)
+        self.assertEqual((yield from self.access(registers["underflow"])), 1)
+
+        yield from self.snapshot()
+        self.assertEqual((yield from self.access(registers["fifo"])),     20)
+        self.assertEqual((yield from self.access(registers["fifo_max"])), 20)
+        self.assertEqual((yield from self.access(registers["underflow"])), 2)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    Runs the test cases of all gateware modules in a process pool
+
+    Each test method is a job of its own, so that the long stress and throughput
+    tests spread over all CPUs; the jobs which took longest last time start first.
+    A test which passed is not run again until something it depends on changed:
+    its key hashes the source of its module and of all local modules that one
+    imports, the parameters of its test case class (FRAGMENT_UNDER_TEST,
+    FRAGMENT_ARGUMENTS, ...), the simulator engine, the environment variables
+    which tests read and the versions of amaranth, amlib and luna.
+"""
+import argparse
+import ast
+import importlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import unittest
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from build_cache import BuildCache, file_contents, package_version
+
+GATEWARE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CACHE_NAMESPACE    = "tests"
+TIMINGS_FILE       = "timings.json"
+
+# environment variables which change what the tests do
+ENVIRONMENT_PREFIXES = ("GATEWARE_", "STREAM_STRESS_")
+
+PACKAGES = ["amaranth", "amlib", "luna"]
+
+def local_modules(directory: str=GATEWARE_DIRECTORY) -> list:
+    """ names of the importable modules in directory; scripts like usb_stream_to_channels-bench.py are not """
+    return sorted(filename[:-3] for filename in os.listdir(directory)
+                  if filename.endswith(".py") and filename[:-3].isidentifier())
+
+def imported_modules(filename: str) -> set:
+    """ top level names of all modules imported by a source file, also from within functions """
+    tree    = ast.parse(file_contents(filename), filename)
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.add(node.module.split(".")[0])
+    return modules
+
+def module_dependencies(module: str, directory: str=GATEWARE_DIRECTORY) -> list:
+    """ the module itself and all local modules it imports, directly or indirectly """
+    local        = set(local_modules(directory))
+    dependencies = set()
+    pending      = [module]
+    while pending:
+        name = pending.pop()
+        if name in dependencies or name not in local:
+            continue
+        dependencies.add(name)
+        pending.extend(imported_modules(os.path.join(directory, name + ".py")))
+    return sorted(dependencies)
+
+def parameter_repr(value) -> str:
+    """ a repr which does not change between runs, unlike the default one of classes and functions """
+    if isinstance(value, type) or callable(value):
+        return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', repr(value))}"
+    return repr(value)
+
+def class_parameters(test_class) -> dict:
+    """ the UPPER_CASE attributes of a test case class, which parametrize the fragment it tests """
+    return { name: parameter_repr(getattr(test_class, name))
+             for name in sorted(dir(test_class)) if name.isupper() and not name.startswith("_") }
+
+def test_environment() -> dict:
+    return { name: value for name, value in sorted(os.environ.items()) if name.startswith(ENVIRONMENT_PREFIXES) }
+
+
+class TestJob():
+    def __init__(self, test_id: str, test_class):
+        self.id         = test_id
+        self.module     = test_class.__module__
+        self.test_class = test_class
+
+    @property
+    def gateware(self) -> bool:
+        return any(base.__name__ == "GatewareTestCase" for base in self.test_class.__mro__)
+
+    def key(self, sources: dict, engine: str) -> str:
+        """ sources: { module name: source bytes } of at least all modules this test depends on """
+        dependencies = module_dependencies(self.module)
+        return BuildCache.key(
+            self.id,
+            [(name, sources[name]) for name in dependencies],
+            class_parameters(self.test_class),
+            engine,
+            test_environment(),
+            [(package, package_version(package)) for package in PACKAGES],
+            platform.python_version(),
+        )
+
+    def __repr__(self):
+        return f"TestJob({self.id})"
+
+
+def collect_tests(suite) -> list:
+    """ flattens a test suite into its test cases """
+    if isinstance(suite, unittest.TestCase):
+        return [suite]
+    return [test for item in suite for test in collect_tests(item)]
+
+def discover(modules: list, gateware_only: bool=False) -> (list, dict):
+    """ imports the modules and returns their tests as jobs, and the modules which failed to import """
+    loader = unittest.TestLoader()
+    jobs   = []
+    errors = {}
+    for module in modules:
+        try:
+            tests = collect_tests(loader.loadTestsFromModule(importlib.import_module(module)))
+        except Exception:
+            errors[module] = traceback.format_exc()
+            continue
+        for test in tests:
+            # the loader also returns tests of the classes a module imports, they belong to that module
+            if type(test).__module__ != module:
+                continue
+            job = TestJob(test.id(), type(test))
+            if job.gateware or not gateware_only:
+                jobs.append(job)
+    return jobs, errors
+
+
+class ResultCache():
+    """ remembers the keys of passed tests, one file per key, and how long each test took """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.timings   = {}
+        timings_file   = os.path.join(directory, TIMINGS_FILE)
+        if os.path.exists(timings_file):
+            try:
+                with open(timings_file) as f:
+                    self.timings = json.load(f)
+            except ValueError:
+                self.timings = {}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def passed(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def store(self, key: str, result: dict):
+        self.timings[result["id"]] = result["seconds"]
+        if result["status"] != "ok":
+            return
+        self._write(self._path(key), dict(id=result["id"], seconds=result["seconds"], time=time.time()))
+
+    def save_timings(self):
+        self._write(os.path.join(self.directory, TIMINGS_FILE), self.timings)
+
+    def _write(self, path: str, content):
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, delete=False) as f:
+            json.dump(content, f, indent=1, sort_keys=True)
+        os.replace(f.name, path)
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        self.timings = {}
+
+
+def initialize_worker(engine: str):
+    sys.path.insert(0, GATEWARE_DIRECTORY)
+    if engine == "cxxrtl":
+        import amlib.test
+        from cxxrtl_sim import CxxrtlSimulator
+        amlib.test.Simulator = CxxrtlSimulator
+
+def run_test(test_id: str) -> dict:
+    """ runs a single test in a worker, with its output captured """
+    start  = time.time()
+    result = unittest.TestResult()
+    result.buffer = True
+    try:
+        unittest.defaultTestLoader.loadTestsFromName(test_id).run(result)
+    except Exception:
+        result.errors.append((test_id, traceback.format_exc()))
+
+    if result.errors:
+        status, output = "error", "\n".join(message for _, message in result.errors)
+    elif result.failures:
+        status, output = "failed", "\n".join(message for _, message in result.failures)
+    elif result.skipped:
+        status, output = "skipped", "\n".join(message for _, message in result.skipped)
+    else:
+        status, output = "ok", ""
+    return dict(id=test_id, status=status, output=output, seconds=round(time.time() - start, 2))
+
+def run_all(jobs: list, cache: ResultCache, engine: str="pysim", workers: int=None,
+            force: bool=False, verbose: bool=False) -> (list, list):
+    """ runs the jobs which did not pass with the same key before, returns (results, ids of skipped jobs) """
+    sources = { module: file_contents(os.path.join(GATEWARE_DIRECTORY, module + ".py")) for module in local_modules() }
+    keys    = { job.id: job.key(sources, engine) for job in jobs }
+    cached  = [job.id for job in jobs if not force and cache.passed(keys[job.id])]
+    pending = [job for job in jobs if job.id not in cached]
+    # the longest tests first, so that they do not end up running alone at the end
+    pending.sort(key=lambda job: cache.timings.get(job.id, float("inf")), reverse=True)
+
+    results = []
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initialize_worker, initargs=(engine,)) as pool:
+            futures = { pool.submit(run_test, job.id): job for job in pending }
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    # the worker died, for example in the compiled simulator
+                    result = dict(id=job.id, status="error", output=traceback.format_exc(), seconds=0.0)
+                cache.store(keys[job.id], result)
+                results.append(result)
+                if verbose or result["status"] != "ok":
+                    print(f"{result['status']:>7} {result['id']} ({result['seconds']}s)", flush=True)
+        cache.save_timings()
+
+    results.sort(key=lambda result: result["id"])
+    return results, cached
+
+
+class TestRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name: str, source: str):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(source)
+
+    def test_dependencies(self):
+        self.write("a.py", "import b\nimport os\n")
+        self.write("b.py", "def f():\n    from c import g\n")
+        self.write("c.py", "import a\n")
+        self.write("d.py", "from amaranth import Signal\n")
+        self.write("a-bench.py", "import d\n")
+        self.assertEqual(local_modules(self.directory), ["a", "b", "c", "d"])
+        self.assertEqual(module_dependencies("a", self.directory), ["a", "b", "c"])
+        self.assertEqual(module_dependencies("d", self.directory), ["d"])
+
+    def test_class_parameters(self):
+        class Fragment():
+            pass
+        class Case(unittest.TestCase):
+            FRAGMENT_UNDER_TEST = Fragment
+            FRAGMENT_ARGUMENTS  = dict(pipelined=True)
+            timeout             = 3
+        parameters = class_parameters(Case)
+        self.assertEqual(set(parameters), { "FRAGMENT_UNDER_TEST", "FRAGMENT_ARGUMENTS" })
+        self.assertTrue(parameters["FRAGMENT_UNDER_TEST"].endswith("test_class_parameters.<locals>.Fragment"))
+        self.assertEqual(parameters["FRAGMENT_ARGUMENTS"], "{'pipelined': True}")
+
+    def test_result_cache(self):
+        cache = ResultCache(os.path.join(self.directory, "tests"))
+        cache.store("k1", dict(id="m.C.test_a", status="ok", seconds=2.0))
+        cache.store("k2", dict(id="m.C.test_b", status="failed", seconds=1.0))
+        cache.save_timings()
+
+        cache = ResultCache(os.path.join(self.directory, "tests"))
+        self.assertTrue(cache.passed("k1"))
+        self.assertFalse(cache.passed("k2"))
+        self.assertEqual(cache.timings, { "m.C.test_a": 2.0, "m.C.test_b": 1.0 })
+
+        cache.clear()
+        self.assertFalse(cache.passed("k1"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run the test cases of the gateware modules in parallel, "
+                                                 "skipping those which passed and did not change since")
+    parser.add_argument("modules", nargs="*", help="only the tests of these modules, defaults to all")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--engine", choices=["pysim", "cxxrtl"], default=os.environ.get("GATEWARE_SIMULATOR", "pysim"))
+    parser.add_argument("--gateware-only", action="store_true", help="only the GatewareTestCases")
+    parser.add_argument("--force", action="store_true", help="also run the tests which passed before")
+    parser.add_argument("--clear", action="store_true", help="forget all passed tests")
+    parser.add_argument("--cache-dir", default=os.path.join(".build_cache", CACHE_NAMESPACE))
+    parser.add_argument("--verbose", "-v", action="store_true", help="print every test, not only those which did not pass")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+
+    start = time.time()
+    jobs, import_errors = discover(args.modules or local_modules(), args.gateware_only)
+    for module, error in import_errors.items():
+        print(f"cannot import {module}:\n{error}")
+
+    results, cached = run_all(jobs, cache, args.engine, args.jobs, args.force, args.verbose)
+
+    not_passed = [result for result in results if result["status"] not in ("ok", "skipped")]
+    for result in not_passed:
+        print(f"\n{'=' * 70}\n{result['status'].upper()}: {result['id']}\n{'-' * 70}\n{result['output']}")
+
+    skipped = sum(result["status"] == "skipped" for result in results)
+    print(f"\n{len(results)} tests run, {len(cached)} unchanged since they passed, {skipped} skipped, "
+          f"{len(not_passed)} not passed, {time.time() - start:.1f}s")
+    exit(1 if not_passed or import_errors else 0)
@@ -14,18 +14,33 @@ from usb_protocol.emitters.descriptors        import midi1
 class USBDescriptors():
     MAX_PACKET_SIZE_MIDI = 64
     CLOCK_ID             = 1
+    # IDs 2-5 are used by the terminals
+    CLOCK_SELECTOR_ID    = 6
+    # one external clock source per ADAT input
+    EXTERNAL_CLOCK_IDS   = [7, 8, 9, 10]
 
-    def __init__(self, *, ila_max_packet_size: int, use_ila=False) -> None:
+    def __init__(self, *, ila_max_packet_size: int, use_ila=False, use_clock_selector=False, samplerates=(48000,),
+                 use_din_midi=False) -> None:
 
         # ILA
         self.USE_ILA             = use_ila
         self.ILA_MAX_PACKET_SIZE = ila_max_packet_size
 
+        # clock selector between the internal clock and the ADAT inputs
+        self.USE_CLOCK_SELECTOR  = use_clock_selector
+
+        # the sample rates USB1 can switch between, USB2 follows USB1
+        self.SAMPLERATES         = sorted(samplerates)
+
+        # a second MIDI cable on USB1 for the DIN MIDI port
+        self.USE_DIN_MIDI        = use_din_midi
+
 
     def create_usb1_descriptors(self, no_channels: int, max_packet_size: int):
         """ Creates the descriptors for the main USB interface """
 
-        return self.create_descriptors("ADATface (USB1)", no_channels, max_packet_size, self.USE_ILA)
+        return self.create_descriptors("ADATface (USB1)", no_channels, max_packet_size, self.USE_ILA, self.USE_CLOCK_SELECTOR,
+                                       samplerate_programmable=len(self.SAMPLERATES) > 1, din_midi_cable=self.USE_DIN_MIDI)
 
 
     def create_usb2_descriptors(self, no_channels: int, max_packet_size: int):
@@ -33,7 +48,8 @@ class USBDescriptors():
         return self.create_descriptors("ADATface (USB2)", no_channels, max_packet_size)
 
 
-    def create_descriptors(self, product_id: str, no_channels: int, max_packet_size: int, create_ila=False):
+    def create_descriptors(self, product_id: str, no_channels: int, max_packet_size: int, create_ila=False, create_clock_selector=False,
+                           samplerate_programmable=False, din_midi_cable=False):
         """ Creates the descriptors for the main USB interface """
 
         descriptors = DeviceDescriptorCollection()
@@ -64,14 +80,14 @@ class USBDescriptors():
             configDescr.add_subordinate_descriptor(interfaceDescriptor)
 
             # AudioControl Interface Descriptor
-            audioControlInterface = self.create_audio_control_interface_descriptor(no_channels)
+            audioControlInterface = self.create_audio_control_interface_descriptor(no_channels, create_clock_selector, samplerate_programmable)
             configDescr.add_subordinate_descriptor(audioControlInterface)
 
             self.create_output_channels_descriptor(configDescr, no_channels, max_packet_size)
 
             self.create_input_channels_descriptor(configDescr, no_channels, max_packet_size)
 
-            midi_interface, midi_streaming_interface = self.create_midi_interface_descriptor()
+            midi_interface, midi_streaming_interface = self.create_midi_interface_descriptor(din_midi_cable)
             configDescr.add_subordinate_descriptor(midi_interface)
             configDescr.add_subordinate_descriptor(midi_streaming_interface)
 
@@ -86,16 +102,26 @@ class USBDescriptors():
         return descriptors
 
 
-    def create_audio_control_interface_descriptor(self, number_of_channels):
+    def create_audio_control_interface_descriptor(self, number_of_channels, create_clock_selector=False, samplerate_programmable=False):
         audioControlInterface = uac2.ClassSpecificAudioControlInterfaceDescriptorEmitter()
 
         # AudioControl Interface Descriptor (ClockSource)
+        # the host only sends SET CUR for the sample rate if the clock is programmable
         clockSource = uac2.ClockSourceDescriptorEmitter()
         clockSource.bClockID     = self.CLOCK_ID
-        clockSource.bmAttributes = uac2.ClockAttributes.INTERNAL_FIXED_CLOCK
-        clockSource.bmControls   = uac2.ClockFrequencyControl.HOST_READ_ONLY
+        if samplerate_programmable:
+            clockSource.bmAttributes = uac2.ClockAttributes.INTERNAL_PROGRAMMABLE_CLOCK
+            clockSource.bmControls   = uac2.ClockFrequencyControl.HOST_PROGRAMMABLE
+        else:
+            clockSource.bmAttributes = uac2.ClockAttributes.INTERNAL_FIXED_CLOCK
+            clockSource.bmControls   = uac2.ClockFrequencyControl.HOST_READ_ONLY
         audioControlInterface.add_subordinate_descriptor(clockSource)
 
+        clock_source_id = self.CLOCK_ID
+        if create_clock_selector:
+            self.create_clock_selector_descriptors(audioControlInterface)
+            clock_source_id = self.CLOCK_SELECTOR_ID
+
         # streaming input port from the host to the USB interface
         inputTerminal               = uac2.InputTerminalDescriptorEmitter()
         inputTerminal.bTerminalID   = 2
@@ -105,7 +131,7 @@ class USBDescriptors():
         # setting with the full channel count, which also references
         # this terminal ID
         inputTerminal.bNrChannels   = 2
-        inputTerminal.bCSourceID    = 1
+        inputTerminal.bCSourceID    = clock_source_id
         audioControlInterface.add_subordinate_descriptor(inputTerminal)
 
         # audio output port from the USB interface to the outside world
@@ -113,7 +139,7 @@ class USBDescriptors():
         outputTerminal.bTerminalID   = 3
         outputTerminal.wTerminalType = uac2.OutputTerminalTypes.SPEAKER
         outputTerminal.bSourceID     = 2
-        outputTerminal.bCSourceID    = 1
+        outputTerminal.bCSourceID    = clock_source_id
         audioControlInterface.add_subordinate_descriptor(outputTerminal)
 
         # audio input port from the outside world to the USB interface
@@ -121,7 +147,7 @@ class USBDescriptors():
         inputTerminal.bTerminalID   = 4
         inputTerminal.wTerminalType = uac2.InputTerminalTypes.MICROPHONE
         inputTerminal.bNrChannels   = number_of_channels
-        inputTerminal.bCSourceID    = 1
+        inputTerminal.bCSourceID    = clock_source_id
         audioControlInterface.add_subordinate_descriptor(inputTerminal)
 
         # audio output port from the USB interface to the host
@@ -129,12 +155,37 @@ class USBDescriptors():
         outputTerminal.bTerminalID   = 5
         outputTerminal.wTerminalType = uac2.USBTerminalTypes.USB_STREAMING
         outputTerminal.bSourceID     = 4
-        outputTerminal.bCSourceID    = 1
+        outputTerminal.bCSourceID    = clock_source_id
         audioControlInterface.add_subordinate_descriptor(outputTerminal)
 
         return audioControlInterface
 
 
+    def create_clock_selector_descriptors(self, audioControlInterface):
+        """ adds a clock source per ADAT input and a clock selector to choose between them and the internal clock """
+        for clock_id in self.EXTERNAL_CLOCK_IDS:
+            externalClock = uac2.ClockSourceDescriptorEmitter()
+            externalClock.bClockID     = clock_id
+            externalClock.bmAttributes = uac2.ClockAttributes.EXTERNAL_CLOCK
+            # frequency and clock validity are both read only
+            externalClock.bmControls   = uac2.ClockFrequencyControl.HOST_READ_ONLY | (0b01 << 2)
+            audioControlInterface.add_subordinate_descriptor(externalClock)
+
+        # usb_protocol has no emitter for the clock selector, so we build it by hand
+        input_pins = [self.CLOCK_ID] + self.EXTERNAL_CLOCK_IDS
+        clockSelector = bytes([
+            7 + len(input_pins), # bLength
+            0x24,                # bDescriptorType: CS_INTERFACE
+            0x0B,                # bDescriptorSubtype: CLOCK_SELECTOR
+            self.CLOCK_SELECTOR_ID,
+            len(input_pins),     # bNrInPins
+            *input_pins,         # baCSourceID
+            0b11,                # bmControls: clock selector control is host programmable
+            0,                   # iClockSelector
+        ])
+        audioControlInterface.add_subordinate_descriptor(clockSelector)
+
+
     def create_output_streaming_interface(self, c, *, no_channels: int, alt_setting_nr: int, max_packet_size):
         # Interface Descriptor (Streaming, OUT, active setting)
         activeAudioStreamingInterface                   = uac2.AudioStreamingInterfaceDescriptorEmitter()
@@ -252,7 +303,8 @@ class USBDescriptors():
             self.create_input_streaming_interface(c, no_channels=no_channels, alt_setting_nr=2, channel_config=0x0, max_packet_size=max_packet_size)
 
 
-    def create_midi_interface_descriptor(self):
+    def create_midi_interface_descriptor(self, din_midi_cable=False):
+        """ cable 0 is the MIDI loop to the other USB port, the optional cable 1 the DIN MIDI port """
         midi_interface = midi1.StandardMidiStreamingInterfaceDescriptorEmitter()
         midi_interface.bInterfaceNumber = 3
         midi_interface.bNumEndpoints    = 2
@@ -281,6 +333,29 @@ class USBDescriptors():
         outFromDeviceJack.add_source(3)
         midi_streaming_interface.add_subordinate_descriptor(outFromDeviceJack)
 
+        if din_midi_cable:
+            dinOutToHostJack = midi1.MidiOutJackDescriptorEmitter()
+            dinOutToHostJack.bJackID = 5
+            dinOutToHostJack.bJackType = midi1.MidiStreamingJackTypes.EMBEDDED
+            dinOutToHostJack.add_source(6)
+            midi_streaming_interface.add_subordinate_descriptor(dinOutToHostJack)
+
+            dinInJack = midi1.MidiInJackDescriptorEmitter()
+            dinInJack.bJackID = 6
+            dinInJack.bJackType = midi1.MidiStreamingJackTypes.EXTERNAL
+            midi_streaming_interface.add_subordinate_descriptor(dinInJack)
+
+            dinInFromHostJack = midi1.MidiInJackDescriptorEmitter()
+            dinInFromHostJack.bJackID = 7
+            dinInFromHostJack.bJackType = midi1.MidiStreamingJackTypes.EMBEDDED
+            midi_streaming_interface.add_subordinate_descriptor(dinInFromHostJack)
+
+            dinOutJack = midi1.MidiOutJackDescriptorEmitter()
+            dinOutJack.bJackID = 8
+            dinOutJack.bJackType = midi1.MidiStreamingJackTypes.EXTERNAL
+            dinOutJack.add_source(7)
+            midi_streaming_interface.add_subordinate_descriptor(dinOutJack)
+
         outEndpoint = midi1.StandardMidiStreamingBulkDataEndpointDescriptorEmitter()
         outEndpoint.bEndpointAddress = USBDirection.OUT.to_endpoint_address(3)
         outEndpoint.wMaxPacketSize = self.MAX_PACKET_SIZE_MIDI
@@ -288,6 +363,8 @@ class USBDescriptors():
 
         outMidiEndpoint = midi1.ClassSpecificMidiStreamingBulkDataEndpointDescriptorEmitter()
         outMidiEndpoint.add_associated_jack(3)
+        if din_midi_cable:
+            outMidiEndpoint.add_associated_jack(7)
         midi_streaming_interface.add_subordinate_descriptor(outMidiEndpoint)
 
         inEndpoint = midi1.StandardMidiStreamingBulkDataEndpointDescriptorEmitter()
@@ -297,6 +374,8 @@ class USBDescriptors():
 
         inMidiEndpoint = midi1.ClassSpecificMidiStreamingBulkDataEndpointDescriptorEmitter()
         inMidiEndpoint.add_associated_jack(1)
+        if din_midi_cable:
+            inMidiEndpoint.add_associated_jack(5)
         midi_streaming_interface.add_subordinate_descriptor(inMidiEndpoint)
 
         return (midi_interface, midi_streaming_interface)
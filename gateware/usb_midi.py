@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    USB-MIDI event packets, see the USB MIDI 1.0 specification, chapter 4
+
+    Every MIDI message travels over USB as a four byte event packet: the cable number
+    and the code index number (CIN) in the first byte, then up to three MIDI bytes.
+    Within the gateware, an event is a 32 bit payload with these four bytes in USB
+    order, the first byte in bits 0 to 7.
+"""
+from amaranth         import *
+from amaranth.build   import Platform
+from amaranth.sim     import Settle
+from amlib.stream     import StreamInterface
+from amlib.test       import GatewareTestCase, sync_test_case
+
+EVENT_BYTES = 4
+
+# code index number -> MIDI bytes in the event
+CIN_LENGTHS = [0, 0, 2, 3, 3, 1, 2, 3, 3, 3, 3, 3, 2, 2, 3, 1]
+
+CIN_SYSTEM_COMMON_2   = 0x2
+CIN_SYSTEM_COMMON_3   = 0x3
+CIN_SYSEX_CONTINUE    = 0x4
+CIN_SYSEX_END_1       = 0x5
+CIN_SYSEX_END_2       = 0x6
+CIN_SYSEX_END_3       = 0x7
+CIN_SINGLE_BYTE       = 0xf
+
+def event(cable: int, cin: int, *midi_bytes) -> int:
+    """ an event packet as the 32 bit payload the gateware uses """
+    data = [(cable << 4) | cin] + list(midi_bytes) + [0] * (3 - len(midi_bytes))
+    return int.from_bytes(bytes(data), "little")
+
+def event_midi_bytes(value: int) -> list:
+    """ the MIDI bytes of an event packet """
+    data = value.to_bytes(EVENT_BYTES, "little")
+    return list(data[1:1 + CIN_LENGTHS[data[0] & 0xf]])
+
+def midi_to_events(data: bytes, cable: int=0) -> list:
+    """ reference model of MIDIEventPacketizer """
+    events    = []
+    status    = 0
+    pending   = []
+    sysex     = None
+    for byte in data:
+        if byte >= 0xf8:
+            events.append(event(cable, CIN_SINGLE_BYTE, byte))
+        elif byte == 0xf7:
+            if sysex is not None:
+                events.append(event(cable, CIN_SYSEX_END_1 + len(sysex), *sysex, byte))
+                sysex = None
+        elif byte == 0xf0:
+            sysex, status = [byte], 0
+        elif byte & 0x80:
+            sysex, pending = None, []
+            status = byte if byte != 0xf6 and byte not in (0xf4, 0xf5) else 0
+            if byte == 0xf6:
+                events.append(event(cable, CIN_SYSEX_END_1, byte))
+        elif sysex is not None:
+            sysex.append(byte)
+            if len(sysex) == 3:
+                events.append(event(cable, CIN_SYSEX_CONTINUE, *sysex))
+                sysex = []
+        elif status:
+            pending.append(byte)
+            if len(pending) == midi_data_length(status):
+                if status < 0xf0:
+                    events.append(event(cable, status >> 4, status, *pending))
+                else:
+                    events.append(event(cable, CIN_SYSTEM_COMMON_2 + len(pending) - 1, status, *pending))
+                    status = 0
+                pending = []
+    return events
+
+def midi_data_length(status: int) -> int:
+    if status in (0xf1, 0xf3) or 0xc0 <= status < 0xe0:
+        return 1
+    return 2
+
+
+class MIDIEventPacketizer(Elaboratable):
+    """ assembles the bytes from a MIDI input into event packets
+
+        Handles running status, realtime messages between the bytes of other messages
+        and system exclusive messages, which go out three bytes per event as they arrive.
+        A data byte without a status is dropped. A byte takes one cycle and an event is
+        out in the cycle after its last byte. As the bytes come from a UART, there is
+        no backpressure: event_out is valid for a single cycle.
+    """
+    def __init__(self, cable: int=0):
+        self._cable = cable
+
+        # I/O
+        self.data_in   = Signal(8)
+        self.valid_in  = Signal()
+        self.event_out = Signal(32)
+        self.valid_out = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        byte      = self.data_in
+        status    = Signal(8)
+        data1     = Signal(8)
+        have_data = Signal()
+        in_sysex  = Signal()
+        sysex     = Array(Signal(8, name=f"sysex{i}") for i in range(2))
+        sysex_count = Signal(range(3))
+
+        one_data_byte = Signal()
+        cin           = Signal(4)
+
+        def emit(cin, *midi_bytes):
+            midi_bytes = list(midi_bytes) + [C(0, 8)] * (3 - len(midi_bytes))
+            return [
+                self.event_out.eq(Cat(C(cin, 4) if isinstance(cin, int) else cin, C(self._cable, 4), *midi_bytes)),
+                self.valid_out.eq(1),
+            ]
+
+        m.d.comb += [
+            one_data_byte.eq((status == 0xf1) | (status == 0xf3) | ((status >= 0xc0) & (status < 0xe0))),
+            # channel messages have their status as CIN, system common messages 2 or 3 by their length
+            cin.eq(Mux(status[4:] == 0xf, Mux(one_data_byte, CIN_SYSTEM_COMMON_2, CIN_SYSTEM_COMMON_3), status[4:])),
+        ]
+        m.d.sync += self.valid_out.eq(0)
+
+        with m.If(self.valid_in):
+            with m.If(byte >= 0xf8):
+                # realtime messages do not change any state
+                m.d.sync += emit(CIN_SINGLE_BYTE, byte)
+
+            with m.Elif(byte == 0xf7):
+                with m.If(in_sysex):
+                    with m.Switch(sysex_count):
+                        with m.Case(0):
+                            m.d.sync += emit(CIN_SYSEX_END_1, byte)
+                        with m.Case(1):
+                            m.d.sync += emit(CIN_SYSEX_END_2, sysex[0], byte)
+                        with m.Case(2):
+                            m.d.sync += emit(CIN_SYSEX_END_3, sysex[0], sysex[1], byte)
+                m.d.sync += in_sysex.eq(0)
+
+            with m.Elif(byte == 0xf0):
+                m.d.sync += [
+                    in_sysex.eq(1),
+                    sysex[0].eq(byte),
+                    sysex_count.eq(1),
+                    status.eq(0),
+                ]
+
+            with m.Elif(byte[7]):
+                m.d.sync += [
+                    in_sysex.eq(0),
+                    have_data.eq(0),
+                    status.eq(byte),
+                ]
+                with m.If(byte == 0xf6):
+                    m.d.sync += [
+                        emit(CIN_SYSEX_END_1, byte),
+                        status.eq(0),
+                    ]
+                with m.Elif((byte == 0xf4) | (byte == 0xf5)):
+                    m.d.sync += status.eq(0)
+
+            with m.Elif(in_sysex):
+                with m.If(sysex_count == 2):
+                    m.d.sync += [
+                        emit(CIN_SYSEX_CONTINUE, sysex[0], sysex[1], byte),
+                        sysex_count.eq(0),
+                    ]
+                with m.Else():
+                    m.d.sync += [
+                        sysex[sysex_count].eq(byte),
+                        sysex_count.eq(sysex_count + 1),
+                    ]
+
+            with m.Elif(status != 0):
+                with m.If(one_data_byte):
+                    m.d.sync += emit(cin, status, byte)
+                with m.Elif(have_data):
+                    m.d.sync += [
+                        emit(cin, status, data1, byte),
+                        have_data.eq(0),
+                    ]
+                with m.Else():
+                    m.d.sync += [
+                        data1.eq(byte),
+                        have_data.eq(1),
+                    ]
+
+                # only channel messages have a running status
+                with m.If(status[4:] == 0xf):
+                    with m.If(one_data_byte | have_data):
+                        m.d.sync += status.eq(0)
+
+        return m
+
+
+class MIDIEventDepacketizer(Elaboratable):
+    """ sends the MIDI bytes of event packets, for a MIDI output
+
+        Omits the status byte of channel messages which repeat the one sent
+        before (running status), which saves a third of the time of dense
+        controller streams on a 31250 baud line.
+    """
+    def __init__(self):
+        # I/O
+        self.event_in  = StreamInterface(name="event_in", payload_width=32)
+        self.data_out  = StreamInterface(name="midi_out", payload_width=8)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        event_in    = self.event_in
+        data_out    = self.data_out
+
+        cin         = Signal(4)
+        status      = Signal(8)
+        length      = Signal(range(4))
+        position    = Signal(range(4))
+        last_status = Signal(8)
+        lengths     = Array(C(n, 2) for n in CIN_LENGTHS)
+        running     = Signal()
+
+        midi_bytes  = Array(event_in.payload.word_select(i, 8) for i in range(1, EVENT_BYTES))
+
+        m.d.comb += [
+            cin.eq(event_in.payload[0:4]),
+            status.eq(event_in.payload[8:16]),
+            length.eq(lengths[cin]),
+            # a channel message with the same status as the one before
+            running.eq((cin >= 0x8) & (cin <= 0xe) & (status == last_status)),
+            data_out.payload.eq(midi_bytes[position]),
+        ]
+
+        with m.If(event_in.valid & (position == 0) & running):
+            # skip the status byte
+            m.d.comb += data_out.valid.eq(0)
+            m.d.sync += position.eq(1)
+        with m.Elif(event_in.valid & (position < length)):
+            m.d.comb += data_out.valid.eq(1)
+            with m.If(data_out.ready):
+                m.d.sync += position.eq(position + 1)
+                with m.If(position + 1 == length):
+                    m.d.comb += event_in.ready.eq(1)
+                    m.d.sync += position.eq(0)
+        with m.Elif(event_in.valid):
+            # events without MIDI bytes
+            m.d.comb += event_in.ready.eq(1)
+            m.d.sync += position.eq(0)
+
+        with m.If(event_in.valid & event_in.ready & (length != 0)):
+            with m.If((cin >= 0x8) & (cin <= 0xe)):
+                m.d.sync += last_status.eq(status)
+            with m.Elif(cin != CIN_SINGLE_BYTE):
+                # system common and exclusive messages end the running status
+                m.d.sync += last_status.eq(0)
+
+        return m
+
+
+class MIDIEventDeserializer(Elaboratable):
+    """ collects the bytes of a USB MIDI endpoint stream into event packets
+
+        USB packets always carry whole events, so the byte position restarts with
+        the first byte of each packet, which keeps a short packet from misaligning
+        the ones after it.
+    """
+    def __init__(self):
+        # I/O
+        self.usb_stream_in = StreamInterface(name="usb_midi_in", payload_width=8)
+        self.event_out     = StreamInterface(name="event_out", payload_width=32)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        usb_stream_in = self.usb_stream_in
+        event_out     = self.event_out
+
+        position = Signal(range(EVENT_BYTES))
+        data     = Signal(24)
+        index    = Signal(range(EVENT_BYTES))
+
+        m.d.comb += [
+            index.eq(Mux(usb_stream_in.first, 0, position)),
+            usb_stream_in.ready.eq(~event_out.valid | event_out.ready),
+        ]
+
+        with m.If(event_out.ready):
+            m.d.sync += event_out.valid.eq(0)
+
+        with m.If(usb_stream_in.valid & usb_stream_in.ready):
+            m.d.sync += position.eq(index + 1)
+            with m.Switch(index):
+                for i in range(EVENT_BYTES - 1):
+                    with m.Case(i):
+                        m.d.sync += data.word_select(i, 8).eq(usb_stream_in.payload)
+                with m.Case(EVENT_BYTES - 1):
+                    m.d.sync += [
+                        event_out.payload.eq(Cat(data, usb_stream_in.payload)),
+                        event_out.valid.eq(1),
+                        position.eq(0),
+                    ]
+
+        return m
+
+
+class MIDIEventSerializer(Elaboratable):
+    """ sends event packets as the bytes of a USB MIDI endpoint stream
+
+        Events which are already waiting when an event has been sent go into the same
+        USB packet, up to max_packet_size, so a busy port fills its packets. When no
+        event is waiting, the packet ends right away and goes out with the next IN token.
+    """
+    def __init__(self, max_packet_size: int=64):
+        self._events_per_packet = max_packet_size // EVENT_BYTES
+
+        # I/O
+        self.event_in       = StreamInterface(name="event_in", payload_width=32)
+        self.usb_stream_out = StreamInterface(name="usb_midi_out", payload_width=8)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        event_in       = self.event_in
+        usb_stream_out = self.usb_stream_out
+
+        event       = Signal(32)
+        have_event  = Signal()
+        position    = Signal(range(EVENT_BYTES))
+        count       = Signal(range(self._events_per_packet))
+        last_byte   = Signal()
+        packet_full = Signal()
+
+        m.d.comb += [
+            last_byte.eq(position == EVENT_BYTES - 1),
+            packet_full.eq(count == self._events_per_packet - 1),
+
+            usb_stream_out.valid.eq(have_event),
+            usb_stream_out.payload.eq(event.word_select(position, 8)),
+            usb_stream_out.first.eq((position == 0) & (count == 0)),
+            usb_stream_out.last.eq(last_byte & (packet_full | ~event_in.valid)),
+
+            # the next event is taken with the last byte of the current one
+            event_in.ready.eq(~have_event | (usb_stream_out.ready & last_byte)),
+        ]
+
+        with m.If(usb_stream_out.valid & usb_stream_out.ready):
+            m.d.sync += position.eq(position + 1)
+            with m.If(last_byte):
+                m.d.sync += [
+                    have_event.eq(0),
+                    count.eq(Mux(usb_stream_out.last, 0, count + 1)),
+                ]
+
+        with m.If(event_in.valid & event_in.ready):
+            m.d.sync += [
+                event.eq(event_in.payload),
+                have_event.eq(1),
+            ]
+
+        return m
+
+
+
+class MIDIEventPacketizerTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = MIDIEventPacketizer
+    FRAGMENT_ARGUMENTS  = dict(cable=1)
+
+    def send(self, data):
+        events = []
+        for byte in data:
+            yield self.dut.data_in.eq(byte)
+            yield self.dut.valid_in.eq(1)
+            yield
+            yield self.dut.valid_in.eq(0)
+            yield Settle()
+            if (yield self.dut.valid_out):
+                events.append((yield self.dut.event_out))
+            # a UART has at least a few cycles between bytes
+            yield
+            yield Settle()
+            self.assertFalse((yield self.dut.valid_out))
+        return events
+
+    @sync_test_case
+    def test_running_status(self):
+        data = [0x90, 0x3c, 0x7f, 0x3e, 0x7f, 0xb0, 0x07, 0x64, 0x0a, 0x40, 0xc2, 0x05, 0x06]
+        events = yield from self.send(data)
+        self.assertEqual(events, midi_to_events(data, cable=1))
+        self.assertEqual(events[1], event(1, 0x9, 0x90, 0x3e, 0x7f))
+        self.assertEqual(events[-1], event(1, 0xc, 0xc2, 0x06))
+
+    @sync_test_case
+    def test_realtime_within_message(self):
+        data = [0x90, 0x3c, 0xf8, 0x7f, 0x3e, 0xfe, 0x7f]
+        events = yield from self.send(data)
+        self.assertEqual(events, [event(1, 0xf, 0xf8), event(1, 0x9, 0x90, 0x3c, 0x7f),
+                                  event(1, 0xf, 0xfe), event(1, 0x9, 0x90, 0x3e, 0x7f)])
+
+    @sync_test_case
+    def test_system_common_ends_running_status(self):
+        data = [0x80, 0x3c, 0x00, 0xf2, 0x10, 0x20, 0x3c, 0x00, 0xf1, 0x35, 0xf6, 0x90, 0x3c, 0x7f]
+        events = yield from self.send(data)
+        self.assertEqual(events, midi_to_events(data, cable=1))
+        self.assertEqual(events[1:3], [event(1, 0x3, 0xf2, 0x10, 0x20), event(1, 0x2, 0xf1, 0x35)])
+
+    @sync_test_case
+    def test_sysex(self):
+        for length in range(0, 7):
+            data = [0xf0] + list(range(1, length + 1)) + [0xf7]
+            events = yield from self.send(data)
+            self.assertEqual(events, midi_to_events(data, cable=1), f"{length} data bytes")
+            self.assertEqual(sum(len(event_midi_bytes(value)) for value in events), length + 2)
+
+
+class MIDIEventDepacketizerTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = MIDIEventDepacketizer
+    FRAGMENT_ARGUMENTS  = dict()
+
+    @sync_test_case
+    def test_running_status(self):
+        dut    = self.dut
+        events = midi_to_events([0x90, 0x3c, 0x7f, 0x3e, 0x7f, 0xf8, 0x40, 0x7f, 0xf0, 0x01, 0xf7, 0x90, 0x3c, 0x00])
+        sent   = []
+        yield dut.data_out.ready.eq(1)
+        for value in events:
+            yield dut.event_in.payload.eq(value)
+            yield dut.event_in.valid.eq(1)
+            for _ in range(8):
+                yield Settle()
+                if (yield dut.data_out.valid):
+                    sent.append((yield dut.data_out.payload))
+                ready = (yield dut.event_in.ready)
+                yield
+                if ready:
+                    break
+            else:
+                self.fail(f"event {value:#010x} was not taken")
+            yield dut.event_in.valid.eq(0)
+
+        self.assertEqual(sent, [0x90, 0x3c, 0x7f, 0x3e, 0x7f, 0xf8, 0x40, 0x7f, 0xf0, 0x01, 0xf7, 0x90, 0x3c, 0x00])
+
+
+class MIDIEventSerializationTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = MIDIEventDeserializer
+    FRAGMENT_ARGUMENTS  = dict()
+
+    @sync_test_case
+    def test_deserialize(self):
+        dut = self.dut
+        # the second packet is cut short, the third starts aligned again
+        packets = [[0x09, 0x90, 0x3c, 0x7f, 0x08, 0x80, 0x3c, 0x00], [0x0b, 0xb0], [0x0f, 0xf8, 0x00, 0x00]]
+        events  = []
+        yield dut.event_out.ready.eq(1)
+        for packet in packets:
+            for pos, byte in enumerate(packet):
+                yield dut.usb_stream_in.payload.eq(byte)
+                yield dut.usb_stream_in.first.eq(pos == 0)
+                yield dut.usb_stream_in.last.eq(pos == len(packet) - 1)
+                yield dut.usb_stream_in.valid.eq(1)
+                yield
+                yield Settle()
+                if (yield dut.event_out.valid):
+                    events.append((yield dut.event_out.payload))
+        yield dut.usb_stream_in.valid.eq(0)
+        self.assertEqual(events, [event(0, 0x9, 0x90, 0x3c, 0x7f), event(0, 0x8, 0x80, 0x3c, 0x00), event(0, 0xf, 0xf8)])
+
+
+class MIDIEventSerializerTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = MIDIEventSerializer
+    FRAGMENT_ARGUMENTS  = dict(max_packet_size=16)
+
+    def send(self, events, gap=0):
+        """ offers the events, the next one gap cycles after the last was taken, and returns the USB packets """
+        dut      = self.dut
+        packets  = []
+        position = 0
+        idle     = 0
+        yield dut.usb_stream_out.ready.eq(1)
+        for _ in range(8 * len(events) + 16):
+            valid = position < len(events) and idle >= gap
+            yield dut.event_in.valid.eq(valid)
+            if valid:
+                yield dut.event_in.payload.eq(events[position])
+            yield Settle()
+            if valid and (yield dut.event_in.ready):
+                position += 1
+                idle = 0
+            else:
+                idle += 1
+            if (yield dut.usb_stream_out.valid):
+                if (yield dut.usb_stream_out.first):
+                    packets.append([])
+                packets[-1].append((yield dut.usb_stream_out.payload))
+                if (yield dut.usb_stream_out.last):
+                    packets[-1] = bytes(packets[-1])
+            yield
+        yield dut.event_in.valid.eq(0)
+        return packets
+
+    @sync_test_case
+    def test_coalesce_when_busy(self):
+        events  = midi_to_events([0xb0, 0x07, 0x00] + [0x07, 0x01, 0x07, 0x02] * 5)
+        packets = yield from self.send(events)
+        expected = b"".join(value.to_bytes(EVENT_BYTES, "little") for value in events)
+        self.assertEqual(packets, [expected[i:i + 16] for i in range(0, len(expected), 16)])
+
+    @sync_test_case
+    def test_flush_when_idle(self):
+        events  = midi_to_events([0x90, 0x3c, 0x7f, 0x3e, 0x7f])
+        packets = yield from self.send(events, gap=6)
+        self.assertEqual(packets, [value.to_bytes(EVENT_BYTES, "little") for value in events])
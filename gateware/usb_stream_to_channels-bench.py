@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
+import time
 from usb_stream_to_channels import USBStreamToChannels
-from amaranth.sim import Simulator, Tick
+from amaranth.sim import Tick
+from cxxrtl_sim import create_simulator
 
 if __name__ == "__main__":
     dut = USBStreamToChannels(8)
@@ -41,9 +43,12 @@ if __name__ == "__main__":
         yield from send_one_frame(seamless=True, drop_ready=True)
         for _ in range(5): yield Tick()
 
-    sim = Simulator(dut)
+    # GATEWARE_SIMULATOR=cxxrtl runs this on the compiled simulator
+    sim = create_simulator(dut)
     sim.add_clock(1.0/60e6,)
     sim.add_sync_process(process)
 
+    start = time.time()
     with sim.write_vcd(f'usb_stream_to_channels.vcd'):
-        sim.run()
\ No newline at end of file
+        sim.run()
+    print(f"simulation took {time.time() - start:.2f}s")
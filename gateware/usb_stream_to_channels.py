@@ -36,11 +36,13 @@ class USBStreamToChannels(Elaboratable):
             last_channel.eq(self.no_channels_in - 1),
         ]
 
-        m.d.sync += [
-            self.channel_stream_out.valid.eq(0),
-            self.channel_stream_out.first.eq(0),
-            self.channel_stream_out.last.eq(0),
-        ]
+        # hold the sample until it is taken, usb_stream_in is stalled meanwhile
+        with m.If(out_ready):
+            m.d.sync += [
+                self.channel_stream_out.valid.eq(0),
+                self.channel_stream_out.first.eq(0),
+                self.channel_stream_out.last.eq(0),
+            ]
 
         with m.If(usb_valid & out_ready):
             with m.FSM() as fsm:
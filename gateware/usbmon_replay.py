@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    Replays captured host traffic into a simulation of the USB OUT path
+
+    Reads a capture of the Linux usbmon interface (tcpdump -i usbmonX or Wireshark,
+    pcap or pcapng, optionally gzipped), takes the isochronous OUT packets the host
+    sent to the audio endpoint and plays them, each in the microframe the host sent
+    it in, into USBStreamToChannels, calculate_usb_input_frame_size and the
+    FeedbackController, like system_simulation.py does with its synthetic host.
+
+    The capture is read record by record while the simulation runs, so the length
+    of a capture is only limited by the simulation time. usbmon does not see the SOFs:
+    the packets of consecutive URBs of an endpoint go out in consecutive slots of its
+    interval, but not before the URB was submitted, which places the gaps where the
+    host was late or stopped streaming. Captures with the mmapped link type, the default
+    of current libpcap, have the boundaries of the packets within an URB. With the old
+    link type each URB is replayed as a single packet.
+"""
+import argparse
+import gzip
+import json
+import math
+import struct
+import unittest
+from collections import Counter
+
+from amaranth     import *
+from amaranth.sim import Passive, Settle
+
+from amlib.stream import StreamInterface
+
+from usb_stream_to_channels    import USBStreamToChannels
+from feedback_controller       import FeedbackController
+from adat_usb2_audio_interface import USB2AudioInterface
+from cxxrtl_sim                import create_simulator
+from pll_solver                import USB_CLOCK_FREQUENCY
+
+LINKTYPE_USB_LINUX         = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS  = 0xa1b23c4d
+PCAPNG_SECTION_HEADER   = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_INTERFACE        = 0x00000001
+PCAPNG_SIMPLE_PACKET    = 0x00000003
+PCAPNG_ENHANCED_PACKET  = 0x00000006
+
+TRANSFER_ISOCHRONOUS = 0
+ENDPOINT_IN          = 0x80
+
+# id, type, transfer type, endpoint, device, bus, setup flag, data flag, seconds, microseconds,
+# status, length, captured length, setup packet or (error count, number of iso descriptors)
+USBMON_HEADER        = "QBBBBHbbqiiII8s"
+# interval, start frame, transfer flags, number of iso descriptors
+USBMON_MMAPPED_EXTRA = "iiII"
+# status, offset, length, padding
+USBMON_ISO_DESCRIPTOR = "iIII"
+
+MICROFRAME_CYCLES = int(USB_CLOCK_FREQUENCY // 8000)
+ADAT_TICKS_PER_SAMPLE = 256
+
+def open_capture(filename: str):
+    return gzip.open(filename, "rb") if filename.endswith(".gz") else open(filename, "rb")
+
+def read_exactly(f, length: int) -> bytes:
+    data = f.read(length)
+    if len(data) < length:
+        raise EOFError
+    return data
+
+def capture_records(f):
+    """ yields (link type, byte order, packet data) of every packet in a pcap or pcapng file, one at a time """
+    start = read_exactly(f, 4)
+    if struct.unpack("<I", start)[0] == PCAPNG_SECTION_HEADER:
+        yield from _pcapng_records(f, start)
+        return
+
+    for order in "<>":
+        if struct.unpack(order + "I", start)[0] in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+            break
+    else:
+        raise ValueError("not a pcap or pcapng file")
+
+    _, _, _, _, _, linktype = struct.unpack(order + "HHiIII", read_exactly(f, 20))
+    while True:
+        try:
+            _, _, captured, _ = struct.unpack(order + "IIII", read_exactly(f, 16))
+            yield linktype, order, read_exactly(f, captured)
+        except EOFError:
+            return
+
+def _pcapng_records(f, start: bytes):
+    order      = "<"
+    interfaces = []
+    block_type = struct.unpack("<I", start)[0]
+    while True:
+        raw_length = read_exactly(f, 4)
+        if block_type == PCAPNG_SECTION_HEADER:
+            # every section has its own byte order and interfaces
+            byte_order = read_exactly(f, 4)
+            order      = "<" if struct.unpack("<I", byte_order)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            interfaces = []
+            body       = byte_order + read_exactly(f, struct.unpack(order + "I", raw_length)[0] - 12)
+        else:
+            body = read_exactly(f, struct.unpack(order + "I", raw_length)[0] - 8)
+        # the body ends with the block length again
+        body = body[:-4]
+
+        if block_type == PCAPNG_INTERFACE:
+            interfaces.append(struct.unpack(order + "H", body[:2])[0])
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, _, _, captured, _ = struct.unpack(order + "IIIII", body[:20])
+            yield interfaces[interface], order, body[20:20 + captured]
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            yield interfaces[0], order, body[4:]
+
+        try:
+            block_type = struct.unpack(order + "I", read_exactly(f, 4))[0]
+        except EOFError:
+            return
+
+
+class URB():
+    """ one usbmon event: the submission ('S') or completion ('C') of an URB """
+    def __init__(self, id=0, event="S", transfer_type=TRANSFER_ISOCHRONOUS, endpoint=0, device=0, bus=0,
+                 timestamp=0.0, status=0, length=0, interval=1, start_frame=-1, iso_descriptors=None, data=b""):
+        self.id              = id
+        self.event           = event
+        self.transfer_type   = transfer_type
+        self.endpoint        = endpoint
+        self.device          = device
+        self.bus             = bus
+        self.timestamp       = timestamp
+        self.status          = status
+        self.length          = length
+        self.interval        = interval
+        self.start_frame     = start_frame
+        # (status, offset, length) of each packet, None if the capture does not have them
+        self.iso_descriptors = iso_descriptors
+        self.data            = data
+
+    @property
+    def direction_in(self) -> bool:
+        return bool(self.endpoint & ENDPOINT_IN)
+
+    def packets(self) -> list:
+        """ (status, data) of each isochronous packet; the data is cut short if the capture was """
+        if self.iso_descriptors is None:
+            return [(self.status, self.data)]
+        return [(status, self.data[offset:offset + length]) for status, offset, length in self.iso_descriptors]
+
+    def __repr__(self):
+        return f"URB({self.event} {self.bus}:{self.device} ep {self.endpoint:#04x}, {self.length} bytes)"
+
+
+def parse_urb(linktype: int, order: str, record: bytes) -> URB:
+    header_size = struct.calcsize(USBMON_HEADER)
+    (id, event, transfer_type, endpoint, device, bus, _, _, seconds, microseconds,
+     status, length, captured, _) = struct.unpack(order + USBMON_HEADER, record[:header_size])
+
+    urb = URB(id, chr(event), transfer_type, endpoint, device, bus, seconds + microseconds * 1e-6, status, length)
+    if linktype == LINKTYPE_USB_LINUX:
+        urb.data = record[header_size:header_size + captured]
+        return urb
+
+    if linktype != LINKTYPE_USB_LINUX_MMAPPED:
+        raise ValueError(f"link type {linktype} is not a usbmon capture")
+
+    extra_size = struct.calcsize(USBMON_MMAPPED_EXTRA)
+    urb.interval, urb.start_frame, _, descriptors = \
+        struct.unpack(order + USBMON_MMAPPED_EXTRA, record[header_size:header_size + extra_size])
+    data = record[header_size + extra_size:header_size + extra_size + captured]
+
+    if transfer_type == TRANSFER_ISOCHRONOUS:
+        descriptor_size = struct.calcsize(USBMON_ISO_DESCRIPTOR)
+        urb.iso_descriptors = []
+        for index in range(descriptors):
+            status, offset, length, _ = struct.unpack_from(order + USBMON_ISO_DESCRIPTOR, data, index * descriptor_size)
+            urb.iso_descriptors.append((status, offset, length))
+        data = data[descriptors * descriptor_size:]
+    urb.data = data
+    return urb
+
+def encode_urb(urb: URB, linktype: int=LINKTYPE_USB_LINUX_MMAPPED) -> bytes:
+    """ the usbmon record of an URB, for writing captures with write_capture() """
+    descriptors = b""
+    if linktype == LINKTYPE_USB_LINUX_MMAPPED and urb.iso_descriptors is not None:
+        descriptors = b"".join(struct.pack("<" + USBMON_ISO_DESCRIPTOR, status, offset, length, 0)
+                               for status, offset, length in urb.iso_descriptors)
+    seconds = int(urb.timestamp)
+    record  = struct.pack("<" + USBMON_HEADER, urb.id, ord(urb.event), urb.transfer_type, urb.endpoint,
+                          urb.device, urb.bus, ord("-"), 0 if urb.data else ord("<"), seconds,
+                          round((urb.timestamp - seconds) * 1e6), urb.status, urb.length,
+                          len(descriptors) + len(urb.data),
+                          struct.pack("<ii", 0, len(urb.iso_descriptors or [])))
+    if linktype == LINKTYPE_USB_LINUX_MMAPPED:
+        record += struct.pack("<" + USBMON_MMAPPED_EXTRA, urb.interval, urb.start_frame, 0, len(urb.iso_descriptors or []))
+    return record + descriptors + urb.data
+
+def write_capture(f, urbs, linktype: int=LINKTYPE_USB_LINUX_MMAPPED):
+    f.write(struct.pack("<IHHiIII", PCAP_MAGIC_MICROSECONDS, 2, 4, 0, 0, 0x40000, linktype))
+    for urb in urbs:
+        record  = encode_urb(urb, linktype)
+        seconds = int(urb.timestamp)
+        f.write(struct.pack("<IIII", seconds, round((urb.timestamp - seconds) * 1e6), len(record), len(record)))
+        f.write(record)
+
+def read_urbs(filename: str):
+    with open_capture(filename) as f:
+        for linktype, order, record in capture_records(f):
+            yield parse_urb(linktype, order, record)
+
+
+class CaptureStatistics():
+    """ what the host saw of the device in the capture, to compare the replay with
+
+        The feedback endpoint sends samples per microframe in 16.16 format,
+        or per frame in 10.14 format at full speed.
+    """
+    def __init__(self, out_endpoint: int, in_endpoint: int, feedback_endpoint: int):
+        self.out_endpoint      = out_endpoint
+        self.in_endpoint       = in_endpoint
+        self.feedback_endpoint = feedback_endpoint
+        self.out_sizes         = Counter()
+        self.in_sizes          = Counter()
+        self.errors            = 0
+        self.feedback_count    = 0
+        self.feedback_sum      = 0.0
+        self.feedback_min      = None
+        self.feedback_max      = None
+
+    def observe(self, urb: URB):
+        for status, data in urb.packets():
+            self.errors += status != 0
+            if urb.event == "S" and urb.endpoint == self.out_endpoint:
+                self.out_sizes[len(data)] += 1
+            elif urb.event == "C" and urb.endpoint == self.in_endpoint:
+                self.in_sizes[len(data)] += 1
+            elif urb.event == "C" and urb.endpoint == self.feedback_endpoint and len(data) in (3, 4):
+                value = int.from_bytes(data, "little") / (2**16 if len(data) == 4 else 2**14 * 8)
+                self.feedback_count += 1
+                self.feedback_sum   += value
+                self.feedback_min    = value if self.feedback_min is None else min(self.feedback_min, value)
+                self.feedback_max    = value if self.feedback_max is None else max(self.feedback_max, value)
+
+    def report(self) -> dict:
+        return dict(
+            out_packet_sizes = dict(sorted(self.out_sizes.items())),
+            in_packet_sizes  = dict(sorted(self.in_sizes.items())),
+            packet_errors    = self.errors,
+            feedback         = dict(count=self.feedback_count, min=self.feedback_min, max=self.feedback_max,
+                                    mean=self.feedback_sum / self.feedback_count if self.feedback_count else None),
+        )
+
+
+def out_packets(urbs, out_endpoint: int=0x01, bus: int=None, device: int=None, statistics: CaptureStatistics=None):
+    """ the isochronous OUT URBs to out_endpoint, of the first device which has any unless bus and device are given """
+    for urb in urbs:
+        if (bus is not None and urb.bus != bus) or (device is not None and urb.device != device):
+            continue
+        if urb.event == "S" and urb.endpoint == out_endpoint and urb.transfer_type == TRANSFER_ISOCHRONOUS:
+            bus, device = urb.bus, urb.device
+            if statistics is not None:
+                statistics.observe(urb)
+            yield urb
+        elif bus is not None and statistics is not None:
+            statistics.observe(urb)
+
+def microframes(urbs, interval: int=None, max_idle: int=None):
+    """ yields (microframe, packet data or None) for every microframe from the first OUT packet on
+
+        interval:  microframes between packets, by default as captured or 1
+        max_idle:  longer gaps between packets, like pauses of the stream, are shortened to this
+    """
+    origin    = None
+    next_slot = 0
+    current   = 0
+    # microframes cut out of pauses
+    shift     = 0
+    for urb in urbs:
+        if origin is None:
+            origin = urb.timestamp
+        # the packets cannot go out before the host submitted them
+        submitted = math.ceil(round((urb.timestamp - origin) * 8000, 6)) - shift
+        slot      = max(next_slot, submitted)
+        step      = interval or max(1, urb.interval)
+
+        for _, data in urb.packets():
+            if max_idle is not None and slot - current > max_idle:
+                shift += slot - current - max_idle
+                slot   = current + max_idle
+            while current < slot:
+                yield current, None
+                current += 1
+            yield current, data
+            current += 1
+            slot     = current + step - 1
+        next_slot = slot
+
+
+class ReplayHarness(Elaboratable):
+    """ the parts of the top level the OUT packets and the SOFs of the host go through """
+    def __init__(self, max_no_channels: int=USB2AudioInterface.USB1_NO_CHANNELS,
+                 max_packet_size: int=USB2AudioInterface.USB1_MAX_PACKET_SIZE):
+        top = USB2AudioInterface
+        self.max_no_channels = max_no_channels
+        self.max_packet_size = max_packet_size
+        self.fifo_depth      = max_packet_size // 2
+
+        self.usb_stream_to_channels = USBStreamToChannels(max_no_channels)
+        self.feedback_controller    = FeedbackController(
+            fifo_depth      = self.fifo_depth,
+            target_fill     = int(self.fifo_depth * top.FEEDBACK_TARGET_FILL),
+            kp_shift        = top.FEEDBACK_KP_SHIFT,
+            ki_shift        = top.FEEDBACK_KI_SHIFT,
+            update_interval = top.FEEDBACK_UPDATE_INTERVAL)
+
+        # stands in for the OUT endpoint and the audio IN endpoint
+        self.stream         = StreamInterface()
+        self.bytes_in_frame = Signal(range(max_packet_size))
+        self.no_channels    = self.usb_stream_to_channels.no_channels_in
+
+    def elaborate(self, platform):
+        m = Module()
+        m.domains.usb = ClockDomain("usb")
+
+        m.submodules.usb_stream_to_channels = DomainRenamer("usb")(self.usb_stream_to_channels)
+        m.submodules.feedback_controller    = DomainRenamer("usb")(self.feedback_controller)
+
+        m.d.comb += [
+            self.usb_stream_to_channels.usb_stream_in.stream_eq(self.stream),
+            self.usb_stream_to_channels.channel_stream_out.ready.eq(1),
+        ]
+
+        # the endpoints only need the signals the harness has
+        USB2AudioInterface.calculate_usb_input_frame_size(m, "replay", self, self,
+                                                          self.max_no_channels, self.max_packet_size)
+        return m
+
+
+class USBReplayHost():
+    """ plays the captured packets into the harness, one microframe after the other
+
+        The FIFO to the outputs is modelled: it gets the samples of USBStreamToChannels
+        and the ADAT side takes a sample of each channel every ADAT_TICKS_PER_SAMPLE ticks.
+    """
+    def __init__(self, harness: ReplayHarness, frames, no_channels: int, samplerate: int=48000,
+                 ppm: float=0, cycles_per_microframe: int=MICROFRAME_CYCLES, feedback_log=None):
+        ticks_per_microframe = ADAT_TICKS_PER_SAMPLE * samplerate / 8000
+        assert cycles_per_microframe > ticks_per_microframe, \
+            f"needs more than {ticks_per_microframe} cycles per microframe for the ADAT ticks"
+
+        self._harness       = harness
+        self._frames        = frames
+        self._no_channels   = no_channels
+        self._cycles        = cycles_per_microframe
+        # the device clock runs off by ppm against the host
+        self._ticks_per_cycle = ticks_per_microframe * (1 + ppm * 1e-6) / cycles_per_microframe
+        self._feedback_log  = feedback_log
+
+        self.microframes    = 0
+        self.packets        = 0
+        self.out_bytes      = 0
+        self.out_stalls     = 0
+        self.odd_packets    = 0
+        self.frame_size_errors = 0
+        self.garbage_seen   = 0
+        self.samples        = 0
+        self.channel_errors = 0
+        self.fifo_level     = harness.fifo_depth // 2
+        self.fifo_min       = self.fifo_level
+        self.fifo_max       = self.fifo_level
+        self.overflows      = 0
+        self.underruns      = 0
+        self.feedback       = dict(count=0, min=None, max=None, sum=0.0, last=None)
+        self._next_channel  = 0
+        self._ticks         = 0.0
+        self._tick_count    = 0
+        self._cycle         = 0
+
+    def tick(self):
+        yield
+        self._cycle += 1
+
+    def send_packet(self, data: bytes):
+        stream = self._harness.stream
+        for pos, byte in enumerate(data):
+            yield stream.payload.eq(byte)
+            yield stream.valid.eq(1)
+            yield stream.first.eq(pos == 0)
+            yield stream.last.eq(pos == len(data) - 1)
+            while True:
+                yield Settle()
+                ready = (yield stream.ready)
+                yield from self.tick()
+                if ready:
+                    break
+                self.out_stalls += 1
+        yield stream.valid.eq(0)
+        yield stream.first.eq(0)
+        yield stream.last.eq(0)
+
+    def read_feedback(self):
+        value    = (yield self._harness.feedback_controller.feedback_value_out) / 2**16
+        feedback = self.feedback
+        if value != feedback["last"]:
+            feedback["count"] += 1
+            feedback["sum"]   += value
+            feedback["min"]    = value if feedback["min"] is None else min(feedback["min"], value)
+            feedback["max"]    = value if feedback["max"] is None else max(feedback["max"], value)
+            feedback["last"]   = value
+            if self._feedback_log is not None:
+                self._feedback_log.write(f"{self.microframes},{value},{self.fifo_level}\n")
+
+    def process(self):
+        harness  = self._harness
+        next_sof = 0
+        yield harness.no_channels.eq(self._no_channels)
+
+        for _, data in self._frames:
+            yield harness.feedback_controller.sof_in.eq(1)
+            yield from self.tick()
+            yield harness.feedback_controller.sof_in.eq(0)
+
+            if data is not None:
+                self.packets     += 1
+                self.out_bytes   += len(data)
+                self.odd_packets += len(data) % (4 * self._no_channels) != 0
+                if data:
+                    yield from self.send_packet(data)
+                    yield from self.tick()
+                    # a full size packet does not fit the counter
+                    if len(data) >= harness.max_packet_size or (yield harness.bytes_in_frame) != len(data):
+                        self.frame_size_errors += 1
+
+            yield from self.read_feedback()
+            self.microframes += 1
+
+            # idle for the rest of the microframe
+            next_sof += self._cycles
+            while self._cycle < next_sof:
+                yield from self.tick()
+
+    def device_process(self):
+        """ ADAT ticks, the FIFO model and the checks of the channel stream, every cycle """
+        harness  = self._harness
+        channels = harness.usb_stream_to_channels.channel_stream_out
+        controller = harness.feedback_controller
+        yield Passive()
+        while True:
+            self._ticks += self._ticks_per_cycle
+            tick = self._ticks >= 1
+            if tick:
+                self._ticks -= 1
+            yield controller.adat_tick_in.eq(tick)
+            yield controller.fifo_level_in.eq(max(0, min(self.fifo_level, harness.fifo_depth)))
+
+            yield Settle()
+            self.garbage_seen += (yield harness.usb_stream_to_channels.garbage_seen_out)
+            if (yield channels.valid):
+                channel = (yield channels.channel_nr)
+                if (yield channels.first):
+                    self._next_channel = 0
+                if channel != self._next_channel:
+                    self.channel_errors += 1
+                self._next_channel = (channel + 1) % self._no_channels
+                self.samples += 1
+                self.fifo_level += 1
+                if self.fifo_level > harness.fifo_depth:
+                    self.overflows += 1
+                    self.fifo_level = harness.fifo_depth
+
+            if tick:
+                self._tick_count += 1
+                if self._tick_count % ADAT_TICKS_PER_SAMPLE == 0:
+                    if self.fifo_level < self._no_channels:
+                        self.underruns += 1
+                    self.fifo_level = max(0, self.fifo_level - self._no_channels)
+            self.fifo_min = min(self.fifo_min, self.fifo_level)
+            self.fifo_max = max(self.fifo_max, self.fifo_level)
+            yield
+
+    def report(self) -> dict:
+        feedback = self.feedback
+        return dict(
+            microframes       = self.microframes,
+            packets           = self.packets,
+            out_bytes         = self.out_bytes,
+            out_stalls        = self.out_stalls,
+            odd_packets       = self.odd_packets,
+            frame_size_errors = self.frame_size_errors,
+            garbage_seen      = self.garbage_seen,
+            samples           = self.samples,
+            channel_errors    = self.channel_errors,
+            fifo_level        = dict(min=self.fifo_min, max=self.fifo_max, overflows=self.overflows, underruns=self.underruns),
+            # samples per microframe, as the device would have sent it
+            feedback          = dict(count=feedback["count"], min=feedback["min"], max=feedback["max"],
+                                     mean=feedback["sum"] / feedback["count"] if feedback["count"] else None),
+            errors            = self.frame_size_errors + self.garbage_seen + self.channel_errors,
+        )
+
+
+def run_replay(frames, no_channels: int=USB2AudioInterface.USB1_NO_CHANNELS, samplerate: int=48000, ppm: float=0,
+               cycles_per_microframe: int=MICROFRAME_CYCLES, feedback_log=None, engine: str=None) -> dict:
+    """ simulates the (microframe, packet) pairs of microframes() and returns the report """
+    harness   = ReplayHarness()
+    host      = USBReplayHost(harness, frames, no_channels, samplerate, ppm, cycles_per_microframe, feedback_log)
+    simulator = create_simulator(harness, engine)
+    simulator.add_clock(1 / USB_CLOCK_FREQUENCY, domain="usb")
+    simulator.add_sync_process(host.process, domain="usb")
+    simulator.add_sync_process(host.device_process, domain="usb")
+    simulator.run()
+    return host.report()
+
+def format_report(report: dict, capture: dict=None) -> str:
+    lines = [f"{report['microframes']} microframes, {report['packets']} OUT packets, {report['out_bytes']} bytes, "
+             f"{report['odd_packets']} not a multiple of the sample frame size, {report['out_stalls']} stalls",
+             f"{report['samples']} samples, {report['garbage_seen']} garbage, {report['channel_errors']} channel errors, "
+             f"{report['frame_size_errors']} wrong IN frame sizes",
+             f"FIFO level {report['fifo_level']}",
+             f"feedback {report['feedback']}"]
+    if capture is not None:
+        lines += [f"captured OUT packet sizes {capture['out_packet_sizes']}",
+                  f"captured IN packet sizes {capture['in_packet_sizes']}",
+                  f"captured feedback {capture['feedback']}, {capture['packet_errors']} packets with errors"]
+    return "\n".join(lines)
+
+
+class USBMonReplayTest(unittest.TestCase):
+    def out_urb(self, timestamp, sizes, id=1):
+        data        = bytes(range(256)) * 8
+        descriptors = []
+        offset      = 0
+        for size in sizes:
+            descriptors.append((0, offset, size))
+            offset += size
+        return URB(id, "S", TRANSFER_ISOCHRONOUS, 0x01, 5, 1, timestamp, 0, offset,
+                   iso_descriptors=descriptors, data=data[:offset])
+
+    def write(self, urbs, linktype=LINKTYPE_USB_LINUX_MMAPPED):
+        import io
+        f = io.BytesIO()
+        write_capture(f, urbs, linktype)
+        f.seek(0)
+        return [parse_urb(*record) for record in capture_records(f)]
+
+    def test_roundtrip(self):
+        urbs = self.write([self.out_urb(1.5, [8, 16, 8]),
+                           URB(2, "C", TRANSFER_ISOCHRONOUS, 0x81, 5, 1, 1.6, iso_descriptors=[(0, 0, 4)], data=b"\x00\x00\x06\x00")])
+        self.assertEqual([(urb.event, urb.endpoint) for urb in urbs], [("S", 0x01), ("C", 0x81)])
+        self.assertEqual([len(data) for _, data in urbs[0].packets()], [8, 16, 8])
+        self.assertEqual(urbs[0].packets()[1][1], bytes(range(8, 24)))
+        self.assertAlmostEqual(urbs[1].timestamp, 1.6)
+
+        statistics = CaptureStatistics(0x01, 0x82, 0x81)
+        list(out_packets(urbs, statistics=statistics))
+        self.assertEqual(statistics.report()["out_packet_sizes"], { 8: 2, 16: 1 })
+        self.assertEqual(statistics.report()["feedback"]["mean"], 6.0)
+
+    def test_old_linktype(self):
+        urbs = self.write([self.out_urb(0, [8, 8])], LINKTYPE_USB_LINUX)
+        self.assertEqual([len(data) for _, data in urbs[0].packets()], [16])
+
+    def test_microframes(self):
+        urbs = [self.out_urb(0, [1, 2]), self.out_urb(0.0001, [3]),
+                # the host is late: not before its submission, 8 microframes later
+                self.out_urb(0.001, [4]),
+                # a pause of the stream
+                self.out_urb(1.0, [5])]
+        frames = [(frame, len(data) if data is not None else None) for frame, data in microframes(urbs, max_idle=5)]
+        self.assertEqual(frames, [(0, 1), (1, 2), (2, 3)] + [(frame, None) for frame in range(3, 8)] +
+                                 [(8, 4)] + [(frame, None) for frame in range(9, 14)] + [(14, 5)])
+
+    def test_replay(self):
+        no_channels = 2
+        packet      = bytes([0, 1, 2, 3] * no_channels * 6)
+        frames      = [(0, packet), (1, None), (2, packet), (3, packet[:-4])]
+        report      = run_replay(frames, no_channels, cycles_per_microframe=1600)
+        self.assertEqual(report["microframes"], 4)
+        self.assertEqual(report["samples"], 3 * 6 * no_channels - 1)
+        self.assertEqual(report["frame_size_errors"], 0, format_report(report))
+        self.assertEqual(report["odd_packets"], 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay the isochronous OUT traffic of a usbmon capture into a simulation "
+                                                 "of USBStreamToChannels, the IN frame size and the feedback controller")
+    parser.add_argument("capture", help="pcap or pcapng file of a usbmon interface, may be gzipped")
+    parser.add_argument("--device", help="bus:device of the interface, defaults to the first one with OUT packets to the endpoint")
+    parser.add_argument("--endpoint", type=lambda value: int(value, 0), default=0x01, help="the audio OUT endpoint")
+    parser.add_argument("--in-endpoint", type=lambda value: int(value, 0), default=0x82, help="the audio IN endpoint, for the statistics")
+    parser.add_argument("--feedback-endpoint", type=lambda value: int(value, 0), default=0x81, help="for the statistics")
+    parser.add_argument("--channels", type=int, default=USB2AudioInterface.USB1_NO_CHANNELS,
+                        help="channels of the alternate setting the host streamed with")
+    parser.add_argument("--samplerate", type=int, default=48000)
+    parser.add_argument("--ppm", type=float, default=0, help="clock offset of the ADAT clock against the host")
+    parser.add_argument("--interval", type=int, help="microframes between OUT packets, defaults to the captured interval")
+    parser.add_argument("--max-idle", type=int, help="shorten pauses of the stream to this many microframes")
+    parser.add_argument("--skip", type=int, default=0, help="microframes at the start of the capture to skip")
+    parser.add_argument("--microframes", type=int, help="only simulate this many microframes")
+    parser.add_argument("--cycles-per-microframe", type=int, default=MICROFRAME_CYCLES,
+                        help="fewer than the 7500 of 60MHz make the simulation faster, but the ADAT ticks need more than 1536")
+    parser.add_argument("--engine", choices=["pysim", "cxxrtl"], help="the simulator, see cxxrtl_sim.py")
+    parser.add_argument("--feedback-log", help="write microframe, feedback value and FIFO level of each feedback change to this CSV")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    from itertools import islice
+    bus, device = map(int, args.device.split(":")) if args.device else (None, None)
+    statistics  = CaptureStatistics(args.endpoint, args.in_endpoint, args.feedback_endpoint)
+    packets     = out_packets(read_urbs(args.capture), args.endpoint, bus, device, statistics)
+    frames      = islice(microframes(packets, args.interval, args.max_idle), args.skip,
+                         None if args.microframes is None else args.skip + args.microframes)
+
+    feedback_log = open(args.feedback_log, "w") if args.feedback_log else None
+    try:
+        if feedback_log is not None:
+            feedback_log.write("microframe,feedback,fifo_level\n")
+        report = run_replay(frames, args.channels, args.samplerate, args.ppm, args.cycles_per_microframe,
+                            feedback_log, args.engine)
+    finally:
+        if feedback_log is not None:
+            feedback_log.close()
+
+    report["capture"] = statistics.report()
+    print(format_report(report, report["capture"]))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    exit(1 if report["errors"] else 0)
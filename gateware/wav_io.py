@@ -0,0 +1,333 @@
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+import os
+import struct
+import tempfile
+import unittest
+import wave
+
+import numpy as np
+
+WAVE_FORMAT_PCM        = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+class WavReader():
+    """ reads PCM WAV files in chunks of frames, returning signed integer numpy arrays """
+
+    def __init__(self, filename: str):
+        self._wav        = wave.open(filename, 'rb')
+        self.channels    = self._wav.getnchannels()
+        self.samplerate  = self._wav.getframerate()
+        self.sample_bits = self._wav.getsampwidth() * 8
+        self.frames      = self._wav.getnframes()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._wav.close()
+
+    def read(self, no_frames: int=None):
+        """ reads up to no_frames frames, returns an int32 array of shape (frames, channels) """
+        if no_frames is None:
+            no_frames = self.frames
+
+        data = self._wav.readframes(no_frames)
+        return decode_pcm(data, self._wav.getsampwidth(), self.channels)
+
+    def chunks(self, chunk_frames: int):
+        """ generator which yields the rest of the file in chunks of chunk_frames frames """
+        while True:
+            chunk = self.read(chunk_frames)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+def wav_layout(f) -> tuple:
+    """ (channels, samplerate, bytes per sample, offset and size of the data) of a PCM WAV file
+
+        Also reads WAVE_FORMAT_EXTENSIBLE headers, which the wave module does not,
+        but which most multichannel files have.
+    """
+    riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+    if riff != b"RIFF" or wave_id != b"WAVE":
+        raise ValueError("not a WAV file")
+
+    file_size = os.fstat(f.fileno()).st_size
+    layout    = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError("WAV file without data")
+        chunk_id, size = struct.unpack("<4sI", header)
+
+        if chunk_id == b"fmt ":
+            fmt = f.read(size)
+            tag, channels, samplerate, _, block_align, _ = struct.unpack("<HHIIHH", fmt[:16])
+            if tag == WAVE_FORMAT_EXTENSIBLE:
+                tag = struct.unpack("<H", fmt[24:26])[0]
+            if tag != WAVE_FORMAT_PCM:
+                raise ValueError(f"unsupported WAV format: {tag:#x}, only PCM is supported")
+            layout = (channels, samplerate, block_align // channels)
+            f.seek(size & 1, 1)
+
+        elif chunk_id == b"data":
+            if layout is None:
+                raise ValueError("WAV data before its format")
+            offset = f.tell()
+            # recorders which were interrupted leave the size at 0 or too large
+            if size == 0 or offset + size > file_size:
+                size = file_size - offset
+            return layout + (offset, size)
+
+        else:
+            f.seek(size + (size & 1), 1)
+
+
+class MappedWavReader():
+    """ reads PCM WAV files through a memory map, like WavReader, but without loading more
+        than the frames which are read, so that files of any length can be processed in chunks """
+
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as f:
+            self.channels, self.samplerate, self._sample_bytes, offset, size = wav_layout(f)
+
+        self.sample_bits  = self._sample_bytes * 8
+        self._frame_bytes = self._sample_bytes * self.channels
+        self.frames       = size // self._frame_bytes
+        self._position    = 0
+        self._data        = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset,
+                                      shape=(self.frames * self._frame_bytes,)) if self.frames else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # the map is closed when the last array which refers to it is gone
+        self._data = None
+
+    def frames_at(self, start: int, no_frames: int):
+        """ returns the frames start .. start + no_frames as an int32 array of shape (frames, channels) """
+        start = min(start, self.frames)
+        end   = min(start + no_frames, self.frames)
+        if start == end:
+            return np.zeros((0, self.channels), dtype=np.int32)
+        data = self._data[start * self._frame_bytes:end * self._frame_bytes].tobytes()
+        return decode_pcm(data, self._sample_bytes, self.channels)
+
+    def read(self, no_frames: int=None):
+        """ reads up to no_frames frames from the current position """
+        if no_frames is None:
+            no_frames = self.frames - self._position
+        frames = self.frames_at(self._position, no_frames)
+        self._position += len(frames)
+        return frames
+
+    def chunks(self, chunk_frames: int):
+        """ generator which yields the rest of the file in chunks of chunk_frames frames """
+        while True:
+            chunk = self.read(chunk_frames)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+class WavWriter():
+    """ writes PCM WAV files chunk by chunk, the header gets its final size when the file is closed """
+
+    def __init__(self, filename: str, channels: int, samplerate: int, sample_bits: int=24):
+        self.channels    = channels
+        self.samplerate  = samplerate
+        self.sample_bits = sample_bits
+        self.frames      = 0
+
+        self._wav = wave.open(filename, 'wb')
+        self._wav.setnchannels(channels)
+        self._wav.setsampwidth(sample_bits // 8)
+        self._wav.setframerate(samplerate)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._wav.close()
+
+    def write(self, samples):
+        """ appends integer samples of shape (frames, channels) """
+        samples = np.asarray(samples).reshape(-1, self.channels)
+        self._wav.writeframes(encode_pcm(samples, self.sample_bits // 8))
+        self.frames += len(samples)
+
+
+def decode_pcm(data: bytes, sample_bytes: int, channels: int):
+    """ converts little endian PCM data into an int32 array of shape (frames, channels) """
+    if sample_bytes == 1:
+        # 8 bit WAV data is unsigned
+        samples = np.frombuffer(data, dtype=np.uint8).astype(np.int32) - 128
+    elif sample_bytes == 2:
+        samples = np.frombuffer(data, dtype='<i2').astype(np.int32)
+    elif sample_bytes == 3:
+        raw     = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        # sign extend from 24 bits
+        samples = (samples ^ 0x800000) - 0x800000
+    elif sample_bytes == 4:
+        samples = np.frombuffer(data, dtype='<i4').astype(np.int32)
+    else:
+        raise ValueError(f"unsupported WAV sample width: {sample_bytes} bytes")
+
+    return samples.reshape(-1, channels)
+
+
+def encode_pcm(samples, sample_bytes: int) -> bytes:
+    """ converts an integer array of shape (frames, channels) into little endian PCM data """
+    samples = np.asarray(samples, dtype=np.int64)
+    if sample_bytes == 1:
+        return ((samples + 128) & 0xff).astype(np.uint8).tobytes()
+    if sample_bytes == 2:
+        return samples.astype('<i2').tobytes()
+    if sample_bytes == 3:
+        words = np.ascontiguousarray(samples.astype('<i4')).reshape(-1)
+        return words.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    if sample_bytes == 4:
+        return samples.astype('<i4').tobytes()
+    raise ValueError(f"unsupported WAV sample width: {sample_bytes} bytes")
+
+
+def rescale(samples, from_bits: int, to_bits: int):
+    """ converts integer samples from one bit width to another by shifting """
+    samples = np.asarray(samples, dtype=np.int64)
+    if to_bits >= from_bits:
+        return samples << (to_bits - from_bits)
+    return samples >> (from_bits - to_bits)
+
+
+def load_impulse_response(filename: str, samplerate: int, bitwidth: int, tapcount: int=None):
+    """ loads a stereo impulse response and validates it against sample rate and bit width """
+    with WavReader(filename) as wav:
+        assert wav.channels == 2, f"IR file {filename} needs to be stereo, but has {wav.channels} channels"
+        assert wav.samplerate == samplerate, \
+            f"Unsupported samplerate {wav.samplerate} for IR file. Required samplerate is {samplerate}"
+        taps = rescale(wav.read(tapcount), wav.sample_bits, bitwidth).astype(np.int32)
+
+    for tap in range(len(taps)):
+        for channel in range(2):
+            assert -1 * 2 ** (bitwidth - 1) <= taps[tap, channel] <= 1 * 2 ** (bitwidth - 1) - 1,\
+                f"Tap #{tap} is out of range for bitwidth {bitwidth}: {taps[tap, channel]}"
+
+    return taps
+
+
+def first_sound(reader, channels: list, chunk_frames: int) -> int:
+    """ index of the first frame in which any of the channels is not silent, None if there is none """
+    for start in range(0, reader.frames, chunk_frames):
+        chunk   = reader.frames_at(start, chunk_frames)[:, channels]
+        nonzero = np.flatnonzero(np.any(chunk != 0, axis=1))
+        if len(nonzero):
+            return start + int(nonzero[0])
+    return None
+
+
+def null_test(reference_file: str, output_file: str, reference_channels: list=None, output_channels: list=None,
+              bits: int=24, delay: int=None, chunk_frames: int=1 << 16) -> dict:
+    """ subtracts the reference from the output, chunk by chunk, and reports the residual per channel
+
+        The output is delayed against the reference by the latency of the path,
+        which is found by the first sound in both, unless delay is given.
+        Both files are compared at the given bit width. A residual of None means
+        the output ended before the reference.
+    """
+    with MappedWavReader(reference_file) as reference, MappedWavReader(output_file) as output:
+        reference_channels = list(range(reference.channels)) if reference_channels is None else reference_channels
+        output_channels    = list(range(output.channels))    if output_channels    is None else output_channels
+        assert len(reference_channels) == len(output_channels), "both files need the same number of channels"
+
+        if delay is None:
+            reference_start = first_sound(reference, reference_channels, chunk_frames)
+            output_start    = first_sound(output, output_channels, chunk_frames)
+            delay = 0 if reference_start is None or output_start is None else output_start - reference_start
+
+        maximum = np.zeros(len(reference_channels), dtype=np.int64)
+        squares = np.zeros(len(reference_channels))
+        frames  = 0
+        for start in range(max(0, -delay), reference.frames, chunk_frames):
+            expected = rescale(reference.frames_at(start, chunk_frames)[:, reference_channels], reference.sample_bits, bits)
+            actual   = rescale(output.frames_at(start + delay, len(expected))[:, output_channels], output.sample_bits, bits)
+            if len(actual) < len(expected):
+                expected = expected[:len(actual)]
+            residual = actual - expected
+            maximum  = np.maximum(maximum, np.max(np.abs(residual), axis=0, initial=0))
+            squares += np.sum(residual.astype(np.float64) ** 2, axis=0)
+            frames  += len(residual)
+            if len(residual) < chunk_frames:
+                break
+
+    full_scale = 2 ** (bits - 1)
+    return dict(
+        delay    = delay,
+        frames   = frames,
+        complete = frames >= reference.frames - max(0, -delay),
+        channels = [dict(max_residual = int(maximum[channel]),
+                         # relative to full scale, -inf for a perfect null
+                         residual_db  = 10 * np.log10(squares[channel] / frames / full_scale ** 2) if squares[channel] and frames else -np.inf)
+                    for channel in range(len(reference_channels))],
+    )
+
+
+class WavIOTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write(self, name: str, samples, sample_bits: int=24, samplerate: int=48000) -> str:
+        filename = os.path.join(self.directory, name)
+        with WavWriter(filename, samples.shape[1], samplerate, sample_bits) as wav:
+            # in chunks, like the simulation writes them
+            wav.write(samples[:3])
+            wav.write(samples[3:])
+        return filename
+
+    def test_roundtrip(self):
+        samples = np.array([[0, -1], [0x7fffff, -0x800000], [1, 2], [-3, 4], [5, -6]], dtype=np.int32)
+        for bits in [16, 24, 32]:
+            filename = self.write(f"test{bits}.wav", rescale(samples, 24, bits), bits)
+            with MappedWavReader(filename) as wav:
+                self.assertEqual((wav.channels, wav.samplerate, wav.frames, wav.sample_bits), (2, 48000, 5, bits))
+                chunks = list(wav.chunks(2))
+                self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+                np.testing.assert_array_equal(rescale(np.concatenate(chunks), bits, 24), rescale(rescale(samples, 24, bits), bits, 24))
+            # the same as the wave module reads
+            with WavReader(filename) as wav:
+                np.testing.assert_array_equal(wav.read(), rescale(samples, 24, bits))
+
+    def test_null_test(self):
+        rng       = np.random.default_rng(0)
+        reference = rng.integers(-2**22, 2**22, size=(1000, 3), dtype=np.int32)
+        reference[:10] = 0
+        delayed   = np.concatenate([np.zeros((37, 3), dtype=np.int32), reference])
+        reference_file = self.write("reference.wav", reference)
+
+        result = null_test(reference_file, self.write("delayed.wav", delayed), chunk_frames=64)
+        self.assertEqual((result["delay"], result["frames"], result["complete"]), (37, 1000, True))
+        self.assertTrue(all(channel["max_residual"] == 0 for channel in result["channels"]))
+
+        delayed[500, 1] += 5
+        result = null_test(reference_file, self.write("changed.wav", delayed), reference_channels=[1], output_channels=[1])
+        self.assertEqual(result["channels"][0]["max_residual"], 5)
+
+        result = null_test(reference_file, self.write("short.wav", delayed[:500]))
+        self.assertFalse(result["complete"])
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: CERN-OHL-W-2.0
+"""
+    Plays WAV files through the simulated interface and records its outputs as WAV files
+
+    The system simulation of system_simulation.py, with the USB host models sending
+    the frames of WAV files instead of tagged samples, and optionally the ADAT inputs
+    driven by ADAT transmitters of their own, which send a WAV file, instead of the
+    loopback. Recorded are the samples the ADAT transmitters and the DACs get, and the
+    USB IN streams of both ports, so they can be listened to, or null tested against
+    the sources with wav_io.null_test, with --null-test for the default routing.
+
+    The WAV files are memory mapped and read and written in chunks, so their size
+    does not matter, only the simulation time does.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from amaranth     import *
+from amaranth.sim import Passive, Settle, Simulator
+
+from adat              import ADATTransmitter
+from wav_io            import MappedWavReader, WavWriter, rescale, null_test
+from system_simulation import SystemSimulation, USBHostModel
+
+AUDIO_BITS   = 24
+CHUNK_FRAMES = 4096
+# after the end of the sources, for the samples still underway
+TAIL_MICROFRAMES = 16
+
+def signed(value: int, bits: int=AUDIO_BITS) -> int:
+    sign = 1 << (bits - 1)
+    return (value ^ sign) - sign
+
+
+class WavSource():
+    """ the frames of a WAV file one by one, rescaled to the audio bit width,
+        padded with silent channels and silent after its end """
+    def __init__(self, filename: str, channels: int, samplerate: int, chunk_frames: int=CHUNK_FRAMES):
+        self._reader = MappedWavReader(filename)
+        assert self._reader.samplerate == samplerate, \
+            f"{filename} has a samplerate of {self._reader.samplerate}, but the simulation runs at {samplerate}"
+        assert self._reader.channels <= channels, \
+            f"{filename} has {self._reader.channels} channels, but there are only {channels}"
+
+        self.filename     = filename
+        self.channels     = channels
+        self.frames_read  = 0
+        self._chunks      = self._reader.chunks(chunk_frames)
+        self._chunk       = []
+        self._position    = 0
+        self._padding     = [0] * (channels - self._reader.channels)
+
+    @property
+    def frames(self) -> int:
+        return self._reader.frames
+
+    def next_frame(self) -> list:
+        if self._position >= len(self._chunk):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return [0] * self.channels
+            self._chunk    = rescale(chunk, self._reader.sample_bits, AUDIO_BITS).tolist()
+            self._position = 0
+
+        frame = self._chunk[self._position]
+        self._position   += 1
+        self.frames_read += 1
+        return frame + self._padding
+
+    def close(self):
+        self._reader.close()
+
+
+class WavSink():
+    """ collects frames and appends them to a WAV file a chunk at a time """
+    def __init__(self, filename: str, channels: int, samplerate: int, chunk_frames: int=CHUNK_FRAMES):
+        self.filename      = filename
+        self.channels      = channels
+        self._writer       = WavWriter(filename, channels, samplerate, AUDIO_BITS)
+        self._chunk_frames = chunk_frames
+        self._frames       = []
+
+    @property
+    def frames(self) -> int:
+        return self._writer.frames + len(self._frames)
+
+    def add(self, frame: list):
+        self._frames.append(frame)
+        if len(self._frames) >= self._chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if self._frames:
+            self._writer.write(np.array(self._frames, dtype=np.int32))
+            self._frames = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+class WavHostModel(USBHostModel):
+    """ sends the frames of a WAV source and records the IN frames to a WAV sink """
+    def __init__(self, device, usb_nr: int, no_channels: int, samplerate: int,
+                 source: WavSource=None, sink: WavSink=None, ppm: float=0):
+        super().__init__(device, usb_nr, no_channels, samplerate, expected_tags=[], ppm=ppm)
+        self._source = source
+        self._sink   = sink
+
+    def out_samples(self):
+        frame = self._source.next_frame() if self._source is not None else [0] * self._no_channels
+        data  = []
+        for sample in frame:
+            data += [0, sample & 0xff, (sample >> 8) & 0xff, (sample >> 16) & 0xff]
+        return data
+
+    def receive_frame(self, samples: list):
+        if self._sink is not None:
+            self._sink.add([signed(sample) for sample in samples])
+
+
+class WavSystemSimulation(SystemSimulation):
+    """ with an ADAT input source, the ADAT inputs are driven by ADAT transmitters of their own instead of the loopback """
+    NO_ADAT_PORTS = 4
+
+    def __init__(self, samplerate: int=48000, adat_input: bool=False, **flags):
+        super().__init__(samplerate, **flags)
+        self.adat_sources = [ADATTransmitter(fifo_depth=9*4) for _ in range(self.NO_ADAT_PORTS)] if adat_input else []
+
+    def elaborate(self, platform):
+        if not self.adat_sources:
+            return super().elaborate(platform)
+
+        m = Module()
+        m.submodules.design = Fragment.get(self.design, self.platform)
+
+        for i, transmitter in enumerate(self.adat_sources):
+            setattr(m.submodules, f"adat{i + 1}_source", transmitter)
+            toslink = self.platform.request("toslink", i + 1)
+            m.d.comb += [
+                transmitter.user_data_in.eq(0),
+                toslink.rx.eq(transmitter.adat_out),
+            ]
+
+        return m
+
+
+def send_adat(transmitters: list, source: WavSource):
+    """ a process which sends the frames of the source to the ADAT transmitters, 8 channels each """
+    def process():
+        yield Passive()
+        while True:
+            frame = source.next_frame()
+            for address in range(8):
+                pending = list(range(len(transmitters)))
+                for nr in pending:
+                    transmitter = transmitters[nr]
+                    yield transmitter.sample_in.eq(frame[8 * nr + address] & 0xffffff)
+                    yield transmitter.addr_in.eq(address)
+                    yield transmitter.last_in.eq(address == 7)
+                    yield transmitter.valid_in.eq(1)
+                while pending:
+                    yield Settle()
+                    accepted = []
+                    for nr in pending:
+                        if (yield transmitters[nr].ready_out):
+                            accepted.append(nr)
+                    yield
+                    for nr in accepted:
+                        yield transmitters[nr].valid_in.eq(0)
+                    pending = [nr for nr in pending if nr not in accepted]
+    return process
+
+def record_stream(sink: WavSink, valid, ready, payload, channel_nr, last):
+    """ a process which records each sample handed over by a valid / ready handshake, a frame ends with last """
+    def process():
+        yield Passive()
+        frame = [0] * sink.channels
+        while True:
+            yield Settle()
+            if (yield valid) and (yield ready):
+                frame[(yield channel_nr)] = signed((yield payload))
+                if (yield last):
+                    sink.add(frame)
+                    frame = [0] * sink.channels
+            yield
+    return process
+
+
+def run_wav_simulation(output_directory: str, usb1_out: str=None, usb2_out: str=None, adat_in: str=None,
+                       samplerate: int=48000, seconds: float=None, usb2_ppm: float=0,
+                       chunk_frames: int=CHUNK_FRAMES, **flags) -> dict:
+    """ plays the WAV files through the interface and writes the outputs to output_directory
+
+        usb1_out, usb2_out: played by the USB hosts, with up to as many channels as the port has
+        adat_in:            up to 32 channels, 8 per ADAT input; without it, the ADAT outputs are looped back
+        seconds:            simulated time, by default the length of the longest source and a bit
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    system    = WavSystemSimulation(samplerate, adat_input=adat_in is not None, **flags)
+    design    = system.design
+    simulator = Simulator(system)
+    for domain, frequency in system.platform.clock_frequencies.items():
+        simulator.add_clock(1 / frequency, domain=domain)
+
+    usb1_channels = design.USB1_NO_CHANNELS
+    usb2_channels = design.USB2_NO_CHANNELS
+    adat_channels = 8 * WavSystemSimulation.NO_ADAT_PORTS
+
+    def output(name: str, channels: int) -> WavSink:
+        return WavSink(os.path.join(output_directory, name), channels, samplerate, chunk_frames)
+
+    sources = { name: WavSource(filename, channels, samplerate, chunk_frames)
+                for name, filename, channels in [("usb1_out", usb1_out, usb1_channels),
+                                                 ("usb2_out", usb2_out, usb2_channels),
+                                                 ("adat_in",  adat_in,  adat_channels)]
+                if filename is not None }
+    sinks = dict(
+        usb1_in = output("usb1_in.wav", usb1_channels),
+        usb2_in = output("usb2_in.wav", usb2_channels),
+        **{ f"adat{i + 1}_out": output(f"adat{i + 1}_out.wav", 8) for i in range(WavSystemSimulation.NO_ADAT_PORTS) },
+        **{ f"dac{i + 1}": output(f"dac{i + 1}.wav", 2) for i in range(design.NO_DACS) },
+    )
+
+    if seconds is None:
+        longest = max([source.frames for source in sources.values()], default=0)
+        seconds = longest / samplerate + TAIL_MICROFRAMES / 8000
+    microframes = math.ceil(seconds * 8000)
+
+    usb1 = WavHostModel(design.usb_devices[1], 1, usb1_channels, samplerate, sources.get("usb1_out"), sinks["usb1_in"])
+    usb2 = WavHostModel(design.usb_devices[2], 2, usb2_channels, samplerate, sources.get("usb2_out"), sinks["usb2_in"], usb2_ppm)
+    simulator.add_sync_process(usb1.process(microframes), domain="usb")
+    simulator.add_sync_process(usb2.process(microframes), domain="usb")
+
+    if "adat_in" in sources:
+        simulator.add_sync_process(send_adat(system.adat_sources, sources["adat_in"]), domain="sync")
+
+    internals = design.internals
+    for i, transmitter in enumerate(internals["adat_transmitters"]):
+        simulator.add_sync_process(record_stream(sinks[f"adat{i + 1}_out"], transmitter.valid_in, transmitter.ready_out,
+                                                 transmitter.sample_in, transmitter.addr_in, transmitter.last_in), domain="sync")
+    for i, dac in enumerate(internals["dacs"]):
+        stream = dac.stream_in
+        # the extractor marks the right channel with last
+        simulator.add_sync_process(record_stream(sinks[f"dac{i + 1}"], stream.valid, stream.ready,
+                                                 stream.payload, stream.last, stream.last), domain="usb")
+
+    try:
+        simulator.run_until(microframes / 8000, run_passive=True)
+    finally:
+        for sink in sinks.values():
+            sink.close()
+        for source in sources.values():
+            source.close()
+
+    return dict(
+        samplerate  = samplerate,
+        microframes = microframes,
+        sources     = { name: dict(file=source.filename, frames=source.frames, played=min(source.frames_read, source.frames))
+                        for name, source in sources.items() },
+        outputs     = { name: dict(file=sink.filename, frames=sink.frames) for name, sink in sinks.items() },
+        usb1        = usb1.report(),
+        usb2        = usb2.report(),
+    )
+
+
+def default_null_tests(report: dict, usb1_channels: int, usb2_channels: int, convolution: bool=False) -> dict:
+    """ (reference, output, reference channels, output channels) of the paths which should be bit exact
+        with the default routing: the host samples go out at the same channels they come back in """
+    sources     = { name: source["file"] for name, source in report["sources"].items() }
+    outputs     = { name: output["file"] for name, output in report["outputs"].items() }
+    adat_ports  = (usb1_channels - usb2_channels) // 8
+    adat_source = sources.get("adat_in", sources.get("usb1_out"))
+    tests       = {}
+
+    if "usb1_out" in sources:
+        for i in range(adat_ports):
+            tests[f"adat{i + 1}_out"] = (sources["usb1_out"], outputs[f"adat{i + 1}_out"], list(range(8 * i, 8 * i + 8)), None)
+        tests["usb2_in"] = (sources["usb1_out"], outputs["usb2_in"], list(range(usb1_channels - usb2_channels, usb1_channels)), None)
+        if not convolution:
+            tests["dac1"] = (sources["usb1_out"], outputs["dac1"], [0, 1], None)
+            tests["dac2"] = (sources["usb1_out"], outputs["dac2"], [2, 3], None)
+    if adat_source is not None:
+        tests["usb1_in_adat"] = (adat_source, outputs["usb1_in"], list(range(8 * adat_ports)), list(range(8 * adat_ports)))
+    if "usb2_out" in sources:
+        tests["usb1_in_usb2"] = (sources["usb2_out"], outputs["usb1_in"], None, list(range(usb1_channels - usb2_channels, usb1_channels)))
+
+    return tests
+
+def run_null_tests(tests: dict, chunk_frames: int=1 << 16) -> dict:
+    """ runs the null tests of default_null_tests(), with only the channels the reference has """
+    results = {}
+    for name, (reference, output, reference_channels, output_channels) in tests.items():
+        with MappedWavReader(reference) as wav:
+            available = wav.channels
+        if reference_channels is None:
+            reference_channels = list(range(available))
+        if output_channels is None:
+            output_channels = list(range(len(reference_channels)))
+        pairs = [(channel, output_channel) for channel, output_channel in zip(reference_channels, output_channels) if channel < available]
+        if pairs:
+            results[name] = null_test(reference, output, [channel for channel, _ in pairs], [channel for _, channel in pairs],
+                                      AUDIO_BITS, chunk_frames=chunk_frames)
+    return results
+
+def format_null_tests(results: dict) -> str:
+    lines = []
+    for name, result in results.items():
+        worst = max(channel["max_residual"] for channel in result["channels"])
+        db    = max(channel["residual_db"] for channel in result["channels"])
+        state = "null" if worst == 0 and result["complete"] else "DIFFERS" if worst else "INCOMPLETE"
+        lines.append(f"{name:>14}: {state:<10} delay {result['delay']} frames, {result['frames']} frames compared, "
+                     f"max residual {worst}, {db:.1f} dBFS")
+    return "\n".join(lines)
+
+
+class WavSimulationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_source_and_sink(self):
+        filename = os.path.join(self.directory, "source.wav")
+        with WavWriter(filename, 2, 48000, 16) as wav:
+            wav.write(np.array([[1, -1], [2, -2], [3, -3]]))
+
+        source = WavSource(filename, 4, 48000, chunk_frames=2)
+        frames = [source.next_frame() for _ in range(4)]
+        source.close()
+        self.assertEqual(frames, [[256, -256, 0, 0], [512, -512, 0, 0], [768, -768, 0, 0], [0, 0, 0, 0]])
+        self.assertEqual(source.frames_read, 3)
+
+        sink = WavSink(os.path.join(self.directory, "sink.wav"), 4, 48000, chunk_frames=2)
+        for frame in frames:
+            sink.add(frame)
+        sink.close()
+        with MappedWavReader(sink.filename) as wav:
+            self.assertEqual(wav.read().tolist(), frames)
+
+    def test_signed(self):
+        self.assertEqual([signed(value) for value in [0, 1, 0x7fffff, 0x800000, 0xffffff]], [0, 1, 0x7fffff, -0x800000, -1])
+
+    def test_usb_to_adat_and_back(self):
+        # a ramp on all channels, which starts after a short silence
+        frames  = 60
+        ramp    = (np.arange(frames) + 1) * 1000
+        samples = np.zeros((frames + 6, 36), dtype=np.int32)
+        samples[6:] = ramp[:, None] + np.arange(36)[None, :]
+        usb1_out = os.path.join(self.directory, "usb1_out.wav")
+        with WavWriter(usb1_out, 36, 48000) as wav:
+            wav.write(samples)
+
+        report = run_wav_simulation(os.path.join(self.directory, "output"), usb1_out=usb1_out)
+        self.assertEqual(report["sources"]["usb1_out"]["played"], frames + 6)
+        self.assertGreater(report["outputs"]["adat1_out"]["frames"], frames)
+
+        results = run_null_tests({ name: test for name, test in default_null_tests(report, 36, 4).items()
+                                   if name in ("adat1_out", "usb2_in") })
+        for name, result in results.items():
+            self.assertTrue(result["complete"] and all(channel["max_residual"] == 0 for channel in result["channels"]),
+                            format_null_tests(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="play WAV files through the simulated interface and record its outputs as WAV files")
+    parser.add_argument("--usb1-out", help="WAV file the USB1 host plays, up to 36 channels")
+    parser.add_argument("--usb2-out", help="WAV file the USB2 host plays, up to 4 channels")
+    parser.add_argument("--adat-in", help="WAV file sent to the ADAT inputs, up to 32 channels, 8 per input; "
+                                          "without it, the ADAT outputs are looped back to the inputs")
+    parser.add_argument("--output-dir", default="wav_simulation", help="where the recorded outputs are written")
+    parser.add_argument("--samplerate", type=int, default=48000)
+    parser.add_argument("--seconds", type=float, help="simulated time, defaults to the length of the longest source")
+    parser.add_argument("--usb2-ppm", type=float, default=0, help="clock offset of the USB2 host against the USB1 host")
+    parser.add_argument("--convolution", action="store_true", help="simulate with USE_CONVOLUTION, the DACs then get the convolved signal")
+    parser.add_argument("--chunk-frames", type=int, default=CHUNK_FRAMES, help="frames read and written at a time")
+    parser.add_argument("--null-test", action="store_true", help="compare the outputs with the sources they should match bit by bit")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    flags  = dict(USE_CONVOLUTION=True) if args.convolution else {}
+    report = run_wav_simulation(args.output_dir, args.usb1_out, args.usb2_out, args.adat_in, args.samplerate,
+                                args.seconds, args.usb2_ppm, args.chunk_frames, **flags)
+    for name, output in report["outputs"].items():
+        print(f"{name:>14}: {output['frames']} frames -> {output['file']}")
+
+    failed = False
+    if args.null_test:
+        from adat_usb2_audio_interface import USB2AudioInterface as top
+        report["null_tests"] = run_null_tests(default_null_tests(report, top.USB1_NO_CHANNELS, top.USB2_NO_CHANNELS, args.convolution))
+        print(format_null_tests(report["null_tests"]))
+        failed = any(channel["max_residual"] != 0 or not result["complete"]
+                     for result in report["null_tests"].values() for channel in result["channels"])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, default=float)
+
+    exit(1 if failed else 0)
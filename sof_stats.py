@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# reads the SOF timing histograms of the interface (USE_SOF_MONITOR) over USB1
+#
+import argparse
+import struct
+import time
+
+import usb
+
+# these mirror gateware/sof_timing_monitor.py and gateware/requesthandlers.py
+READ_SOF_STATS    = 3
+CLEAR_SOF_STATS   = 4
+BINS              = 64
+REGISTERS         = 0x100
+DRIFT_WINDOW_SOFS = 8192
+CLOCK_FREQUENCY   = 60e6
+
+SOF_COUNT, MIN_INTERVAL, MAX_INTERVAL, LAST_DRIFT, NOMINAL_INTERVAL, SHIFTS, NOMINAL_TICKS = range(7)
+
+def read_word(dev, port, address, signed=False):
+    data = dev.ctrl_transfer(0xc0, READ_SOF_STATS, address, port, 4)
+    return struct.unpack("<i" if signed else "<I", bytes(data))[0]
+
+def print_histogram(title, bins, label):
+    print(title)
+    peak = max(bins) or 1
+    for index, count in enumerate(bins):
+        if count:
+            print(f"  {label(index):>14} {count:10d} {'#' * max(1, round(40 * count / peak))}")
+
+def print_stats(dev, port):
+    registers        = [read_word(dev, port, REGISTERS + i) for i in range(7)]
+    last_drift       = read_word(dev, port, REGISTERS + LAST_DRIFT, signed=True)
+    nominal_interval = registers[NOMINAL_INTERVAL]
+    nominal_ticks    = registers[NOMINAL_TICKS]
+    interval_shift   = registers[SHIFTS] & 0xff
+    drift_shift      = (registers[SHIFTS] >> 8) & 0xff
+    cycle_ns         = 1e9 / CLOCK_FREQUENCY
+
+    print(f"USB{port + 1}: {registers[SOF_COUNT]} SOFs, "
+          f"interval {registers[MIN_INTERVAL] * cycle_ns:.1f}..{registers[MAX_INTERVAL] * cycle_ns:.1f} ns, "
+          f"last drift {last_drift / nominal_ticks * 1e6:+.2f} ppm")
+
+    intervals = [read_word(dev, port, i) for i in range(BINS)]
+    drifts    = [read_word(dev, port, BINS + i) for i in range(BINS)]
+
+    def interval_label(index):
+        if index in (0, BINS - 1):
+            return "<" if index == 0 else ">"
+        deviation = (index - BINS // 2) << interval_shift
+        return f"{(nominal_interval + deviation) * cycle_ns:.1f} ns"
+
+    def drift_label(index):
+        if index in (0, BINS - 1):
+            return "<" if index == 0 else ">"
+        deviation = (index - BINS // 2) << drift_shift
+        return f"{deviation / nominal_ticks * 1e6:+.2f} ppm"
+
+    print_histogram("  SOF intervals:", intervals, interval_label)
+    print_histogram(f"  drift over {DRIFT_WINDOW_SOFS} SOFs:", drifts, drift_label)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="read the SOF timing histograms of the ADAT USB2 audio interface")
+    parser.add_argument("--port", type=int, choices=[1, 2], nargs="+", default=[1, 2], help="USB port(s) to show")
+    parser.add_argument("--clear", action="store_true", help="clear the histograms before reading")
+    parser.add_argument("--wait", type=float, default=0, help="seconds to wait between clearing and reading")
+    args = parser.parse_args()
+
+    dev = usb.core.find(idVendor=0x1209, idProduct=0xADA1)
+    assert dev is not None, "USB1 of the interface not found"
+
+    if args.clear:
+        for port in args.port:
+            dev.ctrl_transfer(0x40, CLEAR_SOF_STATS, 0, port - 1, None)
+        time.sleep(args.wait)
+
+    for port in args.port:
+        print_stats(dev, port - 1)